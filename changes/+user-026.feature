@@ -0,0 +1 @@
+The D-Rats repeater now runs on an asyncio event loop, and a repeater_load_test.py load generator was added.
@@ -0,0 +1 @@
+The D-Rats repeater encodes each relayed frame once instead of once per client.
@@ -0,0 +1 @@
+The D-Rats repeater remembers the stations it has heard across restarts, and shows them in a Stations Heard list.
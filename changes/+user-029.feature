@@ -0,0 +1 @@
+The repeater traffic monitor now shows the relay metrics, and path queue depth is read from a copy taken under the queue lock.
@@ -0,0 +1 @@
+Frames relayed around a loop of repeaters are dropped once they have been seen, keyed on source, session, sequence, type and a payload digest.
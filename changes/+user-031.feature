@@ -0,0 +1 @@
+The message router reads its queue from a persistent outbox index, and waits longer before retrying a message after each failed transfer.
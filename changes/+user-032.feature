@@ -0,0 +1 @@
+Queued messages for the same next hop are forwarded in one batch of back-to-back sessions, most urgent first.
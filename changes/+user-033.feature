@@ -0,0 +1 @@
+Message routes in routes.txt may use call sign prefixes such as W1*, and a destination may list several gateways, tried in order of their delivery record.
@@ -0,0 +1 @@
+Outbox messages are locked through an in-process lock table backed by fcntl locks, instead of dot-file locks.
@@ -0,0 +1 @@
+Message folder information is kept in an SQLite message store instead of a ConfigParser .db file in each folder.
@@ -0,0 +1 @@
+The message list is filled from the message store at once, and the messages it does not know yet are read in the background.
@@ -0,0 +1 @@
+Messages can be searched by subject, sender, recipient, body, field values and attachment names from a full-text index.
@@ -0,0 +1 @@
+The message lists, router and mail server read form headers without parsing the attachment data.
@@ -0,0 +1 @@
+Form attachments are kept in a content-addressed attachment store instead of base64 and zlib data inside the form XML.
@@ -0,0 +1 @@
+The POP3 server keeps a cache of rendered messages and only renders the MIME body when a client retrieves it.
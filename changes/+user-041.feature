@@ -0,0 +1 @@
+Winlink messages are compressed and decompressed in process instead of running the lzhuf program for each message.
@@ -0,0 +1 @@
+Winlink B2F proposals are sent in pipelined batches over a buffered socket stream.
@@ -0,0 +1 @@
+Compiled form stylesheets are cached, and forms can be exported to HTML in a batch.
@@ -0,0 +1 @@
+The email gateway fetches IMAP and POP3 accounts concurrently and only downloads new messages.
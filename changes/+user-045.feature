@@ -0,0 +1 @@
+The SMTP and POP3 servers run on one asyncio event loop instead of a thread for each session.
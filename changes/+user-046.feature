@@ -0,0 +1 @@
+New python -m d_rats.formstore tool to batch import, export and reindex the forms of a message folder.
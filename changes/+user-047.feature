@@ -0,0 +1 @@
+Forms can be sent as a diff from the shared form template when both stations have the same template.
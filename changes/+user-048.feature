@@ -0,0 +1 @@
+Form templates are parsed once and shared, so opening a form no longer reparses its template.
@@ -0,0 +1 @@
+Images for sending are resized and encoded in worker threads, so the send image dialog no longer blocks.
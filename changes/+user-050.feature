@@ -0,0 +1 @@
+Chat logs are written from a background thread, rotated by size or day, and the chat scrollback is capped.
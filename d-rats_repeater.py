@@ -28,7 +28,12 @@ from __future__ import print_function
 
 import argparse
 import ast
+import asyncio
+import bisect
+import collections
+import json
 import logging
+import logging.handlers
 import os
 import threading
 import time
@@ -45,6 +50,7 @@ if not '_' in locals():
 import gi  # type: ignore
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk  # type: ignore
+from gi.repository import GLib  # type: ignore
 from gi.repository import GObject  # type: ignore
 
 # Make sure no one tries to run this with privileges.
@@ -60,6 +66,9 @@ from d_rats.version import DRATS_VERSION
 from d_rats.dplatform import Platform
 from d_rats import transport
 from d_rats import comm
+from d_rats import ddt2
+from d_rats.duplicate_cache import DuplicateCache
+from d_rats.repeater_routes import RouteTable
 from d_rats.listwidget import ListWidget
 from d_rats.miscwidgets import make_choice
 from d_rats.configui.dratsradiopanel import prompt_for_port
@@ -72,73 +81,478 @@ OUT = 1
 PEEK = 2
 
 
-class CallInfo:
+def call_in_list(call_info, call):
     '''
-    Call Information.
+    Call in list?
 
-    :param call: Call sign
+    :param call_info: list of callsign information objects
+    :type call_info: list[:class:`CallInfo`]
+    :param call: Call sign to lookup
     :type call: str
-    :param call_transport: Transport call was heard on
-    :type call_transport: :class:`Transporter`
+    :returns true: If call sign is found
+    :rtype: bool
+    '''
+    for info in call_info:
+        if call == info.get_call():
+            return True
+    return False
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class RepeaterCounters:
+    '''
+    Repeater Counters.
+
+    Traffic counters for one path or for the whole repeater.  They are
+    only updated from the repeater event loop, so no lock is needed.
     '''
 
-    def __init__(self, call, call_transport):
-        self.__call = call
-        self.just_heard(call_transport)
+    __slots__ = ("frames_in", "bytes_in", "frames_out", "bytes_out",
+                 "frames_dropped", "frames_flooded", "flood_copies")
 
-    def get_call(self):
+    def __init__(self):
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.frames_dropped = 0
+        self.frames_flooded = 0
+        self.flood_copies = 0
+
+    def to_dict(self):
         '''
-        Get call.
+        To dictionary.
 
-        :returns: Call sign
-        :rtype: str
+        :returns: Counter values by name
+        :rtype: dict
+        '''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class LatencyHistogram:
+    '''
+    Latency Histogram.
+
+    :param buckets: Upper bounds of the buckets in seconds
+    :type buckets: tuple[float]
+    '''
+
+    def __init__(self, buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01,
+                                0.05, 0.1, 0.5, 1.0)):
+        self.buckets = buckets
+        # Last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
         '''
-        return self.__call
+        Observe a value.
 
-    def just_heard(self, heard_transport):
+        :param value: Latency in seconds
+        :type value: float
         '''
-        Just heard.
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
 
-        :param heard_transport: Transport that had something heard
-        :type heard_transport: :class:`Transporter`
+    def cumulative(self):
         '''
-        self.__heard = time.time()
-        self.__transport = heard_transport
+        Cumulative counts.
 
-    def last_heard(self):
+        :returns: Upper bound and count of values at or below it
+        :rtype: list[tuple[str, int]]
         '''
-        Last heard.
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            running += count
+            result.append((str(bound), running))
+        return result
+
+    def to_dict(self):
+        '''
+        To dictionary.
 
-        :returns: Time for last heard station
-        :type float:
+        :returns: Histogram values
+        :rtype: dict
         '''
-        return time.time() - self.__heard
+        return {"buckets": dict(self.cumulative()),
+                "sum": self.total,
+                "count": self.count}
+
+
+class RepeaterMetrics:
+    '''
+    Repeater Metrics.
+
+    Registry of the per path and total repeater counters.
+
+    :param dup_cache: Duplicate cache of the repeater, default None
+    :type dup_cache: :class:`DuplicateCache`
+    '''
 
-    def last_transport(self):
+    def __init__(self, dup_cache=None):
+        self.dup_cache = dup_cache
+        self.started = time.time()
+        self.total = RepeaterCounters()
+        self.auth_failures = 0
+        self.relay_cpu = 0.0
+        self.latency = LatencyHistogram()
+        self._paths = {}
+
+    def duplicates_suppressed(self):
         '''
-        Last transport.
+        Duplicates suppressed.
 
-        :returns: Last transport heard
-        :rtype: :class:`Transporter`
+        :returns: Duplicate frames dropped by the duplicate cache
+        :rtype: int
         '''
-        return self.__transport
+        if self.dup_cache is None:
+            return 0
+        return self.dup_cache.suppressed
 
+    def path(self, path):
+        '''
+        Get the counters for a path.
 
-def call_in_list(call_info, call):
+        :param path: Transport or client
+        :type path: :class:`Transporter` or :class:`RepeaterClient`
+        :returns: Counters for the path
+        :rtype: :class:`RepeaterCounters`
+        '''
+        counters = self._paths.get(path, None)
+        if counters is None:
+            counters = RepeaterCounters()
+            self._paths[path] = counters
+        return counters
+
+    def remove(self, path):
+        '''
+        Remove a path that went away.
+
+        :param path: Transport or client
+        :type path: :class:`Transporter` or :class:`RepeaterClient`
+        '''
+        self._paths.pop(path, None)
+
+    def frame_in(self, path, size):
+        '''
+        Count a frame received.
+
+        :param path: Path the frame was received on
+        :type path: :class:`Transporter` or :class:`RepeaterClient`
+        :param size: Encoded size of the frame
+        :type size: int
+        '''
+        counters = self.path(path)
+        counters.frames_in += 1
+        counters.bytes_in += size
+        self.total.frames_in += 1
+        self.total.bytes_in += size
+
+    def frame_out(self, path, size, sent=True):
+        '''
+        Count a frame sent.
+
+        :param path: Path the frame was sent on
+        :type path: :class:`Transporter` or :class:`RepeaterClient`
+        :param size: Encoded size of the frame
+        :type size: int
+        :param sent: False if the frame was dropped, default True
+        :type sent: bool
+        '''
+        counters = self.path(path)
+        if sent:
+            counters.frames_out += 1
+            counters.bytes_out += size
+            self.total.frames_out += 1
+            self.total.bytes_out += size
+        else:
+            counters.frames_dropped += 1
+            self.total.frames_dropped += 1
+
+    def flooded(self, path, copies):
+        '''
+        Count a frame flooded to all paths.
+
+        :param path: Path the frame was received on
+        :type path: :class:`Transporter` or :class:`RepeaterClient`
+        :param copies: Number of paths the frame was sent to
+        :type copies: int
+        '''
+        counters = self.path(path)
+        counters.frames_flooded += 1
+        counters.flood_copies += copies
+        self.total.frames_flooded += 1
+        self.total.flood_copies += copies
+
+    def to_dict(self, paths):
+        '''
+        To dictionary.
+
+        :param paths: Current paths of the repeater
+        :type paths: list
+        :returns: All metrics, suitable for JSON
+        :rtype: dict
+        '''
+        clients = {}
+        for path in paths:
+            values = self.path(path).to_dict()
+            values["queue_depth"] = path_queue_depth(path)
+            clients[str(path)] = values
+        result = {"uptime": time.time() - self.started,
+                  "clients": len(paths),
+                  "auth_failures": self.auth_failures,
+                  "duplicates_suppressed": self.duplicates_suppressed(),
+                  "relay_cpu_seconds": self.relay_cpu,
+                  "relay_latency_seconds": self.latency.to_dict(),
+                  "paths": clients}
+        result.update(self.total.to_dict())
+        return result
+
+    def summary(self, paths):
+        '''
+        Summary for the traffic monitor.
+
+        :param paths: Current paths of the repeater
+        :type paths: list
+        :returns: Metrics as lines of text
+        :rtype: str
+        '''
+        total = self.total
+        lines = ["Up %i s, %i paths, %i auth failures, "
+                 "%i duplicates dropped" %
+                 (time.time() - self.started, len(paths),
+                  self.auth_failures, self.duplicates_suppressed()),
+                 "Frames in %i (%i bytes), out %i (%i bytes), dropped %i" %
+                 (total.frames_in, total.bytes_in, total.frames_out,
+                  total.bytes_out, total.frames_dropped),
+                 "Flooded %i frames as %i copies" %
+                 (total.frames_flooded, total.flood_copies)]
+        if self.latency.count:
+            lines.append("Relay latency %.2f ms average over %i frames" %
+                         (self.latency.total * 1000 / self.latency.count,
+                          self.latency.count))
+        for path in paths:
+            counters = self.path(path)
+            lines.append("%s: in %i, out %i, dropped %i, queued %i bytes" %
+                         (path, counters.frames_in, counters.frames_out,
+                          counters.frames_dropped, path_queue_depth(path)))
+        return "\n".join(lines) + "\n"
+
+    def to_prometheus(self, paths):
+        '''
+        To Prometheus text format.
+
+        :param paths: Current paths of the repeater
+        :type paths: list
+        :returns: All metrics in the Prometheus text exposition format
+        :rtype: str
+        '''
+        lines = []
+        lines.append("# TYPE drats_repeater_clients gauge")
+        lines.append("drats_repeater_clients %i" % len(paths))
+        lines.append("# TYPE drats_repeater_auth_failures_total counter")
+        lines.append("drats_repeater_auth_failures_total %i" %
+                     self.auth_failures)
+        lines.append("# TYPE drats_repeater_duplicates_suppressed_total "
+                     "counter")
+        lines.append("drats_repeater_duplicates_suppressed_total %i" %
+                     self.duplicates_suppressed())
+        lines.append("# TYPE drats_repeater_relay_cpu_seconds_total counter")
+        lines.append("drats_repeater_relay_cpu_seconds_total %f" %
+                     self.relay_cpu)
+        for name, value in self.total.to_dict().items():
+            metric = "drats_repeater_%s_total" % name
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %i" % (metric, value))
+            for path in paths:
+                lines.append('%s{path="%s"} %i' %
+                             (metric, prometheus_escape(path),
+                              getattr(self.path(path), name)))
+        lines.append("# TYPE drats_repeater_queue_depth_bytes gauge")
+        for path in paths:
+            lines.append('drats_repeater_queue_depth_bytes{path="%s"} %i' %
+                         (prometheus_escape(path), path_queue_depth(path)))
+        metric = "drats_repeater_relay_latency_seconds"
+        lines.append("# TYPE %s histogram" % metric)
+        for bound, count in self.latency.cumulative():
+            lines.append('%s_bucket{le="%s"} %i' % (metric, bound, count))
+        lines.append("%s_sum %f" % (metric, self.latency.total))
+        lines.append("%s_count %i" % (metric, self.latency.count))
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_escape(path):
     '''
-    Call in list?
+    Prometheus escape.
 
-    :param call_info: list of callsign information objects
-    :type call_info: list[:class:`CallInfo`]
-    :param call: Call sign to lookup
-    :type call: str
-    :returns true: If call sign is found
-    :rtype: bool
+    :param path: Path to use as a label value
+    :type path: :class:`Transporter` or :class:`RepeaterClient`
+    :returns: Escaped label value
+    :rtype: str
     '''
-    for info in call_info:
-        if call == info.get_call():
-            return True
-    return False
+    return str(path).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def path_queue_depth(path):
+    '''
+    Path queue depth.
+
+    :param path: Transport or client
+    :type path: :class:`Transporter` or :class:`RepeaterClient`
+    :returns: Bytes waiting to be sent on the path
+    :rtype: int
+    '''
+    if isinstance(path, RepeaterClient):
+        return path.queue_depth()
+    return sum(len(frame.get_packed_once())
+               for frame in path.outq.peek_all())
+
+
+# pylint wants a max of 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class RepeaterClient(transport.BlockParser):
+    '''
+    Repeater Client.
+
+    A network station connected to the repeater event loop.  Frames
+    for the station are queued in a per client write buffer, so a slow
+    client only loses its own frames and never stalls the others.
+
+    :param repeater: Repeater that accepted the client
+    :type repeater: :class:`Repeater`
+    :param reader: Stream for reading from the client
+    :type reader: :class:`asyncio.StreamReader`
+    :param writer: Stream for writing to the client
+    :type writer: :class:`asyncio.StreamWriter`
+    '''
+
+    # Bytes that may be waiting for a client before frames are dropped
+    max_buffer = 256 * 1024
+
+    def __init__(self, repeater, reader, writer):
+        transport.BlockParser.__init__(self, dup_cache=repeater.dup_cache)
+        self.logger = logging.getLogger("RepeaterClient")
+        self.repeater = repeater
+        self.reader = reader
+        self.writer = writer
+        peer = writer.get_extra_info("peername") or "(incoming)"
+        self.name = Repeater.address_to_string(peer)
+        # Routes outlive the connection, so they only use the host.
+        self.route_name = peer[0] if isinstance(peer, tuple) else peer
+        self.enabled = True
+        self.dropped = 0
+        self._out_queue = collections.deque()
+        self._out_bytes = 0
+        self._out_ready = asyncio.Event()
+
+    def _handle_frame(self, frame):
+        self.repeater.repeat_frame(self, frame)
+
+    def send_frame(self, frame):
+        '''
+        Send Frame.
+
+        :param frame: Frame to send
+        :type frame: :class:`DDT2Frame`
+        '''
+        self.send_data(frame.get_packed_once())
+
+    def send_data(self, data):
+        '''
+        Send Data.
+
+        Queues the data for the writer task.  Must be called from the
+        repeater event loop.
+
+        :param data: Encoded data to send
+        :type data: bytes
+        :returns: True if the data was queued
+        :rtype: bool
+        '''
+        if not self.enabled:
+            return False
+        if self._out_bytes + len(data) > self.max_buffer:
+            self.dropped += 1
+            self.logger.info("send_data: %s Write buffer full, "
+                             "dropping %i bytes", self, len(data))
+            return False
+        self._out_queue.append(data)
+        self._out_bytes += len(data)
+        self._out_ready.set()
+        return True
+
+    def queue_depth(self):
+        '''
+        Queue depth.
+
+        :returns: Number of bytes waiting to be written
+        :rtype: int
+        '''
+        return self._out_bytes
+
+    async def _write_loop(self):
+        try:
+            while self.enabled:
+                await self._out_ready.wait()
+                self._out_ready.clear()
+                while self._out_queue and self.enabled:
+                    chunks = list(self._out_queue)
+                    self._out_queue.clear()
+                    self._out_bytes = 0
+                    self.writer.writelines(chunks)
+                    # Waits only when the socket buffer is above its high
+                    # water mark, while send_data keeps queueing up to
+                    # max_buffer.
+                    await self.writer.drain()
+        except (ConnectionError, OSError) as err:
+            self.logger.info("_write_loop: %s Write failed: %s", self, err)
+            self.disable()
+
+    async def _read_loop(self):
+        while self.enabled:
+            data = await self.reader.read(4096)
+            if not data:
+                self.logger.info("_read_loop: %s Disconnected", self)
+                break
+            self.inbuf += data
+            self.parse_blocks()
+            self.parse_gps()
+            if len(self.inbuf) > self.max_buffer:
+                self.logger.info("_read_loop: %s ### Unconverted data: %i "
+                                 "bytes", self, len(self.inbuf))
+                self.inbuf = b''
+
+    async def run(self):
+        '''Run the client until it disconnects or is disabled.'''
+        writer_task = None
+        try:
+            if not await self.repeater.auth_user(self):
+                return
+            writer_task = asyncio.ensure_future(self._write_loop())
+            await self._read_loop()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as err:
+            self.logger.info("run: %s Connection error: %s", self, err)
+        finally:
+            self.disable()
+            if writer_task:
+                writer_task.cancel()
+
+    def disable(self):
+        '''Disable client.'''
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._out_queue.clear()
+        self._out_bytes = 0
+        self._out_ready.set()
+        self.writer.close()
+
+    def __str__(self):
+        return "[NET %s]" % self.name
 
 
 # pylint wants only 7 instance attributes per class
@@ -147,6 +561,11 @@ class Repeater:
     '''
     Repeater.
 
+    Network clients are served by an asyncio event loop running in one
+    thread.  Frames heard on the configured radio paths are handed to
+    the same loop, so all routing happens in a single thread without a
+    relay lock.
+
     :param ident: Identity string, Default 'D-RATS Network Proxy'
     :type ident: str
     :param require_auth: True is authorization required
@@ -155,14 +574,30 @@ class Repeater:
     :type trust_local: bool
     :param gps_okay_ports: List of GPS active TCP/IP ports, default None
     :type gps_ok_ports: list
+    :param route_file: File to keep learned routes in, default None
+    :type route_file: str
+    :param dup_cache: Cache for dropping duplicate frames, default None
+    :type dup_cache: :class:`DuplicateCache`
     '''
 
     logger = logging.getLogger("Repeater")
 
+    # Seconds a client has to complete the authorization exchange
+    auth_timeout = 60
+    # Seconds between relay statistics log entries
+    stats_interval = 60
+    # Seconds between checks for expired routes
+    route_expire_interval = 30
+    # Seconds between saves of the learned routes
+    route_save_interval = 300
+
+    # pylint wants a max of 5 arguments
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
     def __init__(self, ident="D-RATS Network Proxy",
-                 require_auth=False, trust_local=False, gps_okay_ports=None):
+                 require_auth=False, trust_local=False, gps_okay_ports=None,
+                 route_file=None, dup_cache=None):
         self.paths = []
-        self.calls = {}
+        self.dup_cache = dup_cache
         self.thread = None
         self.enabled = True
         self.socket = None
@@ -170,21 +605,36 @@ class Repeater:
         self.ident = ident
         self.require_auth = require_auth
         self.trust_local = trust_local
-        self.condition = threading.Condition()
+        self.loop = asyncio.new_event_loop()
         self.gps_socket = None
         self.gps_sockets = []
         self.gps_okay_ports = []
         if gps_okay_ports:
             self.gps_okay_ports = gps_okay_ports
+        self._shutdown = None
+        self._client_tasks = set()
+        self.metrics = RepeaterMetrics(dup_cache)
+        self.metrics_socket = None
+        self.metrics_file = None
 
         # Forget port for a station after 10 minutes
         self.__call_timeout = 600
+        self.routes = RouteTable(self.__call_timeout, route_file)
 
     def __should_repeat_gps(self, gps_transport, _frame):
         if not self.gps_okay_ports:
             return True
         return gps_transport.name in self.gps_okay_ports
 
+    def _drop_path(self, path):
+        self.paths.remove(path)
+        self.metrics.remove(path)
+        if isinstance(path, RepeaterClient):
+            path.disable()
+        else:
+            # Transporter.disable() joins the worker thread
+            self.loop.run_in_executor(None, path.disable)
+
     # pylint wants a max of 12 branches per function or method
     # pylint: disable=too-many-branches
     def __repeat(self, rpt_transport, frame):
@@ -197,50 +647,130 @@ class Repeater:
                 frame.session == 1 and \
                 frame.data.startswith(gps_start) and \
                 self.__should_repeat_gps(rpt_transport, frame):
-            for sock in self.gps_sockets:
-                sock.send(frame.data)
-
-        src_info = self.calls.get(frame.s_station, None)
-        if src_info is None and frame.s_station != "CQCQCQ":
-
-            self.logger.info("__repeat: Adding new station %s to port %s",
-                             frame.s_station, rpt_transport)
-            self.calls[frame.s_station] = CallInfo(frame.s_station,
-                                                   rpt_transport)
-        elif src_info:
-            if src_info.last_transport() != rpt_transport:
+            gps_data = frame.data
+            if isinstance(gps_data, str):
+                gps_data = gps_data.encode('utf-8', 'replace')
+            for writer in list(self.gps_sockets):
+                # Same limit as the data clients, a GPS client that has
+                # stopped reading is dropped.
+                if writer.transport.get_write_buffer_size() + \
+                        len(gps_data) > RepeaterClient.max_buffer:
+                    self.logger.info("__repeat: GPS client %s write buffer "
+                                     "full, dropping it",
+                                     self.address_to_string(
+                                         writer.get_extra_info("peername")
+                                         or "(incoming)"))
+                    self.gps_sockets.remove(writer)
+                    writer.transport.abort()
+                    continue
+                writer.write(gps_data)
+
+        if frame.s_station != "CQCQCQ":
+            src_info, changed = self.routes.heard(frame.s_station,
+                                                  rpt_transport)
+            if changed and src_info.frames == 1:
+                self.logger.info("__repeat: Adding new station %s to port %s",
+                                 frame.s_station, rpt_transport)
+            elif changed:
                 self.logger.info("__repeat: Station %s moved to port %s",
                                  frame.s_station, rpt_transport)
 
-            src_info.just_heard(rpt_transport)
-
-        dst_info = self.calls.get(frame.d_station, None)
+        dst_info = self.routes.get(frame.d_station)
         if dst_info is not None:
-            if not dst_info.last_transport().enabled:
-                self.logger.info("__repeat: Last transport for %s is dead",
-                                 frame.d_station)
-            elif dst_info.last_heard() < self.__call_timeout:
+            dst_transport = self.routes.lookup(frame.d_station)
+            if dst_transport:
                 self.logger.info("__repeat: Delivering frame to %s at %s",
-                                 frame.d_station, dst_info.last_transport())
-                dst_info.last_transport().send_frame(frame.get_copy())
+                                 frame.d_station, dst_transport)
+                self._forward(dst_transport, frame)
                 return
-            self.logger.info("__repeat: Last port for %s was %i sec"
-                             " ago (>%i sec)",
-                             frame.d_station,
-                             dst_info.last_heard(),
-                             self.__call_timeout)
+            if dst_info.last_heard() < self.__call_timeout:
+                self.logger.info("__repeat: Last transport for %s is dead",
+                                 frame.d_station)
+            else:
+                self.logger.info("__repeat: Last port for %s was %i sec"
+                                 " ago (>%i sec)",
+                                 frame.d_station,
+                                 dst_info.last_heard(),
+                                 self.__call_timeout)
 
         self.logger.info("__repeat: Repeating frame to %s on all ports",
                          frame.d_station)
+        copies = 0
         for path in self.paths[:]:
             if path == rpt_transport:
                 continue
             if not path.enabled:
                 self.logger.info("__repeat: Found a stale path, removing...")
-                path.disable()
-                self.paths.remove(path)
+                self._drop_path(path)
             else:
-                path.send_frame(frame.get_copy())
+                self._forward(path, frame)
+                copies += 1
+        self.metrics.flooded(rpt_transport, copies)
+
+    def _forward(self, path, frame):
+        # Every path is sent the same encoded bytes, so the frame is
+        # compressed and encoded at most once however many paths
+        # it goes out on.
+        data = frame.get_packed_once()
+        if isinstance(path, RepeaterClient):
+            sent = path.send_data(data)
+        else:
+            path.send_frame(ddt2.DDT2RelayedFrame(frame))
+            sent = True
+        self.metrics.frame_out(path, len(data), sent)
+
+    async def _metrics_summary(self):
+        return self.metrics.summary(self.paths)
+
+    def metrics_summary(self):
+        '''
+        Get a metrics summary from the repeater event loop.
+
+        Safe to call from any thread.
+
+        :returns: Future for the summary text
+        :rtype: :class:`concurrent.futures.Future`
+        '''
+        return asyncio.run_coroutine_threadsafe(self._metrics_summary(),
+                                                self.loop)
+
+    def relay_stats(self):
+        '''
+        Relay statistics.
+
+        :returns: Frames relayed and average CPU seconds per frame
+        :rtype: tuple[int, float]
+        '''
+        count = self.metrics.total.frames_in
+        if not count:
+            return 0, 0.0
+        return count, self.metrics.relay_cpu / count
+
+    def repeat_frame(self, rpt_transport, frame, received=None):
+        '''
+        Repeat a frame.
+
+        Must be called from the repeater event loop.
+
+        :param rpt_transport: Transport the frame was heard on
+        :type rpt_transport: :class:`Transporter` or :class:`RepeaterClient`
+        :param frame: Frame received
+        :type frame: :class:`DDT2Frame`
+        :param received: time.monotonic() when the frame was received,
+                         default now
+        :type received: float
+        '''
+        start = time.thread_time()
+        if received is None:
+            received = time.monotonic()
+        self.metrics.frame_in(rpt_transport, len(frame.get_packed_once()))
+        try:
+            self.__repeat(rpt_transport, frame)
+        except Exception:  # pylint: disable=broad-except
+            self.logger.info("repeat_frame: Generic Exception",
+                             exc_info=True)
+        self.metrics.relay_cpu += time.thread_time() - start
+        self.metrics.latency.observe(time.monotonic() - received)
 
     def add_new_transport(self, new_transport):
         '''
@@ -250,53 +780,40 @@ class Repeater:
         :type new_transport: :class:`Transporter`
         '''
         self.paths.append(new_transport)
+        self.routes.attach(new_transport)
+        new_transport.dup_cache = self.dup_cache
 
         def handler(frame):
-            self.condition.acquire()
-            try:
-                self.__repeat(new_transport, frame)
-            # pylint: disable=broad-except
-            except Exception:
-                self.logger.info("add_new_transport: Generic Exception",
-                                 exc_info=True)
-            self.condition.release()
+            self.loop.call_soon_threadsafe(self.repeat_frame,
+                                           new_transport, frame,
+                                           time.monotonic())
 
         new_transport.inhandler = handler
 
-    def auth_exchange(self, pipe):
+    async def auth_exchange(self, client):
         '''
         Authorization Exchange.
 
-        :param pipe: socket object
-        :type pipe: socket
+        :param client: Client being authorized
+        :type client: :class:`RepeaterClient`
         :returns: Data for exchange
         :rtype: tuple[str, str]
         '''
         username = password = None
         count = 0
 
-        def readline(sock):
-            data = ""
-            while "\r\n" not in data:
-                try:
-                    data_part = sock.read(32)
-                except socket.timeout:
-                    continue
-
-                if data_part == b"":
-                    break
-
-                data += data_part.decode('utf-8', 'replace')
-            return data.strip()
-
         while (not username or not password) and count < 3:
-            line = readline(pipe)
+            data = await client.reader.readline()
+            if not data:
+                break
+            count += 1
+            line = data.decode('utf-8', 'replace').strip()
             if not line:
                 continue
             try:
                 cmd, value = line.split(" ", 1)
             except ValueError:
-                pipe.write(b"501 Invalid Syntax\r\n")
+                client.writer.write(b"501 Invalid Syntax\r\n")
                 break
 
             cmd = cmd.upper()
@@ -306,48 +823,55 @@ class Repeater:
             elif cmd == "PASS" and username and not password:
                 password = value
             else:
-                pipe.write(b"201 Protocol violation\r\n")
+                client.writer.write(b"201 Protocol violation\r\n")
                 break
 
             if username and not password:
                 out_data = b"102 %s okay\r\n" % cmd.encode('utf-8', 'replace')
-                pipe.write(out_data)
+                client.writer.write(out_data)
 
         if not username or not password:
             self.logger.info("auth_exchange: Negotiation failed with client")
 
         return username, password
 
-    def auth_user(self, pipe):
+    async def auth_user(self, client):
         '''
         Authorize user.
 
-        :param pipe: Pipe object
-        :type pipe: socket
+        :param client: Client being authorized
+        :type client: :class:`RepeaterClient`
         :return: True if authorized
         :rtype: bool
         '''
-        # pylint: disable=protected-access
-        host, _port = pipe._socket.getpeername()
+        writer = client.writer
+        peer = writer.get_extra_info("peername")
+        host = peer[0] if peer else None
 
         if not self.require_auth:
-            pipe.write(b"100 Authentication not required\r\n")
+            writer.write(b"100 Authentication not required\r\n")
             return True
         if self.trust_local and host == "127.0.0.1":
-            pipe.write(b"100 Authentication not required for localhost\r\n")
+            writer.write(b"100 Authentication not required for localhost\r\n")
             return True
 
+        lines = []
         auth_fname = Platform.get_platform().config_file("users.txt")
         try:
-            auth = open(auth_fname)
-            lines = auth.readlines()
-            auth.close()
+            with open(auth_fname) as auth:
+                lines = auth.readlines()
         except (NameError, FileNotFoundError) as err:
             self.logger.info("auth_user: Failed to open %s: %s",
                              auth_fname, err)
 
-        pipe.write(b"101 Authorization required\r\n")
-        username, password = self.auth_exchange(pipe)
+        writer.write(b"101 Authorization required\r\n")
+        try:
+            username, password = await asyncio.wait_for(
+                self.auth_exchange(client), self.auth_timeout)
+        except asyncio.TimeoutError:
+            self.logger.info("auth_user: %s Timed out", client)
+            self.metrics.auth_failures += 1
+            return False
 
         lno = 1
         for line in lines:
@@ -363,11 +887,13 @@ class Repeater:
 
             if user == username and passwd == password:
                 self.logger.info("Authorized user %s", user)
-                pipe.write(b"200 Authorized\r\n")
+                writer.write(b"200 Authorized\r\n")
                 return True
 
         self.logger.info("auth_user: User %s failed to authenticate", username)
-        pipe.write(b"500 Not authorized\r\n")
+        self.metrics.auth_failures += 1
+        writer.write(b"500 Not authorized\r\n")
+        await writer.drain()
         return False
 
     @staticmethod
@@ -391,46 +917,50 @@ class Repeater:
             ret_str += str(part)
         return ret_str
 
-    def accept_new(self):
-        '''Accept new.'''
-        if not self.socket:
-            return
-
+    async def _client_connected(self, reader, writer):
+        client = RepeaterClient(self, reader, writer)
+        self.logger.info("_client_connected: Accepted new client %s",
+                         client.name)
+        task = asyncio.current_task()
+        self._client_tasks.add(task)
+        self.paths.append(client)
+        self.routes.attach(client)
         try:
-            (csocket, addr) = self.socket.accept()
-        except BlockingIOError:
-            return
-
-        addr_str = self.address_to_string(addr)
-        self.logger.info("accept_new: Accepted new client %s", addr_str)
-
-        path = comm.SocketDataPath(csocket)
-        tport = transport.Transporter(path,
-                                      authfn=self.auth_user,
-                                      warmup_timeout=0)
-        self.add_new_transport(tport)
-
-    def accept_new_gps(self):
-        '''Accept new GPS.'''
-        if not self.gps_socket:
-            return
-
+            await client.run()
+        finally:
+            if client in self.paths:
+                self.paths.remove(client)
+            self.metrics.remove(client)
+            self._client_tasks.discard(task)
+
+    async def _gps_connected(self, reader, writer):
+        addr_str = self.address_to_string(
+            writer.get_extra_info("peername") or "(incoming)")
+        self.logger.info("_gps_connected: Accepted new GPS client %s",
+                         addr_str)
+        self.gps_sockets.append(writer)
         try:
-            (csocket, addr) = self.gps_socket.accept()
-        except BlockingIOError:
-            return
-
-        addr_str = self.address_to_string(addr)
-        self.logger.info("accept_new_gps: Accepted new GPS client %s", addr_str)
-        self.gps_sockets.append(csocket)
+            # GPS clients only listen, so just wait for them to go away.
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if writer in self.gps_sockets:
+                self.gps_sockets.remove(writer)
+            writer.close()
+        self.logger.info("_gps_connected: GPS client %s disconnected",
+                         addr_str)
 
     @staticmethod
-    def listen_on(port):
+    def listen_on(port, address='0.0.0.0'):
         '''
         Listen on.
 
         :param port: TCP/IP port number
         :type port: int
+        :param address: Address to listen on, default all addresses
+        :type address: str
         :returns: socket object
         :rtype: socket
         '''
@@ -439,19 +969,126 @@ class Repeater:
         sock.setsockopt(socket.SOL_SOCKET,
                         socket.SO_REUSEADDR,
                         1)
-        sock.bind(('0.0.0.0', port))
-        sock.listen(0)
+        sock.bind((address, port))
+        sock.listen(socket.SOMAXCONN)
 
         return sock
 
-    def _repeat(self):
-        while self.enabled:
-            self.condition.acquire()
-            self.accept_new()
-            self.accept_new_gps()
-            self.condition.release()
+    def _request_shutdown(self):
+        if self._shutdown:
+            self._shutdown.set()
+
+    async def _metrics_connected(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            writer.close()
+            return
+        try:
+            _method, url, _version = request.decode('ascii').split(" ", 2)
+        except (UnicodeDecodeError, ValueError):
+            url = None
+        if url == "/metrics":
+            status = "200 OK"
+            content_type = "text/plain; version=0.0.4"
+            body = self.metrics.to_prometheus(self.paths)
+        elif url == "/metrics.json":
+            status = "200 OK"
+            content_type = "application/json"
+            body = json.dumps(self.metrics.to_dict(self.paths))
+        else:
+            status = "404 Not Found"
+            content_type = "text/plain"
+            body = "Try /metrics or /metrics.json\n"
+        data = body.encode('utf-8')
+        writer.write(("HTTP/1.0 %s\r\nContent-Type: %s\r\n"
+                      "Content-Length: %i\r\nConnection: close\r\n\r\n" %
+                      (status, content_type, len(data))).encode('ascii'))
+        writer.write(data)
+        try:
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        writer.close()
+
+    async def _log_stats(self):
+        metrics_logger = None
+        if self.metrics_file:
+            handler = logging.handlers.RotatingFileHandler(
+                self.metrics_file, maxBytes=1024 * 1024, backupCount=5)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            metrics_logger = logging.getLogger("RepeaterMetrics")
+            metrics_logger.propagate = False
+            metrics_logger.setLevel(logging.INFO)
+            metrics_logger.addHandler(handler)
+        try:
+            while True:
+                await asyncio.sleep(self.stats_interval)
+                count, cpu = self.relay_stats()
+                self.logger.info("_log_stats: %i clients, %i frames relayed, "
+                                 "%.1f usec CPU per frame",
+                                 len(self.paths), count, cpu * 1000000)
+                if metrics_logger:
+                    metrics = self.metrics.to_dict(self.paths)
+                    metrics_logger.info(json.dumps(metrics))
+        finally:
+            if metrics_logger:
+                metrics_logger.removeHandler(handler)
+                handler.close()
+
+    async def _maintain_routes(self):
+        last_save = time.time()
+        while True:
+            await asyncio.sleep(self.route_expire_interval)
+            self.routes.expire()
+            if time.time() - last_save >= self.route_save_interval:
+                last_save = time.time()
+                routes = self.routes.snapshot()
+                if routes is not None:
+                    await self.loop.run_in_executor(None, self.routes.save,
+                                                    routes)
+
+    async def _serve(self):
+        self._shutdown = asyncio.Event()
+        if not self.enabled:
+            return
+        servers = []
+        if self.socket:
+            servers.append(await asyncio.start_server(
+                self._client_connected, sock=self.socket))
+        if self.gps_socket:
+            servers.append(await asyncio.start_server(
+                self._gps_connected, sock=self.gps_socket))
+        if self.metrics_socket:
+            servers.append(await asyncio.start_server(
+                self._metrics_connected, sock=self.metrics_socket))
+
+        tasks = [asyncio.ensure_future(self._log_stats()),
+                 asyncio.ensure_future(self._maintain_routes())]
+        await self._shutdown.wait()
+        for task in tasks:
+            task.cancel()
+        self.routes.save()
+
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        for path in self.paths[:]:
+            if isinstance(path, RepeaterClient):
+                path.disable()
+        for writer in self.gps_sockets:
+            writer.close()
+        if self._client_tasks:
+            await asyncio.wait(list(self._client_tasks), timeout=5)
 
-            time.sleep(0.5)
+    def _repeat(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
 
         self.logger.info("_repeat: Repeater thread ended")
 
@@ -465,20 +1102,26 @@ class Repeater:
         '''Stop.'''
         self.enabled = False
 
-        self.condition.acquire()
-        self.condition.notify()
-        self.condition.release()
-
         if self.repeat_thread:
             self.logger.info("stop: Stopping repeater")
+            if self.repeat_thread.is_alive():
+                self.loop.call_soon_threadsafe(self._request_shutdown)
             self.repeat_thread.join()
+            count, cpu = self.relay_stats()
+            self.logger.info("stop: %i frames relayed, "
+                             "%.1f usec CPU per frame", count, cpu * 1000000)
 
         for path in self.paths:
-            self.logger.info("stop: Stopping")
-            path.disable()
+            if isinstance(path, transport.Transporter):
+                self.logger.info("stop: Stopping")
+                path.disable()
 
         if self.socket:
             self.socket.close()
+        if self.gps_socket:
+            self.gps_socket.close()
+        if self.metrics_socket:
+            self.metrics_socket.close()
 
 
 class RepeaterUI:
@@ -514,14 +1157,33 @@ class RepeaterUI:
         config.set("settings", "require_auth", "False")
         config.set("settings", "trust_local", "True")
         config.set("settings", "gpsport", "9500")
+        config.set("settings", "metricsport", "9001")
 
         config.add_section("tweaks")
         config.set("tweaks", "allow_gps", "")
+        config.set("tweaks", "persist_routes", "True")
+        config.set("tweaks", "dup_cache_ttl", "3")
+        config.set("tweaks", "dup_cache_entries", "16384")
 
         config.read(self.config_fn)
 
         return config
 
+    def listen_metrics(self):
+        '''Listen for metrics requests on localhost if configured.'''
+        try:
+            metricsport = int(self.config.get("settings", "metricsport"))
+        except (ValueError, configparser.NoOptionError):
+            metricsport = 0
+        if not metricsport:
+            return
+        try:
+            self.repeater.metrics_socket = self.repeater.listen_on(
+                metricsport, "127.0.0.1")
+        except OSError as err:
+            self.logger.info("listen_metrics: Unable to listen on %i: %s",
+                             metricsport, err)
+
     # pylint wants a max of 15 local variables
     # pylint wants a max of 50 statements
     # pylint wants a max of 12 branches
@@ -538,9 +1200,20 @@ class RepeaterUI:
         require_auth = self.config.get("settings", "require_auth") == "True"
         trust_local = self.config.get("settings", "trust_local") == "True"
         gps_okay_ports = self.config.get("tweaks", "allow_gps").split(",")
+        route_file = None
+        if self.config.getboolean("tweaks", "persist_routes"):
+            route_file = self.platform.config_file("repeater_routes.json")
+        dup_cache = None
+        dup_ttl = self.config.getfloat("tweaks", "dup_cache_ttl")
+        if dup_ttl > 0:
+            dup_cache = DuplicateCache(
+                dup_ttl, self.config.getint("tweaks", "dup_cache_entries"))
         self.logger.info("add_outgoing_path: Repeater id is %s", ident)
         self.repeater = Repeater(ident, require_auth,
-                                 trust_local, gps_okay_ports)
+                                 trust_local, gps_okay_ports, route_file,
+                                 dup_cache)
+        self.repeater.metrics_file = self.platform.config_file(
+            "repeater_metrics.log")
         for dev, param in paths:
             timeout = 0
             if dev.startswith("net:"):
@@ -617,12 +1290,13 @@ class RepeaterUI:
 
             path.connect()
             tport = transport.Transporter(path, warmup_timeout=timeout,
-                                          name=dev)
+                                          port_name=dev)
             self.repeater.add_new_transport(tport)
 
 
 # pylint wants a max of 7 instance attributes
-# pylint: disable=too-many-instance-attributes
+# pylint wants a max of 20 public methods
+# pylint: disable=too-many-instance-attributes, too-many-public-methods
 class RepeaterGUI(RepeaterUI):
     '''Repeater GUI.'''
 
@@ -640,6 +1314,7 @@ class RepeaterGUI(RepeaterUI):
         self.traffic_buffer = None
         self.traffic_view = None
         self.conn_list = None
+        self.route_list = None
         self.trust_local = None
         self.req_auth = None
         self.id_freq = None
@@ -1037,6 +1712,30 @@ class RepeaterGUI(RepeaterUI):
 
         return frame
 
+    def make_routes(self):
+        '''
+        Make Stations Heard.
+
+        :returns: Gtk.Frame object with the learned routes
+        :rtype: :class:`Gtk.Frame`
+        '''
+        frame = Gtk.Frame.new("Stations Heard")
+
+        routelist = ListWidget([(GObject.TYPE_STRING, "Station"),
+                                (GObject.TYPE_STRING, "Path"),
+                                (GObject.TYPE_INT, "Heard (s)"),
+                                (GObject.TYPE_INT, "Frames")])
+        routelist.show()
+
+        self.route_list = Gtk.ScrolledWindow()
+        self.route_list.add(routelist)
+        self.route_list.show()
+
+        frame.add(self.route_list)
+        frame.show()
+
+        return frame
+
     def make_traffic(self):
         '''
         Make Traffic Monitor.
@@ -1067,6 +1766,19 @@ class RepeaterGUI(RepeaterUI):
 
         return frame
 
+    def _show_metrics(self, future):
+        '''
+        Show the repeater metrics in the traffic monitor.
+
+        :param future: Future with the metrics summary
+        :type future: :class:`concurrent.futures.Future`
+        :returns: False to run once
+        :rtype: bool
+        '''
+        if not future.cancelled() and not future.exception():
+            self.traffic_buffer.set_text(future.result())
+        return False
+
     def make_monitor(self):
         '''
         Make Monitor.
@@ -1077,6 +1789,7 @@ class RepeaterGUI(RepeaterUI):
         vbox = Gtk.Box.new(Gtk.Orientation.VERTICAL, 5)
 
         vbox.pack_start(self.make_connected(), 1, 1, 1)
+        vbox.pack_start(self.make_routes(), 1, 1, 1)
         vbox.pack_start(self.make_traffic(), 1, 1, 1)
 
         vbox.show()
@@ -1144,6 +1857,7 @@ class RepeaterGUI(RepeaterUI):
         if port and enabled:
             self.repeater.socket = self.repeater.listen_on(port)
             self.repeater.gps_socket = self.repeater.listen_on(gpsport)
+        self.listen_metrics()
 
         #self.tap = LoopDataPath("TAP", self.repeater.condition)
         #self.repeater.paths.append(self.tap)
@@ -1183,6 +1897,20 @@ class RepeaterGUI(RepeaterUI):
 
         self.conn_list.get_child().set_values(path_list)
 
+        if self.repeater and self.repeater.loop.is_running():
+            self.repeater.metrics_summary().add_done_callback(
+                lambda future: GLib.idle_add(self._show_metrics, future))
+
+        route_list = []
+        if self.repeater:
+            route_list = [(info.get_call(), info.name or "",
+                           int(info.last_heard()), info.frames)
+                          for info in self.repeater.routes.get_routes()]
+            # Most recently heard first, and not thousands of rows
+            route_list.sort(key=lambda row: row[2])
+            del route_list[200:]
+        self.route_list.get_child().set_values(route_list)
+
         # self.tap not currently implemented
         # if self.tap:
         #     traffic = self.tap.peek()
@@ -1240,6 +1968,7 @@ class RepeaterConsole(RepeaterUI):
         if acceptnet:
             self.repeater.socket = self.repeater.listen_on(netport)
             self.repeater.gps_socket = self.repeater.listen_on(gpsport)
+        self.listen_metrics()
 
         self.repeater.repeat()
 
@@ -0,0 +1,428 @@
+#!/usr/bin/python
+'''Attachment Store.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import copy
+import hashlib
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+import zlib
+
+from lxml import etree
+
+from .dplatform import Platform
+
+ATTACHMENT_DIR = "attachments"
+
+# Attachments not referenced by any form are only removed after this
+# many seconds, a form being written may not have been saved yet.
+PRUNE_AGE = 24 * 60 * 60
+
+# Compressed bytes encoded at a time, a multiple of 3 so the base64
+# pieces join without padding in between.
+ENCODE_CHUNK = 3 * 64 * 1024
+
+# Inlined attachments can be larger than libxml2 allows by default.
+_HUGE_PARSER = etree.XMLParser(huge_tree=True)
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_REF_RE = re.compile(rb"<att\s[^>]*\bref=[\"']([0-9a-f]{64})[\"']")
+
+
+class AttachmentStoreError(Exception):
+    '''Attachment Store Exception.'''
+
+
+class AttachmentStore:
+    '''
+    Attachment Store.
+
+    Keeps the attachments of the forms out of the form files.  Each
+    attachment is kept once, zlib compressed, in a file named after
+    the SHA-256 hash of its data.  A form refers to it with an empty
+    att element that has ref and size attributes.
+
+    Forms leave D-RATS with the attachments inlined as before, base64
+    encoded zlib data in the att element, so other stations do not
+    need to know about the store.  Use :meth:`get_store` to share
+    one store.
+
+    :param store_dir: Directory for the attachments
+    :type store_dir: str
+    '''
+
+    logger = logging.getLogger("AttachmentStore")
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    @classmethod
+    def get_store(cls, store_dir=None):
+        '''
+        Get the shared store.
+
+        :param store_dir: Directory, default ATTACHMENT_DIR in the
+                          configuration directory
+        :type store_dir: str
+        :returns: Attachment store
+        :rtype: :class:`AttachmentStore`
+        '''
+        if not store_dir:
+            store_dir = Platform.get_platform().config_file(ATTACHMENT_DIR)
+        store_dir = os.path.abspath(store_dir)
+        with cls._stores_lock:
+            store = cls._stores.get(store_dir, None)
+            if store is None:
+                store = cls(store_dir)
+                cls._stores[store_dir] = store
+            return store
+
+    def path(self, digest):
+        '''
+        Get the file of an attachment.
+
+        :param digest: SHA-256 hash of the attachment data
+        :type digest: str
+        :returns: Filename of the compressed data
+        :rtype: str
+        :raises: :class:`AttachmentStoreError` if the hash is not valid
+        '''
+        if not _DIGEST_RE.match(digest or ""):
+            raise AttachmentStoreError("Invalid attachment hash %r" % digest)
+        return os.path.join(self.store_dir, digest[:2], digest)
+
+    def exists(self, digest):
+        '''
+        Check if an attachment is in the store.
+
+        :param digest: SHA-256 hash of the attachment data
+        :type digest: str
+        :returns: True if the attachment is in the store
+        :rtype: bool
+        '''
+        return os.path.exists(self.path(digest))
+
+    def put(self, data, zdata=None):
+        '''
+        Add an attachment.
+
+        :param data: Attachment data
+        :type data: bytes
+        :param zdata: Data already compressed with zlib, default None
+        :type zdata: bytes
+        :returns: Hash and size of the data
+        :rtype: tuple[str, int]
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            # An attachment already stored may be one that no form
+            # refers to any more.  Make it new again, so prune does not
+            # remove it under the form about to refer to it.
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handle, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(handle, "wb") as tmp_file:
+                tmp_file.write(zdata or zlib.compress(data, 9))
+            os.replace(tmp_name, path)
+        return digest, len(data)
+
+    def get(self, digest):
+        '''
+        Get the data of an attachment.
+
+        :param digest: SHA-256 hash of the attachment data
+        :type digest: str
+        :returns: Attachment data
+        :rtype: bytes
+        :raises: :class:`AttachmentStoreError` if it can not be read
+        '''
+        try:
+            with open(self.path(digest), "rb") as handle:
+                return zlib.decompress(handle.read())
+        except (OSError, zlib.error) as err:
+            raise AttachmentStoreError("Attachment %s: %s" %
+                                       (digest, err)) from err
+
+    def iter_encoded(self, digest):
+        '''
+        Read an attachment the way it is inlined in a form.
+
+        :param digest: SHA-256 hash of the attachment data
+        :type digest: str
+        :returns: Pieces of the base64 encoded zlib data
+        :rtype: iterator[bytes]
+        :raises: :class:`AttachmentStoreError` if it can not be read
+        '''
+        try:
+            with open(self.path(digest), "rb") as handle:
+                while True:
+                    chunk = handle.read(ENCODE_CHUNK)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+        except OSError as err:
+            raise AttachmentStoreError("Attachment %s: %s" %
+                                       (digest, err)) from err
+
+    def prune(self, root_dir, age=PRUNE_AGE):
+        '''
+        Remove attachments that no form refers to.
+
+        :param root_dir: Directory holding the message folders
+        :type root_dir: str
+        :param age: Only remove attachments older than this many
+                    seconds, default PRUNE_AGE
+        :type age: float
+        :returns: Number of attachments removed
+        :rtype: int
+        '''
+        used = set()
+        for folder, _dirs, files in os.walk(root_dir):
+            for name in files:
+                if not name.endswith(".xml"):
+                    continue
+                try:
+                    with open(os.path.join(folder, name), "rb") as handle:
+                        used.update(ref.decode("ascii") for ref in
+                                    _REF_RE.findall(handle.read()))
+                except OSError as err:
+                    self.logger.info("prune: %s", err)
+        removed = 0
+        limit = time.time() - age
+        for folder, _dirs, files in os.walk(self.store_dir):
+            for name in files:
+                if name in used:
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    # Read the time right before removing, as put may
+                    # have stored the attachment again since the forms
+                    # were read.
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                        removed += 1
+                except OSError as err:
+                    self.logger.info("prune: %s", err)
+        if removed:
+            self.logger.info("prune: removed %i attachments", removed)
+        return removed
+
+
+def externalize(doc, store):
+    '''
+    Move the inlined attachments of a form into the store.
+
+    :param doc: Form document
+    :type doc: :class:`etree._ElementTree`
+    :param store: Attachment store
+    :type store: :class:`AttachmentStore`
+    :returns: Number of attachments moved
+    :rtype: int
+    '''
+    moved = 0
+    for att in doc.xpath("//form/att[not(@ref)]"):
+        if not att.text:
+            continue
+        try:
+            zdata = base64.b64decode(att.text)
+            data = zlib.decompress(zdata)
+        except (binascii.Error, zlib.error) as err:
+            # Left inline, get_attachment reports it when it is used.
+            AttachmentStore.logger.info("externalize: %s: %s",
+                                        att.get("name"), err)
+            continue
+        digest, size = store.put(data, zdata)
+        att.text = None
+        att.set("ref", digest)
+        att.set("size", str(size))
+        moved += 1
+    return moved
+
+
+def iter_inline(doc, store):
+    '''
+    Serialize a form with its attachments inlined.
+
+    The form is serialized with a marker in place of each attachment,
+    and the attachments are read from the store piece by piece where
+    the markers are.
+
+    :param doc: Form document
+    :type doc: :class:`etree._ElementTree`
+    :param store: Attachment store
+    :type store: :class:`AttachmentStore`
+    :returns: Pieces of the serialized form
+    :rtype: iterator[bytes]
+    :raises: :class:`AttachmentStoreError` if an attachment is missing
+    '''
+    if not doc.xpath("//form/att[@ref]"):
+        yield etree.tostring(doc)
+        return
+    doc = copy.deepcopy(doc)
+    token = secrets.token_hex(8)
+    digests = []
+    for att in doc.xpath("//form/att[@ref]"):
+        att.text = "%s:%i:" % (token, len(digests))
+        digests.append(att.attrib.pop("ref"))
+        att.attrib.pop("size", None)
+    pieces = re.split(token.encode("ascii") + rb":(\d+):",
+                      etree.tostring(doc))
+    yield pieces[0]
+    for index in range(1, len(pieces), 2):
+        yield from store.iter_encoded(digests[int(pieces[index])])
+        yield pieces[index + 1]
+
+
+def inline_file(filename, store=None):
+    '''
+    Read a form file with its attachments inlined.
+
+    :param filename: Form filename
+    :type filename: str
+    :param store: Attachment store, default the shared store
+    :type store: :class:`AttachmentStore`
+    :returns: Pieces of the form
+    :rtype: iterator[bytes]
+    :raises: :class:`etree.XMLSyntaxError` if the form is not valid
+    :raises: :class:`AttachmentStoreError` if an attachment is missing
+    '''
+    with open(filename, "rb") as handle:
+        data = handle.read()
+    if not _REF_RE.search(data):
+        # Nothing to inline, send it as it is.
+        yield data
+        return
+    yield from iter_inline(etree.ElementTree(etree.fromstring(data)),
+                           store or AttachmentStore.get_store())
+
+
+def externalize_file(filename, store=None):
+    '''
+    Move the inlined attachments of a form file into the store.
+
+    :param filename: Form filename
+    :type filename: str
+    :param store: Attachment store, default the shared store
+    :type store: :class:`AttachmentStore`
+    :returns: Number of attachments moved
+    :rtype: int
+    :raises: :class:`etree.XMLSyntaxError` if the form is not valid
+    '''
+    doc = etree.parse(filename, _HUGE_PARSER)
+    moved = externalize(doc, store or AttachmentStore.get_store())
+    if moved:
+        doc.write(filename)
+    return moved
+
+
+_BENCH_FORM = '''<xml>
+<form id="email">
+<title>Email</title>
+<field id="subject"><caption>Subject</caption>
+<entry type="text">Photos</entry></field>
+<field id="message"><caption>Message</caption>
+<entry type="multiline">Photos of the bridge.</entry></field>
+<att name="photo.jpg">%s</att>
+<path><src>N0CALL</src><dst>W1AW</dst></path>
+</form>
+</xml>
+'''
+
+
+def _list_attachments(filename):
+    doc = etree.parse(filename)
+    return [(att.get("name"), int(att.get("size", len(att.text or ""))))
+            for att in doc.xpath("//form/att")]
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Unit test and benchmark with 64 KB to 8 MB attachments.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("AttachmentStore.test")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        store = AttachmentStore(os.path.join(work_dir, ATTACHMENT_DIR))
+        form_dir = os.path.join(work_dir, "messages", "Inbox")
+        os.makedirs(form_dir)
+        for size in (64 << 10, 1 << 20, 4 << 20, 8 << 20):
+            data = os.urandom(size)
+            filename = os.path.join(form_dir, "form_%i.xml" % size)
+            with open(filename, "wb") as handle:
+                handle.write((_BENCH_FORM % base64.b64encode(
+                    zlib.compress(data, 9)).decode("ascii")).encode("ascii"))
+            original = b"".join(inline_file(filename, store))
+
+            times = []
+            for _step in ("inline", "stored"):
+                start = time.perf_counter()
+                try:
+                    for _num in range(5):
+                        atts = _list_attachments(filename)
+                    times.append("%8.2f ms" %
+                                 ((time.perf_counter() - start) * 200))
+                except etree.XMLSyntaxError:
+                    # FormFile can not read these either.
+                    times.append("too large")
+                externalize_file(filename, store)
+            logger.info("%5i KB attachment: parse and list inline %s, "
+                        "stored %s, form file %i bytes",
+                        size >> 10, times[0], times[1],
+                        os.path.getsize(filename))
+
+            start = time.perf_counter()
+            sent = b"".join(inline_file(filename, store))
+            elapsed = time.perf_counter() - start
+            digest = etree.parse(filename).find(".//att").get("ref")
+            if etree.tostring(etree.fromstring(sent, _HUGE_PARSER)) == \
+                    etree.tostring(etree.fromstring(original, _HUGE_PARSER)) \
+                    and atts == [("photo.jpg", size)] and \
+                    store.get(digest) == data:
+                logger.info("PASS: inlined for sending in %.1f ms",
+                            elapsed * 1000)
+            else:
+                logger.info("FAIL: inlined form differs")
+
+        os.utime(store.path(digest), (0, 0))
+        os.remove(filename)
+        # An old attachment stored again is kept for its new form.
+        store.put(data)
+        kept = store.prune(os.path.join(work_dir, "messages")) == 0
+        os.utime(store.path(digest), (0, 0))
+        if kept and store.prune(os.path.join(work_dir, "messages")) == 1 and \
+                not store.exists(digest) and \
+                len(list(os.scandir(os.path.dirname(form_dir)))) == 1:
+            logger.info("PASS: prune")
+        else:
+            logger.info("FAIL: prune")
+
+
+if __name__ == "__main__":
+    main()
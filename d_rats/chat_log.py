@@ -0,0 +1,556 @@
+#!/usr/bin/python
+'''Chat Log.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import glob
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Rotation of the chat logs
+ROTATE_SIZE = "Size"
+ROTATE_DAILY = "Daily"
+ROTATE_CHOICES = [ROTATE_SIZE, ROTATE_DAILY]
+
+# Default size a chat log is rotated at
+LOG_MAX_BYTES = 1 << 20
+
+# Seconds lines wait before they are written
+FLUSH_INTERVAL = 1.0
+
+# Bytes waiting that are written right away
+FLUSH_BYTES = 64 << 10
+
+# Most lines waiting for the writer before a write blocks
+QUEUE_LINES = 10000
+
+# Most seconds the GTK thread waits for a log to be written
+FLUSH_TIMEOUT = 5.0
+
+# Bytes read at a time when reading a log backwards
+READ_BLOCK = 64 << 10
+
+
+class ChatLogWriter(threading.Thread):
+    '''
+    Chat Log Writer.
+
+    Writes the lines of all chat logs from one thread, so that the GTK
+    thread never waits for the disk.  Lines are written in batches,
+    when FLUSH_BYTES are waiting or after FLUSH_INTERVAL seconds.
+
+    Use :meth:`get_writer` to share one writer.
+    '''
+
+    logger = logging.getLogger("ChatLogWriter")
+
+    _writer = None
+    _writer_lock = threading.Lock()
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="ChatLogWriter", daemon=True)
+        self._queue = queue.Queue(maxsize=QUEUE_LINES)
+        self._put_lock = threading.Lock()
+        self._stopped = False
+        self._pending = {}
+        self._pending_bytes = 0
+
+    @classmethod
+    def get_writer(cls):
+        '''
+        Get the shared writer.
+
+        :returns: Chat log writer
+        :rtype: :class:`ChatLogWriter`
+        '''
+        with cls._writer_lock:
+            if not cls._writer:
+                cls._writer = ChatLogWriter()
+                cls._writer.start()
+            return cls._writer
+
+    @classmethod
+    def stop_writer(cls):
+        '''Write what is waiting and stop the shared writer.'''
+        with cls._writer_lock:
+            writer = cls._writer
+            cls._writer = None
+        if writer:
+            writer.put(None, None)
+            writer.join()
+
+    def put(self, log, text):
+        '''
+        Queue text for a log.
+
+        :param log: Chat log, None to stop the writer
+        :type log: :class:`ChatLog`
+        :param text: Text, or an Event to set when the log is written
+        :type text: str or :class:`threading.Event`
+        :returns: False if the writer is stopped and the text not queued
+        :rtype: bool
+        '''
+        with self._put_lock:
+            if self._stopped or not self.is_alive():
+                return False
+            if log is None:
+                self._stopped = True
+            self._queue.put((log, text))
+        return True
+
+    def _write_pending(self):
+        for log, texts in self._pending.items():
+            try:
+                log.append("".join(texts))
+            except OSError as err:
+                self.logger.info("_write_pending: %s: %s", log.filename, err)
+        self._pending = {}
+        self._pending_bytes = 0
+
+    def run(self):
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                log, text = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._write_pending()
+                deadline = None
+                continue
+            if log is None:
+                self._write_pending()
+                return
+            if isinstance(text, threading.Event):
+                self._write_pending()
+                deadline = None
+                text.set()
+                continue
+            self._pending.setdefault(log, []).append(text)
+            self._pending_bytes += len(text)
+            if deadline is None:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+            if self._pending_bytes >= FLUSH_BYTES:
+                self._write_pending()
+                deadline = None
+
+
+# pylint wants a max of 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class ChatLog:
+    '''
+    Chat Log.
+
+    A chat log file that is rotated when it gets too big, or each day.
+    Rotated logs keep the name of the log with the time they were
+    rotated added, like Main.20240102-030405-678.txt.
+
+    :param filename: Log file
+    :type filename: str
+    :param rotate: ROTATE_SIZE or ROTATE_DAILY, default ROTATE_SIZE
+    :type rotate: str
+    :param max_bytes: Size to rotate at, default LOG_MAX_BYTES
+    :type max_bytes: int
+    :param keep: Rotated logs to keep, default None for all
+    :type keep: int
+    '''
+
+    logger = logging.getLogger("ChatLog")
+
+    # pylint wants a max of 5 arguments
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, filename, rotate=ROTATE_SIZE, max_bytes=LOG_MAX_BYTES,
+                 keep=None, writer=None):
+        self.filename = filename
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self._writer = writer
+        self._handle = None
+        self._size = 0
+        self._day = None
+        self.rotations = 0
+
+    def write(self, text):
+        '''
+        Queue text to be written to the log.
+
+        Once the writer is stopped, as it is on shutdown, the text is
+        written right away instead.
+
+        :param text: Text with its line ending
+        :type text: str
+        '''
+        if not self._writer:
+            self._writer = ChatLogWriter.get_writer()
+        if self._writer.put(self, text):
+            return
+        # Let the stopped writer finish what it has first.
+        self._writer.join(FLUSH_TIMEOUT)
+        try:
+            self.append(text)
+        except OSError as err:
+            self.logger.info("write: %s: %s", self.filename, err)
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        '''
+        Wait for the text queued for the log to be written.
+
+        :param timeout: Most seconds to wait, default FLUSH_TIMEOUT
+        :type timeout: float
+        :returns: True if the text is written
+        :rtype: bool
+        '''
+        if not self._writer:
+            return True
+        done = threading.Event()
+        if self._writer.put(self, done):
+            return done.wait(timeout)
+        self._writer.join(timeout)
+        return not self._writer.is_alive()
+
+    def close(self):
+        '''Write the queued text and close the log file.'''
+        if not self.flush():
+            self.logger.info("close: %s: not all text written",
+                             self.filename)
+            return
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+
+    def _open(self):
+        base = os.path.dirname(self.filename)
+        if base:
+            os.makedirs(base, exist_ok=True)
+        # The writer thread batches the lines, so no line buffering.
+        # pylint: disable=consider-using-with
+        self._handle = open(self.filename, "ab")
+        stat = os.fstat(self._handle.fileno())
+        self._size = stat.st_size
+        self._day = time.localtime(stat.st_mtime if self._size
+                                   else time.time())[:3]
+
+    def append(self, text):
+        '''
+        Write text to the log, rotating it first if needed.
+
+        Only called from the writer thread.
+
+        :param text: Text
+        :type text: str
+        '''
+        data = text.encode("utf-8")
+        if not self._handle:
+            self._open()
+        if self._size:
+            if self.rotate == ROTATE_DAILY:
+                full = time.localtime()[:3] != self._day
+            else:
+                full = self._size + len(data) > self.max_bytes
+            if full:
+                self._rotate()
+        self._handle.write(data)
+        self._handle.flush()
+        self._size += len(data)
+
+    def _rotate(self):
+        self._handle.close()
+        self._handle = None
+        base, ext = os.path.splitext(self.filename)
+        now = time.time()
+        while True:
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+            rotated = "%s.%s-%03i%s" % (base, stamp, now * 1000 % 1000, ext)
+            if not os.path.exists(rotated):
+                break
+            now += 0.001
+        os.rename(self.filename, rotated)
+        self.rotations += 1
+        self.logger.debug("_rotate: %s", rotated)
+        if self.keep is not None:
+            for old in self.rotated()[self.keep:]:
+                os.unlink(old)
+        self._open()
+
+    def rotated(self):
+        '''
+        Get the rotated logs.
+
+        :returns: Rotated log files, newest first
+        :rtype: list[str]
+        '''
+        base, ext = os.path.splitext(self.filename)
+        return sorted(glob.glob(glob.escape(base) + ".[0-9]*" + ext),
+                      reverse=True)
+
+    def history(self):
+        '''
+        Get a reader for the history of the log, newest lines first.
+
+        :returns: History reader
+        :rtype: :class:`ChatHistory`
+        '''
+        return ChatHistory(self)
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class ChatHistory:
+    '''
+    Chat History.
+
+    Pages back through a chat log and its rotated logs.  Only the
+    blocks holding the lines asked for are read, so each page takes
+    about the same time however far back it is.  Lines written after
+    the reader was made are not returned.
+
+    :param log: Chat log
+    :type log: :class:`ChatLog`
+    '''
+
+    def __init__(self, log):
+        self._log = log
+        log.flush()
+        self._files = []
+        for filename in [log.filename] + log.rotated():
+            try:
+                self._files.append((filename, os.stat(filename)))
+            except OSError:
+                pass
+        self._index = 0
+        self._pos = None
+        self._rest = None
+        self._ready = []
+
+    def _locate(self):
+        '''Find a log file again if it has been rotated since.'''
+        filename, stat = self._files[self._index]
+        try:
+            now = os.stat(filename)
+            if (now.st_dev, now.st_ino) == (stat.st_dev, stat.st_ino):
+                return filename
+        except OSError:
+            pass
+        for rotated in self._log.rotated():
+            now = os.stat(rotated)
+            if (now.st_dev, now.st_ino) == (stat.st_dev, stat.st_ino):
+                return rotated
+        return filename
+
+    def _next_block(self):
+        '''
+        Read the next block back.
+
+        :returns: False if there is nothing older
+        :rtype: bool
+        '''
+        while self._index < len(self._files):
+            if self._pos is None:
+                self._pos = self._files[self._index][1].st_size
+            if self._pos == 0:
+                if self._rest is not None:
+                    self._ready.append(self._rest)
+                self._index += 1
+                self._pos = None
+                self._rest = None
+                continue
+            size = min(READ_BLOCK, self._pos)
+            try:
+                with open(self._locate(), "rb") as handle:
+                    handle.seek(self._pos - size)
+                    block = handle.read(size)
+            except OSError:
+                self._pos = 0
+                self._rest = None
+                continue
+            self._pos -= size
+            if self._rest is None:
+                # The line ending of the last line does not start a line.
+                if block.endswith(b"\n"):
+                    block = block[:-1]
+                self._rest = b""
+            lines = (block + self._rest).split(b"\n")
+            self._rest = lines.pop(0)
+            self._ready.extend(reversed(lines))
+            return True
+        return False
+
+    def older(self, count):
+        '''
+        Read the next older lines.
+
+        :param count: Most lines to read
+        :type count: int
+        :returns: Lines, oldest first, empty when there are no more
+        :rtype: list[str]
+        '''
+        while len(self._ready) < count and self._next_block():
+            pass
+        lines = self._ready[:count]
+        del self._ready[:count]
+        lines.reverse()
+        return [line.rstrip(b"\r").decode("utf-8", "replace")
+                for line in lines]
+
+
+# Lines timed by the soak test, one in this many
+TIME_SAMPLE = 16
+
+
+def _old_write(filename, lines):
+    '''Write lines the way LoggedTextBuffer did before.'''
+    # pylint: disable=unspecified-encoding, consider-using-with
+    handle = open(filename, "a+", 1)
+    times = []
+    for line in lines:
+        start = time.perf_counter()
+        handle.write(line)
+        times.append(time.perf_counter() - start)
+    handle.close()
+    return times
+
+
+def _percentile(times, fraction):
+    return sorted(times)[int(len(times) * fraction)] * 1e6
+
+
+# pylint wants a max of 15 local variables
+# pylint: disable=too-many-locals
+def soak(seconds, rate, logger):
+    '''
+    Soak test the chat log with a busy net.
+
+    :param seconds: Seconds to run
+    :type seconds: float
+    :param rate: Lines a second, 0 for as fast as possible
+    :type rate: int
+    :param logger: Logger for the results
+    :type logger: :class:`logging.Logger`
+    :returns: True if every line is in the logs in order
+    :rtype: bool
+    '''
+    # Only for the soak test, and not on all platforms
+    # pylint: disable=import-outside-toplevel
+    import resource
+
+    work_dir = tempfile.mkdtemp(prefix="chat_log_")
+    try:
+        log = ChatLog(os.path.join(work_dir, "Main.txt"),
+                      max_bytes=256 << 10)
+        times = []
+        count = 0
+        start = time.monotonic()
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        while time.monotonic() - start < seconds:
+            line = "%s [%08i] N0CALL: Net check in, traffic for W1AW, " \
+                "signal 5 by 9%s" % (time.strftime("%H:%M:%S"), count,
+                                     os.linesep)
+            if count % TIME_SAMPLE:
+                log.write(line)
+            else:
+                begin = time.perf_counter()
+                log.write(line)
+                times.append(time.perf_counter() - begin)
+            count += 1
+            if rate and count % rate == 0:
+                time.sleep(max(0, count / rate - (time.monotonic() - start)))
+        log.close()
+        elapsed = time.monotonic() - start
+        rss_grow = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - \
+            rss_start
+        sample = ["line %i%s" % (num, os.linesep)
+                  for num in range(min(len(times), 100000))]
+        old_times = _old_write(os.path.join(work_dir, "Old.txt"), sample)
+
+        logger.info("%i lines in %.1f s, %i rotated logs, max RSS grew "
+                    "%i KB", count, elapsed, log.rotations, rss_grow)
+        logger.info("GTK thread per line: %6.2f us p50, %7.2f us p99 "
+                    "before", _percentile(old_times, 0.5),
+                    _percentile(old_times, 0.99))
+        logger.info("GTK thread per line: %6.2f us p50, %7.2f us p99 "
+                    "now", _percentile(times, 0.5),
+                    _percentile(times, 0.99))
+
+        begin = time.perf_counter()
+        history = log.history()
+        pages = 0
+        passed = True
+        page = history.older(1000)
+        while page:
+            first = count - pages * 1000 - len(page)
+            passed = passed and all("[%08i]" % (first + num) in line
+                                    for num, line in enumerate(page))
+            pages += 1
+            page = history.older(1000)
+        passed = passed and pages * 1000 >= count
+        logger.info("Older history: %i pages of 1000 lines, %.2f ms "
+                    "a page", pages,
+                    (time.perf_counter() - begin) * 1000 / max(pages, 1))
+    finally:
+        shutil.rmtree(work_dir)
+    return passed
+
+
+def _stopped_test(logger):
+    '''Check that a log still writes once the writer is stopped.'''
+    with tempfile.TemporaryDirectory() as work_dir:
+        log = ChatLog(os.path.join(work_dir, "Main.txt"))
+        log.write("before" + os.linesep)
+        ChatLogWriter.stop_writer()
+        start = time.monotonic()
+        log.write("after" + os.linesep)
+        flushed = log.flush()
+        log.close()
+        elapsed = time.monotonic() - start
+        with open(log.filename) as handle:
+            passed = flushed and elapsed < 1 and \
+                handle.read().split() == ["before", "after"]
+    logger.info("%s: written after the writer stopped in %.3f s",
+                ("FAIL", "PASS")[passed], elapsed)
+    return passed
+
+
+def main():
+    '''Soak test the chat log.'''
+    parser = argparse.ArgumentParser(
+        prog="python -m d_rats.chat_log",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="D-RATS chat log soak test")
+    parser.add_argument("-s", "--seconds", type=float, default=30,
+                        help="Seconds to run")
+    parser.add_argument("-r", "--rate", type=int, default=0,
+                        help="Lines a second, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("ChatLog.test")
+
+    passed = soak(args.seconds, args.rate, logger)
+    passed = _stopped_test(logger) and passed
+    logger.info("%s", ("FAIL", "PASS")[passed])
+    sys.exit(not passed)
+
+
+if __name__ == "__main__":
+    main()
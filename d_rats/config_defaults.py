@@ -99,6 +99,8 @@ _DEF_PREFS = {
     "callsigns" : "%s" % str([(True, "US")]),
     "logresume" : "True",
     "scrollback" : "1024",
+    "logrotate" : "Size",
+    "logsize" : "1024",
     "restore_stations" : "True",
     "useutc" : "False",
     "country": DEFAULT_COUNTRY,
@@ -170,6 +172,8 @@ _DEF_SETTINGS = {
     "warmup_length" : "16",                # changed from 8 to 16 in 0.3.6
     "warmup_timeout" : "0",                # changed from 3 to 0 in 0.3.6
     "force_delay" : "-2",
+    "dup_cache_ttl" : "3",        # seconds, 0 disables duplicate dropping
+    "dup_cache_entries" : "4096",
     "ping_info" : "",
     "smtp_server" : "",
     "smtp_replyto" : "",
@@ -183,6 +187,9 @@ _DEF_SETTINGS = {
 
     "msg_flush" : "30",           # changed from 60 to 30sec in 0.3.6
     "msg_forward" : "True",       # changed from False to True in 0.3.6
+    "msg_port_limit" : "1",
+    "msg_batch_limit" : "25",
+    "msg_route_journal" : "False",
     "station_msg_ttl" : "600",    # changed from 3660 to 600 in 0.3.6
 
     "form_logo_dir" : os.path.join(Platform.get_platform().config_dir(),
@@ -79,6 +79,12 @@ TIPS_SETTINGS = {
     "station_msg_ttl" : _("If a station was last heard more than this many"
                           " seconds ago, do not assume you have a clear path"
                           " (ping it first)"),
+    "msg_port_limit" : _("Number of stations messages are forwarded to at"
+                         " the same time on each port"),
+    "msg_batch_limit" : _("Messages sent to one station one after the other"
+                          " before other stations get a turn on the port"),
+    "msg_route_journal" : _("Write each message routing decision to the"
+                            " message_routes log file"),
 
     "mapurlbase" :_("Path to the online map tile server used to feed the"
                     " \"base\" map - can be changed to suit what is"
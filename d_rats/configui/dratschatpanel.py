@@ -25,6 +25,7 @@ if not '_' in locals():
     import gettext
     _ = gettext.gettext
 
+from ..chat_log import ROTATE_CHOICES
 from .dratspanel import DratsPanel
 from .dratsconfigwidget import DratsConfigWidget
 
@@ -46,6 +47,14 @@ class DratsChatPanel(DratsPanel):
         val.add_bool()
         self.make_view(_("Log chat traffic"), val)
 
+        val = DratsConfigWidget(section="prefs", name="logrotate")
+        val.add_combo(list(ROTATE_CHOICES), False)
+        self.make_view(_("Start a new chat log"), val)
+
+        val = DratsConfigWidget(section="prefs", name="logsize")
+        val.add_numeric(16, 999999, 1)
+        self.make_view(_("Chat log size (KB)"), val)
+
         val = DratsConfigWidget(section="prefs", name="logresume")
         val.add_bool()
         self.make_view(_("Load log tail"), val)
@@ -65,6 +65,22 @@ class DratsMessagePanel(DratsPanel):
         self.make_view(_("Station TTL"), val, lab)
         disable_with_toggle(vala.child_widget, val.child_widget)
 
+        val = DratsConfigWidget(section="settings", name="msg_port_limit")
+        val.add_numeric(1, 16, 1)
+        self.make_view(_("Forwarding sessions per port"), val)
+        disable_with_toggle(vala.child_widget, val.child_widget)
+
+        val = DratsConfigWidget(section="settings", name="msg_batch_limit")
+        val.add_numeric(1, 999, 1)
+        lab = Gtk.Label.new(_("messages"))
+        self.make_view(_("Forwarding batch limit"), val, lab)
+        disable_with_toggle(vala.child_widget, val.child_widget)
+
+        val = DratsConfigWidget(section="settings", name="msg_route_journal")
+        val.add_bool()
+        self.make_view(_("Log routing decisions"), val)
+        disable_with_toggle(vala.child_widget, val.child_widget)
+
         val = DratsConfigWidget(section="prefs", name="msg_include_reply")
         val.add_bool()
         self.make_view(_("Include original in reply"), val)
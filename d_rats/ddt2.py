@@ -84,6 +84,9 @@ class DDT2Frame():
         self._xmit_e = 0
         self._xmit_z = 0
 
+        # Encoded form of the frame as received or first packed
+        self._packed = None
+
     def get_xmit_bps(self):
         '''
         Get Transmit bps
@@ -184,6 +187,21 @@ class DDT2Frame():
 
         return val + data
 
+    def get_packed_once(self):
+        '''
+        Get packed data, encoding the frame at most once.
+
+        A frame that was received returns the block exactly as it
+        was received.  Only use this for frames that are not modified
+        afterwards, such as frames being relayed.
+
+        :returns: packed data
+        :rtype: bytes
+        '''
+        if self._packed is None:
+            self._packed = self.get_packed()
+        return self._packed
+
     # pylint wants a max of 12 branches
     # pylint: disable=too-many-branches
     def unpack(self, val):
@@ -344,7 +362,11 @@ class DDT2EncodedFrame(DDT2Frame):
             return False
 
         decoded = decode(payload)
-        return DDT2Frame.unpack(self, decoded)
+        if not DDT2Frame.unpack(self, decoded):
+            return False
+        self._packed = bytes(val[h_index - len(ENCODED_HEADER):
+                                 t_index + len(ENCODED_TRAILER)])
+        return True
 
 
 class DDT2RawData(DDT2Frame):
@@ -377,6 +399,40 @@ class DDT2RawData(DDT2Frame):
         return self.data
 
 
+class DDT2RelayedFrame(DDT2Frame):
+    '''
+    DDT2 Relayed Frame.
+
+    Shares the encoded data of another frame, so a frame relayed to
+    several transports is only encoded once.
+
+    :param frame: Frame being relayed
+    :type frame: :class:`DDT2Frame`
+    '''
+
+    def __init__(self, frame):
+        DDT2Frame.__init__(self)
+        self.logger = logging.getLogger("DDT2RelayedFrame")
+        self.seq = frame.seq
+        self.session = frame.session
+        self.type = frame.type
+        self.s_station = frame.s_station
+        self.d_station = frame.d_station
+        self.data = frame.data
+        self.compress = frame.compress
+        self._packed = frame.get_packed_once()
+
+    def get_packed(self):
+        '''
+        Get packed frame.
+
+        :returns: Encoded data of the relayed frame
+        :rtype: bytes
+        '''
+        self._xmit_z = len(self._packed)
+        return self._packed
+
+
 def test_symmetric(logger, compress=True):
     '''
     Test Symmetric operations.
@@ -404,6 +460,27 @@ def test_symmetric(logger, compress=True):
     logger.info("fout: %s", fout)
 
 
+def test_relay(logger):
+    '''
+    Test that a relayed frame is sent exactly as received.
+
+    :param logger: Logger object
+    :type logger: :class:`logging.Logger`
+    '''
+    fin = DDT2EncodedFrame()
+    fin.s_station = "FOO"
+    fin.d_station = "BAR"
+    fin.data = b"This is a test"
+    packed_frame = fin.get_packed()
+
+    fout = DDT2EncodedFrame()
+    fout.unpack(b"junk" + packed_frame + b"junk")
+    if DDT2RelayedFrame(fout).get_packed() == packed_frame:
+        logger.info("PASS")
+    else:
+        logger.info("FAIL")
+
+
 def test_crap(logger):
     '''
     Test routine.
@@ -425,6 +502,7 @@ def main():
     logger = logging.getLogger("DDT2.test")
     test_symmetric(logger)
     test_symmetric(logger, True)
+    test_relay(logger)
     test_crap(logger)
 
 if __name__ == "__main__":
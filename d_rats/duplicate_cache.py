@@ -0,0 +1,314 @@
+#!/usr/bin/python
+'''Duplicate Cache.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import logging
+import struct
+import threading
+import time
+
+from . import ddt2
+
+# Stateful sessions ask again for an ACK after 4 seconds, and that
+# request is identical to the first one, so the default time to live
+# must stay below that.
+DEFAULT_TTL = 3.0
+DEFAULT_ENTRIES = 4096
+HEADER_LENGTH = struct.calcsize(ddt2.DDT2Frame.format)
+
+
+class DuplicateCache:
+    '''
+    Duplicate Cache.
+
+    Remembers the frames seen in the last few seconds so that copies
+    arriving again through a loop of repeaters or digipeaters can be
+    dropped before they are decompressed and dispatched.
+
+    A received block is keyed on the source station, session, sequence
+    and type from its header plus a digest of its payload.  Only the
+    yencoding is undone to get these, the payload is not decompressed.
+
+    Stateless sessions such as chat and ping send every frame with
+    sequence 0, so a station repeating the same short message looks
+    like a duplicate.  With stateless set to False those frames are
+    never dropped, which is what a station wants.  A repeater keeps the
+    default so chat frames flooded around a loop are still dropped.
+
+    Safe to use from several threads.
+
+    :param ttl: Seconds a frame is remembered, default 3
+    :type ttl: float
+    :param max_entries: Most frames remembered, default 4096
+    :type max_entries: int
+    :param stateless: Also drop duplicate sequence 0 frames, default True
+    :type stateless: bool
+    '''
+
+    logger = logging.getLogger("DuplicateCache")
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_ENTRIES,
+                 stateless=True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stateless = stateless
+        self.checked = 0
+        self.suppressed = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _seen(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            # Entries are in the order they were added, which is also
+            # the order they expire in.
+            entries = self._entries
+            while entries:
+                oldest_key, expires = next(iter(entries.items()))
+                if expires > now and len(entries) < self.max_entries:
+                    break
+                del entries[oldest_key]
+            if key in entries:
+                self.suppressed += 1
+                return True
+            entries[key] = now + self.ttl
+            return False
+
+    @staticmethod
+    def block_key(block):
+        '''
+        Get the cache key of an encoded block.
+
+        :param block: Block as received, from header to trailer
+        :type block: bytes
+        :returns: Source, session, sequence, type and payload digest,
+                  or None if the block can not be decoded
+        :rtype: tuple
+        '''
+        start = len(ddt2.ENCODED_HEADER)
+        end = len(block) - len(ddt2.ENCODED_TRAILER)
+        raw = ddt2.decode(block[start:end])
+        if len(raw) < HEADER_LENGTH:
+            return None
+        (_magic, seq, session, frame_type, _checksum, _length,
+         s_station, _d_station) = struct.unpack(ddt2.DDT2Frame.format,
+                                               raw[:HEADER_LENGTH])
+        digest = hashlib.sha1(raw[HEADER_LENGTH:]).digest()
+        return (s_station, session, seq, frame_type, digest)
+
+    def seen_block(self, block):
+        '''
+        Check and remember an encoded block.
+
+        Blocks that can not be decoded, and sequence 0 blocks when
+        stateless is False, are never reported as seen.
+
+        :param block: Block as received, from header to trailer
+        :type block: bytes
+        :returns: True if the block was seen within the time to live
+        :rtype: bool
+        '''
+        try:
+            key = self.block_key(bytes(block))
+        except (ValueError, struct.error):
+            key = None
+        if key is None or (key[2] == 0 and not self.stateless):
+            return False
+        return self._seen(key)
+
+    def get_stats(self):
+        '''
+        Get statistics.
+
+        :returns: Frames checked, suppressed and currently remembered
+        :rtype: dict
+        '''
+        return {"checked": self.checked,
+                "suppressed": self.suppressed,
+                "entries": len(self._entries)}
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class _LoopRepeater:
+    '''
+    Simulated repeater for the loop test.
+
+    :param name: Repeater name
+    :type name: str
+    :param dup_cache: Duplicate cache or None
+    :type dup_cache: :class:`DuplicateCache`
+    '''
+
+    def __init__(self, name, dup_cache):
+        self.name = name
+        self.dup_cache = dup_cache
+        self.links = []
+        self.relayed = 0
+
+    def receive(self, block, from_link, pending):
+        '''
+        Receive a block and flood it to all other links.
+
+        :param block: Encoded block
+        :type block: bytes
+        :param from_link: Repeater the block came from, or None
+        :type from_link: :class:`_LoopRepeater`
+        :param pending: Queue of deliveries still in flight
+        :type pending: :class:`collections.deque`
+        '''
+        if self.dup_cache is not None and self.dup_cache.seen_block(block):
+            return
+        self.relayed += 1
+        for link in self.links:
+            if link is not from_link:
+                pending.append((link, block, self))
+
+
+def make_block(data, seq=1, session=2):
+    '''
+    Make an encoded block for testing.
+
+    :param data: Payload
+    :type data: bytes
+    :param seq: Sequence number, default 1
+    :type seq: int
+    :param session: Session number, default 2
+    :type session: int
+    :returns: Encoded block
+    :rtype: bytes
+    '''
+    frame = ddt2.DDT2EncodedFrame()
+    frame.s_station = "K1ABC"
+    frame.d_station = "CQCQCQ"
+    frame.seq = seq
+    frame.session = session
+    frame.data = data
+    return frame.get_packed()
+
+
+def loop_test(logger, use_cache, hop_limit=300):
+    '''
+    Simulate three repeaters linked in a loop.
+
+    :param logger: Logger object
+    :type logger: :class:`logging.Logger`
+    :param use_cache: True to give each repeater a duplicate cache
+    :type use_cache: bool
+    :param hop_limit: Deliveries after which the test gives up
+    :type hop_limit: int
+    :returns: Total number of times the frame was relayed
+    :rtype: int
+    '''
+    repeaters = [_LoopRepeater(name, DuplicateCache() if use_cache else None)
+                 for name in ("A", "B", "C")]
+    rpt_a, rpt_b, rpt_c = repeaters
+    rpt_a.links = [rpt_b, rpt_c]
+    rpt_b.links = [rpt_a, rpt_c]
+    rpt_c.links = [rpt_a, rpt_b]
+
+    block = make_block(b"loop test frame")
+    pending = collections.deque([(rpt_a, block, None)])
+    hops = 0
+    while pending and hops < hop_limit:
+        link, data, from_link = pending.popleft()
+        link.receive(data, from_link, pending)
+        hops += 1
+
+    relayed = sum(rpt.relayed for rpt in repeaters)
+    suppressed = sum(rpt.dup_cache.suppressed for rpt in repeaters
+                     if rpt.dup_cache is not None)
+    logger.info("cache %s: %i relays, %i suppressed, %i still in flight",
+                use_cache, relayed, suppressed, len(pending))
+    return relayed
+
+
+def key_test(logger):
+    '''
+    Test what the cache treats as a duplicate.
+
+    :param logger: Logger object
+    :type logger: :class:`logging.Logger`
+    '''
+    cache = DuplicateCache()
+    # Same payload but a different sequence is not a duplicate.
+    cache.seen_block(make_block(b"data", seq=1))
+    if not cache.seen_block(make_block(b"data", seq=2)) and \
+            cache.seen_block(make_block(b"data", seq=1)):
+        logger.info("PASS: key")
+    else:
+        logger.info("FAIL: key")
+
+    station = DuplicateCache(stateless=False)
+    chat = make_block(b"73", seq=0, session=1)
+    station.seen_block(chat)
+    if not station.seen_block(chat) and \
+            not station.seen_block(b"[SOB]broken[EOB]"):
+        logger.info("PASS: stateless")
+    else:
+        logger.info("FAIL: stateless")
+
+
+def main():
+    '''Unit test for module.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("DuplicateCache.test")
+
+    # Without a cache the frame circulates until the hop limit.
+    if loop_test(logger, False) < 300:
+        logger.info("FAIL: loop did not circulate")
+    # With a cache each repeater relays the frame exactly once.
+    if loop_test(logger, True) == 3:
+        logger.info("PASS: loop")
+    else:
+        logger.info("FAIL: loop")
+
+    cache = DuplicateCache(ttl=0.1, max_entries=100)
+    for i in range(1000):
+        cache.seen_block(make_block(b"block %i" % i))
+    if len(cache) <= 100 and not cache.seen_block(make_block(b"block 0")):
+        logger.info("PASS: size limit")
+    else:
+        logger.info("FAIL: size limit")
+
+    again = make_block(b"again")
+    cache.seen_block(again)
+    time.sleep(0.2)
+    if not cache.seen_block(again):
+        logger.info("PASS: time to live")
+    else:
+        logger.info("FAIL: time to live")
+
+    key_test(logger)
+
+    blocks = [make_block(b"%i benchmark block" % i) for i in range(50)]
+    count = 100000
+    start = time.perf_counter()
+    for i in range(count):
+        cache.seen_block(blocks[i % 50])
+    elapsed = time.perf_counter() - start
+    logger.info("%.2f usec per check, %s", elapsed * 1000000 / count,
+                cache.get_stats())
+
+
+if __name__ == "__main__":
+    main()
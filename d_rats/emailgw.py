@@ -16,15 +16,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import logging
 import os
 import threading
-import poplib
 import re
 import random
 import time
 
-import email
 from email.utils import parseaddr
 
 import gi
@@ -38,6 +37,11 @@ from .ui import main_events
 from . import signals
 from . import utils
 from . import msgrouting
+from .mail_fetch import FETCH_ERRORS
+from .mail_fetch import MailAccount
+from .mail_fetch import MailFetchError
+from .mail_fetch import MailPoller
+from .mail_fetch import fetch_account
 
 
 if not '_' in locals():
@@ -115,10 +119,10 @@ def create_form_from_mail(config, mail, tmpfn):
         logger.info("AIEE: Unable to lock incoming email message file!")
 
     if xml:
-        file_handle = open(tmpfn, "w")
-        file_handle.write(xml)
-        file_handle.close()
+        with open(tmpfn, "w") as file_handle:
+            file_handle.write(xml)
         form = formgui.FormFile(tmpfn)
+        form.externalize_attachments()
         recip = form.get_recipient_string()
         if "%" in recip:
             recip, _addr = recip.split("%", 1)
@@ -153,7 +157,7 @@ class MailThread(threading.Thread, GObject.GObject):
 
     :param config: Config object
     :type config: :class:`DratsConfig`
-    :param host: Email host
+    :param host: Email host, "imap://" in front selects IMAP
     :type host: str
     :param user: User account
     :type user: str
@@ -163,6 +167,7 @@ class MailThread(threading.Thread, GObject.GObject):
     :type port: int
     :param ssl: Use ssl, default False
     :type ssl: bool
+    :raises: :class:`mail_fetch.MailFetchError` for an unknown protocol
     '''
 
     __gsignals__ = {
@@ -186,11 +191,10 @@ class MailThread(threading.Thread, GObject.GObject):
         self.logger = logging.getLogger("MailThread")
         self.daemon = True
 
+        self.account = MailAccount(host, user, pasw, port, ssl)
         self.username = user
-        self.password = pasw
-        self.server = host
-        self.port = port
-        self.use_ssl = ssl
+        self.server = self.account.host
+        self.port = self.account.port
 
         self.config = config
 
@@ -243,65 +247,45 @@ class MailThread(threading.Thread, GObject.GObject):
 
         self._emit("form-received", -999, ffn)
 
-    def fetch_mails(self):
+    def fetch_mails(self, handler):
         '''
         Fetch mails.
 
-        :returns: List of messages
-        :rtype: list[:class:`EmailMessage`]
-        '''
-        self.message("Querying %s:%i" % (self.server, self.port))
-
-        if self.use_ssl:
-            server = poplib.POP3_SSL(self.server, self.port)
-        else:
-            server = poplib.POP3(self.server, self.port)
-
-        server.user(self.username)
-        server.pass_(self.password)
+        Only the messages not fetched before are read, each one is
+        passed to the handler as soon as it arrives.
 
-        num = len(server.list()[1])
-
-        messages = []
-
-        for i in range(num):
-            self.message("Fetching %i/%i" % (i+1, num))
-            result = server.retr(i+1)
-            message = email.message_from_bytes(b"\r\n".join(result[1]))
-            messages.append(message)
-            server.dele(i+1)
-
-        server.quit()
-
-        return messages
+        :param handler: Function taking each message
+        :type handler: function(:class:`EmailMessage`)
+        :returns: Number of messages
+        :rtype: int
+        '''
+        self.message("Querying %s" % self.account)
+        return fetch_account(self.account, handler)
 
     def run(self):
         self.message("One-shot thread starting")
-        mails = None
+        count = None
 
         if not self.config.getboolean("state", "connected_inet"):
             result = "Not connected to the Internet"
         else:
             try:
-                mails = self.fetch_mails()
-            except (poplib.error_proto, ConnectionError, OSError) as err:
+                count = self.fetch_mails(self.create_form_from_mail)
+            except FETCH_ERRORS as err:
                 result = "Failed (%s)" % (err)
 
-            if mails:
-                for mail in mails:
-                    self.create_form_from_mail(mail)
+            if count:
                 event = main_events.Event(None,
-                                          _("Received %i messages") % \
-                                          len(mails))
+                                          _("Received %i messages") % count)
                 self._emit("event", event)
 
-                result = "Queued %i messages" % len(mails)
-            elif mails is not None:
+                result = "Queued %i messages" % count
+            elif count is not None:
                 result = "No messages"
 
         self.message("Thread ended [ %s ]" % result)
 
-        self._emit("mail-thread-complete", mails is not None, result)
+        self._emit("mail-thread-complete", count is not None, result)
 
 
 class CoercedMailThread(MailThread):
@@ -369,17 +353,18 @@ class AccountMailThread(MailThread):
                                          (action, user, host))
 
         ssl = ssl == "True"
-        if not port:
-            port = 995 if ssl else 110
-        else:
-            port = int(port)
+        # Without a port the default one for the protocol is used
+        port = int(port) if port else None
 
         self._poll = int(poll)
-
-        self.event = threading.Event()
+        self._account_name = account
         self.enabled = enb == "True"
 
-        MailThread.__init__(self, config, host, user, pasw, port, ssl)
+        try:
+            MailThread.__init__(self, config, host, user, pasw, port, ssl)
+        except MailFetchError as err:
+            raise BadAccountSettingsError("%s for `%s'" %
+                                          (err, account)) from err
         self.logger = logging.getLogger("AccountMailThread")
 
     def do_chat_from_mail(self, mail):
@@ -421,17 +406,15 @@ class AccountMailThread(MailThread):
         # Removing the connection check as it was always failing,
         # need to sort the scope of the variable
         # if self.config.getboolean("state", "connected_inet"):
-        mails = []
+        count = 0
         try:
-            mails = self.fetch_mails()
-        except (poplib.error_proto, ConnectionError, OSError) as err:
+            count = self.fetch_mails(self.__action)
+        except FETCH_ERRORS as err:
             self.message("Failed to retrieve messages: %s" % err)
-        for mail in mails:
-            self.__action(mail)
-            if mails:
-                event = main_events.Event(None,
-                                          "Received %i email(s)" % len(mails))
-                self._emit("event", event)
+        if count:
+            event = main_events.Event(None,
+                                      "Received %i email(s)" % count)
+            self._emit("event", event)
         # else:
         #     self.message("Not connected")
 
@@ -440,6 +423,10 @@ class PeriodicAccountMailThread(AccountMailThread):
     '''
     Periodic Account Mail Thread.
 
+    Starting it adds the account to the shared :class:`MailPoller`,
+    which fetches the mail in its worker threads.  An IMAP account
+    is also fetched as soon as the server reports new mail.
+
     :param config: Config object
     :type config: :class:`DratsConfig`
     :param account: Account name
@@ -454,25 +441,26 @@ class PeriodicAccountMailThread(AccountMailThread):
         AccountMailThread.__init__(self, config, account)
         self.logger = logging.getLogger("PeriodicAccountMailThread")
 
-    def run(self):
-        '''Run periodic thread.'''
-        self.message("Periodic thread starting")
-
-        while self.enabled:
-            AccountMailThread.run(self)
-            self.event.wait(self._poll * 60)
-            self.event.clear()
-
-        self.message("Thread ending")
+    def start(self):
+        '''Start polling the account.'''
+        if not self.enabled:
+            return
+        self.message("Periodic polling starting")
+        MailPoller.get_poller().add(self._account_name,
+                                    functools.partial(AccountMailThread.run,
+                                                      self),
+                                    self._poll * 60,
+                                    idle_account=self.account)
 
     def trigger(self):
         '''Trigger.'''
-        self.event.set()
+        MailPoller.get_poller().trigger(self._account_name)
 
     def stop(self):
         '''Stop.'''
         self.enabled = False
-        self.trigger()
+        MailPoller.get_poller().remove(self._account_name)
+        self.message("Periodic polling ended")
 
 
 def __validate_access(config, callsign, emailaddr, types):
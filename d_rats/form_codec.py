@@ -0,0 +1,358 @@
+#!/usr/bin/python
+'''Form Codec.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import logging
+import os
+import zlib
+
+from lxml import etree
+
+from .form_registry import HASH_SIZE
+from .form_registry import FormRegistry
+
+# Start of a template-diff encoded form.  A zlib stream never starts
+# with it, so a receiver can tell the two encodings apart.
+MAGIC = b"DTF\x01"
+
+# Record types of the encoding
+T_TITLE = 1
+T_FIELD = 2
+T_SET = 3
+T_PATH = 4
+T_ATT = 5
+
+# Values of the set attribute of an entry and its choices
+_SET_STATES = (None, "y", "n")
+
+# Inlined attachments can be larger than libxml2 allows by default.
+_HUGE_PARSER = etree.XMLParser(huge_tree=True)
+
+
+class FormCodecError(Exception):
+    '''Form can not be decoded Exception.'''
+
+
+def _put_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise FormCodecError("Truncated form data")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _put_bytes(out, data):
+    _put_varint(out, len(data))
+    out += data
+
+
+def _get_bytes(data, pos):
+    size, pos = _get_varint(data, pos)
+    if pos + size > len(data):
+        raise FormCodecError("Truncated form data")
+    return data[pos:pos + size], pos + size
+
+
+def _put_record(out, rec_type, payload):
+    out.append(rec_type)
+    _put_bytes(out, payload)
+
+
+def _form_element(root):
+    return root if root.tag == "form" else root.find("form")
+
+
+def _set_states(entry):
+    '''
+    Get the set attribute of an entry and its choices.
+
+    :returns: Index in _SET_STATES for each, or None for another value
+    :rtype: bytes
+    '''
+    states = bytearray()
+    for node in [entry] + entry.findall("choice"):
+        value = node.get("set", None)
+        if value not in _SET_STATES:
+            return None
+        states.append(_SET_STATES.index(value))
+    return bytes(states)
+
+
+def _encode_path(path):
+    payload = bytearray()
+    for child in path:
+        _put_bytes(payload, child.tag.encode("utf-8"))
+        _put_bytes(payload, (child.text or "").encode("utf-8"))
+    return payload
+
+
+def _encode_att(att):
+    payload = bytearray()
+    _put_bytes(payload, att.get("name", "").encode("utf-8"))
+    try:
+        payload += base64.b64decode(att.text or "", validate=True)
+    except binascii.Error:
+        return None
+    return payload
+
+
+# pylint wants a max of 12 branches
+# pylint: disable=too-many-branches
+def _encode_records(form, t_form, out):
+    '''
+    Encode how a form differs from its template.
+
+    :returns: False if the form has something that can not be encoded
+    :rtype: bool
+    '''
+    t_children = list(t_form)
+    children = list(form)
+    if len(children) < len(t_children):
+        return False
+    index = 0
+    for t_child, child in zip(t_children, children):
+        if child.tag != t_child.tag:
+            return False
+        if child.tag == "title" and child.text != t_child.text:
+            _put_record(out, T_TITLE, (child.text or "").encode("utf-8"))
+        elif child.tag == "field":
+            entry = child.find("entry")
+            t_entry = t_child.find("entry")
+            if entry is not None and t_entry is not None:
+                if entry.text != t_entry.text:
+                    payload = bytearray()
+                    _put_varint(payload, index)
+                    payload += (entry.text or "").encode("utf-8")
+                    _put_record(out, T_FIELD, payload)
+                states = _set_states(entry)
+                if states is None:
+                    return False
+                if states != _set_states(t_entry):
+                    payload = bytearray()
+                    _put_varint(payload, index)
+                    payload += states
+                    _put_record(out, T_SET, payload)
+            index += 1
+    for child in children[len(t_children):]:
+        if child.tag == "path":
+            _put_record(out, T_PATH, _encode_path(child))
+        elif child.tag == "att":
+            payload = _encode_att(child)
+            if payload is None:
+                return False
+            _put_record(out, T_ATT, payload)
+        else:
+            return False
+    return True
+
+
+# pylint wants a max of 6 return statements
+# pylint: disable=too-many-return-statements
+def encode_form(data, templates, accept=None):
+    '''
+    Encode a form as the differences from its template.
+
+    Only the form id, the template hash, and what the form changed or
+    added are sent: field values, choices, the path and attachments.
+    The encoding is checked by decoding it again.
+
+    :param data: Form XML, with the attachments inlined
+    :type data: bytes
+    :param templates: Form templates
+    :type templates: :class:`FormRegistry`
+    :param accept: Template hashes the receiver has, default any
+    :type accept: set[bytes]
+    :returns: Encoded form, or None if the form must be sent as XML
+    :rtype: bytes
+    '''
+    try:
+        root = etree.fromstring(data, _HUGE_PARSER)
+    except etree.XMLSyntaxError:
+        return None
+    form = _form_element(root)
+    if form is None:
+        return None
+    template = templates.by_id(form.get("id", ""))
+    if template is None or (accept is not None and
+                            template.key not in accept):
+        return None
+
+    out = bytearray(MAGIC)
+    _put_bytes(out, template.form_id.encode("utf-8"))
+    out += template.key
+    if not _encode_records(form, _form_element(template.root), out):
+        return None
+    out = bytes(out)
+    try:
+        if decode_form(out, templates) != etree.tostring(root):
+            return None
+    except FormCodecError:
+        return None
+    return out
+
+
+def _apply_record(form, fields, rec_type, payload):
+    '''Apply one record to the copy of the template.'''
+    if rec_type == T_TITLE:
+        form.find("title").text = payload.decode("utf-8")
+    elif rec_type in (T_FIELD, T_SET):
+        index, pos = _get_varint(payload, 0)
+        if index >= len(fields) or fields[index] is None:
+            raise FormCodecError("No field %i in template" % index)
+        entry = fields[index]
+        if rec_type == T_FIELD:
+            entry.text = payload[pos:].decode("utf-8")
+            return
+        nodes = [entry] + entry.findall("choice")
+        if len(nodes) != len(payload) - pos:
+            raise FormCodecError("Choices do not match template")
+        for node, state in zip(nodes, payload[pos:]):
+            if state >= len(_SET_STATES):
+                raise FormCodecError("Choice state %i not valid" % state)
+            if _SET_STATES[state] is None:
+                node.attrib.pop("set", None)
+            else:
+                node.set("set", _SET_STATES[state])
+    elif rec_type == T_PATH:
+        path = etree.SubElement(form, "path")
+        pos = 0
+        while pos < len(payload):
+            tag, pos = _get_bytes(payload, pos)
+            text, pos = _get_bytes(payload, pos)
+            etree.SubElement(path, tag.decode("utf-8")).text = \
+                text.decode("utf-8")
+    elif rec_type == T_ATT:
+        name, pos = _get_bytes(payload, 0)
+        att = etree.SubElement(form, "att", name=name.decode("utf-8"))
+        att.text = base64.b64encode(payload[pos:]).decode("ascii")
+    else:
+        raise FormCodecError("Unknown record type %i" % rec_type)
+
+
+def decode_form(data, templates):
+    '''
+    Rebuild a form from its template.
+
+    :param data: Encoded form
+    :type data: bytes
+    :param templates: Form templates
+    :type templates: :class:`FormRegistry`
+    :returns: Form XML
+    :rtype: bytes
+    :raises: :class:`FormCodecError` if the form can not be rebuilt
+    '''
+    if not data.startswith(MAGIC):
+        raise FormCodecError("Not a template encoded form")
+    form_id, pos = _get_bytes(data, len(MAGIC))
+    key = data[pos:pos + HASH_SIZE]
+    pos += HASH_SIZE
+    template = templates.by_key(key)
+    if template is None or template.form_id != form_id.decode("utf-8"):
+        raise FormCodecError("No template %s version %s" %
+                             (form_id.decode("utf-8", "replace"), key.hex()))
+    root, form = template.new_form()
+    fields = [field.find("entry") for field in form.iterfind("field")]
+    try:
+        while pos < len(data):
+            rec_type = data[pos]
+            payload, pos = _get_bytes(data, pos + 1)
+            _apply_record(form, fields, rec_type, payload)
+    except (UnicodeDecodeError, ValueError, AttributeError) as err:
+        raise FormCodecError("Form %s is not valid! (%s)" %
+                             (template.form_id, err)) from err
+    return etree.tostring(root)
+
+
+def _fill_form(template, num):
+    '''Fill in a copy of a template like a station would.'''
+    root, form = template.new_form()
+    for field in form.iterfind("field"):
+        entry = field.find("entry")
+        if entry is None:
+            continue
+        choices = entry.findall("choice")
+        if entry.get("type") == "multiselect":
+            for pos, choice in enumerate(choices):
+                choice.set("set", "y" if (pos + num) % 3 == 0 else "n")
+        elif choices:
+            choices[num % len(choices)].set("set", "y")
+        elif entry.get("type") == "multiline":
+            entry.text = "Shelter at the high school is open, water and " \
+                "cots needed for %i people.\nRoad north is closed." % num
+        elif entry.get("type") not in ("label", "toggle"):
+            entry.text = "%s %i" % (field.get("id"), num)
+    path = etree.SubElement(form, "path")
+    for tag, text in (("src", "N0CALL"), ("dst", "W1AW"),
+                      ("mid", "N0CALL.%i" % num), ("e", "N0CALL"),
+                      ("e", "K1ABC")):
+        etree.SubElement(path, tag).text = text
+    return etree.tostring(root)
+
+
+def main():
+    '''Unit test and bytes on air for the bundled forms.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("FormCodec.test")
+
+    templates = FormRegistry(os.path.join(os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))), "forms"))
+    passed = True
+    total_xml = total_diff = 0
+    for key in templates.keys():
+        template = templates.by_key(key)
+        data = _fill_form(template, 7)
+        encoded = encode_form(data, templates)
+        if encoded is None:
+            logger.info("FAIL: %s can not be encoded", template.form_id)
+            passed = False
+            continue
+        passed = passed and decode_form(encoded, templates) == data
+        xml_size = len(zlib.compress(data, 9))
+        diff_size = len(zlib.compress(encoded, 9))
+        total_xml += xml_size
+        total_diff += diff_size
+        logger.info("%-22s %6i bytes as XML, %5i as template diff (%3i%%)",
+                    template.form_id, xml_size, diff_size,
+                    diff_size * 100 // xml_size)
+    logger.info("%-22s %6i bytes as XML, %5i as template diff (%3i%%)",
+                "total", total_xml, total_diff, total_diff * 100 // total_xml)
+
+    # Not the receiver's version of the template, or not a template
+    data = _fill_form(templates.by_id("email"), 1)
+    if encode_form(data, templates, accept=set()) is not None or \
+            encode_form(data.replace(b"<path>", b"<extra/><path>"),
+                        templates) is not None:
+        passed = False
+    logger.info("%s", ("FAIL", "PASS")[passed])
+
+
+if __name__ == "__main__":
+    main()
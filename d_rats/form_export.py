@@ -0,0 +1,348 @@
+#!/usr/bin/python
+'''Form Export.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+# Forms handed to a worker process at a time
+EXPORT_CHUNK = 32
+
+# Fewer forms than this are exported without starting worker processes
+POOL_MINIMUM = 64
+
+# Added to the head of the printable pages, for printing or converting
+# to PDF from a browser.
+PRINT_STYLE = '''
+@page { size: auto; margin: 15mm; }
+body { -webkit-print-color-adjust: exact; print-color-adjust: exact; }
+table, tr, img { page-break-inside: avoid; }
+'''
+
+# Inlined attachments can be larger than libxml2 allows by default.
+_HUGE_PARSER = etree.XMLParser(huge_tree=True)
+
+
+class FormExportError(Exception):
+    '''Form Export Exception.'''
+
+
+def stylesheet_path(form_type, xsl_dir):
+    '''
+    Stylesheet Path.
+
+    :param form_type: String for type of form
+    :type form_type: str
+    :param xsl_dir: Directory path for xsl file
+    :type xsl_dir: str
+    :returns: Stylesheet for the form type, or the default stylesheet
+    :rtype: str
+    '''
+    xslpath = os.path.join(xsl_dir, "%s.xsl" % form_type)
+    if not os.path.exists(xslpath):
+        xslpath = os.path.join(xsl_dir, "default.xsl")
+    return xslpath
+
+
+class XsltCache:
+    '''
+    XSLT Cache.
+
+    Keeps each stylesheet compiled, with the modification time and
+    size of its file.  A stylesheet is compiled again when the file
+    changes.
+
+    Safe to use from several threads, a compiled stylesheet runs one
+    transform at a time.
+    '''
+
+    logger = logging.getLogger("XsltCache")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stylesheets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stylesheets)
+
+    def _get(self, xslpath):
+        '''
+        Get a compiled stylesheet.
+
+        :param xslpath: Stylesheet filename
+        :type xslpath: str
+        :returns: Stylesheet and the lock for running it
+        :rtype: tuple[:class:`etree.XSLT`, :class:`threading.Lock`]
+        :raises: :class:`FormExportError` if the stylesheet is not valid
+        :raises: :class:`OSError` if the stylesheet can not be read
+        '''
+        path = os.path.abspath(xslpath)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._stylesheets.get(path, None)
+            if cached and cached[0] == key:
+                self.hits += 1
+                return cached[1], cached[2]
+        try:
+            style_sheet = etree.XSLT(etree.parse(path))
+        except (etree.XMLSyntaxError, etree.XSLTParseError) as err:
+            raise FormExportError("Stylesheet %s is not valid! (%s)" %
+                                  (xslpath, err)) from err
+        self.logger.info("_get: Compiled %s", xslpath)
+        with self._lock:
+            self.misses += 1
+            self._stylesheets[path] = (key, style_sheet, threading.Lock())
+            return style_sheet, self._stylesheets[path][2]
+
+    def transform(self, xslpath, doc):
+        '''
+        Transform a document.
+
+        :param xslpath: Stylesheet filename
+        :type xslpath: str
+        :param doc: Form document
+        :type doc: :class:`etree._ElementTree`
+        :returns: Transformed document
+        :rtype: :class:`etree._XSLTResultTree`
+        :raises: :class:`FormExportError` if the stylesheet is not valid
+        :raises: :class:`OSError` if the stylesheet can not be read
+        '''
+        style_sheet, lock = self._get(xslpath)
+        with lock:
+            return style_sheet(doc)
+
+    def clear(self):
+        '''Drop all of the stylesheets.'''
+        with self._lock:
+            self._stylesheets.clear()
+
+
+# Stylesheets of the forms written by HTMLFormWriter and export_folder
+XSLT_CACHE = XsltCache()
+
+
+def add_print_style(result):
+    '''
+    Add the print style to the head of a transformed form.
+
+    :param result: Transformed form
+    :type result: :class:`etree._XSLTResultTree`
+    '''
+    root = result.getroot()
+    if root is None:
+        return
+    head = root.find("head")
+    if head is None:
+        head = etree.Element("head")
+        root.insert(0, head)
+    style = etree.SubElement(head, "style", type="text/css", media="print")
+    style.text = PRINT_STYLE
+
+
+def export_form(filename, out_dir, xsl_dir, printable=False):
+    '''
+    Export a form file to HTML.
+
+    :param filename: Form filename
+    :type filename: str
+    :param out_dir: Directory to write the HTML file in
+    :type out_dir: str
+    :param xsl_dir: Directory path for xsl files
+    :type xsl_dir: str
+    :param printable: Add the print style, default False
+    :type printable: bool
+    :returns: HTML filename
+    :rtype: str
+    :raises: :class:`FormExportError` if the form or stylesheet is not valid
+    :raises: :class:`OSError` if a file can not be read or written
+    '''
+    try:
+        doc = etree.parse(filename, _HUGE_PARSER)
+    except etree.XMLSyntaxError as err:
+        raise FormExportError("Form file %s is not valid! (%s)" %
+                              (filename, err)) from err
+    forms = doc.xpath("//form")
+    if len(forms) != 1:
+        raise FormExportError("%i forms in %s" % (len(forms), filename))
+
+    result = XSLT_CACHE.transform(
+        stylesheet_path(forms[0].get("id", "default"), xsl_dir), doc)
+    if printable:
+        add_print_style(result)
+
+    base = os.path.splitext(os.path.basename(filename))[0]
+    outfile = os.path.join(out_dir, base + ".html")
+    result.write(outfile, pretty_print=True)
+    return outfile
+
+
+def _export_chunk(filenames, out_dir, xsl_dir, printable):
+    '''
+    Export forms in a worker process.
+
+    :param filenames: Form filenames
+    :type filenames: list[str]
+    :param out_dir: Directory to write the HTML files in
+    :type out_dir: str
+    :param xsl_dir: Directory path for xsl files
+    :type xsl_dir: str
+    :param printable: Add the print style
+    :type printable: bool
+    :returns: HTML filenames, and the errors of the forms that failed
+    :rtype: tuple[list[str], list[str]]
+    '''
+    written = []
+    errors = []
+    for filename in filenames:
+        try:
+            written.append(export_form(filename, out_dir, xsl_dir, printable))
+        except (FormExportError, OSError) as err:
+            errors.append(str(err))
+    return written, errors
+
+
+# pylint wants a max of 5 arguments
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def export_folder(folder, out_dir, xsl_dir, printable=False,
+                  processes=None, logger=None):
+    '''
+    Export the forms in a folder to HTML.
+
+    The forms are split between worker processes, each compiling the
+    stylesheets once.
+
+    :param folder: Folder with the form files
+    :type folder: str
+    :param out_dir: Directory to write the HTML files in
+    :type out_dir: str
+    :param xsl_dir: Directory path for xsl files
+    :type xsl_dir: str
+    :param printable: Add the print style, default False
+    :type printable: bool
+    :param processes: Number of worker processes, default the CPU count.
+                      With 1 the forms are exported in this process.
+    :type processes: int
+    :param logger: Logger for the forms that failed, default module logger
+    :type logger: :class:`logging.Logger`
+    :returns: HTML filenames
+    :rtype: list[str]
+    '''
+    logger = logger or logging.getLogger("FormExport")
+    os.makedirs(out_dir, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(folder, "*.xml")))
+    chunks = [files[start:start + EXPORT_CHUNK]
+              for start in range(0, len(files), EXPORT_CHUNK)]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(files) < POOL_MINIMUM:
+        results = [_export_chunk(chunk, out_dir, xsl_dir, printable)
+                   for chunk in chunks]
+    else:
+        count = len(chunks)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_export_chunk, chunks,
+                                    [out_dir] * count, [xsl_dir] * count,
+                                    [printable] * count))
+
+    written = []
+    for chunk_written, errors in results:
+        written.extend(chunk_written)
+        for error in errors:
+            logger.info("export_folder: %s", error)
+    return written
+
+
+def _bench_forms(form_dir, xsl_dir, count):
+    '''Write count forms, copied from the form templates.'''
+    templates = sorted(glob.glob(os.path.join(xsl_dir, "*.xml")))
+    for num in range(count):
+        shutil.copy(templates[num % len(templates)],
+                    os.path.join(form_dir, "form%04i.xml" % num))
+    return len(templates)
+
+
+def _export_uncached(folder, out_dir, xsl_dir):
+    '''Export compiling the stylesheet for each form, as before the cache.'''
+    for filename in sorted(glob.glob(os.path.join(folder, "*.xml"))):
+        doc = etree.parse(filename, _HUGE_PARSER)
+        xslpath = stylesheet_path(doc.xpath("//form")[0].get("id"), xsl_dir)
+        result = etree.XSLT(etree.parse(xslpath))(doc)
+        base = os.path.splitext(os.path.basename(filename))[0]
+        result.write(os.path.join(out_dir, base + ".html"), pretty_print=True)
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Unit test and benchmark exporting 1000 forms.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("FormExport.test")
+    logging.getLogger("XsltCache").setLevel(logging.WARNING)
+
+    xsl_dir = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "forms")
+    with tempfile.TemporaryDirectory() as work_dir:
+        form_dir = os.path.join(work_dir, "forms")
+        os.mkdir(form_dir)
+        templates = _bench_forms(form_dir, xsl_dir, 1000)
+
+        old_dir = os.path.join(work_dir, "old")
+        os.mkdir(old_dir)
+        start = time.perf_counter()
+        _export_uncached(form_dir, old_dir, xsl_dir)
+        logger.info("uncached:        %6.2f s", time.perf_counter() - start)
+
+        new_dir = os.path.join(work_dir, "new")
+        start = time.perf_counter()
+        written = export_folder(form_dir, new_dir, xsl_dir, processes=1)
+        logger.info("cached:          %6.2f s", time.perf_counter() - start)
+
+        same = len(written) == 1000
+        for filename in written:
+            with open(filename, "rb") as new, \
+                    open(os.path.join(old_dir, os.path.basename(filename)),
+                         "rb") as old:
+                same = same and new.read() == old.read()
+        logger.info("%s: same HTML as uncached, %i stylesheets compiled "
+                    "for %i templates", ("FAIL", "PASS")[same],
+                    XSLT_CACHE.misses, templates)
+
+        pool_dir = os.path.join(work_dir, "pool")
+        start = time.perf_counter()
+        written = export_folder(form_dir, pool_dir, xsl_dir, printable=True)
+        logger.info("printable, pool: %6.2f s with %i processes",
+                    time.perf_counter() - start, os.cpu_count() or 1)
+        with open(written[0], "rb") as handle:
+            printable = b"@page" in handle.read()
+        logger.info("%s: %i printable pages",
+                    ("FAIL", "PASS")[printable and len(written) == 1000],
+                    len(written))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+#!/usr/bin/python
+'''Form Header.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+# Headers kept by the shared cache
+CACHE_SIZE = 4096
+
+# Same escapes as formgui.xml_unescape, which the field values of a
+# FormFile go through.  Unknown escapes and a lone & are dropped.
+_ESCAPES = {"&lt;": "<", "&gt;": ">", "&amp;": "&",
+            "&quot;": '"', "&apos;": "'"}
+_ESCAPE_RE = re.compile(r"&[^;]*;|&")
+
+# Characters that can follow "<att" in the start tag of an attachment
+_ATT_TAG_END = (b" ", b"\t", b"\r", b"\n", b">", b"/")
+
+
+class FormHeaderError(Exception):
+    '''Form file is not valid Exception.'''
+
+
+def _unescape(text):
+    if "&" not in text:
+        return text
+    return _ESCAPE_RE.sub(lambda match: _ESCAPES.get(match.group(0), ""),
+                          text)
+
+
+def _strip_attachments(data):
+    '''
+    Drop the encoded data of the attachments from a form.
+
+    The data of an attachment never has a "<" in it, so the end tag
+    is the next "<" and can be found without parsing the data.
+
+    :param data: Form XML
+    :type data: bytes
+    :returns: Form XML with empty attachments, and the size of the
+              data of each attachment
+    :rtype: tuple[bytes, list[int]]
+    '''
+    pieces = []
+    sizes = []
+    pos = 0
+    while True:
+        start = data.find(b"<att", pos)
+        if start < 0:
+            break
+        tag_end = data.find(b">", start)
+        if tag_end < 0:
+            break
+        if data[start + 4:start + 5] not in _ATT_TAG_END or \
+                data[tag_end - 1:tag_end] == b"/":
+            if data[start + 4:start + 5] in _ATT_TAG_END:
+                # Empty, like the ones in the attachment store
+                sizes.append(0)
+            pieces.append(data[pos:tag_end + 1])
+            pos = tag_end + 1
+            continue
+        # A one byte find is much faster than looking for "</att>".
+        close = data.find(b"<", tag_end)
+        if data[close:close + 6] != b"</att>":
+            break
+        pieces.append(data[pos:tag_end + 1])
+        sizes.append(close - tag_end - 1)
+        pos = close
+    if not pieces:
+        return data, sizes
+    pieces.append(data[pos:])
+    return b"".join(pieces), sizes
+
+
+class FormSummary:
+    '''
+    Form Summary.
+
+    The subject, recipient and sender strings of a form, shared by
+    :class:`FormHeader` and :class:`d_rats.formgui.FormFile` so that
+    the message lists show the same for both.
+    '''
+
+    __slots__ = ()
+
+    def get_path_src(self):
+        '''
+        Get path source.
+
+        :returns: Path source
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def get_path_dst(self):
+        '''
+        Get path destination.
+
+        :returns: Destination element
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def get_field_value(self, field_id):
+        '''
+        Get field value.
+
+        :param field_id: Field ID
+        :type field_id: str
+        :returns: Field value or None
+        :rtype: str
+        '''
+        raise NotImplementedError
+
+    def _try_get_fields(self, *names):
+        for field in names:
+            try:
+                val = self.get_field_value(field)
+                if val is not None:
+                    return val
+            except AttributeError:
+                pass
+
+        return "Unknown"
+
+    def get_subject_string(self):
+        '''
+        Get subject string.
+
+        :returns: Subject string
+        :rtype: str
+        '''
+        subj = self._try_get_fields("_auto_subject", "subject")
+        if subj != "Unknown":
+            return subj.replace("\r", "").replace("\n", "")
+
+        return "%s#%s" % (self.get_path_src(),
+                          self._try_get_fields("_auto_number"))
+
+    def get_recipient_string(self):
+        '''
+        Get recipient string.
+
+        :returns: Recipient string
+        :rtype: str
+        '''
+        dst = self.get_path_dst()
+        if dst:
+            return dst
+        return self._try_get_fields("_auto_recip", "recip", "recipient")
+
+    def get_sender_string(self):
+        '''
+        Get sender string.
+
+        :returns: Sender string
+        :rtype: str
+        '''
+        src = self.get_path_src()
+        if src:
+            return src
+        return self._try_get_fields("_auto_sender", "sender")
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class FormHeader(FormSummary):
+    '''
+    Form Header.
+
+    The values of a form that the message lists and the router need,
+    read without the encoded data of the attachments.  The methods return the same as
+    the ones of :class:`d_rats.formgui.FormFile` with the same name.
+
+    :param filename: Form filename
+    :type filename: str
+    '''
+
+    __slots__ = ("filename", "ident", "title_text", "fields", "choices",
+                 "attachments", "path", "_path_elements")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.ident = ""
+        self.title_text = ""
+        self.fields = {}
+        self.choices = {}
+        self.attachments = []
+        self.path = {}
+        self._path_elements = []
+
+    def __str__(self):
+        return "%s: %s" % (self.filename, self.get_subject_string())
+
+    def get_path(self):
+        '''
+        Get path.
+
+        :returns: Stations the form passed through
+        :rtype: list[str]
+        '''
+        return list(self._path_elements)
+
+    def get_path_src(self):
+        '''
+        Get path source.
+
+        :returns: Path source
+        :rtype: str
+        '''
+        return self.path.get("src", "")
+
+    def get_path_dst(self):
+        '''
+        Get path destination.
+
+        :returns: Destination element
+        :rtype: str
+        '''
+        return self.path.get("dst", "")
+
+    def get_path_mid(self):
+        '''
+        Get path mid.
+
+        :returns: mid element
+        :rtype: str
+        '''
+        return self.path.get("mid", "")
+
+    def get_field_value(self, field_id):
+        '''
+        Get field value.
+
+        :param field_id: Field ID
+        :type field_id: str
+        :returns: Field value or None
+        :rtype: str
+        '''
+        value = self.fields.get(field_id, None)
+        if value:
+            return _unescape(value)
+        return None
+
+    def get_precedence(self):
+        '''
+        Get the precedence of the form.
+
+        :returns: Selected precedence, or "" if the form has none
+        :rtype: str
+        '''
+        selected = self.choices.get("precedence", None)
+        if selected:
+            return selected[0]
+        return self.fields.get("precedence", None) or ""
+
+    def get_attachments(self):
+        '''
+        Get attachments.
+
+        :returns: Name and size of each attachment, the size of the
+                  encoded data for an inlined attachment
+        :rtype: list[tuple[str, int]]
+        '''
+        return list(self.attachments)
+
+    def _add_field(self, field):
+        entry = field.find("entry")
+        if entry is None:
+            return
+        field_id = field.get("id", "")
+        self.fields[field_id] = (entry.text or "").strip()
+        selected = [choice.text.strip() for choice in entry.iterfind("choice")
+                    if choice.get("set") and choice.text]
+        if selected:
+            self.choices[field_id] = selected
+
+    def _add_path(self, path):
+        for child in path:
+            text = (child.text or "").strip()
+            if child.tag == "e":
+                if text:
+                    self._path_elements.append(text)
+            elif child.tag not in self.path:
+                self.path[child.tag] = text
+
+    def read(self, data, schema=None):
+        '''
+        Read the header from form XML.
+
+        :param data: Form XML
+        :type data: bytes
+        :param schema: Schema to validate the form with, without the
+                       data of its attachments, default None
+        :type schema: :class:`etree._Validator`
+        :raises: :class:`FormHeaderError` if the form is not valid
+        '''
+        # Without the attachments the rest of a form is small, parsing
+        # it in one go is faster than streaming it with iterparse.  The
+        # path comes after the attachments, so iterparse could not stop
+        # before them and would still have to tokenize their data.
+        data, sizes = _strip_attachments(data)
+        try:
+            root = etree.fromstring(data)
+        except etree.XMLSyntaxError as err:
+            raise FormHeaderError("Form file %s is not valid! (%s)" %
+                                  (self.filename, err)) from err
+        if schema is not None and not schema.validate(root):
+            raise FormHeaderError("Form file %s is not valid! (%s)" %
+                                  (self.filename, schema.error_log.last_error))
+        form = root if root.tag == "form" else root.find(".//form")
+        if form is None:
+            return
+        self.ident = form.get("id", "")
+        sizes = iter(sizes)
+        for elem in form:
+            if elem.tag == "field":
+                self._add_field(elem)
+            elif elem.tag == "title":
+                self.title_text = (elem.text or "").strip()
+            elif elem.tag == "att":
+                size = next(sizes, 0)
+                self.attachments.append((elem.get("name", None),
+                                         int(elem.get("size", size))))
+            elif elem.tag == "path":
+                self._add_path(elem)
+
+
+def read_form_header(filename, schema=None):
+    '''
+    Read the header of a form file.
+
+    :param filename: Form filename
+    :type filename: str
+    :param schema: Schema to validate the form with, default None
+    :type schema: :class:`etree._Validator`
+    :returns: Form header
+    :rtype: :class:`FormHeader`
+    :raises: :class:`FormHeaderError` if the form is not valid
+    :raises: :class:`OSError` if the form can not be read
+    '''
+    with open(filename, "rb") as handle:
+        data = handle.read()
+    header = FormHeader(filename)
+    header.read(data, schema)
+    return header
+
+
+class FormHeaderCache:
+    '''
+    Form Header Cache.
+
+    Keeps the headers of the most recently read forms, each with the
+    modification time and size of its file.  A header is read again
+    when the file changes.
+
+    Safe to use from several threads.
+
+    :param size: Most headers to keep, default CACHE_SIZE
+    :type size: int
+    '''
+
+    logger = logging.getLogger("FormHeaderCache")
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._headers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._headers)
+
+    def get(self, filename):
+        '''
+        Get the header of a form file.
+
+        :param filename: Form filename
+        :type filename: str
+        :returns: Form header
+        :rtype: :class:`FormHeader`
+        :raises: :class:`FormHeaderError` if the form is not valid
+        :raises: :class:`OSError` if the form can not be read
+        '''
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._headers.get(path, None)
+            if cached and cached[0] == key:
+                self._headers.move_to_end(path)
+                self.hits += 1
+                return cached[1]
+        header = read_form_header(filename)
+        with self._lock:
+            self.misses += 1
+            self._headers[path] = (key, header)
+            self._headers.move_to_end(path)
+            while len(self._headers) > self.size:
+                self._headers.popitem(last=False)
+        return header
+
+    def forget(self, filename):
+        '''
+        Drop the header of a form file.
+
+        :param filename: Form filename
+        :type filename: str
+        '''
+        with self._lock:
+            self._headers.pop(os.path.abspath(filename), None)
+
+    def clear(self):
+        '''Drop all of the headers.'''
+        with self._lock:
+            self._headers.clear()
+
+
+# Headers of the forms read by the router, mail server and message lists
+FORM_HEADERS = FormHeaderCache()
+
+
+_BENCH_FORM = '''<xml>
+<form id="email">
+<title>Email</title>
+<field id="_auto_sender"><caption>From</caption>
+<entry type="text">N0CALL</entry></field>
+<field id="recipient"><caption>To</caption>
+<entry type="text">W1AW</entry></field>
+<field id="subject"><caption>Subject</caption>
+<entry type="text">Photos %(num)i of the bridge</entry></field>
+<field id="precedence"><caption>Precedence</caption>
+<entry type="choice"><choice>Routine</choice>\
+<choice set="y">Priority</choice></entry></field>
+<field id="message"><caption>Message</caption>
+<entry type="multiline">Attached are the photos.</entry></field>
+<att name="photo%(num)i.jpg">%(data)s</att>
+<att name="map%(num)i.png">%(data)s</att>
+<path><src>N0CALL</src><dst>W1AW</dst><mid>%(num)i</mid>\
+<e>N0CALL</e><e>N1ABC</e></path>
+</form>
+</xml>
+'''
+
+
+def _full_parse(filename):
+    '''Parse a whole form, the way FormFile reads it.'''
+    doc = etree.parse(filename)
+    return [doc.xpath("//form/field[@id='%s']/entry" % field_id)
+            for field_id in ("subject", "_auto_sender", "recipient")]
+
+
+def _iterparse(filename):
+    '''Stream a form, dropping each element once it is read.'''
+    values = []
+    for _event, elem in etree.iterparse(filename, huge_tree=True,
+                                        tag=("entry", "att", "src", "dst")):
+        if elem.tag != "att":
+            values.append(elem.text)
+        elem.clear()
+    return values
+
+
+def _time_reads(read, files, repeat=3):
+    start = time.perf_counter()
+    for _num in range(repeat):
+        for filename in files:
+            read(filename)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(files))
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Unit test and benchmark with 1 MB attachments.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("FormHeader.test")
+
+    # Base64 lines like the attachments of a form
+    data = "\n".join(["QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9w"
+                      "cXJzdHV2d3h5ejAx"] * 14000)
+    with tempfile.TemporaryDirectory() as form_dir:
+        files = []
+        for num in range(20):
+            filename = os.path.join(form_dir, "form%02i.xml" % num)
+            with open(filename, "w") as handle:
+                handle.write(_BENCH_FORM % {"num": num, "data": data})
+            files.append(filename)
+        logger.info("form size %.1f MB", os.path.getsize(files[0]) / 1e6)
+
+        header = read_form_header(files[7])
+        values = (header.ident, header.get_subject_string(),
+                  header.get_sender_string(), header.get_recipient_string(),
+                  header.get_path_mid(), header.get_path(),
+                  header.get_precedence(),
+                  [name for name, _size in header.get_attachments()])
+        if values == ("email", "Photos 7 of the bridge", "N0CALL", "W1AW",
+                      "7", ["N0CALL", "N1ABC"], "Priority",
+                      ["photo7.jpg", "map7.png"]):
+            logger.info("PASS: %s", header)
+        else:
+            logger.info("FAIL: %s %s", header, header.get_attachments())
+
+        logger.info("full parse:       %7.2f ms per form",
+                    _time_reads(_full_parse, files))
+        logger.info("iterparse:        %7.2f ms per form",
+                    _time_reads(_iterparse, files))
+        logger.info("read_form_header: %7.2f ms per form",
+                    _time_reads(read_form_header, files))
+        cache = FormHeaderCache()
+        logger.info("FormHeaderCache:  %7.3f ms per form, %i read",
+                    _time_reads(cache.get, files, repeat=10), cache.misses)
+
+        with open(files[3], "a") as handle:
+            handle.write("\n")
+        if cache.get(files[3]) is not cache.get(files[4]) and \
+                cache.misses == len(files) + 1:
+            logger.info("PASS: changed form read again")
+        else:
+            logger.info("FAIL: changed form read again, %i read",
+                        cache.misses)
+
+        with open(files[5], "w") as handle:
+            handle.write("<xml><form id='x'><title>Broken</title>")
+        try:
+            read_form_header(files[5])
+            logger.info("FAIL: broken form read")
+        except FormHeaderError as err:
+            logger.info("PASS: %s", err)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+#!/usr/bin/python
+'''Form Template Registry.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from lxml import etree
+
+from .dplatform import Platform
+
+# Bytes of the template file hash that identify a template version
+HASH_SIZE = 4
+
+# Form template directory in the configuration directory, the same as
+# DratsConfig.form_source_dir
+TEMPLATE_DIR = "Form_Templates"
+
+# Seconds between checks of the template directory for changes
+CHECK_INTERVAL = 2.0
+
+
+class FormRegistryError(Exception):
+    '''Form template is not valid Exception.'''
+
+
+# pylint wants only 7 instance attributes
+# pylint wants at least 2 public methods
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
+class FormXPaths:
+    '''
+    Form XPaths.
+
+    The XPath expressions used on form documents, compiled once.  An
+    XPath evaluator is not shared between threads, use
+    :func:`get_xpaths` to get the ones of the current thread.
+    '''
+
+    def __init__(self):
+        self.forms = etree.XPath("//form")
+        self.titles = etree.XPath("//form/title")
+        self.logos = etree.XPath("//form/logo")
+        self.fields = etree.XPath("//form/field")
+        self.field_entry = etree.XPath("//form/field[@id=$field_id]/entry")
+        self.field_caption = etree.XPath(
+            "//form/field[@id=$field_id]/caption")
+        self.path = etree.XPath("//form/path")
+        self.path_elements = etree.XPath("//form/path/e")
+        self.path_child = etree.XPath("//form/path/*[name()=$name]")
+        self.atts = etree.XPath("//form/att")
+        self.att_named = etree.XPath("//form/att[@name=$name]")
+
+
+_XPATHS = threading.local()
+
+
+def get_xpaths():
+    '''
+    Get the compiled form XPath expressions of the current thread.
+
+    :returns: Form XPath expressions
+    :rtype: :class:`FormXPaths`
+    '''
+    xpaths = getattr(_XPATHS, "xpaths", None)
+    if xpaths is None:
+        xpaths = FormXPaths()
+        _XPATHS.xpaths = xpaths
+    return xpaths
+
+
+def _form_element(root):
+    return root if root.tag == "form" else root.find("form")
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class FormTemplate:
+    '''
+    Form Template.
+
+    A parsed form template, checked the way
+    :meth:`d_rats.formgui.FormFile.process_form` checks a form.
+
+    :param filename: Template filename
+    :type filename: str
+    :param data: Template file contents
+    :type data: bytes
+    :raises: :class:`FormRegistryError` if the template is not valid
+    '''
+
+    __slots__ = ("filename", "form_id", "key", "root", "title_text",
+                 "logo_path", "field_ids", "stamp")
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.key = hashlib.sha256(data).digest()[:HASH_SIZE]
+        self.stamp = None
+        try:
+            self.root = etree.fromstring(data)
+        except etree.XMLSyntaxError as err:
+            raise FormRegistryError("Template %s is not valid! (%s)" %
+                                    (filename, err)) from err
+        xpaths = get_xpaths()
+        forms = xpaths.forms(self.root)
+        if len(forms) != 1:
+            raise FormRegistryError("%i forms in template %s" %
+                                    (len(forms), filename))
+        self.form_id = forms[0].get("id", "")
+        titles = xpaths.titles(self.root)
+        if len(titles) != 1:
+            raise FormRegistryError("%i titles in template %s" %
+                                    (len(titles), filename))
+        self.title_text = (titles[0].text or "").strip()
+        logos = xpaths.logos(self.root)
+        if len(logos) > 1:
+            raise FormRegistryError("%i logos in template %s" %
+                                    (len(logos), filename))
+        self.logo_path = None
+        if logos and logos[0].text:
+            self.logo_path = logos[0].text.strip()
+        self.field_ids = [field.get("id") for field in xpaths.fields(self.root)]
+
+    def new_form(self):
+        '''
+        Get a copy of the template.
+
+        :returns: Root element and form element of the copy
+        :rtype: tuple[:class:`etree._Element`, :class:`etree._Element`]
+        '''
+        root = copy.deepcopy(self.root)
+        return root, _form_element(root)
+
+    def new_doc(self):
+        '''
+        Get a copy of the template as a document.
+
+        :returns: Form document
+        :rtype: :class:`etree._ElementTree`
+        '''
+        return etree.ElementTree(copy.deepcopy(self.root))
+
+
+class FormRegistry:
+    '''
+    Form Template Registry.
+
+    The form templates of a directory, loaded and checked once, each
+    identified by its form id and the hash of its file.  The directory
+    is checked for new, changed and removed templates at most every
+    CHECK_INTERVAL seconds, when a template is looked up.  Use
+    :meth:`get_registry` to share the templates of a directory.
+
+    :param form_dir: Form template directory
+    :type form_dir: str
+    :param check_interval: Seconds between checks for changes,
+                           default CHECK_INTERVAL
+    :type check_interval: float
+    '''
+
+    logger = logging.getLogger("FormRegistry")
+
+    _registries = {}
+    _registries_lock = threading.Lock()
+
+    def __init__(self, form_dir, check_interval=CHECK_INTERVAL):
+        self.form_dir = os.path.abspath(form_dir)
+        self.check_interval = check_interval
+        self._checked = None
+        self._files = {}
+        self._by_id = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_registry(cls, form_dir=None):
+        '''
+        Get the shared registry of a directory.
+
+        :param form_dir: Form template directory, default TEMPLATE_DIR
+                         in the configuration directory
+        :type form_dir: str
+        :returns: Form template registry
+        :rtype: :class:`FormRegistry`
+        '''
+        if not form_dir:
+            form_dir = Platform.get_platform().config_file(TEMPLATE_DIR)
+        form_dir = os.path.abspath(form_dir)
+        with cls._registries_lock:
+            registry = cls._registries.get(form_dir, None)
+            if registry is None:
+                registry = cls(form_dir)
+                cls._registries[form_dir] = registry
+            return registry
+
+    @classmethod
+    def find_template(cls, filename):
+        '''
+        Find the template of a file in a shared registry.
+
+        :param filename: Form filename
+        :type filename: str
+        :returns: Template, or None if the file is not a template in a
+                  registry or changed since it was loaded
+        :rtype: :class:`FormTemplate`
+        '''
+        path = os.path.abspath(filename)
+        with cls._registries_lock:
+            registry = cls._registries.get(os.path.dirname(path), None)
+        if registry is None:
+            return None
+        return registry.by_file(path)
+
+    def _check(self):
+        '''Load the new and changed templates, if it is time to.'''
+        now = time.monotonic()
+        if self._checked is not None and \
+                now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        files = {}
+        changed = False
+        for filename in glob.glob(os.path.join(self.form_dir, "*.xml")):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            cached = self._files.get(filename, None)
+            if cached and cached[0] == stamp:
+                files[filename] = cached
+                continue
+            changed = True
+            template = None
+            try:
+                with open(filename, "rb") as handle:
+                    template = FormTemplate(filename, handle.read())
+                template.stamp = stamp
+            except (FormRegistryError, OSError) as err:
+                # Not tried again until the file changes
+                self.logger.info("_check: %s", err)
+            files[filename] = (stamp, template)
+        if changed or len(files) != len(self._files):
+            self._files = files
+            templates = [template for _stamp, template in files.values()
+                         if template]
+            self._by_id = {template.form_id: template
+                           for template in templates}
+            self._by_key = {template.key: template for template in templates}
+            self.logger.info("_check: %i templates in %s",
+                             len(templates), self.form_dir)
+
+    def load(self):
+        '''
+        Load the templates now.
+
+        :returns: Number of templates
+        :rtype: int
+        '''
+        with self._lock:
+            self._checked = None
+            self._check()
+            return len(self._by_id)
+
+    def by_id(self, form_id):
+        '''
+        Get the template of a form.
+
+        :param form_id: Form id
+        :type form_id: str
+        :returns: Template, or None if there is none
+        :rtype: :class:`FormTemplate`
+        '''
+        with self._lock:
+            self._check()
+            return self._by_id.get(form_id, None)
+
+    def by_key(self, key):
+        '''
+        Get a template by its hash.
+
+        :param key: Template hash
+        :type key: bytes
+        :returns: Template, or None if there is none
+        :rtype: :class:`FormTemplate`
+        '''
+        with self._lock:
+            self._check()
+            return self._by_key.get(key, None)
+
+    def by_file(self, filename):
+        '''
+        Get the template loaded from a file.
+
+        The file is checked for changes since it was loaded.
+
+        :param filename: Template filename
+        :type filename: str
+        :returns: Template, or None if the file is not a loaded template
+        :rtype: :class:`FormTemplate`
+        '''
+        path = os.path.abspath(filename)
+        with self._lock:
+            self._check()
+            cached = self._files.get(path, None)
+        if not cached or not cached[1]:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) != cached[0]:
+            return None
+        return cached[1]
+
+    def keys(self):
+        '''
+        Get the hashes of the templates.
+
+        :returns: Template hashes
+        :rtype: list[bytes]
+        '''
+        with self._lock:
+            self._check()
+            return sorted(self._by_key)
+
+    def templates(self):
+        '''
+        Get the templates.
+
+        :returns: Templates, by form id
+        :rtype: dict[str, :class:`FormTemplate`]
+        '''
+        with self._lock:
+            self._check()
+            return dict(self._by_id)
+
+
+def _write_received(form_dir, registry, count):
+    '''Write count received forms of the template types.'''
+    templates = sorted(registry.templates().values(),
+                       key=lambda template: template.form_id)
+    files = []
+    for num in range(count):
+        root, form = templates[num % len(templates)].new_form()
+        for field in form.iterfind("field"):
+            entry = field.find("entry")
+            if entry is not None and entry.get("type") in ("text",
+                                                           "multiline"):
+                entry.text = "%s %i" % (field.get("id"), num)
+        path = etree.SubElement(form, "path")
+        for tag, text in (("src", "N0CALL"), ("dst", "W1AW"),
+                          ("mid", "N0CALL.%i" % num), ("e", "N0CALL")):
+            etree.SubElement(path, tag).text = text
+        filename = os.path.join(form_dir, "msg%04i.xml" % num)
+        etree.ElementTree(root).write(filename)
+        files.append(filename)
+    return files
+
+
+def _legacy_open(filename):
+    '''Open a form and read it the way FormFile did before.'''
+    doc = etree.parse(filename)
+    if len(doc.xpath("//form")) != 1 or \
+            len(doc.xpath("//form/title")) != 1 or \
+            len(doc.xpath("//form/logo")) > 1:
+        raise FormRegistryError("Not valid")
+    values = [doc.xpath("//form/path/%s" % name)
+              for name in ("src", "dst", "mid")]
+    for field_id in ("subject", "message"):
+        values.append(doc.xpath("//form/field[@id='%s']/entry" % field_id))
+    values.append(doc.xpath("//form/att"))
+    return values
+
+
+def _registry_doc(filename):
+    '''Open a form the way FormFile does, using the shared registry.'''
+    template = FormRegistry.find_template(filename)
+    if template:
+        return template.new_doc()
+    doc = etree.parse(filename)
+    xpaths = get_xpaths()
+    if len(xpaths.forms(doc)) != 1 or len(xpaths.titles(doc)) != 1 or \
+            len(xpaths.logos(doc)) > 1:
+        raise FormRegistryError("Not valid")
+    return doc
+
+
+def _registry_open(filename):
+    '''Open a form and read it the way FormFile does now.'''
+    doc = _registry_doc(filename)
+    xpaths = get_xpaths()
+    values = [xpaths.path_child(doc, name=name)
+              for name in ("src", "dst", "mid")]
+    for field_id in ("subject", "message"):
+        values.append(xpaths.field_entry(doc, field_id=field_id))
+    values.append(xpaths.atts(doc))
+    return values
+
+
+def _time_opens(open_form, files):
+    start = time.perf_counter()
+    for filename in files:
+        open_form(filename)
+    return (time.perf_counter() - start) * 1000
+
+
+# pylint wants a max of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Unit test and benchmark opening 1000 forms of mixed types.'''
+    # pylint: disable=import-outside-toplevel
+    import shutil
+    import tempfile
+
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("FormRegistry.test")
+    logging.getLogger("FormFile").setLevel(logging.WARNING)
+
+    source_dir = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "forms")
+    with tempfile.TemporaryDirectory() as work_dir:
+        form_dir = os.path.join(work_dir, TEMPLATE_DIR)
+        os.mkdir(form_dir)
+        for filename in glob.glob(os.path.join(source_dir, "*.xml")):
+            shutil.copy(filename, form_dir)
+        received_dir = os.path.join(work_dir, "Inbox")
+        os.mkdir(received_dir)
+
+        registry = FormRegistry.get_registry(form_dir)
+        start = time.perf_counter()
+        count = registry.load()
+        logger.info("loaded %i templates in %.1f ms", count,
+                    (time.perf_counter() - start) * 1000)
+        files = _write_received(received_dir, registry, 1000)
+        new_forms = [registry.by_id(form_id).filename
+                     for form_id in sorted(registry.templates())] * 167
+
+        logger.info("1000 received forms: %7.1f ms before, %7.1f ms now",
+                    _time_opens(_legacy_open, files),
+                    _time_opens(_registry_open, files))
+        logger.info("1000 new forms:      %7.1f ms before, %7.1f ms now",
+                    _time_opens(_legacy_open, new_forms),
+                    _time_opens(_registry_doc, new_forms))
+
+        # A new form is a copy, changing it leaves the template alone.
+        doc = _registry_doc(new_forms[0])
+        form = _form_element(doc.getroot())
+        etree.SubElement(form, "path")
+        template = registry.by_file(new_forms[0])
+        passed = template is not None and form.get("id") == template.form_id \
+            and not template.root.xpath("//form/path")
+        mid = _registry_open(files[1])[2]
+        passed = passed and mid and mid[0].text == "N0CALL.1"
+
+        # A changed template is loaded again at the next check.
+        with open(template.filename, "ab") as handle:
+            handle.write(b"\n")
+        registry.check_interval = 0
+        passed = passed and registry.by_file(template.filename) is not None \
+            and registry.by_file(template.filename) is not template
+        logger.info("%s", ("FAIL", "PASS")[passed])
+
+
+if __name__ == "__main__":
+    main()
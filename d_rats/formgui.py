@@ -44,6 +44,15 @@ if not '_' in locals():
 
 MODULE_LOGGER = logging.getLogger("Formgui")
 
+from .attachment_store import AttachmentStore
+from .attachment_store import AttachmentStoreError
+from .attachment_store import externalize
+from .attachment_store import iter_inline
+from .form_export import XSLT_CACHE
+from .form_export import stylesheet_path
+from .form_header import FormSummary
+from .form_registry import FormRegistry
+from .form_registry import get_xpaths
 from .keyedlistwidget import KeyedListWidget
 from .miscwidgets import make_choice
 from .ui.main_common import ask_for_confirmation
@@ -206,6 +215,8 @@ class HTMLFormWriter():
     '''
     HTML Form Writer.
 
+    The compiled stylesheets are shared through :data:`XSLT_CACHE`.
+
     :param form_type: String for type of form
     :type form_type: str
     :param xsl_dir: Directory path for xsl file
@@ -214,9 +225,7 @@ class HTMLFormWriter():
     logger = logging.getLogger("HTMLFormWriter")
 
     def __init__(self, form_type, xsl_dir):
-        self.xslpath = os.path.join(xsl_dir, "%s.xsl" % form_type)
-        if not os.path.exists(self.xslpath):
-            self.xslpath = os.path.join(xsl_dir, "default.xsl")
+        self.xslpath = stylesheet_path(form_type, xsl_dir)
 
     def write_doc(self, doc, outfile):
         '''
@@ -228,9 +237,7 @@ class HTMLFormWriter():
         :type outfile: str
         '''
         self.logger.info("Writing to %s", outfile)
-        style_doc = etree.parse(self.xslpath)
-        style_sheet = etree.XSLT(style_doc)
-        result = style_sheet(doc)
+        result = XSLT_CACHE.transform(self.xslpath, doc)
         result.write(outfile, pretty_print=True)
 
     def write_string(self, doc):
@@ -242,9 +249,7 @@ class HTMLFormWriter():
         :returns: element written as a string
         :rtype: str
         '''
-        style_doc = etree.parse(self.xslpath)
-        style_sheet = etree.XSLT(style_doc)
-        result = style_sheet(doc)
+        result = XSLT_CACHE.transform(self.xslpath, doc)
         return etree.tostring(result, pretty_print=True).decode()
 
 
@@ -1036,26 +1041,43 @@ class FormField():
 # pylint wants only 7 instance attributes
 # pylint wants only 20 public methods
 # pylint: disable=too-many-public-methods, too-many-instance-attributes
-class FormFile():
+class FormFile(FormSummary):
     '''
     Form File.
 
+    Attachments are kept in an :class:`AttachmentStore`, the form only
+    refers to them.  Forms with the attachments inlined are read the
+    same way.
+
+    A template already loaded by a :class:`FormRegistry` is copied
+    from the registry instead of being parsed and checked again.
+
     :param filename: File name for form
     :type filename: str
+    :param attachment_store: Attachment store, default the shared store
+    :type attachment_store: :class:`AttachmentStore`
     :raises: FormguiFormFileEmpty exception
     '''
     logger = logging.getLogger("FormFile")
 
-    def __init__(self, filename):
+    def __init__(self, filename, attachment_store=None):
         self._filename = filename
+        self._attachment_store = attachment_store
+        self.fields = []
+        self.xsl_dir = 'forms'
+
+        template = FormRegistry.find_template(filename)
+        if template:
+            self.doc = template.new_doc()
+            self.ident = template.form_id
+            self.title_text = template.title_text
+            self.logo_path = template.logo_path
+            return
         try:
             self.doc = etree.parse(self._filename)
         except etree.XMLSyntaxError as err:
             raise FormguiFileNotValid("Form file %s is not valid! (%s)" %
                                       (filename, err)) from err
-
-        self.fields = []
-        self.xsl_dir = 'forms'
         self.process_form(self.doc)
 
     def configure(self, config):
@@ -1086,15 +1108,34 @@ class FormFile():
         form_writer = HTMLFormWriter(self.ident, self.xsl_dir)
         return form_writer.write_string(self.doc)
 
+    def _get_store(self):
+        if not self._attachment_store:
+            self._attachment_store = AttachmentStore.get_store()
+        return self._attachment_store
+
     def get_xml(self):
         '''
         Get xml.
 
+        The attachments are inlined, for sending the form out.
+
         :returns: XML serialized into a string
-        :rtype: str
+        :rtype: bytes
+        :raises: :class:`FormguiFileInvalidAtt` if an attachment is missing
+        '''
+        try:
+            return b"".join(iter_inline(self.doc, self._get_store()))
+        except AttachmentStoreError as err:
+            raise FormguiFileInvalidAtt(str(err)) from err
+
+    def externalize_attachments(self):
         '''
-        root = self.doc.getroot()
-        return etree.tostring(root)
+        Move the inlined attachments into the attachment store.
+
+        :returns: Number of attachments moved
+        :rtype: int
+        '''
+        return externalize(self.doc, self._get_store())
 
     def process_form(self, doc):
         '''
@@ -1106,7 +1147,8 @@ class FormFile():
         :raises: FormguiFileMultipleTitles if more than one title in file
         :raises: FormguiFileMultipleLogos if more than one logo in file
         '''
-        forms = doc.xpath("//form")
+        xpaths = get_xpaths()
+        forms = xpaths.forms(doc)
         if len(forms) != 1:
             raise FormguiFileMultipleForms("%i forms in document" % len(forms))
 
@@ -1114,7 +1156,7 @@ class FormFile():
             if attrib == 'id':
                 self.ident = value
 
-        titles = doc.xpath("//form/title")
+        titles = xpaths.titles(doc)
         if len(titles) != 1:
             raise FormguiFileMultipleTitles("%i titles in document" %
                                             len(titles))
@@ -1124,7 +1166,7 @@ class FormFile():
         else:
             self.title_text = ""
 
-        logos = doc.xpath("//form/logo")
+        logos = xpaths.logos(doc)
         if len(logos) > 1:
             raise FormguiFileMultipleLogos("%i logos in document" % len(logos))
         if logos and logos[0].text:
@@ -1140,7 +1182,7 @@ class FormFile():
         :rtype: list[str]
         '''
         path_elements = []
-        for element in self.doc.xpath("//form/path/e"):
+        for element in get_xpaths().path_elements(self.doc):
             if element.text:
                 text = element.text.strip()
                 if text:
@@ -1148,11 +1190,12 @@ class FormFile():
         return path_elements
 
     def _add_path_element(self, name, element, append=False):
-        els = self.doc.xpath("//form/path")
+        xpaths = get_xpaths()
+        els = xpaths.path(self.doc)
         if els:
             path = els[0]
         else:
-            form = self.doc.xpath("//form")
+            form = xpaths.forms(self.doc)
             path = etree.SubElement(form[0], "path")
 
         if append:
@@ -1160,7 +1203,7 @@ class FormFile():
             child.text = element
             return
 
-        els = self.doc.xpath("//form/path/%s" % name)
+        els = xpaths.path_child(self.doc, name=name)
         if not els:
             child = etree.SubElement(path, name)
             child.text = element
@@ -1205,7 +1248,7 @@ class FormFile():
         self._add_path_element("mid", mid)
 
     def _get_path_element(self, name):
-        els = self.doc.xpath("//form/path/%s" % name)
+        els = get_xpaths().path_child(self.doc, name=name)
         if els and els[0].text:
             return els[0].text.strip()
         return ""
@@ -1247,7 +1290,7 @@ class FormFile():
         :rtype: str
         :raises: FormguiFileMultipleIds when multiple IDs are in a form
         '''
-        els = self.doc.xpath("//form/field[@id='%s']/entry" % field_id)
+        els = get_xpaths().field_entry(self.doc, field_id=field_id)
         if len(els) > 1:
             raise FormguiFileMultipleIds("More than one id=%s node!" %
                                          field_id)
@@ -1265,7 +1308,7 @@ class FormFile():
         :rtype: str
         :raises: FormguiFileMultipleIds when multiple IDs are in a form
         '''
-        els = self.doc.xpath("//form/field[@id='%s']/caption" % field_id)
+        els = get_xpaths().field_caption(self.doc, field_id=field_id)
         if len(els) > 1:
             raise FormguiFileMultipleIds("More than one id=%s node!" %
                                          field_id)
@@ -1282,7 +1325,7 @@ class FormFile():
         :param value: Value to set
         :type value: str
         '''
-        els = self.doc.xpath("//form/field[@id='%s']/entry" % field_id)
+        els = get_xpaths().field_entry(self.doc, field_id=field_id)
         self.logger.info("Setting %s to %s (%i)", field_id, value, len(els))
         if len(els) == 1:
             multiline = False
@@ -1295,72 +1338,20 @@ class FormFile():
             else:
                 els[0].text=value.strip()
 
-    def _try_get_fields(self, *names):
-        for field in names:
-            try:
-                val = self.get_field_value(field)
-                if val is not None:
-                    return val
-            except AttributeError:
-                pass
-
-        return "Unknown"
-
-    def get_subject_string(self):
-        '''
-        Get subject string.
-
-        :returns: Subject string
-        :rtype: str
-        '''
-        subj = self._try_get_fields("_auto_subject", "subject")
-        if subj != "Unknown":
-            return subj.replace("\r", "").replace("\n", "")
-
-        return "%s#%s" % (self.get_path_src(),
-                          self._try_get_fields("_auto_number"))
-
-    def get_recipient_string(self):
-        '''
-        Get recipient string.
-
-        :returns: Recipient string
-        :rtype: str
-        '''
-        dst = self.get_path_dst()
-        if dst:
-            return dst
-        return self._try_get_fields("_auto_recip", "recip", "recipient")
-
-    def get_sender_string(self):
-        '''
-        Get sender string.
-
-        :returns: Sender string
-        :rtype: str
-        '''
-        src = self.get_path_src()
-        if src:
-            return src
-        return self._try_get_fields("_auto_sender", "sender")
-
     def get_attachments(self):
         '''
         Get attachments.
 
-        :returns: list of attachment tuples
+        :returns: Name and size of each attachment, the size of the
+                  encoded data for an inlined attachment
         :rtype: list[tuple[str, int]]
         '''
         atts = []
-        els = self.doc.xpath("//form/att")
-        for element in els:
-            name = None
-            for attrib, value in els[0].items():
-                if attrib == 'name':
-                    name = value
-                    break
-            data = etree.tostring(element)
-            atts.append((name, len(data)))
+        for element in get_xpaths().atts(self.doc):
+            size = element.get('size', None)
+            if size is None:
+                size = len(element.text or "")
+            atts.append((element.get('name', None), int(size)))
 
         return atts
 
@@ -1376,7 +1367,7 @@ class FormFile():
         :returns: Number of attachments with that name.
         :rtype: int
         '''
-        elements = self.doc.xpath("//form/att[@name='%s']" % name)
+        elements = get_xpaths().att_named(self.doc, name=name)
         return len(elements)
 
     def get_attachment(self, name):
@@ -1389,8 +1380,14 @@ class FormFile():
         :rtype: bytes
         :raises: :class:`FormguiFileMultipleAtts` if more than one attachment
         '''
-        elements = self.doc.xpath("//form/att[@name='%s']" % name)
+        elements = get_xpaths().att_named(self.doc, name=name)
         if len(elements) == 1:
+            digest = elements[0].get('ref', None)
+            if digest:
+                try:
+                    return self._get_store().get(digest)
+                except AttachmentStoreError as err:
+                    raise FormguiFileInvalidAtt(str(err)) from err
             data = elements[0].text
             b64data = base64.b64decode(data)
             return zlib.decompress(b64data)
@@ -1420,14 +1417,14 @@ class FormFile():
             # raise FormguiFileDuplicateAtt(error_message)
             return
 
-        elements = self.doc.xpath("//form")
+        elements = get_xpaths().forms(self.doc)
         if len(elements) == 1:
+            digest, size = self._get_store().put(data)
             attachment_node = etree.Element('att')
             elements[0].append(attachment_node)
             attachment_node.set('name', name)
-            zdata = zlib.compress(data, 9)
-            b64data = base64.b64encode(zdata)
-            attachment_node.text = b64data
+            attachment_node.set('ref', digest)
+            attachment_node.set('size', str(size))
 
     def remove_attachment(self, name):
         '''
@@ -1436,7 +1433,7 @@ class FormFile():
         :param name: Name of attachment
         :type name: str
         '''
-        for attachment in self.doc.xpath("//form/att[@name='%s']" % name):
+        for attachment in get_xpaths().att_named(self.doc, name=name):
             attachment.getparent().remove(attachment)
 
 
@@ -1497,7 +1494,7 @@ class FormDialog(FormFile, Gtk.Dialog):
         :param doc: XML ElementTree
         :type doc: :class:`etree._ElementTree`
         '''
-        fields = doc.xpath("//form/field")
+        fields = get_xpaths().fields(doc)
         for field in fields:
             self.fields.append(FormField(field, config=self.config))
 
@@ -0,0 +1,579 @@
+#!/usr/bin/python
+'''Form Store Batch Import and Export.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from .attachment_store import ATTACHMENT_DIR
+from .attachment_store import AttachmentStore
+from .attachment_store import AttachmentStoreError
+from .attachment_store import externalize_file
+from .attachment_store import inline_file
+from .dplatform import Platform
+from .form_header import FormHeader
+from .form_header import FormHeaderError
+from .form_header import read_form_header
+from .message_store import MessageStore
+from .message_store import STORE_FILE
+
+# Forms handed to a worker process at a time
+BATCH_CHUNK = 256
+
+# Fewer forms than this are handled without starting worker processes
+POOL_MINIMUM = 512
+
+# Folder of the form store directory in the configuration directory
+STORE_DIR = "messages"
+
+# Suffix of a form being written, the router only looks at .xml files
+PART_SUFFIX = ".part"
+
+# Structure of a form file, as written by formgui.FormFile.  The data
+# of the attachments is not validated, it is stripped before parsing.
+FORM_SCHEMA = '''\
+<grammar xmlns="http://relaxng.org/ns/structure/1.0">
+  <start>
+    <choice>
+      <element name="xml"><ref name="form"/></element>
+      <ref name="form"/>
+    </choice>
+  </start>
+  <define name="other_attributes">
+    <zeroOrMore>
+      <attribute><anyName><except><name>id</name></except></anyName>
+      </attribute>
+    </zeroOrMore>
+  </define>
+  <define name="form">
+    <element name="form">
+      <attribute name="id"/>
+      <ref name="other_attributes"/>
+      <zeroOrMore>
+        <choice>
+          <element name="title"><text/></element>
+          <element name="logo"><ref name="other_attributes"/><text/></element>
+          <ref name="field"/>
+          <element name="att">
+            <ref name="other_attributes"/>
+            <text/>
+          </element>
+          <element name="path">
+            <zeroOrMore>
+              <element><anyName/><text/></element>
+            </zeroOrMore>
+          </element>
+        </choice>
+      </zeroOrMore>
+    </element>
+  </define>
+  <define name="field">
+    <element name="field">
+      <attribute name="id"/>
+      <ref name="other_attributes"/>
+      <interleave>
+        <optional><element name="caption"><text/></element></optional>
+        <optional>
+          <element name="entry">
+            <ref name="other_attributes"/>
+            <mixed>
+              <zeroOrMore>
+                <element name="choice">
+                  <ref name="other_attributes"/>
+                  <text/>
+                </element>
+              </zeroOrMore>
+            </mixed>
+          </element>
+        </optional>
+      </interleave>
+    </element>
+  </define>
+</grammar>
+'''
+
+# Compiled once in each process by get_schema
+_SCHEMA = []
+
+
+class FormStoreError(Exception):
+    '''Form Store Exception.'''
+
+
+def get_schema():
+    '''
+    Get the compiled form schema.
+
+    :returns: Form schema
+    :rtype: :class:`etree.RelaxNG`
+    '''
+    if not _SCHEMA:
+        _SCHEMA.append(etree.RelaxNG(etree.fromstring(FORM_SCHEMA)))
+    return _SCHEMA[0]
+
+
+def _form_fields(form):
+    '''
+    Get the message store fields of a form.
+
+    :param form: Form header
+    :type form: :class:`FormHeader`
+    :returns: Header fields for :meth:`MessageStore.set_headers`
+    :rtype: dict[str, str]
+    '''
+    return {"msg_type": form.ident,
+            "subject": form.get_subject_string(),
+            "sender": form.get_sender_string(),
+            "recip": form.get_recipient_string(),
+            "path_dst": form.get_path_dst()}
+
+
+def check_form(filename):
+    '''
+    Validate a form file and read its message store fields.
+
+    :param filename: Form filename
+    :type filename: str
+    :returns: Header fields for :meth:`MessageStore.set_headers`
+    :rtype: dict[str, str]
+    :raises: :class:`FormHeaderError` if the form is not valid
+    :raises: :class:`OSError` if the form can not be read
+    '''
+    return _form_fields(read_form_header(filename, get_schema()))
+
+
+def _copy_in(filename, data, folder, store):
+    '''
+    Write a form into a folder.
+
+    The inlined attachments of the copy are moved into the attachment
+    store, as the message list does for the forms it imports.  The copy
+    is renamed into place when complete, so the router never sees part
+    of a form.
+
+    :param filename: Form filename
+    :type filename: str
+    :param data: Form XML
+    :type data: bytes
+    :param folder: Folder directory
+    :type folder: str
+    :param store: Attachment store
+    :type store: :class:`AttachmentStore`
+    :returns: Name of the copy and its modification time
+    :rtype: tuple[str, float]
+    :raises: :class:`FormStoreError` if the folder has a form of that name
+    :raises: :class:`OSError` if the form can not be written
+    :raises: :class:`etree.XMLSyntaxError` if the form can not be parsed
+    '''
+    name = os.path.basename(filename)
+    dest = os.path.join(folder, name)
+    if os.path.exists(dest):
+        raise FormStoreError("%s is already in %s" % (name, folder))
+    part = dest + PART_SUFFIX
+    with open(part, "wb") as handle:
+        handle.write(data)
+    try:
+        externalize_file(part, store)
+    except (etree.XMLSyntaxError, OSError):
+        os.remove(part)
+        raise
+    stamp = os.stat(part).st_mtime
+    os.replace(part, dest)
+    return name, stamp
+
+
+def _import_chunk(filenames, folder, attachment_dir):
+    '''
+    Validate forms and copy them into a folder, in a worker process.
+
+    Each form is read once, for validating and copying.
+
+    :param filenames: Form filenames
+    :type filenames: list[str]
+    :param folder: Folder directory, or None to only read the forms
+                   that are in the folder already
+    :type folder: str
+    :param attachment_dir: Attachment store directory, or None when
+                           only reading the forms
+    :type attachment_dir: str
+    :returns: Name, modification time and header fields of each form,
+              and the errors of the forms that failed
+    :rtype: tuple[list[tuple[str, float, dict]], list[str]]
+    '''
+    store = None
+    if folder:
+        store = AttachmentStore.get_store(attachment_dir)
+    schema = get_schema()
+    records = []
+    errors = []
+    for filename in filenames:
+        try:
+            with open(filename, "rb") as handle:
+                data = handle.read()
+                stamp = os.fstat(handle.fileno()).st_mtime
+            form = FormHeader(filename)
+            form.read(data, schema)
+            name = os.path.basename(filename)
+            if folder:
+                name, stamp = _copy_in(filename, data, folder, store)
+            records.append((name, stamp, _form_fields(form)))
+        except (FormHeaderError, FormStoreError, OSError,
+                etree.XMLSyntaxError) as err:
+            errors.append(str(err))
+    return records, errors
+
+
+def _export_chunk(filenames, out_dir, attachment_dir):
+    '''
+    Write forms with their attachments inlined, in a worker process.
+
+    :param filenames: Form filenames
+    :type filenames: list[str]
+    :param out_dir: Directory to write the forms in
+    :type out_dir: str
+    :param attachment_dir: Attachment store directory
+    :type attachment_dir: str
+    :returns: Forms written, and the errors of the forms that failed
+    :rtype: tuple[list[str], list[str]]
+    '''
+    store = AttachmentStore.get_store(attachment_dir)
+    schema = get_schema()
+    written = []
+    errors = []
+    for filename in filenames:
+        outfile = os.path.join(out_dir, os.path.basename(filename))
+        try:
+            data = b"".join(inline_file(filename, store))
+            FormHeader(filename).read(data, schema)
+            with open(outfile + PART_SUFFIX, "wb") as handle:
+                handle.write(data)
+            os.replace(outfile + PART_SUFFIX, outfile)
+            written.append(outfile)
+        except (FormHeaderError, AttachmentStoreError, OSError,
+                etree.XMLSyntaxError) as err:
+            errors.append("%s: %s" % (filename, err))
+    return written, errors
+
+
+def _run_chunks(function, files, args, processes):
+    '''
+    Run a function over the files in chunks, in worker processes.
+
+    :param function: Function taking a chunk and args
+    :type function: function
+    :param files: Form filenames
+    :type files: list[str]
+    :param args: Other arguments of the function
+    :type args: tuple
+    :param processes: Number of worker processes, default the CPU count.
+                      With 1 the forms are handled in this process.
+    :type processes: int
+    :returns: Result of the function for each chunk
+    :rtype: list
+    '''
+    chunks = [files[start:start + BATCH_CHUNK]
+              for start in range(0, len(files), BATCH_CHUNK)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(files) < POOL_MINIMUM:
+        return [function(chunk, *args) for chunk in chunks]
+    count = len(chunks)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(function, chunks,
+                             *[[arg] * count for arg in args]))
+
+
+def _form_files(sources):
+    '''
+    Find the form files to import.
+
+    :param sources: Form files and directories of form files
+    :type sources: list[str]
+    :returns: Form filenames
+    :rtype: list[str]
+    '''
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(sorted(glob.glob(os.path.join(source, "*.xml"))))
+        else:
+            files.append(source)
+    return files
+
+
+def _index(store, folder, results, logger):
+    '''
+    Write the records of the forms read into the message store.
+
+    :returns: Number of forms indexed
+    :rtype: int
+    '''
+    count = 0
+    with store.transaction():
+        for records, errors in results:
+            for name, stamp, fields in records:
+                store.set_headers(folder, name, stamp=stamp, **fields)
+            count += len(records)
+            for error in errors:
+                logger.info("%s", error)
+    return count
+
+
+# pylint wants a max of 5 arguments
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def import_forms(sources, folder, store, attachment_dir, processes=None,
+                 logger=None):
+    '''
+    Import forms into a folder.
+
+    The forms are validated and copied by worker processes, with their
+    attachments moved into the attachment store, and written to the
+    message store in one transaction.  Forms that are not valid, or
+    that the folder already has, are skipped.
+
+    :param sources: Form files and directories of form files
+    :type sources: list[str]
+    :param folder: Folder directory
+    :type folder: str
+    :param store: Message store
+    :type store: :class:`MessageStore`
+    :param attachment_dir: Attachment store directory
+    :type attachment_dir: str
+    :param processes: Number of worker processes, default the CPU count
+    :type processes: int
+    :param logger: Logger for the forms skipped, default module logger
+    :type logger: :class:`logging.Logger`
+    :returns: Number of forms imported
+    :rtype: int
+    '''
+    logger = logger or logging.getLogger("FormStore")
+    os.makedirs(folder, exist_ok=True)
+    results = _run_chunks(_import_chunk, _form_files(sources),
+                          (os.path.abspath(folder),
+                           os.path.abspath(attachment_dir)), processes)
+    return _index(store, folder, results, logger)
+
+
+def reindex_folder(folder, store, processes=None, logger=None):
+    '''
+    Read the forms of a folder into the message store again.
+
+    Messages of the store whose files are gone are dropped.
+
+    :param folder: Folder directory
+    :type folder: str
+    :param store: Message store
+    :type store: :class:`MessageStore`
+    :param processes: Number of worker processes, default the CPU count
+    :type processes: int
+    :param logger: Logger for the forms not valid, default module logger
+    :type logger: :class:`logging.Logger`
+    :returns: Number of forms indexed
+    :rtype: int
+    '''
+    logger = logger or logging.getLogger("FormStore")
+    files = sorted(glob.glob(os.path.join(folder, "*.xml")))
+    results = _run_chunks(_import_chunk, files, (None, None), processes)
+    present = set(os.path.basename(filename) for filename in files)
+    with store.transaction():
+        for info in store.messages(folder):
+            if info.filename not in present:
+                store.delete_message(folder, info.filename)
+        return _index(store, folder, results, logger)
+
+
+def export_forms(folder, out_dir, attachment_dir, processes=None,
+                 logger=None):
+    '''
+    Export the forms of a folder, with their attachments inlined.
+
+    :param folder: Folder directory
+    :type folder: str
+    :param out_dir: Directory to write the forms in
+    :type out_dir: str
+    :param attachment_dir: Attachment store directory
+    :type attachment_dir: str
+    :param processes: Number of worker processes, default the CPU count
+    :type processes: int
+    :param logger: Logger for the forms that failed, default module logger
+    :type logger: :class:`logging.Logger`
+    :returns: Forms written
+    :rtype: list[str]
+    '''
+    logger = logger or logging.getLogger("FormStore")
+    os.makedirs(out_dir, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(folder, "*.xml")))
+    results = _run_chunks(_export_chunk, files,
+                          (os.path.abspath(out_dir),
+                           os.path.abspath(attachment_dir)), processes)
+    written = []
+    for chunk_written, errors in results:
+        written.extend(chunk_written)
+        for error in errors:
+            logger.info("%s", error)
+    return written
+
+
+def _write_forms(folder, count):
+    '''Write count forms for the benchmark.'''
+    # pylint: disable=import-outside-toplevel
+    from .outbox_index import BENCH_FORM
+    body = "Lorem ipsum dolor sit amet. " * 10
+    for num in range(count):
+        with open(os.path.join(folder, "msg%06i.xml" % num), "w") as handle:
+            handle.write(BENCH_FORM % {"num": num, "body": body,
+                                       "dst": "N%03i" % (num % 50)})
+
+
+def _import_per_file(files, folder, store):
+    '''Import forms one at a time, the way the message list did.'''
+    for filename in files:
+        fields = check_form(filename)
+        name = os.path.basename(filename)
+        shutil.copy2(filename, os.path.join(folder, name))
+        store.set_headers(folder, name,
+                          stamp=os.stat(os.path.join(folder, name)).st_mtime,
+                          **fields)
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def benchmark(count, processes=None):
+    '''
+    Benchmark importing, reindexing and exporting count forms.
+
+    :param count: Number of forms
+    :type count: int
+    :param processes: Number of worker processes, default the CPU count
+    :type processes: int
+    :returns: True if the forms made it through unchanged
+    :rtype: bool
+    '''
+    logger = logging.getLogger("FormStore.bench")
+    with tempfile.TemporaryDirectory() as work_dir:
+        source = os.path.join(work_dir, "source")
+        os.mkdir(source)
+        _write_forms(source, count)
+        store = MessageStore(os.path.join(work_dir, STORE_FILE))
+
+        # The per file path commits each form, time a sample of it.
+        sample = sorted(glob.glob(os.path.join(source, "*.xml")))[:1000]
+        single = os.path.join(work_dir, "Single")
+        os.mkdir(single)
+        start = time.perf_counter()
+        _import_per_file(sample, single, store)
+        per_file = (time.perf_counter() - start) / len(sample)
+        logger.info("one at a time: %7.1f usec per form", per_file * 1e6)
+
+        inbox = os.path.join(work_dir, "Inbox")
+        attachment_dir = os.path.join(work_dir, ATTACHMENT_DIR)
+        for label, function, args in (
+                ("import", import_forms,
+                 ([source], inbox, store, attachment_dir)),
+                ("reindex", reindex_folder, (inbox, store)),
+                ("export", export_forms,
+                 (inbox, os.path.join(work_dir, "out"), attachment_dir))):
+            start = time.perf_counter()
+            result = function(*args, processes=processes)
+            elapsed = time.perf_counter() - start
+            logger.info("%-13s %7.1f usec per form, %.1f s for %i forms",
+                        label + ":", elapsed / count * 1e6, elapsed,
+                        result if isinstance(result, int) else len(result))
+
+        info = store.get_info(inbox, "msg000007.xml")
+        passed = len(store.messages(inbox)) == count and \
+            info.subject == "Test message 7" and info.path_dst == "N007"
+        with open(os.path.join(source, "msg000007.xml"), "rb") as old, \
+                open(os.path.join(work_dir, "out", "msg000007.xml"),
+                     "rb") as new:
+            passed = passed and old.read() == new.read()
+        store.close()
+    return passed
+
+
+def main():
+    '''Batch import, export and reindex of the form store.'''
+    platform = Platform.get_platform()
+    parser = argparse.ArgumentParser(
+        prog="python -m d_rats.formstore",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="D-RATS form store batch import and export")
+    parser.add_argument("-c", "--config",
+                        default=platform.config_dir(),
+                        help="Use alternate configuration directory")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="Worker processes, default the CPU count")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("import", help="Import forms into a folder")
+    cmd.add_argument("folder", help="Folder, like Inbox")
+    cmd.add_argument("sources", nargs="+",
+                     help="Form files or directories of form files")
+    cmd = commands.add_parser("export",
+                              help="Export the forms of a folder with "
+                                   "their attachments inlined")
+    cmd.add_argument("folder", help="Folder, like Sent")
+    cmd.add_argument("out_dir", help="Directory to write the forms in")
+    cmd = commands.add_parser("reindex",
+                              help="Read the forms of folders into the "
+                                   "message store again")
+    cmd.add_argument("folders", nargs="+", help="Folders, like Inbox")
+    cmd = commands.add_parser("bench", help="Benchmark with generated forms")
+    cmd.add_argument("-n", "--count", type=int, default=100000,
+                     help="Number of forms")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("FormStore")
+
+    if args.command == "bench":
+        passed = benchmark(args.count, args.processes)
+        logger.info("%s", ("FAIL", "PASS")[passed])
+        sys.exit(not passed)
+
+    platform.set_config_dir(args.config)
+    store_dir = platform.config_file(STORE_DIR)
+    store = MessageStore.get_store(platform.config_file(STORE_FILE))
+    if args.command == "import":
+        count = import_forms(args.sources,
+                             os.path.join(store_dir, args.folder), store,
+                             platform.config_file(ATTACHMENT_DIR),
+                             args.processes, logger)
+        logger.info("Imported %i forms into %s", count, args.folder)
+    elif args.command == "export":
+        written = export_forms(os.path.join(store_dir, args.folder),
+                               args.out_dir,
+                               platform.config_file(ATTACHMENT_DIR),
+                               args.processes, logger)
+        logger.info("Exported %i forms from %s", len(written), args.folder)
+    else:
+        for folder in args.folders:
+            count = reindex_folder(os.path.join(store_dir, folder), store,
+                                   args.processes, logger)
+            logger.info("Indexed %i forms in %s", count, folder)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/python
+'''Forward Scheduler.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+import threading
+import time
+
+# Priority classes, lower is sent first.  The names follow the
+# precedence used by the radiogram and ICS-213 forms.
+PRIORITY_EMERGENCY = 0
+PRIORITY_PRIORITY = 1
+PRIORITY_WELFARE = 2
+PRIORITY_ROUTINE = 3
+
+PRIORITY_NAMES = {PRIORITY_EMERGENCY: "Emergency",
+                  PRIORITY_PRIORITY: "Priority",
+                  PRIORITY_WELFARE: "Welfare",
+                  PRIORITY_ROUTINE: "Routine"}
+
+_PRECEDENCE = {name.upper(): value for value, name in PRIORITY_NAMES.items()}
+
+# Seconds a next hop is considered busy without hearing back about
+# the message sent to it.
+BUSY_TIMEOUT = 300
+
+
+def message_priority(entry):
+    '''
+    Message priority.
+
+    The precedence field of the form sets the priority.  ICS-213
+    forms are sent at least at Priority.
+
+    :param entry: Outbox entry
+    :type entry: :class:`OutboxEntry`
+    :returns: Priority class, one of the PRIORITY_* values
+    :rtype: int
+    '''
+    priority = _PRECEDENCE.get(entry.precedence.upper(), PRIORITY_ROUTINE)
+    if entry.ident.upper().startswith("ICS213"):
+        priority = min(priority, PRIORITY_PRIORITY)
+    return priority
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class ForwardBatch:
+    '''
+    Forward Batch.
+
+    Messages going to the same next hop over the same port, sent one
+    after the other without waiting for another routing pass.
+
+    :param next_hop: Station the messages are handed to
+    :type next_hop: str
+    :param port: Radio port
+    :type port: str
+    '''
+
+    def __init__(self, next_hop, port):
+        self.next_hop = next_hop
+        self.port = port
+        self.pending = []
+        self.current = None
+        self.sent = 0
+        self.failed = 0
+        self.last_activity = 0
+        self._queued = set()
+
+    def add(self, entry):
+        '''
+        Add a message to the batch.
+
+        :param entry: Outbox entry
+        :type entry: :class:`OutboxEntry`
+        '''
+        if entry.filename in self._queued:
+            return
+        self._queued.add(entry.filename)
+        heapq.heappush(self.pending, (message_priority(entry), entry.mtime,
+                                      entry.filename, entry))
+
+    def priority(self):
+        '''
+        Priority.
+
+        :returns: Best priority class waiting in the batch
+        :rtype: int
+        '''
+        if self.pending:
+            return self.pending[0][0]
+        return PRIORITY_ROUTINE
+
+    def sort_key(self):
+        '''
+        Sort key.
+
+        :returns: Key that orders the most urgent and oldest batch first
+        :rtype: tuple
+        '''
+        if self.pending:
+            return self.pending[0][:2]
+        return (PRIORITY_ROUTINE, 0)
+
+    def pop(self):
+        '''
+        Pop the next message to send.
+
+        :returns: Outbox entry or None if the batch is empty
+        :rtype: :class:`OutboxEntry`
+        '''
+        if not self.pending:
+            self.current = None
+            return None
+        entry = heapq.heappop(self.pending)[3]
+        self._queued.discard(entry.filename)
+        self.current = entry
+        return entry
+
+    def __str__(self):
+        return "%s via %s" % (self.next_hop, self.port)
+
+
+class ForwardScheduler:
+    '''
+    Forward Scheduler.
+
+    Schedules the messages the router has found a next hop for.  The
+    messages for one next hop and port are sent as a batch, one after
+    the other as each transfer finishes, so the next message does not
+    wait for the next routing pass.  Batches are started most urgent
+    first, with at most port_limit batches active on a port.  An
+    active batch gives up its port after the current message when a
+    more urgent batch is waiting for that port.
+
+    The router calls :meth:`schedule` from its thread and
+    :meth:`done` from the GUI thread, so the state is locked.
+
+    :param port_limit: Batches active at once on a port, default 1
+    :type port_limit: int
+    :param batch_limit: Messages sent before the batch gives up the
+                        port to let others in, default 25
+    :type batch_limit: int
+    :param busy_timeout: Seconds without progress before a batch is
+                         dropped, default BUSY_TIMEOUT
+    :type busy_timeout: float
+    '''
+
+    logger = logging.getLogger("ForwardScheduler")
+
+    def __init__(self, port_limit=1, batch_limit=25,
+                 busy_timeout=BUSY_TIMEOUT):
+        self.port_limit = max(port_limit, 1)
+        self.batch_limit = max(batch_limit, 1)
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._active = {}
+        self._waiting = {}
+        self._files = {}
+
+    def _port_active(self, port):
+        return sum(1 for batch in self._active.values() if batch.port == port)
+
+    def _expire(self, now):
+        for key, batch in list(self._active.items()):
+            if now - batch.last_activity > self.busy_timeout:
+                self.logger.info("_expire: No progress on batch %s, "
+                                 "dropping it", batch)
+                del self._active[key]
+                if batch.current:
+                    self._files.pop(batch.current.filename, None)
+
+    def is_busy(self, next_hop):
+        '''
+        Is a next hop busy?
+
+        :param next_hop: Station messages are handed to
+        :type next_hop: str
+        :returns: True if a batch is active for the station
+        :rtype: bool
+        '''
+        with self._lock:
+            return any(key[0] == next_hop for key in self._active)
+
+    def schedule(self, candidates, now=None):
+        '''
+        Schedule messages that have a route.
+
+        Messages for a next hop that already has an active batch join
+        that batch.  Other messages are grouped into new batches, and
+        as many of them as the port limits allow are started.
+
+        :param candidates: Outbox entry, next hop and port of each message
+        :type candidates: list[tuple[:class:`OutboxEntry`, str, str]]
+        :param now: Current time, default time.time()
+        :type now: float
+        :returns: Batches started and the first message for each
+        :rtype: list[tuple[:class:`ForwardBatch`, :class:`OutboxEntry`]]
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._expire(now)
+            waiting = {}
+            for entry, next_hop, port in candidates:
+                if entry.filename in self._files:
+                    continue
+                key = (next_hop, port)
+                batch = self._active.get(key, None)
+                if batch is None:
+                    batch = waiting.get(key, None)
+                    if batch is None:
+                        batch = ForwardBatch(next_hop, port)
+                        waiting[key] = batch
+                batch.add(entry)
+
+            started = []
+            for key, batch in sorted(waiting.items(),
+                                     key=lambda item: item[1].sort_key()):
+                busy_hop = any(active[0] == key[0] for active in self._active)
+                if busy_hop or self._port_active(batch.port) >= \
+                        self.port_limit:
+                    continue
+                del waiting[key]
+                self._active[key] = batch
+                batch.last_activity = now
+                entry = batch.pop()
+                self._files[entry.filename] = batch
+                started.append((batch, entry))
+            self._waiting = waiting
+        for batch, entry in started:
+            self.logger.info("schedule: Starting %s batch %s, %i messages",
+                             PRIORITY_NAMES[message_priority(entry)], batch,
+                             len(batch.pending) + 1)
+        return started
+
+    def done(self, filename, failed, now=None):
+        '''
+        A message transfer finished.
+
+        :param filename: Message file name
+        :type filename: str
+        :param failed: True if the transfer failed
+        :type failed: bool
+        :param now: Current time, default time.time()
+        :type now: float
+        :returns: Batch and next message to send now, or None if the
+                  batch is finished and a routing pass should run
+        :rtype: tuple[:class:`ForwardBatch`, :class:`OutboxEntry`]
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            batch = self._files.pop(filename, None)
+            if batch is None:
+                return None
+            batch.last_activity = now
+            if failed:
+                # The station is not taking messages, the rest will
+                # be routed again by the next pass.
+                batch.failed += 1
+                self._release(batch)
+                return None
+            batch.sent += 1
+            if batch.sent % self.batch_limit == 0 or self._preempted(batch):
+                self._release(batch)
+                return None
+            entry = batch.pop()
+            if entry is None:
+                self._release(batch)
+                return None
+            self._files[entry.filename] = batch
+            return batch, entry
+
+    def skip(self, batch, entry):
+        '''
+        Skip a message that could not be sent.
+
+        :param batch: Batch the message is in
+        :type batch: :class:`ForwardBatch`
+        :param entry: Message that was skipped
+        :type entry: :class:`OutboxEntry`
+        :returns: Next message to send, or None if the batch is finished
+        :rtype: :class:`OutboxEntry`
+        '''
+        with self._lock:
+            self._files.pop(entry.filename, None)
+            next_entry = batch.pop()
+            if next_entry is None:
+                self._release(batch)
+                return None
+            self._files[next_entry.filename] = batch
+            return next_entry
+
+    def _preempted(self, batch):
+        '''
+        Is a more urgent batch waiting for the port of a batch?
+
+        :param batch: Active batch
+        :type batch: :class:`ForwardBatch`
+        :returns: True if the batch should give up its port
+        :rtype: bool
+        '''
+        for waiting in self._waiting.values():
+            if waiting.port == batch.port and \
+                    waiting.priority() < batch.priority():
+                return True
+        return False
+
+    def _release(self, batch):
+        self._active.pop((batch.next_hop, batch.port), None)
+        self.logger.info("_release: Batch %s done, %i sent, %i failed, "
+                         "%i left", batch, batch.sent, batch.failed,
+                         len(batch.pending))
+
+    def get_active(self):
+        '''
+        Get the active batches.
+
+        :returns: Active batches
+        :rtype: list[:class:`ForwardBatch`]
+        '''
+        with self._lock:
+            return list(self._active.values())
+
+
+class _SimEntry:
+    '''Stand in outbox entry for the simulation.'''
+
+    # pylint wants at least 2 public methods
+    # pylint: disable=too-few-public-methods
+    def __init__(self, num, dst, precedence="", ident="email"):
+        self.filename = "msg%05i.xml" % num
+        self.dst = dst
+        self.precedence = precedence
+        self.ident = ident
+        self.mtime = num
+
+
+# Seconds to start a session and get the first ACK, to send one form,
+# and between routing passes, for the simulation.
+SIM_LINK = {"setup": 8.0, "transfer": 12.0, "flush": 30.0}
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def simulate(logger, batched, messages, urgent_at, link=None):
+    '''
+    Simulate a backlog going over one radio link.
+
+    :param logger: Logger object
+    :type logger: :class:`logging.Logger`
+    :param batched: True to use the scheduler, False for the old
+                    one message per port per routing pass
+    :type batched: bool
+    :param messages: Number of routine messages in the backlog
+    :type messages: int
+    :param urgent_at: Time an Emergency message is queued
+    :type urgent_at: float
+    :param link: Setup, transfer and flush seconds, default SIM_LINK
+    :type link: dict
+    :returns: Seconds to deliver everything, and the urgent message
+    :rtype: tuple[float, float]
+    '''
+    link = link or SIM_LINK
+    calls = ["N%i" % (i % 4) for i in range(messages)]
+    queue = [_SimEntry(i, calls[i]) for i in range(messages)]
+    urgent = _SimEntry(messages, "N0", "Emergency")
+    scheduler = ForwardScheduler()
+    clock = 0.0
+    urgent_done = None
+    next_pass = 0.0
+
+    while queue or (clock < urgent_at and urgent_done is None):
+        if urgent_done is None and clock >= urgent_at and \
+                urgent not in queue:
+            queue.append(urgent)
+        clock = max(clock, next_pass)
+        next_pass = clock + link["flush"]
+        if batched:
+            # All stations are reached through the one relay.
+            started = scheduler.schedule([(entry, "RELAY", "port")
+                                          for entry in queue], clock)
+        else:
+            # Dict order of destinations, one message per pass.
+            started = [(None, queue[0])] if queue else []
+        for _batch, entry in started:
+            # Each form is sent in its own session, back to back.
+            while entry:
+                clock += link["setup"] + link["transfer"]
+                queue.remove(entry)
+                if entry is urgent:
+                    urgent_done = clock - urgent_at
+                if not batched:
+                    break
+                if urgent_done is None and clock >= urgent_at and \
+                        urgent not in queue:
+                    # The new message is seen by the next pass
+                    queue.append(urgent)
+                    scheduler.schedule([(urgent, "RELAY", "port")], clock)
+                result = scheduler.done(entry.filename, False, clock)
+                entry = result[1] if result else None
+            if batched:
+                # A finished batch triggers a pass right away.
+                next_pass = clock
+    logger.info("%s: %i messages delivered in %.0f sec, "
+                "Emergency message after %.0f sec",
+                "scheduler" if batched else "one per pass",
+                messages + 1, clock, urgent_done)
+    return clock, urgent_done
+
+
+def main():
+    '''Unit test and simulated link benchmark with a 200 message backlog.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logging.getLogger("ForwardScheduler").setLevel(logging.WARNING)
+    logger = logging.getLogger("ForwardScheduler.test")
+    logger.setLevel(logging.INFO)
+
+    old_total, old_urgent = simulate(logger, False, 200, 600)
+    new_total, new_urgent = simulate(logger, True, 200, 600)
+    if new_total < old_total and new_urgent < old_urgent:
+        logger.info("PASS")
+    else:
+        logger.info("FAIL")
+
+
+if __name__ == "__main__":
+    main()
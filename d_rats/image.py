@@ -10,8 +10,9 @@ if __name__ == "__main__":
 
 HAVE_PIL = False
 try:
-    from PIL import Image
     from PIL import UnidentifiedImageError
+    from .image_pipeline import ImagePipeline
+    from .image_pipeline import SIZES
     HAVE_PIL = True
 except ImportError:
     # This needs to be moved out of main_common
@@ -19,6 +20,7 @@ except ImportError:
 
 import gi
 gi.require_version("Gtk", "3.0")
+from gi.repository import GLib
 from gi.repository import Gtk
 
 if not '_' in locals():
@@ -30,63 +32,88 @@ from . import inputdialog
 from . import miscwidgets
 # from . import dplatform #imported by kater apparently not used...
 
-SIZES = [
-    "160x120",
-    "320x240",
-    "640x480",
-    "1024x768",
-    "Original Size",
-    "10%",
-    "20%",
-    "30%",
-    "40%",
-    "50%",
-    "60%",
-    "70%",
-    "80%",
-    "90%",
-    ]
-
-
 def update_image(filename, dlg):
     '''
     Update Image.
 
+    The image is resized and encoded in a worker thread, and the
+    preview is updated when it is done.
+
+    :param filename: Filename for image
+    :type filename: str
     :param dlg: Dialog widget
     :type dlg: :class:`Gtk.Widget`
     '''
-    logger = logging.getLogger("update_image")
     reqsize = dlg.size.get_active_text()
-    if "x" in reqsize:
-        _h, _w = reqsize.split("x")
+    if reqsize != dlg.estimated:
+        dlg.estimated = reqsize
+        dlg.quality_scale.clear_marks()
+        for quality, future in dlg.pipeline.estimates(reqsize).items():
+            future.add_done_callback(
+                lambda future, quality=quality: GLib.idle_add(
+                    show_estimate, dlg, reqsize, quality, future))
+    dlg.pipeline.preview(
+        reqsize, dlg.quality,
+        lambda reqsize, quality, data: GLib.idle_add(
+            show_image, filename, dlg, reqsize, quality, data))
+
+
+def show_estimate(dlg, reqsize, quality, future):
+    '''
+    Show the size estimate for a quality on the quality scale.
 
-        height = int(_h)
-        width = int(_w)
-    elif "%" in reqsize:
-        factor = float(reqsize[0:2]) / 100.0
-        height, width = dlg.image.size
+    :param dlg: Dialog widget
+    :type dlg: :class:`Gtk.Widget`
+    :param reqsize: Resize choice of the estimate
+    :type reqsize: str
+    :param quality: Quality of the estimate
+    :type quality: int
+    :param future: Future with the encoded size
+    :type future: :class:`concurrent.futures.Future`
+    :returns: False to run once
+    :rtype: bool
+    '''
+    if dlg.pipeline and reqsize == dlg.estimated and \
+            not future.exception():
+        dlg.quality_scale.add_mark(quality, Gtk.PositionType.BOTTOM,
+                                   "%i" % (future.result() >> 10))
+    return False
 
-        width = int(width * factor)
-        height = int(height * factor)
-    else:
-        height, width = dlg.image.size
 
-    resized = dlg.image.resize((height, width))
+# pylint wants a max of 5 arguments
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def show_image(filename, dlg, reqsize, quality, data):
+    '''
+    Show an encoded image in the dialog.
 
+    :param filename: Filename for image
+    :type filename: str
+    :param dlg: Dialog widget
+    :type dlg: :class:`Gtk.Widget`
+    :param reqsize: Resize choice of the image
+    :type reqsize: str
+    :param quality: Quality of the image
+    :type quality: int
+    :param data: JPEG data
+    :type data: bytes
+    :returns: False to run once
+    :rtype: bool
+    '''
+    logger = logging.getLogger("update_image")
+    if dlg.pipeline is None:
+        return False
     (base, _ext) = os.path.splitext(os.path.basename(filename))
     dlg.resized = os.path.join(tempfile.gettempdir(),
                                "resized_" + base + ".jpg")
-    resized.save(dlg.resized, quality=dlg.quality)
+    with open(dlg.resized, "wb") as file_handle:
+        file_handle.write(data)
+    dlg.shown = (reqsize, quality)
 
     logger.info("Saved to %s", dlg.resized)
 
-    file_handle = open(dlg.resized)
-    file_handle.seek(0, 2)
-    size = file_handle.tell()
-    file_handle.close()
-
-    dlg.sizelabel.set_text("%i KB" % (size >> 10))
+    dlg.sizelabel.set_text("%i KB" % (len(data) >> 10))
     dlg.preview.set_from_file(dlg.resized)
+    return False
 
 
 def set_quality(_scale, _event, value, dlg):
@@ -103,13 +130,14 @@ def set_quality(_scale, _event, value, dlg):
     dlg.update()
 
 
-def build_image_dialog(filename, image, dialog_parent=None):
+def build_image_dialog(filename, pipeline, dialog_parent=None):
     '''
     Build Image Dialog.
 
     :param filename: Filename for image
     :type filename: str
-    :param image: Image
+    :param pipeline: Image pipeline
+    :type pipeline: :class:`ImagePipeline`
     :param dialog_parent: Parent widget
     :type dialog_parent: :class:`Gtk.Widget`
     :returns: Field Dialog
@@ -138,6 +166,7 @@ def build_image_dialog(filename, image, dialog_parent=None):
                     lambda s, v: "%i" % v)
     quality.connect("change-value", set_quality, dialog)
     dialog.add_field(_("Quality"), quality)
+    dialog.quality_scale = quality
 
     dialog.preview = Gtk.Image()
     dialog.preview.show()
@@ -148,9 +177,12 @@ def build_image_dialog(filename, image, dialog_parent=None):
 
     dialog.set_size_request(400, 450)
 
-    dialog.image = image
+    dialog.pipeline = pipeline
     dialog.resized = None
+    dialog.shown = None
+    dialog.estimated = None
     dialog.quality = 50
+    pipeline.start(SIZES[1])
 
     dialog.update = update
     dialog.update()
@@ -175,7 +207,7 @@ def send_image(filename, dialog_parent=None):
             return filename
         return None
     try:
-        img = Image.open(filename)
+        pipeline = ImagePipeline(filename)
     except UnidentifiedImageError:
         dialog = Gtk.MessageDialog(buttons=Gtk.BUTTONS_OK, parent=dialog_parent)
         dialog.set_property("text", _("Unknown image type"))
@@ -183,11 +215,16 @@ def send_image(filename, dialog_parent=None):
         dialog.destroy()
         return None
 
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
-    dialog = build_image_dialog(filename, img, dialog_parent)
+    dialog = build_image_dialog(filename, pipeline, dialog_parent)
     run_status = dialog.run()
+    if run_status == Gtk.ResponseType.OK:
+        # Save the settings chosen if the preview has not caught up.
+        wanted = (dialog.size.get_active_text(), dialog.quality)
+        if dialog.shown != wanted:
+            show_image(filename, dialog, *wanted, pipeline.encode(*wanted))
     temp_file = dialog.resized
+    dialog.pipeline = None
+    pipeline.close()
     dialog.destroy()
 
     if run_status == Gtk.ResponseType.OK:
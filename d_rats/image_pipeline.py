@@ -0,0 +1,582 @@
+#!/usr/bin/python
+'''Image Pipeline.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from PIL import ImageFilter
+
+SIZES = [
+    "160x120",
+    "320x240",
+    "640x480",
+    "1024x768",
+    "Original Size",
+    "10%",
+    "20%",
+    "30%",
+    "40%",
+    "50%",
+    "60%",
+    "70%",
+    "80%",
+    "90%",
+    ]
+
+# Qualities that size estimates are made for
+QUALITIES = tuple(range(10, 101, 10))
+
+# Lowest quality an image is sent with to fit a byte budget
+MIN_QUALITY = 10
+
+# PIL releases the GIL while it resizes and encodes, so the
+# workers run in parallel.
+PIPELINE_WORKERS = max(2, os.cpu_count() or 1)
+
+# Images read at the same time by a batch
+BATCH_WORKERS = 2
+
+# Encoded images kept for each image
+KEEP_ENCODED = 4
+
+
+class ImagePipelineError(Exception):
+    '''Image can not be fit in the budget Exception.'''
+
+
+def scaled_size(size, reqsize):
+    '''
+    Get the size of an image for a resize choice.
+
+    :param size: Width and height of the image
+    :type size: tuple[int, int]
+    :param reqsize: Choice from SIZES
+    :type reqsize: str
+    :returns: Width and height to resize to
+    :rtype: tuple[int, int]
+    '''
+    if "x" in reqsize:
+        width, height = reqsize.split("x")
+        return int(width), int(height)
+    if "%" in reqsize:
+        factor = float(reqsize[0:2]) / 100.0
+        return max(1, int(size[0] * factor)), max(1, int(size[1] * factor))
+    return size
+
+
+def encode_jpeg(image, quality):
+    '''
+    Encode an image as a JPEG.
+
+    :param image: Image
+    :type image: :class:`PIL.Image.Image`
+    :param quality: JPEG quality, 1 to 100
+    :type quality: int
+    :returns: JPEG data
+    :rtype: bytes
+    '''
+    out = io.BytesIO()
+    # Image.save keeps its options on the image, so encoding one image
+    # at two qualities at once needs a copy for each.
+    image.copy().save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def parse_budget(text):
+    '''
+    Parse a byte budget like 20K.
+
+    :param text: Bytes, with an optional K or M suffix
+    :type text: str
+    :returns: Bytes
+    :rtype: int
+    :raises: ValueError if the text is not a budget
+    '''
+    text = text.strip().upper().rstrip("B")
+    scale = {"K": 1 << 10, "M": 1 << 20}.get(text[-1:], 1)
+    if scale > 1:
+        text = text[:-1]
+    return int(float(text) * scale)
+
+
+# pylint wants a max of 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class ImagePipeline:
+    '''
+    Image Pipeline.
+
+    Decodes an image once and keeps it resized for each of the SIZES
+    choices.  The resizing and the JPEG encoding run in a shared pool
+    of worker threads, so a dialog only waits for the results it shows.
+
+    :param filename: Image file
+    :type filename: str
+    :param sizes: Resize choices, default SIZES
+    :type sizes: list[str]
+    :raises: :class:`PIL.UnidentifiedImageError` if the image type is
+             not known
+    '''
+
+    logger = logging.getLogger("ImagePipeline")
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, filename, sizes=None):
+        self.filename = filename
+        self.sizes = list(sizes or SIZES)
+        self._image = Image.open(filename)
+        self.size = self._image.size
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._decode_lock = threading.Lock()
+        self._levels = {}
+        self._level_locks = {}
+        self._estimates = {}
+        self._encoded = OrderedDict()
+        self._wanted = None
+        self._previewing = False
+        self._closed = False
+
+    @classmethod
+    def get_executor(cls):
+        '''
+        Get the worker threads shared by all pipelines.
+
+        :returns: Executor
+        :rtype: :class:`concurrent.futures.ThreadPoolExecutor`
+        '''
+        with cls._executor_lock:
+            if not cls._executor:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=PIPELINE_WORKERS,
+                    thread_name_prefix="ImagePipeline")
+            return cls._executor
+
+    def start(self, first=None):
+        '''
+        Start building the resized images in a worker thread.
+
+        :param first: Resize choice to build first, default None
+        :type first: str
+        '''
+        order = sorted(self.sizes, key=lambda choice: choice != first)
+        self.get_executor().submit(self._build_pyramid, order)
+
+    def close(self):
+        '''Drop the decoded images and any work not started yet.'''
+        with self._lock:
+            self._closed = True
+            self._levels.clear()
+            self._encoded.clear()
+            self._wanted = None
+
+    def _source(self):
+        '''Decode the image the first time it is needed.'''
+        with self._decode_lock:
+            if not self._loaded:
+                image = self._image
+                image.load()
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+                self._image = image
+                self._loaded = True
+            return self._image
+
+    def _level_lock(self, reqsize):
+        with self._lock:
+            return self._level_locks.setdefault(reqsize, threading.Lock())
+
+    def level(self, reqsize):
+        '''
+        Get the image resized for a choice.
+
+        :param reqsize: Choice from SIZES
+        :type reqsize: str
+        :returns: Resized image
+        :rtype: :class:`PIL.Image.Image`
+        '''
+        with self._level_lock(reqsize):
+            image = self._levels.get(reqsize, None)
+            if image is None:
+                source = self._source()
+                size = scaled_size(self.size, reqsize)
+                if size == source.size:
+                    image = source
+                else:
+                    image = source.resize(size, reducing_gap=3.0)
+                with self._lock:
+                    if not self._closed:
+                        self._levels[reqsize] = image
+            return image
+
+    def _build_pyramid(self, order):
+        for reqsize in order:
+            if self._closed:
+                return
+            self.level(reqsize)
+
+    def encode(self, reqsize, quality):
+        '''
+        Encode the image for a choice and quality.
+
+        :param reqsize: Choice from SIZES
+        :type reqsize: str
+        :param quality: JPEG quality
+        :type quality: int
+        :returns: JPEG data
+        :rtype: bytes
+        '''
+        key = (reqsize, quality)
+        with self._lock:
+            data = self._encoded.get(key, None)
+            if data is not None:
+                self._encoded.move_to_end(key)
+                return data
+        data = encode_jpeg(self.level(reqsize), quality)
+        with self._lock:
+            self._estimates[key] = len(data)
+            if not self._closed:
+                self._encoded[key] = data
+                while len(self._encoded) > KEEP_ENCODED:
+                    self._encoded.popitem(last=False)
+        return data
+
+    def estimate(self, reqsize, quality):
+        '''
+        Get the encoded size for a choice and quality.
+
+        :param reqsize: Choice from SIZES
+        :type reqsize: str
+        :param quality: JPEG quality
+        :type quality: int
+        :returns: Bytes
+        :rtype: int
+        '''
+        with self._lock:
+            size = self._estimates.get((reqsize, quality), None)
+        if size is None:
+            size = len(encode_jpeg(self.level(reqsize), quality))
+            with self._lock:
+                self._estimates[(reqsize, quality)] = size
+        return size
+
+    def estimates(self, reqsize, qualities=QUALITIES):
+        '''
+        Estimate the encoded sizes for the qualities in parallel.
+
+        :param reqsize: Choice from SIZES
+        :type reqsize: str
+        :param qualities: JPEG qualities, default QUALITIES
+        :type qualities: tuple[int]
+        :returns: Futures of the size for each quality
+        :rtype: dict[int, :class:`concurrent.futures.Future`]
+        '''
+        executor = self.get_executor()
+        return {quality: executor.submit(self.estimate, reqsize, quality)
+                for quality in qualities}
+
+    def preview(self, reqsize, quality, callback):
+        '''
+        Encode the image for a choice and quality in a worker thread.
+
+        Requests made while an encode is running replace each other,
+        so dragging the quality slider only encodes the settings that
+        are still wanted when a worker gets to them.
+
+        :param reqsize: Choice from SIZES
+        :type reqsize: str
+        :param quality: JPEG quality
+        :type quality: int
+        :param callback: Called from the worker with the results
+        :type callback: function(str, int, bytes)
+        '''
+        with self._lock:
+            self._wanted = (reqsize, quality, callback)
+            if self._previewing:
+                return
+            self._previewing = True
+        self.get_executor().submit(self._preview_job)
+
+    def _preview_job(self):
+        while True:
+            with self._lock:
+                wanted = self._wanted
+                self._wanted = None
+                if wanted is None or self._closed:
+                    self._previewing = False
+                    return
+            reqsize, quality, callback = wanted
+            try:
+                callback(reqsize, quality, self.encode(reqsize, quality))
+            # A failed callback must not leave the preview stuck.
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("_preview_job: %s %s %i",
+                                      self.filename, reqsize, quality)
+
+    def _smaller(self, reqsize):
+        '''Key to order choices from the fewest pixels to the most.'''
+        width, height = scaled_size(self.size, reqsize)
+        return width * height, reqsize
+
+    def fit(self, budget, min_quality=MIN_QUALITY):
+        '''
+        Find the largest size and best quality that fit a byte budget.
+
+        :param budget: Most bytes the encoded image may take
+        :type budget: int
+        :param min_quality: Lowest quality to use, default MIN_QUALITY
+        :type min_quality: int
+        :returns: Choice, quality and JPEG data
+        :rtype: tuple[str, int, bytes]
+        :raises: :class:`ImagePipelineError` if even the smallest size
+                 is too big
+        '''
+        choices = sorted(set(self.sizes), key=self._smaller)
+        low = 0
+        high = len(choices)
+        while low < high:
+            mid = (low + high) // 2
+            if self.estimate(choices[mid], min_quality) <= budget:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            raise ImagePipelineError(
+                "%s does not fit in %i bytes" % (self.filename, budget))
+        reqsize = choices[low - 1]
+        qualities = [quality for quality in QUALITIES
+                     if quality > min_quality]
+        quality = min_quality
+        for test, future in self.estimates(reqsize, qualities).items():
+            if future.result() <= budget:
+                quality = max(quality, test)
+        return reqsize, quality, self.encode(reqsize, quality)
+
+
+def _fit_image(filename, budget, out_dir, min_quality):
+    pipeline = ImagePipeline(filename)
+    try:
+        reqsize, quality, data = pipeline.fit(budget, min_quality)
+    finally:
+        pipeline.close()
+    base = os.path.splitext(os.path.basename(filename))[0]
+    resized = os.path.join(out_dir, "resized_" + base + ".jpg")
+    with open(resized, "wb") as handle:
+        handle.write(data)
+    return resized, reqsize, quality, len(data)
+
+
+# pylint wants a max of 5 arguments
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def fit_images(filenames, budget, out_dir=None, min_quality=MIN_QUALITY,
+               workers=BATCH_WORKERS, logger=None):
+    '''
+    Resize and recompress images to fit a byte budget each.
+
+    :param filenames: Image files
+    :type filenames: list[str]
+    :param budget: Most bytes for each image
+    :type budget: int
+    :param out_dir: Directory to write to, default the temporary directory
+    :type out_dir: str
+    :param min_quality: Lowest quality to use, default MIN_QUALITY
+    :type min_quality: int
+    :param workers: Images read at the same time, default BATCH_WORKERS
+    :type workers: int
+    :param logger: Logger for images that can not be fit, default None
+    :type logger: :class:`logging.Logger`
+    :returns: Resized file, choice, quality and bytes for each image,
+              or None if it can not be fit
+    :rtype: list[tuple[str, str, int, int]]
+    '''
+    out_dir = out_dir or tempfile.gettempdir()
+    results = []
+    # The images get their own threads, since they wait for the
+    # resize and encode jobs in the shared pipeline workers.
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix="ImageBatch") as batch:
+        futures = [batch.submit(_fit_image, filename, budget, out_dir,
+                                min_quality)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                results.append(future.result())
+            except (OSError, ImagePipelineError) as err:
+                if logger:
+                    logger.info("fit_images: %s", err)
+                results.append(None)
+    return results
+
+
+def _write_photo(filename, size, seed):
+    '''Write a photo-like test image.'''
+    photo = Image.effect_noise(size, 40 + seed % 30)
+    photo = Image.merge("RGB", (
+        photo,
+        Image.linear_gradient("L").resize(size),
+        photo.filter(ImageFilter.GaussianBlur(2 + seed % 3))))
+    photo.save(filename, quality=92)
+
+
+# pylint wants a max of 5 arguments
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def _record_preview(shown, done, last, _reqsize, quality, data):
+    '''Record a preview like the send image dialog shows it.'''
+    shown.append((quality, len(data)))
+    if quality == last:
+        done.set()
+
+
+def _old_update(image, filename, reqsize, quality):
+    '''Resize and save an image like update_image did before.'''
+    resized = image.resize(scaled_size(image.size, reqsize))
+    base = os.path.splitext(os.path.basename(filename))[0]
+    name = os.path.join(tempfile.gettempdir(), "resized_" + base + ".jpg")
+    resized.save(name, quality=quality)
+    return os.path.getsize(name)
+
+
+# pylint wants a max of 15 local variables
+# pylint: disable=too-many-locals
+def benchmark(count, logger):
+    '''
+    Benchmark preparing photos the way the send image dialog does.
+
+    :param count: Number of photos
+    :type count: int
+    :param logger: Logger for the results
+    :type logger: :class:`logging.Logger`
+    :returns: True if the results check out
+    :rtype: bool
+    '''
+    work_dir = tempfile.mkdtemp(prefix="image_pipeline_")
+    passed = True
+    try:
+        files = []
+        for num in range(count):
+            files.append(os.path.join(work_dir, "photo%i.jpg" % num))
+            _write_photo(files[-1], (2592, 1944), num)
+        drag = list(range(50, 91, 5))
+
+        old_ui = new_ui = 0.0
+        prep = []
+        for filename in files:
+            # Before: every change of the slider resized and encoded
+            # the full image on the GTK thread.
+            start = time.perf_counter()
+            image = Image.open(filename).convert("RGB")
+            old_sizes = [_old_update(image, filename, SIZES[1], quality)
+                         for quality in drag]
+            old_ui += time.perf_counter() - start
+
+            begin = time.perf_counter()
+            pipeline = ImagePipeline(filename)
+            pipeline.start(SIZES[1])
+            done = threading.Event()
+            shown = []
+            ui_time = time.perf_counter() - begin
+            show = functools.partial(_record_preview, shown, done, drag[-1])
+
+            for quality in drag:
+                start = time.perf_counter()
+                pipeline.preview(SIZES[1], quality, show)
+                ui_time += time.perf_counter() - start
+            estimates = pipeline.estimates(SIZES[1])
+            done.wait()
+            sizes = {quality: future.result()
+                     for quality, future in estimates.items()}
+            prep.append(time.perf_counter() - begin)
+            new_ui += ui_time
+            # Only the last of the slider changes has to be shown.
+            passed = passed and shown[-1][0] == drag[-1] and \
+                list(sizes.values()) == sorted(sizes.values()) and \
+                abs(sizes[50] - old_sizes[0]) < old_sizes[0] // 10
+            pipeline.close()
+        logger.info("%i photos of 2592x1944, %i quality changes each",
+                    count, len(drag))
+        logger.info("GTK thread blocked: %8.1f ms before, %6.2f ms now "
+                    "per photo", old_ui * 1000 / count, new_ui * 1000 / count)
+        logger.info("Preprocessing:      %8.1f ms per photo, with "
+                    "estimates for %i qualities",
+                    sum(prep) * 1000 / count, len(QUALITIES))
+
+        budget = 20 << 10
+        start = time.perf_counter()
+        results = fit_images(files, budget, work_dir)
+        elapsed = time.perf_counter() - start
+        passed = passed and all(result and result[3] <= budget
+                                for result in results)
+        logger.info("Fit into %i KB:      %8.1f ms per photo (%s)",
+                    budget >> 10, elapsed * 1000 / count,
+                    ", ".join("%s q%i %i bytes" % result[1:]
+                              for result in results[:2]))
+    finally:
+        shutil.rmtree(work_dir)
+    return passed
+
+
+def main():
+    '''Fit images into a byte budget, or benchmark the pipeline.'''
+    parser = argparse.ArgumentParser(
+        prog="python -m d_rats.image_pipeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="D-RATS image resize and recompress")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("fit",
+                              help="Fit images into a byte budget each")
+    cmd.add_argument("-b", "--budget", type=parse_budget, default="20K",
+                     help="Most bytes for each image, like 20K")
+    cmd.add_argument("-q", "--min-quality", type=int, default=MIN_QUALITY,
+                     help="Lowest JPEG quality to use")
+    cmd.add_argument("-o", "--out-dir", default=tempfile.gettempdir(),
+                     help="Directory to write the resized images in")
+    cmd.add_argument("images", nargs="+", help="Image files")
+    cmd = commands.add_parser("bench", help="Benchmark with generated photos")
+    cmd.add_argument("-n", "--count", type=int, default=8,
+                     help="Number of photos")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("ImagePipeline.test")
+
+    if args.command == "bench":
+        passed = benchmark(args.count, logger)
+        logger.info("%s", ("FAIL", "PASS")[passed])
+        sys.exit(not passed)
+
+    results = fit_images(args.images, args.budget, args.out_dir,
+                         args.min_quality, logger=logger)
+    for filename, result in zip(args.images, results):
+        if result:
+            logger.info("%s: %s %s q%i %i bytes", filename, *result)
+    sys.exit(None in results)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,85 +16,536 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# The LZHUF algorithm is by Haruyasu Yoshizaki and Haruhiko Okumura.
+# This is the variant of the lzhuf program used for FBB B2 and
+# Winlink, with a 2048 byte window and a 4 byte little endian length
+# in front of the compressed data.
+
+import io
 import logging
 import os
-import tempfile
+import random
 import struct
 import subprocess
-import sys
+import tempfile
+import time
+import zlib
 
 from d_rats import crc_checksum
-from d_rats.dplatform import Platform
 
+# Size of the sliding window
+WINDOW = 2048
+# Longest match
+LOOKAHEAD = 60
+# Matches this long or shorter are sent as characters
+THRESHOLD = 2
 
-class Lzhuf():
-    '''Lzhuf.'''
+# Bytes read or written at a time by the stream functions
+STREAM_CHUNK = 64 * 1024
 
-    logger = logging.getLogger("Lzhuf")
-    lzhuf_path = None
+_NIL = WINDOW
+_N_CHAR = 256 - THRESHOLD + LOOKAHEAD
+_T = _N_CHAR * 2 - 1
+_R = _T - 1
+_MAX_FREQ = 0x8000
+_KEY_TOP = LOOKAHEAD - 1
 
-    @classmethod
-    def _set_lzhuf_path(cls):
-        if cls.lzhuf_path:
-            return
-        cls.lzhuf_path = Platform.get_exe_path('lzhuf')
+# Code lengths for the upper 6 bits of a match position.
+_P_LEN = [3] + [4] * 3 + [5] * 8 + [6] * 12 + [7] * 24 + [8] * 16
 
-    @classmethod
-    @property
-    def have_lzhuf(cls):
-        '''
-        Have lzhuf?
 
-        Do we have the lzhuf executable?
-        :returns: True if we have lzhuf
-        :rtype: bool
-        '''
-        cls._set_lzhuf_path()
-        if cls.lzhuf_path:
-            return True
-        return False
+def _make_tables():
+    '''
+    Make the position code tables of lzhuf.c.
 
-    @classmethod
-    def _run(cls, cmd, data):
+    :returns: p_code, d_code and d_len tables
+    :rtype: tuple[list[int], list[int], list[int]]
+    '''
+    p_code = []
+    d_code = []
+    d_len = []
+    code = 0
+    for index, length in enumerate(_P_LEN):
+        p_code.append(code)
+        count = 1 << (8 - length)
+        d_code.extend([index] * count)
+        d_len.extend([length] * count)
+        code += count
+    return p_code, d_code, d_len
+
+
+_P_CODE, _D_CODE, _D_LEN = _make_tables()
+
+
+class LzhufError(Exception):
+    '''LZHUF Data Error.'''
+
+
+class _Huffman:
+    '''
+    Adaptive Huffman tree of lzhuf.c, shared by encoder and decoder.
+    '''
+
+    __slots__ = ("freq", "prnt", "son")
+
+    def __init__(self):
+        freq = [1] * _N_CHAR + [0] * (_T + 1 - _N_CHAR)
+        son = list(range(_T, _T + _N_CHAR)) + [0] * (_T - _N_CHAR)
+        prnt = [0] * (_T + _N_CHAR)
+        for index in range(_N_CHAR):
+            prnt[index + _T] = index
+        index = 0
+        for node in range(_N_CHAR, _R + 1):
+            freq[node] = freq[index] + freq[index + 1]
+            son[node] = index
+            prnt[index] = prnt[index + 1] = node
+            index += 2
+        freq[_T] = 0xffff
+        prnt[_R] = 0
+        self.freq = freq
+        self.prnt = prnt
+        self.son = son
+
+    def reconst(self):
+        '''Rebuild the tree with the frequencies halved.'''
+        freq = self.freq
+        son = self.son
+        prnt = self.prnt
+        leaf = 0
+        for node in range(_T):
+            if son[node] >= _T:
+                freq[leaf] = (freq[node] + 1) // 2
+                son[leaf] = son[node]
+                leaf += 1
+        node = 0
+        for parent in range(_N_CHAR, _T):
+            total = freq[node] + freq[node + 1]
+            place = parent - 1
+            while total < freq[place]:
+                place -= 1
+            place += 1
+            freq.insert(place, total)
+            del freq[parent + 1]
+            son.insert(place, node)
+            del son[parent + 1]
+            node += 2
+        for node in range(_T):
+            child = son[node]
+            prnt[child] = node
+            if child < _T:
+                prnt[child + 1] = node
+
+    def update(self, char):
         '''
-        Run lzhuf internal.
+        Count a character and keep the tree in order.
 
-        :param cmd: lzhuf command
-        :type cmd: str
-        :param data: Data to process
-        :type data: bytes
-        :returns: Processed data
-        :rtype: bytes
+        :param char: Character or match length code
+        :type char: int
         '''
-        cls._set_lzhuf_path()
-        if not cls.lzhuf_path:
-            cls.logger.info("lzhuf binary not found")
-            return None
-        tmp_dir = tempfile.mkdtemp()
+        freq = self.freq
+        if freq[_R] == _MAX_FREQ:
+            self.reconst()
+        prnt = self.prnt
+        son = self.son
+        node = prnt[char + _T]
+        while True:
+            count = freq[node] + 1
+            freq[node] = count
+            other = node + 1
+            if count > freq[other]:
+                other += 1
+                while count > freq[other]:
+                    other += 1
+                other -= 1
+                freq[node] = freq[other]
+                freq[other] = count
 
-        with open(os.path.join(tmp_dir, "input"), "wb") as file_handle:
-            file_handle.write(data)
+                child = son[node]
+                prnt[child] = other
+                if child < _T:
+                    prnt[child + 1] = other
+                swap = son[other]
+                son[other] = child
+                prnt[swap] = node
+                if swap < _T:
+                    prnt[swap + 1] = node
+                son[node] = swap
+                node = other
+            node = prnt[node]
+            if node == 0:
+                return
 
-        kwargs = {}
-        if sys.platform == 'win32':
-            child = subprocess.STARTUPINFO()
-            child.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            child.wShowWindow = subprocess.SW_HIDE
-            kwargs["startupinfo"] = child
 
-        run = [cls.lzhuf_path, cmd, "input", "output"]
+def _iter_chunks(src):
+    '''
+    Read a file in chunks.
 
-        cls.logger.info("Running %s in %s", run, tmp_dir)
+    :param src: File to read
+    :type src: :class:`io.BufferedIOBase`
+    :returns: Chunks of the file
+    :rtype: iterator[bytes]
+    '''
+    while True:
+        chunk = src.read(STREAM_CHUNK)
+        if not chunk:
+            return
+        yield chunk
 
-        ret = subprocess.call(run, cwd=tmp_dir, **kwargs)
-        cls.logger.info("LZHUF returned %s", ret)
-        if ret:
-            return None
 
-        with open(os.path.join(tmp_dir, "output"), "rb") as file_handle:
-            data = file_handle.read()
+def _iter_bytes(src):
+    '''
+    Read a file a byte at a time.
+
+    :param src: File to read
+    :type src: :class:`io.BufferedIOBase`
+    :returns: Bytes of the file
+    :rtype: iterator[int]
+    '''
+    for chunk in _iter_chunks(src):
+        yield from chunk
+
+
+# pylint wants a maximum of 12 branches
+# pylint wants a maximum of 15 local variables
+# pylint wants a maximum of 50 statements
+# pylint: disable=too-many-branches, too-many-locals, too-many-statements
+def compress_stream(src, dst, size=None):
+    '''
+    Compress a stream like "lzhuf e".
+
+    :param src: Data to compress
+    :type src: :class:`io.BufferedIOBase`
+    :param dst: File for the compressed data
+    :type dst: :class:`io.BufferedIOBase`
+    :param size: Size of the data, default found by seeking in src
+    :type size: int
+    :returns: Size of the compressed data, with the length
+    :rtype: int
+    '''
+    if size is None:
+        start = src.tell()
+        size = src.seek(0, io.SEEK_END) - start
+        src.seek(start)
+    dst.write(struct.pack("<I", size))
+    if size == 0:
+        return 4
+
+    huff = _Huffman()
+    prnt = huff.prnt
+    update = huff.update
+    out = bytearray()
+    written = 4
+    acc = 0
+    acc_bits = 0
+
+    text_buf = bytearray(b" " * (WINDOW - LOOKAHEAD) +
+                         b"\0" * (2 * LOOKAHEAD - 1))
+    lson = [_NIL] * (WINDOW + 1)
+    rson = [_NIL] * (WINDOW + 257)
+    dad = [_NIL] * (WINDOW + 1)
+    keys = [0] * WINDOW
+    match = [0, 0]  # length, position
+
+    def insert_node(pos):
+        node = WINDOW + 1 + text_buf[pos]
+        # The strings are compared as numbers, the highest differing
+        # bit is in the first differing byte.  A string does not
+        # change while it is in the tree, so its number is kept.
+        key = int.from_bytes(text_buf[pos:pos + LOOKAHEAD], "big")
+        keys[pos] = key
+        rson[pos] = lson[pos] = _NIL
+        match_length = 0
+        match_position = 0
+        right = True
+        while True:
+            if right:
+                if rson[node] == _NIL:
+                    rson[node] = pos
+                    dad[pos] = node
+                    match[0] = match_length
+                    match[1] = match_position
+                    return
+                node = rson[node]
+            else:
+                if lson[node] == _NIL:
+                    lson[node] = pos
+                    dad[pos] = node
+                    match[0] = match_length
+                    match[1] = match_position
+                    return
+                node = lson[node]
+            other = keys[node]
+            diff = key ^ other
+            if not diff:
+                match[0] = LOOKAHEAD
+                match[1] = ((pos - node) & (WINDOW - 1)) - 1
+                break
+            right = key > other
+            index = _KEY_TOP - ((diff.bit_length() - 1) >> 3)
+            if index > THRESHOLD:
+                distance = ((pos - node) & (WINDOW - 1)) - 1
+                if index > match_length:
+                    match_position = distance
+                    match_length = index
+                elif index == match_length and distance < match_position:
+                    match_position = distance
+        # Full match, the new node takes the place of the old one.
+        dad[pos] = dad[node]
+        lson[pos] = lson[node]
+        rson[pos] = rson[node]
+        dad[lson[node]] = pos
+        dad[rson[node]] = pos
+        if rson[dad[node]] == node:
+            rson[dad[node]] = pos
+        else:
+            lson[dad[node]] = pos
+        dad[node] = _NIL
+
+    def delete_node(pos):
+        if dad[pos] == _NIL:
+            return
+        if rson[pos] == _NIL:
+            node = lson[pos]
+        elif lson[pos] == _NIL:
+            node = rson[pos]
+        else:
+            node = lson[pos]
+            if rson[node] != _NIL:
+                while rson[node] != _NIL:
+                    node = rson[node]
+                rson[dad[node]] = lson[node]
+                dad[lson[node]] = dad[node]
+                lson[node] = lson[pos]
+                dad[lson[pos]] = node
+            rson[node] = rson[pos]
+            dad[rson[pos]] = node
+        dad[node] = dad[pos]
+        if rson[dad[pos]] == pos:
+            rson[dad[pos]] = node
+        else:
+            lson[dad[pos]] = node
+        dad[pos] = _NIL
+
+    source = _iter_bytes(src)
+    read = 0
+    pos_s = 0
+    pos_r = WINDOW - LOOKAHEAD
+    length = 0
+    for char in source:
+        text_buf[pos_r + length] = char
+        length += 1
+        if length == LOOKAHEAD:
+            break
+    read = length
+    for index in range(1, LOOKAHEAD + 1):
+        insert_node(pos_r - index)
+    insert_node(pos_r)
+
+    while length > 0:
+        match_length = min(match[0], length)
+        if match_length <= THRESHOLD:
+            match_length = 1
+            char = text_buf[pos_r]
+        else:
+            char = 255 - THRESHOLD + match_length
 
-        return data
+        # Walk from the leaf to the root for the code of the character.
+        code = 0
+        code_bits = 0
+        node = prnt[char + _T]
+        while node != _R:
+            code = (code >> 1) | ((node & 1) << 15)
+            code_bits += 1
+            node = prnt[node]
+        update(char)
+        # Only the 16 bits next to the root are kept, as in lzhuf.c.
+        acc = (acc << code_bits) | (code >> (16 - code_bits)
+                                    if code_bits <= 16 else
+                                    code << (code_bits - 16))
+        acc_bits += code_bits
+
+        if match_length > THRESHOLD:
+            position = match[1]
+            upper = position >> 6
+            plen = _P_LEN[upper]
+            acc = (((acc << plen) | (_P_CODE[upper] >> (8 - plen))) << 6) | \
+                (position & 0x3f)
+            acc_bits += plen + 6
+
+        if acc_bits >= 8:
+            extra = acc_bits & 7
+            out += (acc >> extra).to_bytes(acc_bits >> 3, "big")
+            acc &= (1 << extra) - 1
+            acc_bits = extra
+            if len(out) >= STREAM_CHUNK:
+                dst.write(out)
+                written += len(out)
+                out = bytearray()
+
+        index = 0
+        while index < match_length:
+            char = next(source, None)
+            if char is None:
+                break
+            delete_node(pos_s)
+            text_buf[pos_s] = char
+            if pos_s < LOOKAHEAD - 1:
+                text_buf[pos_s + WINDOW] = char
+            pos_s = (pos_s + 1) & (WINDOW - 1)
+            pos_r = (pos_r + 1) & (WINDOW - 1)
+            insert_node(pos_r)
+            index += 1
+        read += index
+        while index < match_length:
+            index += 1
+            delete_node(pos_s)
+            pos_s = (pos_s + 1) & (WINDOW - 1)
+            pos_r = (pos_r + 1) & (WINDOW - 1)
+            length -= 1
+            if length:
+                insert_node(pos_r)
+
+    if acc_bits:
+        out.append((acc << (8 - acc_bits)) & 0xff)
+    dst.write(out)
+    if read != size:
+        raise LzhufError("Read %i bytes, expected %i" % (read, size))
+    return written + len(out)
+
+
+def decompress_stream(src, dst):
+    '''
+    Decompress a stream like "lzhuf d".
+
+    :param src: Compressed data, starting with the length
+    :type src: :class:`io.BufferedIOBase`
+    :param dst: File for the data
+    :type dst: :class:`io.BufferedIOBase`
+    :returns: Size of the data
+    :rtype: int
+    :raises: :class:`LzhufError` if the length is missing or the data
+             ends before all of it is decoded
+    '''
+    header = src.read(4)
+    if len(header) < 4:
+        raise LzhufError("Compressed data too short")
+    size, = struct.unpack("<I", header)
+    if size == 0:
+        return 0
+
+    huff = _Huffman()
+    son = huff.son
+    update = huff.update
+    chunks = _iter_chunks(src)
+    chunk = b""
+    offset = 0
+    bits = 0
+    nbits = 0
+    padding = 0
+
+    window = bytearray(b" " * (WINDOW - LOOKAHEAD) + b"\0" * LOOKAHEAD)
+    pos_r = WINDOW - LOOKAHEAD
+    out = bytearray()
+    count = 0
+    while count < size:
+        if nbits < 64 and not padding:
+            # Enough bits for the longest code and a position.
+            if offset >= len(chunk):
+                chunk = next(chunks, None)
+                offset = 0
+            if chunk is None:
+                # Past the end of the data lzhuf.c reads zero bits, a
+                # code that needs them means the data was cut short.
+                padding = 64
+                bits <<= padding
+                nbits += padding
+            else:
+                more = chunk[offset:offset + 8]
+                offset += 8
+                bits = (bits << (len(more) * 8)) | \
+                    int.from_bytes(more, "big")
+                nbits += len(more) * 8
+
+        node = son[_R]
+        while node < _T:
+            nbits -= 1
+            node = son[node + ((bits >> nbits) & 1)]
+        char = node - _T
+        update(char)
+
+        if char < 256:
+            out.append(char)
+            window[pos_r] = char
+            pos_r = (pos_r + 1) & (WINDOW - 1)
+            count += 1
+        else:
+            nbits -= 8
+            upper = (bits >> nbits) & 0xff
+            extra = _D_LEN[upper] - 2
+            nbits -= extra
+            position = (_D_CODE[upper] << 6) | \
+                ((((upper << extra) | ((bits >> nbits) &
+                                       ((1 << extra) - 1)))) & 0x3f)
+            start = (pos_r - position - 1) & (WINDOW - 1)
+            for index in range(min(char - 255 + THRESHOLD, size - count)):
+                char = window[(start + index) & (WINDOW - 1)]
+                out.append(char)
+                window[pos_r] = char
+                pos_r = (pos_r + 1) & (WINDOW - 1)
+            count += index + 1
+        if nbits < padding:
+            raise LzhufError("Compressed data ends after %i of %i bytes" %
+                             (count, size))
+        bits &= (1 << nbits) - 1
+
+        if len(out) >= STREAM_CHUNK:
+            dst.write(out)
+            out = bytearray()
+    dst.write(out)
+    return count
+
+
+def compress(data):
+    '''
+    Compress data like "lzhuf e".
+
+    :param data: Data to compress
+    :type data: bytes
+    :returns: Length and compressed data
+    :rtype: bytes
+    '''
+    dst = io.BytesIO()
+    compress_stream(io.BytesIO(data), dst, len(data))
+    return dst.getvalue()
+
+
+def decompress(data):
+    '''
+    Decompress data like "lzhuf d".
+
+    :param data: Length and compressed data
+    :type data: bytes
+    :returns: Data
+    :rtype: bytes
+    :raises: :class:`LzhufError` if the length is missing
+    '''
+    dst = io.BytesIO()
+    decompress_stream(io.BytesIO(data), dst)
+    return dst.getvalue()
+
+
+class Lzhuf():
+    '''
+    Lzhuf.
+
+    Winlink B2 compression, the compressed data has a checksum
+    in front of it.
+    '''
+
+    logger = logging.getLogger("Lzhuf")
+
+    # The codec is built in.
+    have_lzhuf = True
 
     @classmethod
     def decode(cls, data):
@@ -103,10 +554,14 @@ class Lzhuf():
 
         :param data: Encoded data
         :type data: bytes
-        :returns: Uncompressed data
+        :returns: Uncompressed data, None if it is not valid
         :rtype: bytes
         '''
-        return cls._run("d", data[2:])
+        try:
+            return decompress(data[2:])
+        except LzhufError as err:
+            cls.logger.info("decode: %s", err)
+            return None
 
     @classmethod
     def encode(cls, data):
@@ -118,16 +573,62 @@ class Lzhuf():
         :returns: Compressed data
         :rtype: bytes
         '''
-        lzh = cls._run("e", data)
-        if lzh:
-            lzh = struct.pack("<H", crc_checksum.calc_checksum(lzh)) + lzh
-        else:
-            cls.logger.info('encode: lzhuf returned no data')
-        return lzh
+        lzh = compress(data)
+        return struct.pack("<H", crc_checksum.calc_checksum(lzh)) + lzh
+
+
+# Compressed size and CRC-32 of the test data compressed by lzhuf.c
+# built with the FBB window size.
+_CORPUS = {
+    "empty": (4, 0x2144df1c),
+    "one byte": (6, 0x9f02a54c),
+    "short": (18, 0xafb74965),
+    "spaces": (9, 0x2311d798),
+    "repeated": (48, 0x705f0e80),
+    "binary": (343, 0x37ec3903),
+    "random": (40145, 0xf58d6a64),
+    "text": (3165, 0x0b98410f),
+}
+
+
+def _corpus_data():
+    '''
+    Make the test data.
+
+    :returns: Name and data of each test
+    :rtype: list[tuple[str, bytes]]
+    '''
+    words = b"winlink message routine N0CALL position report 73 de".split()
+    text = b"".join(b"%s %s %s %i\r\n" %
+                    (words[num % 8], words[num * 7 % 5],
+                     words[num * num % 8], num)
+                    for num in range(1000))
+    return [
+        ("empty", b""),
+        ("one byte", b"A"),
+        ("short", b"uncompressed"),
+        ("spaces", b" " * 100),
+        ("repeated", b"hello hello hello world " * 40),
+        ("binary", bytes(range(256)) * 8),
+        # Enough characters for the tree to be rebuilt.
+        ("random", random.Random(41).randbytes(40000)),
+        ("text", text),
+    ]
+
+
+def _run_lzhuf(lzhuf_path, cmd, data):
+    '''Run the lzhuf program, for the compatibility test.'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, "input"), "wb") as handle:
+            handle.write(data)
+        subprocess.run([lzhuf_path, cmd, "input", "output"],
+                       cwd=tmp_dir, check=True)
+        with open(os.path.join(tmp_dir, "output"), "rb") as handle:
+            return handle.read()
 
 
 def main():
-    '''Unit Test.'''
+    '''Unit Test, compatibility test and benchmark.'''
 
     logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
                         datefmt="%m/%d/%Y %H:%M:%S",
@@ -135,18 +636,42 @@ def main():
 
     logger = logging.getLogger("lzhuf_test")
     logger.info("Starting test")
+    # pylint: disable=import-outside-toplevel
+    from d_rats.dplatform import Platform
+    lzhuf_path = Platform.get_exe_path('lzhuf')
+
+    for name, data in _corpus_data():
+        start = time.perf_counter()
+        encoded = compress(data)
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = decompress(encoded)
+        decode_time = time.perf_counter() - start
+        result = "PASS"
+        if decoded != data:
+            result = "FAIL decoded data differs"
+        elif _CORPUS[name] != (len(encoded), zlib.crc32(encoded)):
+            result = "FAIL compressed data differs from corpus"
+        elif lzhuf_path and (_run_lzhuf(lzhuf_path, "e", data) != encoded or
+                             _run_lzhuf(lzhuf_path, "d", encoded) != data):
+            result = "FAIL lzhuf program differs"
+        logger.info("%s: %-8s %6i -> %6i bytes, encode %6.1f ms, "
+                    "decode %5.1f ms", result, name, len(data), len(encoded),
+                    encode_time * 1000, decode_time * 1000)
+
+    encoded = compress(_corpus_data()[-1][1])
+    try:
+        decompress(encoded[:len(encoded) // 2])
+        logger.info("FAIL: truncated data decoded")
+    except LzhufError as err:
+        logger.info("PASS: truncated data: %s", err)
+
     in_data = b'uncompressed'
-    encoded = Lzhuf.encode(in_data)
-    if encoded:
-        decoded = Lzhuf.decode(encoded)
-        print("in_data=", in_data)
-        print("decoded=", decoded)
-        if decoded != in_data:
-            logger.info("Sanity test failed!")
-        else:
-            logger.info("Sanity test passed!")
+    if Lzhuf.decode(Lzhuf.encode(in_data)) == in_data:
+        logger.info("Sanity test passed!")
     else:
-        logger.info("Sanity test lzhuf not found!")
+        logger.info("Sanity test failed!")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1056 @@
+#!/usr/bin/python
+'''Mail Fetch.'''
+# pylint wants a max of 1000 lines per module.
+# pylint: disable=too-many-lines
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+import email
+import functools
+import imaplib
+import logging
+import os
+import poplib
+import select
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .dplatform import Platform
+
+STATE_FILE = "mail_fetch.db"
+
+# Accounts fetched at the same time by the shared poller
+FETCH_WORKERS = 4
+
+# Seconds an IMAP IDLE command is kept open, servers may drop an idle
+# connection after 30 minutes.
+IDLE_RENEW = 25 * 60
+
+# Seconds between the checks for a stop request while idling
+IDLE_CHECK = 1.0
+
+# Seconds before an IMAP IDLE connection is tried again after an error
+IDLE_RETRY = 60.0
+
+DEFAULT_PORTS = {("pop3", False): 110,
+                 ("pop3", True): 995,
+                 ("imap", False): 143,
+                 ("imap", True): 993}
+
+
+class MailFetchError(Exception):
+    '''Mail Fetch Exception.'''
+
+
+# Errors from talking to a mail server
+FETCH_ERRORS = (poplib.error_proto, imaplib.IMAP4.error, MailFetchError,
+                OSError)
+
+
+def parse_host(host):
+    '''
+    Split the protocol from a mail server name.
+
+    A server name of "imap://host" or "imaps://host" selects IMAP,
+    a plain name or "pop3://host" POP3.
+
+    :param host: Mail server name, with an optional protocol
+    :type host: str
+    :returns: Protocol, server name and if the protocol asked for SSL
+    :rtype: tuple[str, str, bool]
+    '''
+    scheme, sep, name = host.partition("://")
+    if not sep:
+        return "pop3", host, False
+    scheme = scheme.lower()
+    if scheme in ("imap", "imaps"):
+        return "imap", name, scheme == "imaps"
+    if scheme in ("pop", "pop3", "pop3s", "pops"):
+        return "pop3", name, scheme in ("pop3s", "pops")
+    raise MailFetchError("Unknown mail protocol `%s'" % scheme)
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class MailAccount:
+    '''
+    Mail Account.
+
+    :param host: Mail server name, "imap://" in front selects IMAP
+    :type host: str
+    :param user: User account
+    :type user: str
+    :param password: Password for account
+    :type password: str
+    :param port: Mail server port, default for the protocol
+    :type port: int
+    :param use_ssl: Use ssl, default False
+    :type use_ssl: bool
+    :raises: :class:`MailFetchError` for an unknown protocol
+    '''
+
+    # pylint wants a max of 5 arguments
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, host, user, password, port=None, use_ssl=False):
+        self.protocol, self.host, scheme_ssl = parse_host(host)
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl or scheme_ssl
+        self.port = port or DEFAULT_PORTS[(self.protocol, self.use_ssl)]
+        self.key = "%s:%s@%s:%i" % (self.protocol, user, self.host, self.port)
+
+    def __str__(self):
+        return self.key
+
+    def connect(self):
+        '''
+        Connect to the mail server.
+
+        :returns: Connection
+        :rtype: :class:`poplib.POP3` or :class:`imaplib.IMAP4`
+        '''
+        if self.protocol == "imap":
+            if self.use_ssl:
+                return imaplib.IMAP4_SSL(self.host, self.port)
+            return imaplib.IMAP4(self.host, self.port)
+        if self.use_ssl:
+            return poplib.POP3_SSL(self.host, self.port)
+        return poplib.POP3(self.host, self.port)
+
+
+class FetchState:
+    '''
+    Fetch State.
+
+    Remembers the POP3 unique ids of the messages already passed on,
+    until the server has deleted them, and the last IMAP UID passed on
+    for each account.  A fetch that breaks off then never passes the
+    same message on twice, and an unchanged IMAP mailbox is seen from
+    the SELECT response alone.
+
+    Use :meth:`get_state` to share the state file.
+
+    :param filename: SQLite file for the state
+    :type filename: str
+    '''
+
+    _states = {}
+    _states_lock = threading.Lock()
+
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pop3_uids ("
+                         "account TEXT, uid TEXT, "
+                         "PRIMARY KEY (account, uid))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pop3_kept ("
+                         "account TEXT, uid TEXT, "
+                         "PRIMARY KEY (account, uid))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS imap_uids ("
+                         "account TEXT PRIMARY KEY, validity INTEGER, "
+                         "last_uid INTEGER)")
+        self._db.commit()
+
+    @classmethod
+    def get_state(cls, filename=None):
+        '''
+        Get a shared fetch state.
+
+        :param filename: SQLite file, default mail_fetch.db in the
+                         configuration directory
+        :type filename: str
+        :returns: Fetch state
+        :rtype: :class:`FetchState`
+        '''
+        if not filename:
+            filename = Platform.get_platform().config_file(STATE_FILE)
+        filename = os.path.abspath(filename)
+        with cls._states_lock:
+            state = cls._states.get(filename, None)
+            if not state:
+                state = FetchState(filename)
+                cls._states[filename] = state
+            return state
+
+    def pop3_seen(self, account):
+        '''
+        POP3 unique ids already passed on.
+
+        :param account: Account key
+        :type account: str
+        :returns: Unique ids
+        :rtype: set[str]
+        '''
+        with self._lock:
+            rows = self._db.execute("SELECT uid FROM pop3_uids "
+                                    "WHERE account = ?", (account,))
+            return {row[0] for row in rows}
+
+    def pop3_add(self, account, uid):
+        '''
+        Remember a POP3 unique id as passed on.
+
+        :param account: Account key
+        :type account: str
+        :param uid: Unique id
+        :type uid: str
+        '''
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO pop3_uids VALUES (?, ?)",
+                             (account, uid))
+            self._db.commit()
+
+    def pop3_kept(self, account):
+        '''
+        POP3 unique ids left on the server because they failed.
+
+        :param account: Account key
+        :type account: str
+        :returns: Unique ids
+        :rtype: set[str]
+        '''
+        with self._lock:
+            rows = self._db.execute("SELECT uid FROM pop3_kept "
+                                    "WHERE account = ?", (account,))
+            return {row[0] for row in rows}
+
+    def pop3_keep(self, account, uid):
+        '''
+        Remember a POP3 unique id as failed, to leave it on the server.
+
+        :param account: Account key
+        :type account: str
+        :param uid: Unique id
+        :type uid: str
+        '''
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO pop3_kept VALUES (?, ?)",
+                             (account, uid))
+            self._db.commit()
+
+    def pop3_forget(self, account, uids):
+        '''
+        Forget POP3 unique ids no longer on the server.
+
+        :param account: Account key
+        :type account: str
+        :param uids: Unique ids
+        :type uids: iterable[str]
+        '''
+        rows = [(account, uid) for uid in uids]
+        with self._lock:
+            self._db.executemany("DELETE FROM pop3_uids "
+                                 "WHERE account = ? AND uid = ?", rows)
+            self._db.executemany("DELETE FROM pop3_kept "
+                                 "WHERE account = ? AND uid = ?", rows)
+            self._db.commit()
+
+    def imap_last(self, account):
+        '''
+        Last IMAP UID passed on.
+
+        :param account: Account key
+        :type account: str
+        :returns: UIDVALIDITY of the mailbox and last UID, 0 for none
+        :rtype: tuple[int, int]
+        '''
+        with self._lock:
+            row = self._db.execute("SELECT validity, last_uid FROM imap_uids "
+                                   "WHERE account = ?", (account,)).fetchone()
+        return row or (0, 0)
+
+    def imap_set_last(self, account, validity, last_uid):
+        '''
+        Remember the last IMAP UID passed on.
+
+        :param account: Account key
+        :type account: str
+        :param validity: UIDVALIDITY of the mailbox
+        :type validity: int
+        :param last_uid: Last UID
+        :type last_uid: int
+        '''
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO imap_uids "
+                             "VALUES (?, ?, ?)",
+                             (account, validity, last_uid))
+            self._db.commit()
+
+    def close(self):
+        '''Close the state file.'''
+        with self._lock:
+            self._db.close()
+
+
+def _handle(account, handler, raw):
+    '''
+    Pass a message to the handler.
+
+    :param account: Mail account
+    :type account: :class:`MailAccount`
+    :param handler: Function taking each message
+    :type handler: function(:class:`email.message.Message`)
+    :param raw: Message as read from the server
+    :type raw: bytes
+    :returns: True if the handler took the message
+    :rtype: bool
+    '''
+    try:
+        handler(email.message_from_bytes(raw))
+        return True
+    # A bad message must not stop the rest of the account.
+    except Exception:  # pylint: disable=broad-except
+        logging.getLogger("MailFetch").info(
+            "_handle: %s: Message not handled", account, exc_info=True)
+        return False
+
+
+def fetch_pop3(account, state, handler):
+    '''
+    Fetch the new messages of a POP3 account.
+
+    Each message is passed to the handler as soon as it is read, and
+    deleted after the handler returns.  A message the handler fails on
+    is logged and left on the server, and its unique id is kept so it
+    is not fetched again.  Without UIDL there is no way to tell it from
+    a new message, so it is deleted.
+
+    :param account: Mail account
+    :type account: :class:`MailAccount`
+    :param state: Fetch state
+    :type state: :class:`FetchState`
+    :param handler: Function taking each message
+    :type handler: function(:class:`email.message.Message`)
+    :returns: Number of messages passed on
+    :rtype: int
+    '''
+    server = account.connect()
+    done = False
+    try:
+        server.user(account.user)
+        server.pass_(account.password)
+        try:
+            listing = [line.decode("utf-8", "replace").split(None, 1)
+                       for line in server.uidl()[1]]
+        except poplib.error_proto:
+            # No UIDL, every message on the server is new.
+            listing = [(line.split()[0].decode(), None)
+                       for line in server.list()[1]]
+
+        seen = state.pop3_seen(account.key)
+        kept = state.pop3_kept(account.key)
+        deleted = []
+        count = 0
+        for num, uid in listing:
+            if uid in kept:
+                continue
+            if uid not in seen:
+                lines = server.retr(int(num))[1]
+                if _handle(account, handler, b"\r\n".join(lines)):
+                    count += 1
+                elif uid:
+                    state.pop3_keep(account.key, uid)
+                    continue
+                if uid:
+                    state.pop3_add(account.key, uid)
+            server.dele(int(num))
+            deleted.append(uid)
+        server.quit()
+        done = True
+    finally:
+        if not done:
+            server.close()
+    # The server only deletes the messages when QUIT succeeds.
+    # Failed messages removed from the server some other way are
+    # forgotten too.
+    listed = {uid for _num, uid in listing}
+    state.pop3_forget(account.key,
+                      [uid for uid in deleted if uid] + list(kept - listed))
+    return count
+
+
+def fetch_imap(account, state, handler):
+    '''
+    Fetch the new messages of the inbox of an IMAP account.
+
+    Messages with a UID above the last one passed on are fetched, each
+    is passed to the handler as soon as it is read, and deleted after
+    the handler returns.  A message the handler fails on is logged and
+    left in the inbox, it is not fetched again.
+
+    :param account: Mail account
+    :type account: :class:`MailAccount`
+    :param state: Fetch state
+    :type state: :class:`FetchState`
+    :param handler: Function taking each message
+    :type handler: function(:class:`email.message.Message`)
+    :returns: Number of messages passed on
+    :rtype: int
+    :raises: :class:`MailFetchError` if the inbox can not be selected
+    '''
+    server = account.connect()
+    done = False
+    count = 0
+    try:
+        server.login(account.user, account.password)
+        if server.select("INBOX")[0] != "OK":
+            raise MailFetchError("Unable to select INBOX")
+        validity = int(server.response("UIDVALIDITY")[1][0] or 0)
+        uid_next = server.response("UIDNEXT")[1][0]
+
+        last_validity, last_uid = state.imap_last(account.key)
+        if validity != last_validity:
+            last_uid = 0
+        uids = []
+        if uid_next is None or int(uid_next) > last_uid + 1:
+            _typ, data = server.uid("SEARCH", "UID", "%i:*" % (last_uid + 1))
+            uids = sorted(uid for uid in (int(uid)
+                                          for uid in data[0].split())
+                          if uid > last_uid)
+        for uid in uids:
+            _typ, data = server.uid("FETCH", str(uid), "(RFC822)")
+            raw = next(part[1] for part in data if isinstance(part, tuple))
+            if _handle(account, handler, raw):
+                server.uid("STORE", str(uid), "+FLAGS", r"(\Deleted)")
+                count += 1
+            state.imap_set_last(account.key, validity, uid)
+        if count:
+            server.expunge()
+        done = True
+    finally:
+        if done:
+            server.logout()
+        else:
+            server.shutdown()
+    return count
+
+
+def fetch_account(account, handler, state=None):
+    '''
+    Fetch the new messages of a mail account.
+
+    :param account: Mail account
+    :type account: :class:`MailAccount`
+    :param handler: Function taking each message
+    :type handler: function(:class:`email.message.Message`)
+    :param state: Fetch state, default the shared state
+    :type state: :class:`FetchState`
+    :returns: Number of messages passed on
+    :rtype: int
+    '''
+    state = state or FetchState.get_state()
+    if account.protocol == "imap":
+        return fetch_imap(account, state, handler)
+    return fetch_pop3(account, state, handler)
+
+
+class ImapIdler(threading.Thread):
+    '''
+    IMAP IDLE watcher.
+
+    Keeps an IDLE command open on the inbox of an account and calls
+    the notify function when a message arrives.  The thread ends if
+    the server does not support IDLE.
+
+    :param account: IMAP mail account
+    :type account: :class:`MailAccount`
+    :param notify: Function called when new mail arrives
+    :type notify: function()
+    '''
+
+    logger = logging.getLogger("ImapIdler")
+
+    def __init__(self, account, notify):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.account = account
+        self.supported = True
+        self._notify = notify
+        self._stop_event = threading.Event()
+        self._tag = 0
+
+    def stop(self):
+        '''Stop watching.'''
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                server = self.account.connect()
+            except FETCH_ERRORS as err:
+                self.logger.info("run: %s: %s", self.account, err)
+                self._stop_event.wait(IDLE_RETRY)
+                continue
+            try:
+                self._watch(server)
+            except FETCH_ERRORS as err:
+                self.logger.info("run: %s: %s", self.account, err)
+            finally:
+                server.shutdown()
+            if not self.supported:
+                self.logger.info("run: %s does not support IDLE",
+                                 self.account)
+                break
+            self._stop_event.wait(IDLE_CHECK)
+
+    def _watch(self, server):
+        '''
+        Idle on an IMAP connection until stopped.
+
+        :param server: IMAP connection
+        :type server: :class:`imaplib.IMAP4`
+        :raises: :class:`MailFetchError` if the server ends the IDLE
+        '''
+        server.login(self.account.user, self.account.password)
+        if "IDLE" not in server.capabilities:
+            self.supported = False
+            return
+        server.select("INBOX", readonly=True)
+        # Mail that came in before the IDLE started
+        self._notify()
+        sock = server.socket()
+        while not self._stop_event.is_set():
+            self._tag += 1
+            tag = b"IDLE%i" % self._tag
+            server.send(tag + b" IDLE\r\n")
+            if not server.readline().startswith(b"+"):
+                raise MailFetchError("IDLE refused")
+            renew = time.monotonic() + IDLE_RENEW
+            new_mail = False
+            while not (new_mail or self._stop_event.is_set() or
+                       time.monotonic() > renew):
+                readable, _w, _x = select.select([sock], [], [], IDLE_CHECK)
+                if readable:
+                    line = server.readline()
+                    if not line:
+                        raise MailFetchError("Connection closed")
+                    new_mail = line.rstrip().endswith(b"EXISTS")
+            server.send(b"DONE\r\n")
+            line = server.readline()
+            while not line.startswith(tag):
+                if not line:
+                    raise MailFetchError("Connection closed")
+                line = server.readline()
+            if new_mail:
+                self._notify()
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class _PollJob:
+    '''Account polled by :class:`MailPoller`.'''
+
+    __slots__ = ("job", "interval", "due", "pending", "idler")
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self.due = time.monotonic()
+        self.pending = False
+        self.idler = None
+
+
+class MailPoller:
+    '''
+    Mail Poller.
+
+    Runs the fetch job of each account when it is due, in a pool of a
+    few worker threads, so many accounts are fetched at the same time
+    without a thread each.  An account is never fetched twice at the
+    same time, also when it is removed and added again while a fetch
+    is running.  IMAP accounts can also be fetched as soon as the
+    server reports new mail with IDLE.
+
+    Use :meth:`get_poller` to share one poller.
+
+    :param workers: Most accounts fetched at once, default FETCH_WORKERS
+    :type workers: int
+    '''
+
+    logger = logging.getLogger("MailPoller")
+
+    _poller = None
+    _poller_lock = threading.Lock()
+
+    def __init__(self, workers=FETCH_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="MailPoller")
+        self._jobs = {}
+        # Names of the accounts being fetched
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+    @classmethod
+    def get_poller(cls):
+        '''
+        Get the shared poller.
+
+        :returns: Mail poller
+        :rtype: :class:`MailPoller`
+        '''
+        with cls._poller_lock:
+            if not cls._poller:
+                cls._poller = MailPoller()
+            return cls._poller
+
+    def add(self, name, job, interval, idle_account=None):
+        '''
+        Add an account, replacing one with the same name.
+
+        The job runs right away, and then every interval seconds.
+
+        :param name: Account name
+        :type name: str
+        :param job: Function that fetches the mail of the account
+        :type job: function()
+        :param interval: Seconds between fetches
+        :type interval: float
+        :param idle_account: IMAP account to watch with IDLE, default None
+        :type idle_account: :class:`MailAccount`
+        '''
+        self.remove(name)
+        entry = _PollJob(job, interval)
+        if idle_account and idle_account.protocol == "imap":
+            entry.idler = ImapIdler(idle_account,
+                                    functools.partial(self.trigger, name))
+            entry.idler.start()
+        with self._lock:
+            self._jobs[name] = entry
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name="MailPoller",
+                                                daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def trigger(self, name):
+        '''
+        Fetch an account now.
+
+        :param name: Account name
+        :type name: str
+        '''
+        with self._lock:
+            entry = self._jobs.get(name, None)
+            if not entry:
+                return
+            if name in self._running:
+                entry.pending = True
+            else:
+                entry.due = time.monotonic()
+                self._wake.notify()
+
+    def remove(self, name):
+        '''
+        Remove an account.
+
+        A fetch already running is finished.
+
+        :param name: Account name
+        :type name: str
+        '''
+        with self._lock:
+            entry = self._jobs.pop(name, None)
+        if entry and entry.idler:
+            entry.idler.stop()
+
+    def stop(self):
+        '''Stop polling all of the accounts.'''
+        with self._lock:
+            self._stopped = True
+            entries = list(self._jobs.values())
+            self._jobs.clear()
+            self._wake.notify()
+        for entry in entries:
+            if entry.idler:
+                entry.idler.stop()
+        self._pool.shutdown(wait=True)
+
+    def _run(self):
+        '''Start the jobs that are due.'''
+        with self._lock:
+            while not self._stopped:
+                now = time.monotonic()
+                wait = None
+                for name, entry in self._jobs.items():
+                    if name in self._running:
+                        continue
+                    if entry.due <= now:
+                        self._running.add(name)
+                        future = self._pool.submit(entry.job)
+                        future.add_done_callback(
+                            functools.partial(self._done, name, entry))
+                    elif wait is None or entry.due - now < wait:
+                        wait = entry.due - now
+                self._wake.wait(wait)
+
+    def _done(self, name, entry, future):
+        '''
+        Schedule the next fetch of an account.
+
+        :param name: Account name
+        :type name: str
+        :param entry: Account
+        :type entry: :class:`_PollJob`
+        :param future: Finished job
+        :type future: :class:`concurrent.futures.Future`
+        '''
+        if future.exception():
+            self.logger.info("_done: Fetch failed", exc_info=future.exception())
+        with self._lock:
+            self._running.discard(name)
+            if self._jobs.get(name, None) is not entry:
+                # Removed, or replaced by an account that is already due.
+                self._wake.notify()
+                return
+            entry.due = time.monotonic()
+            if not entry.pending:
+                entry.due += entry.interval
+            entry.pending = False
+            self._wake.notify()
+
+
+class _TestMailServer(socketserver.ThreadingTCPServer):
+    '''
+    Stand-in POP3 or IMAP server for the unit test.
+
+    :param handler: Request handler class
+    :type handler: type
+    :param latency: Seconds to wait before each response
+    :type latency: float
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, latency):
+        self.latency = latency
+        # user -> list of [uid, message, deleted]
+        self.mailboxes = {}
+        self.next_uids = {}
+        self.commands = 0
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 handler)
+
+    def deliver(self, user, message):
+        '''
+        Deliver a message.
+
+        :param user: User account
+        :type user: str
+        :param message: Message
+        :type message: bytes
+        '''
+        with self.lock:
+            uid = self.next_uids.get(user, 1)
+            self.mailboxes.setdefault(user, []).append([uid, message, False])
+            self.next_uids[user] = uid + 1
+
+
+class _TestPop3Handler(socketserver.StreamRequestHandler):
+    '''POP3 session of the stand-in server.'''
+
+    def _reply(self, *lines):
+        time.sleep(self.server.latency)
+        self.wfile.write(b"".join(line + b"\r\n" for line in lines))
+
+    def handle(self):
+        server = self.server
+        user = None
+        self._reply(b"+OK Test POP3")
+        for line in self.rfile:
+            words = line.split()
+            command = words[0].upper() if words else b""
+            with server.lock:
+                server.commands += 1
+                mailbox = server.mailboxes.get(user, [])
+                live = [(num, entry) for num, entry in
+                        enumerate(mailbox, 1) if not entry[2]]
+            if command == b"USER":
+                user = words[1].decode()
+                self._reply(b"+OK")
+            elif command == b"UIDL":
+                self._reply(b"+OK", *[b"%i uid%i" % (num, entry[0])
+                                      for num, entry in live], b".")
+            elif command == b"RETR":
+                data = mailbox[int(words[1]) - 1][1]
+                self._reply(b"+OK", data[:-2].replace(b"\r\n.", b"\r\n.."),
+                            b".")
+            elif command == b"DELE":
+                mailbox[int(words[1]) - 1][2] = True
+                self._reply(b"+OK")
+            elif command == b"QUIT":
+                with server.lock:
+                    mailbox[:] = [entry for entry in mailbox if not entry[2]]
+                self._reply(b"+OK")
+                break
+            else:
+                self._reply(b"+OK")
+
+
+class _TestImapHandler(socketserver.StreamRequestHandler):
+    '''IMAP session of the stand-in server.'''
+
+    def _reply(self, *lines):
+        time.sleep(self.server.latency)
+        self.wfile.write(b"".join(line + b"\r\n" for line in lines))
+
+    def _idle(self, tag, user):
+        self._reply(b"+ idling")
+        next_uid = self.server.next_uids.get(user, 1)
+        while True:
+            readable, _w, _x = select.select([self.rfile], [], [], 0.01)
+            if readable:
+                self.rfile.readline()
+                self._reply(tag + b" OK IDLE done")
+                return
+            if self.server.next_uids.get(user, 1) > next_uid:
+                next_uid = self.server.next_uids.get(user, 1)
+                self._reply(b"* %i EXISTS" % len(self.server.mailboxes[user]))
+
+    # pylint wants a max of 12 branches
+    # pylint: disable=too-many-branches
+    def handle(self):
+        server = self.server
+        mailbox = []
+        user = None
+        self._reply(b"* OK Test IMAP")
+        for line in self.rfile:
+            tag, command, *args = line.split() + [b""]
+            command = command.upper()
+            with server.lock:
+                server.commands += 1
+            if command == b"CAPABILITY":
+                self._reply(b"* CAPABILITY IMAP4rev1 IDLE", tag + b" OK done")
+            elif command == b"LOGIN":
+                user = args[0].strip(b'"').decode()
+                with server.lock:
+                    mailbox = server.mailboxes.setdefault(user, [])
+                self._reply(tag + b" OK done")
+            elif command in (b"SELECT", b"EXAMINE"):
+                self._reply(b"* %i EXISTS" % len(mailbox),
+                            b"* OK [UIDVALIDITY 7]",
+                            b"* OK [UIDNEXT %i]" %
+                            server.next_uids.get(user, 1),
+                            tag + b" OK [READ-WRITE]")
+            elif command == b"UID":
+                self._uid(tag, args, mailbox)
+            elif command == b"EXPUNGE":
+                with server.lock:
+                    mailbox[:] = [entry for entry in mailbox if not entry[2]]
+                self._reply(tag + b" OK done")
+            elif command == b"IDLE":
+                self._idle(tag, user)
+            elif command == b"LOGOUT":
+                self._reply(b"* BYE", tag + b" OK done")
+                break
+            else:
+                self._reply(tag + b" OK done")
+
+    def _uid(self, tag, args, mailbox):
+        command = args[0].upper()
+        if command == b"SEARCH":
+            first = int(args[2].split(b":")[0])
+            uids = [b"%i" % entry[0] for entry in mailbox
+                    if entry[0] >= first]
+            if not uids and mailbox:
+                uids = [b"%i" % mailbox[-1][0]]
+            self._reply(b"* SEARCH " + b" ".join(uids), tag + b" OK done")
+            return
+        uid = int(args[1])
+        for num, entry in enumerate(mailbox, 1):
+            if entry[0] == uid:
+                break
+        else:
+            self._reply(tag + b" OK done")
+            return
+        if command == b"FETCH":
+            self._reply(b"* %i FETCH (UID %i RFC822 {%i}" %
+                        (num, uid, len(entry[1])) + b"\r\n" + entry[1] + b")",
+                        tag + b" OK done")
+        else:
+            entry[2] = True
+            self._reply(b"* %i FETCH (FLAGS (\\Deleted) UID %i)" % (num, uid),
+                        tag + b" OK done")
+
+
+def _test_message(user, num):
+    return ("From: N0CALL <n0call@example.com>\r\n"
+            "To: %s@example.com\r\n"
+            "Subject: Test %i\r\n"
+            "Message-ID: <%s.%i@example.com>\r\n"
+            "\r\n"
+            "Test message %i for %s.\r\n" %
+            (user, num, user, num, num, user)).encode()
+
+
+def _test_job(account, handler, state, done):
+    fetch_account(account, handler, state)
+    done.release()
+
+
+def _failing_handler(received, message):
+    if message["Subject"] == "Test 1":
+        raise ValueError("Test message that can not be handled")
+    received.append(message)
+
+
+def _handler_test(logger, server, account, state):
+    '''Check that a message the handler fails on does not stop a fetch.'''
+    for num in range(3):
+        server.deliver(account.user, _test_message(account.user, num))
+    received = []
+    fetch_logger = logging.getLogger("MailFetch")
+    fetch_logger.setLevel(logging.WARNING)
+    fetch_account(account, functools.partial(_failing_handler, received),
+                  state)
+    # The message is left on the server and not passed on again.
+    fetch_account(account, functools.partial(_failing_handler, received),
+                  state)
+    fetch_logger.setLevel(logging.NOTSET)
+    left = len(server.mailboxes[account.user])
+    result = len(received) == 2 and left == 1
+    logger.info("%s: %s message not handled, %i of 3 passed on, %i left",
+                ("FAIL", "PASS")[result], account.protocol, len(received),
+                left)
+
+
+def _slow_job(running, runs):
+    running.append(None)
+    runs.append(len(running))
+    time.sleep(0.2)
+    running.pop()
+
+
+def _poller_test(logger):
+    '''Check that an account replaced while it is fetched runs once.'''
+    poller = MailPoller(FETCH_WORKERS)
+    running = []
+    runs = []
+    job = functools.partial(_slow_job, running, runs)
+    poller.add("account", job, 3600)
+    time.sleep(0.1)
+    poller.remove("account")
+    poller.add("account", job, 3600)
+    time.sleep(0.5)
+    poller.stop()
+    result = runs == [1, 1]
+    logger.info("%s: replaced account fetched %i times, at most %i at once",
+                ("FAIL", "PASS")[result], len(runs), max(runs))
+
+
+def _start_server(handler, latency):
+    server = _TestMailServer(handler, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals, too-many-statements
+def main():
+    '''Unit test with stand-in POP3 and IMAP servers.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MailFetch.test")
+
+    accounts = 20
+    per_account = 10
+    latency = 0.01
+    with tempfile.TemporaryDirectory() as state_dir:
+        state = FetchState(os.path.join(state_dir, STATE_FILE))
+        for protocol, handler in (("pop3", _TestPop3Handler),
+                                  ("imap", _TestImapHandler)):
+            server = _start_server(handler, latency)
+            host = "%s://127.0.0.1" % protocol
+            port = server.server_address[1]
+            users = ["user%02i" % num for num in range(accounts)]
+
+            # Sequential fetching, one account after the other
+            for user in users:
+                for num in range(per_account):
+                    server.deliver(user, _test_message(user, num))
+            received = []
+            start = time.perf_counter()
+            for user in users:
+                fetch_account(MailAccount(host, user, "pw", port),
+                              received.append, state)
+            sequential = time.perf_counter() - start
+
+            # The same accounts through the poller
+            for user in users:
+                for num in range(per_account):
+                    server.deliver(user, _test_message(user, num))
+            poller = MailPoller(FETCH_WORKERS)
+            done = threading.Semaphore(0)
+            polled = []
+
+            start = time.perf_counter()
+            for user in users:
+                account = MailAccount(host, user, "pw", port)
+                poller.add(user, functools.partial(
+                    _test_job, account, polled.append, state, done), 3600)
+            for _user in users:
+                done.acquire()  # pylint: disable=consider-using-with
+            concurrent = time.perf_counter() - start
+
+            # An unchanged mailbox
+            commands = server.commands
+            fetch_account(MailAccount(host, users[0], "pw", port),
+                          polled.append, state)
+            commands = server.commands - commands
+            poller.stop()
+
+            expected = accounts * per_account
+            result = len(received) == expected and len(polled) == expected \
+                and not any(server.mailboxes.values())
+            logger.info("%s: %s %i messages: sequential %.2f s, "
+                        "%i workers %.2f s, unchanged mailbox %i commands",
+                        ("FAIL", "PASS")[result], protocol, expected,
+                        sequential, FETCH_WORKERS, concurrent, commands)
+
+            if protocol == "imap":
+                arrived = threading.Event()
+                idler = ImapIdler(MailAccount(host, users[1], "pw", port),
+                                  arrived.set)
+                idler.start()
+                arrived.wait(5)
+                arrived.clear()
+                time.sleep(0.2)
+                start = time.perf_counter()
+                server.deliver(users[1], _test_message(users[1], 99))
+                pushed = arrived.wait(5)
+                logger.info("%s: IDLE reported new mail in %.3f s",
+                            ("FAIL", "PASS")[pushed],
+                            time.perf_counter() - start)
+                idler.stop()
+                idler.join()
+
+            _handler_test(logger, server,
+                          MailAccount(host, users[2], "pw", port), state)
+            server.shutdown()
+            server.server_close()
+        state.close()
+    _poller_test(logger)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 # File: d_rats/mailsrv.py
 
 '''Mail Server.'''
+# pylint wants only 1000 lines per module
+# pylint: disable=too-many-lines
 
 # Copyright 2010 Dan Smith <dsmith@danplanet.com>
 # Copyright 2022-2025 John. E. Malmberg - Python3 Conversion
@@ -18,49 +20,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import absolute_import
-from __future__ import print_function
-import os
-from glob import glob
-
-import logging
-import threading
-SMTPD_AVAILABLE = False
-try:
-    # pylint: disable=deprecated-module
-    import smtpd
-    SMTPD_AVAILABLE = True
-except ModuleNotFoundError:
-    print("SMTP Module no longer available!")
-
-    # pylint: disable=invalid-name, too-few-public-methods
-    class smtpd():
-        '''Fake SMTP server class.'''
-        # pylint: disable=too-few-public-methods
-        class SMTPServer():
-            '''Fake SMTPServer class.'''
-
-# It looks like full solution is to rewrite this module to use
-# either smtp_lib or aiosmtpd module.
-
-ASYNCORE_AVAILABLE = False
-try:
-    # pylint: disable=deprecated-module
-    import asyncore
-    ASYNCORE_AVAILABLE = True
-except ModuleNotFoundError:
-    print("ASYNCORE Module no longer available!")
-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import email
+import functools
+import logging
+import os
 import random
-import time
 import re
-from socketserver import StreamRequestHandler
-from socketserver import TCPServer
+import tempfile
+import threading
+import time
 
 from d_rats import utils
 from d_rats import msgrouting
 from d_rats import emailgw
+from d_rats.pop3_cache import Pop3Cache
+
+# Bytes of a message collected before they are written to the client.
+SEND_BUFFER = 64 * 1024
+
+# Worker threads for the blocking parts of the sessions, like reading
+# the message caches and storing forms.
+SESSION_WORKERS = 8
+
+# Longest line accepted from a client
+LINE_LIMIT = 1024 * 1024
+
+# Bytes of an SMTP message kept in memory, the rest is spooled to disk.
+SPOOL_SIZE = 256 * 1024
 
 
 def mkmsgid(callsign):
@@ -76,42 +64,6 @@ def mkmsgid(callsign):
     return "%s.%x.%x" % (callsign, int(time.time()) - 1114880400, rand_num)
 
 
-class TCPServerThread(threading.Thread):
-    '''
-    TCP Server Thread.
-
-    :param config: D-Rats configuration
-    :type config: :class:`DratsConfig`
-    :param server: Type of server
-    :type server: :class:`TCPServer`
-    :param server_address: Server address and port
-    :type server_address: tuple[str, int]
-    :param RequestHandlerClass: Message handler
-    :type RequestHandlerClass: :class:`POP3Handler`
-    '''
-
-    name = "[UNNAMEDSERVER]"
-
-    def __init__(self, config, server, server_address, RequestHandlerClass):
-        self.logger = logging.getLogger("TCPServerThread")
-        self.__server = server(server_address, RequestHandlerClass)
-        self.__server.set_config(config)
-        threading.Thread.__init__(self)
-        self.daemon = True
-
-    def run(self):
-        '''Run Server.'''
-        self.__server.serve_forever()
-        self.logger.info("%s Exiting", self.name)
-
-    def stop(self):
-        '''Stop Server.'''
-        self.__server.shutdown()
-        self.__server.server_close()
-        self.logger.info("%s Shutdown", self.name)
-        self.join()
-
-
 class POP3Exception(Exception):
     '''POP3 Exception.'''
 
@@ -128,24 +80,24 @@ class EmailSenderError(Exception):
     '''Email Sender Exception.'''
 
 
-class POP3Handler(StreamRequestHandler):
+class POP3Handler:
     '''
     POP3 Handler.
 
-    :param request: Incoming request
-    :type request: :class:`socket.socket`
-    :param client_address: Remote address
-    :type Remote address: tuple[str, int]
-    :param server: Base server
-    :type server: :class:`DratsPOP3Server`
+    Handles the commands of one POP3 session, a line at a time.  The
+    replies go to the write function, so the handler does not depend
+    on how the session talks to the client.
+
+    :param write: Function taking the reply data
+    :type write: function(bytes)
     '''
 
-    def __init__(self, request, client_address, server):
+    def __init__(self, write):
         if not hasattr(self, 'logger'):
             self.logger = logging.getLogger("POP3Handler")
-        StreamRequestHandler.__init__(self, request, client_address, server)
-        self.state = None
+        self.state = b""
         self._user = None
+        self._write = write
         self.__message_cache = []
 
     def _say(self, what, error=False):
@@ -162,7 +114,7 @@ class POP3Handler(StreamRequestHandler):
         else:
             code = b"+OK"
 
-        self.wfile.write(code + b" %s\r\n" % what)
+        self._write(code + b" %s\r\n" % what)
         self.logger.info("[POP3] %s %s", code, what)
 
     def _handle_user(self, args):
@@ -192,19 +144,19 @@ class POP3Handler(StreamRequestHandler):
 
     # pylance wants a template method to have a possibility
     # of returning or it marks code incorrectly as unreachable.
-    def get_message(self, index):
+    def open_message(self, index):
         '''
-        Get Message.
+        Open a message.
 
         :param index: Index of message
         :type index: int
-        :returns: Mime message
-        :rtype: :class:`MIMEMultipart`
+        :returns: Message with CRLF line ends
+        :rtype: :class:`io.BufferedReader`
         '''
         if self.__message_cache:
             return self.__message_cache[index]
         raise POP3TemplateMethod('%s called template '
-                                 'get_message(%s) called' %
+                                 'open_message(%s) called' %
                                  (type(self), index))
 
     def del_message(self, index):
@@ -227,8 +179,8 @@ class POP3Handler(StreamRequestHandler):
 
         :param username: Username to get messages for
         :type username: bytes
-        :returns: Empty
-        :rtype: list[:class:`MIMEMultipart`]
+        :returns: Messages with size and uid, None for deleted ones
+        :rtype: list[:class:`CachedMessage`]
         '''
         if self.__message_cache:
             return self.__message_cache
@@ -236,6 +188,29 @@ class POP3Handler(StreamRequestHandler):
                                  'get_messages(%s) called' %
                                  (type(self), username))
 
+    def _get_numbered(self, args):
+        '''
+        Get the messages to list.
+
+        :param args: Message number, or empty for all messages
+        :type args: bytes
+        :returns: Message numbers and messages that are not deleted
+        :rtype: list[tuple[int, :class:`CachedMessage`]]
+        :raises: :class:`POP3Exception` for an unknown message
+        '''
+        msgs = self.get_messages(self._user)
+        if not args.strip():
+            return [(index, msg) for index, msg in enumerate(msgs, 1)
+                    if msg is not None]
+        try:
+            index = int(args)
+            msg = msgs[index - 1] if index > 0 else None
+        except (ValueError, IndexError):
+            msg = None
+        if msg is None:
+            raise POP3Exception("No such message")
+        return [(index, msg)]
+
     def _handle_list(self, args):
         '''
         Handle List internal.
@@ -245,14 +220,32 @@ class POP3Handler(StreamRequestHandler):
         :returns: True
         :rtype: bool
         '''
+        numbered = self._get_numbered(args)
+        if args.strip():
+            self._say(b"%i %i" % (numbered[0][0], numbered[0][1].size))
+            return True
         self._handle_stat(args)
-        msgs = self.get_messages(self._user)
-        index = 1
-        for msg in msgs:
-            self.logger.info("_handle_list: %i %i", index, len(str(msg)))
-            self.wfile.write(b"%i %i \r\n" % (index, len(str(msg))))
-            index += 1
-        self.wfile.write(b".\r\n")
+        self._write(b"".join(b"%i %i\r\n" % (index, msg.size)
+                             for index, msg in numbered) + b".\r\n")
+        return True
+
+    def _handle_uidl(self, args):
+        '''
+        Handle Unique id listing internal.
+
+        :param args: arguments
+        :type args: bytes
+        :returns: True
+        :rtype: bool
+        '''
+        numbered = self._get_numbered(args)
+        if args.strip():
+            self._say(b"%i %s" % (numbered[0][0],
+                                  numbered[0][1].uid.encode("ascii")))
+            return True
+        self._say(b"unique-id listing follows")
+        self._write(b"".join(b"%i %s\r\n" % (index, msg.uid.encode("ascii"))
+                             for index, msg in numbered) + b".\r\n")
         return True
 
     def _handle_stat(self, _args):
@@ -264,13 +257,45 @@ class POP3Handler(StreamRequestHandler):
         :returns: False
         :rtype: bool
         '''
-        msgs = self.get_messages(self._user)
-        size = 0
-        for i in msgs:
-            size += len(str(i))
-        self._say(b"%i %i" % (len(msgs), size))
+        msgs = [msg for msg in self.get_messages(self._user)
+                if msg is not None]
+        self._say(b"%i %i" % (len(msgs), sum(msg.size for msg in msgs)))
         return False
 
+    def _send_message(self, index, lines=None):
+        '''
+        Send a message, dot stuffed, and the terminating line.
+
+        :param index: Message number
+        :type index: int
+        :param lines: Body lines to send, default the whole message
+        :type lines: int
+        '''
+        buf = []
+        buf_size = 0
+        in_body = False
+        with self.open_message(index - 1) as handle:
+            for line in handle:
+                if in_body:
+                    if lines is not None:
+                        if lines <= 0:
+                            break
+                        lines -= 1
+                elif line == b"\r\n":
+                    in_body = True
+                if line.startswith(b"."):
+                    line = b"." + line
+                buf.append(line)
+                buf_size += len(line)
+                if buf_size >= SEND_BUFFER:
+                    self._write(b"".join(buf))
+                    buf = []
+                    buf_size = 0
+        if buf and not buf[-1].endswith(b"\r\n"):
+            buf.append(b"\r\n")
+        buf.append(b".\r\n")
+        self._write(b"".join(buf))
+
     def _handle_retr(self, args):
         '''
         Handle retrieve of messages internal?
@@ -278,19 +303,9 @@ class POP3Handler(StreamRequestHandler):
         :param args: Byte string containing message number
         :type args: bytes
         '''
-        try:
-            index = int(args)
-        except ValueError:
-            utils.log_exception()
-            # pylint: disable=raise-missing-from
-            raise POP3Exception("Invalid message number")
-
-        msg = self.get_message(index - 1)
-        mstr_str = str(msg)
-        mstr = mstr_str.encode('utf-8', 'replace')
-
-        self._say(b"OK %i octets" % len(mstr))
-        self.wfile.write(mstr + b"\r\n.\r\n")
+        index, msg = self._get_numbered(args)[0]
+        self._say(b"%i octets" % msg.size)
+        self._send_message(index)
 
     def _handle_top(self, args):
         '''
@@ -299,16 +314,17 @@ class POP3Handler(StreamRequestHandler):
         :param args: Arguments
         :type args: bytes
         '''
-        msg_number, lines = args.split(b" ", 1)
-
-        msg_number = int(msg_number) - 1
-        lines = int(lines)
+        try:
+            msg_number, lines = args.split(b" ", 1)
+            lines = int(lines)
+        except ValueError:
+            utils.log_exception()
+            # pylint: disable=raise-missing-from
+            raise POP3Exception("Invalid arguments")
 
-        msg_str = self.get_message(msg_number)
-        msg = msg_str.encode('utf-8', 'replace')
+        index, _msg = self._get_numbered(msg_number)[0]
         self._say(b"top of message follows")
-        self.wfile.write(b"\r\n".join(str(msg).split(b"\r\n")[:lines]))
-        self.wfile.write(b"\r\n.\r\n")
+        self._send_message(index, lines)
 
     def _handle_dele(self, args):
         '''
@@ -327,19 +343,28 @@ class POP3Handler(StreamRequestHandler):
         self.del_message(index-1)
         self._say(b"Deleted")
 
-    def _handle(self):
-        '''Handle Internal.'''
+    def _handle(self, data):
+        '''
+        Handle Internal.
+
+        :param data: Command line
+        :type data: bytes
+        '''
         dispatch = {
             b"USER" : ((b"",), self._handle_user),
             b"PASS" : ((b"USER",), self._handle_pass),
-            b"LIST" : ((b"PASS", b"LIST", b"STAT"), self._handle_list),
-            b"STAT" : ((b"PASS", b"LIST", b"STAT"), self._handle_stat),
-            b"RETR" : ((b"LIST", b"STAT"), self._handle_retr),
-            b"TOP"  : ((b"LIST", b"STAT"), self._handle_top),
-            b"DELE" : ((b"LIST", b"STAT"), self._handle_dele),
+            b"LIST" : ((b"PASS", b"LIST", b"STAT", b"UIDL"),
+                       self._handle_list),
+            b"STAT" : ((b"PASS", b"LIST", b"STAT", b"UIDL"),
+                       self._handle_stat),
+            b"UIDL" : ((b"PASS", b"LIST", b"STAT", b"UIDL"),
+                       self._handle_uidl),
+            b"RETR" : ((b"LIST", b"STAT", b"UIDL"), self._handle_retr),
+            b"TOP"  : ((b"LIST", b"STAT", b"UIDL"), self._handle_top),
+            b"DELE" : ((b"LIST", b"STAT", b"UIDL"), self._handle_dele),
             }
 
-        data = self.rfile.readline().strip()
+        data = data.strip()
         if not data:
             raise POP3Exception("Conversation error")
 
@@ -369,103 +394,143 @@ class POP3Handler(StreamRequestHandler):
         if handler(args):
             self.state = cmd
 
-    def handle(self):
-        '''Handle.'''
-        self.state = b""
-
+    def greet(self):
+        '''Send the greeting that starts a session.'''
         self._say(b"D-RATS waiting")
 
-        while True:
-            # in this case handling a broad exception is needed
-            # to prevent a protocol deadlock
-            # pylint: disable=broad-except
-            try:
-                self._handle()
-            except POP3Exit as err:
-                err_str = "%s" % err
-                self._say(err_str.encode('utf-8', 'replace'))
-                break
-            except POP3Exception as err:
-                err_str = "%s" % err
-                self._say(err_str.encode('utf-8', 'replace'), True)
-                break
-            except Exception:
-                utils.log_exception()
-                self._say(b"Internal error", True)
-                break
+    def handle_line(self, data):
+        '''
+        Handle a command line.
+
+        :param data: Command line
+        :type data: bytes
+        :returns: False when the session is over
+        :rtype: bool
+        '''
+        # in this case handling a broad exception is needed
+        # to prevent a protocol deadlock
+        # pylint: disable=broad-except
+        try:
+            self._handle(data)
+        except POP3Exit as err:
+            err_str = "%s" % err
+            self._say(err_str.encode('utf-8', 'replace'))
+            return False
+        except POP3Exception as err:
+            err_str = "%s" % err
+            self._say(err_str.encode('utf-8', 'replace'), True)
+            return False
+        except Exception:
+            utils.log_exception()
+            self._say(b"Internal error", True)
+            return False
+        return True
+
+
+def render_message(config, filename):
+    '''
+    Render a message for the POP3 server.
+
+    :param config: D-Rats configuration
+    :type config: :class:`DratsConfig`
+    :param filename: Message filename
+    :type filename: str
+    :returns: Destination of the message and the Mime message
+    :rtype: tuple[str, :class:`MIMEMultipart`]
+    '''
+    msg = msgrouting.form_to_email(config, filename)
+    dst = msg["To"]
+
+    name, addr = email.utils.parseaddr(msg["From"])
+    if addr == "DO_NOT_REPLY@d-rats.com":
+        addr = "%s@d-rats.com" % name.upper()
+        msg.replace_header("From", addr)
+        del msg["Reply-To"]
+
+    name, addr = email.utils.parseaddr(msg["To"])
+    if not name and "@" not in addr:
+        msg.replace_header("To", "%s@d-rats.com" % addr.upper())
+
+    msg["X-DRATS-Source"] = filename
+    return dst, msg
+
+
+def get_pop3_cache(config, folder):
+    '''
+    Get the POP3 message cache of a message folder.
+
+    :param config: D-Rats configuration
+    :type config: :class:`DratsConfig`
+    :param folder: Name of the message folder
+    :type folder: str
+    :returns: Shared message cache
+    :rtype: :class:`Pop3Cache`
+    '''
+    return Pop3Cache.get_cache(os.path.join(config.form_store_dir(), folder),
+                               functools.partial(render_message, config))
 
 
 class DratsPOP3Handler(POP3Handler):
     '''
     D-Rats POP3 Handler.
 
+    The messages are served from the :class:`Pop3Cache` of the
+    mailbox, so a session does not have to read the forms.
+
     :param config: D-Rats configuration
     :type config: :class:`DratsConfig`
-    :param args: Arguments for pop3 handler
+    :param write: Function taking the reply data
+    :type write: function(bytes)
     '''
 
-    def __init__(self, config, *args):
+    def __init__(self, config, write):
         self.logger = logging.getLogger("DratsPOP3Handler")
         self.__config = config
-        self.__message_cache = []
-        POP3Handler.__init__(self, *args)
+        self.__cache = None
+        self.__messages = None
+        POP3Handler.__init__(self, write)
 
     def get_messages(self, username):
         '''
         Get messages for a user.
 
+        The station's own callsign gets all of the Inbox, other users
+        get the messages in the Outbox for them.
+
         :param user: user to look up callsign
         :type user: bytes
-        :returns: Mime Messages
-        :rtype: list[:class:`MIMEMultipart`]
+        :returns: Messages, None for the deleted ones
+        :rtype: list[:class:`CachedMessage`]
         '''
-        if self.__message_cache:
-            return self.__message_cache
+        if self.__messages is not None:
+            return self.__messages
 
         self.logger.info('username %s', username)
         username_str = username.upper().decode('utf-8', 'replace')
         if username_str == self.__config.get("user", "callsign"):
-            dir_name = os.path.join(self.__config.form_store_dir(), "Inbox")
-            all_message = True
+            self.__cache = get_pop3_cache(self.__config, "Inbox")
+            self.__messages = self.__cache.messages()
         else:
-            dir_name = os.path.join(self.__config.form_store_dir(), "Outbox")
-            all_message = False
-
-        files = glob(os.path.join(dir_name, "*.xml"))
-
-        for filename in files:
-            self.logger.info('Filename %s', filename)
-            msg = msgrouting.form_to_email(self.__config, filename)
-            if not all_message and msg["To"] != username_str:
-                continue
-
-            name, addr = email.utils.parseaddr(msg["From"])
-            self.logger.info('From: name %s addr %s', name, addr)
-            if addr == "DO_NOT_REPLY@d-rats.com":
-                addr = "%s@d-rats.com" % name.upper()
-                msg.replace_header("From", addr)
-                del msg["Reply-To"]
-
-            name, addr = email.utils.parseaddr(msg["To"])
-            self.logger.info('To: name %s addr %s', name, addr)
-            if not name and "@" not in addr:
-                msg.replace_header("To", "%s@d-rats.com" % addr.upper())
-
-            msg["X-DRATS-Source"] = filename
-            self.__message_cache.append(msg)
+            self.__cache = get_pop3_cache(self.__config, "Outbox")
+            self.__messages = self.__cache.messages(username_str)
+        return self.__messages
 
-        return self.__message_cache
-
-    def get_message(self, index):
+    def open_message(self, index):
         '''
-        Get Message.
+        Open a message.
 
         :param index: Index of message
         :type index: int
-        :returns: Mime message
-        :rtype: :class:`MIMEMultipart`
+        :returns: Message with CRLF line ends
+        :rtype: :class:`io.BufferedReader`
+        :raises: :class:`POP3Exception` if the message is gone
         '''
-        return self.__message_cache[index]
+        try:
+            return self.__cache.open_message(self.__messages[index])
+        except OSError as err:
+            self.logger.info("open_message: %s", err)
+            # pylint: disable=raise-missing-from
+            raise POP3Exception("Message is gone")
 
     def del_message(self, index):
         '''
@@ -474,182 +539,511 @@ class DratsPOP3Handler(POP3Handler):
         :param index: Index of message to be deleted
         :type index: int
         '''
-        msg = self.__message_cache[index]
-        self.__message_cache[index] = None
-        filename = msg["X-DRATS-Source"]
+        msg = self.__messages[index]
+        if msg is None:
+            raise POP3Exception("Already deleted")
+        self.__messages[index] = None
+        filename = os.path.join(self.__cache.mailbox_dir, msg.name)
 
         if os.path.exists(filename):
             msgrouting.move_to_folder(self.__config, filename, "Trash")
+            self.__cache.forget(filename)
         else:
             raise POP3Exception("Already deleted")
 
 
-class DratsPOP3Server(TCPServer):
-    '''
-    D-RATS POP3 Server.
-
-    :param server_address: Server address and port
-    :type server_address: tuple[str, int]
-    :param RequestHandlerClass: Message handler
-    :type RequestHandlerClass: :class:`POP3Handler`
-    :param bind_and_activate: Default True
-    :type bind_and_activate: bool
+def smtp_sender(mailfrom):
     '''
+    Callsign of the sender of an SMTP message.
 
-    allow_reuse_address = True
-
-    def __init__(self, server_address, RequestHandlerClass,
-                 bind_and_activate=True):
-        TCPServer.__init__(self, server_address, RequestHandlerClass,
-                           bind_and_activate)
-        self.__config = None
-
-    # Not finding a direct caller of this but this
-    # may be an overridden TCPServer method
-    def finish_request(self, request, client_address):
-        '''
-        Finish Request.
-
-        :param request: request
-        :type request: :class:`socket.socket`
-        :param client_address: client address
-        :type client_address: tuple[str, int]
-        '''
-        self.RequestHandlerClass(self.__config,
-                                 request, client_address, self)
-
-    def set_config(self, config):
-        '''
-        Set D-rats config for the object.
+    :param mailfrom: Address from the MAIL command
+    :type mailfrom: str
+    :returns: Sender callsign
+    :rtype: str
+    :raises: :class:`EmailSenderError` if sender is invalid
+    '''
+    if "@" in mailfrom:
+        sender, _other = mailfrom.split("@", 1)
+    else:
+        sender = mailfrom
+    sender = sender.upper()
 
-        :param config: D-Rats configuration
-        :type config: :class:`DratsConfig`
-        '''
-        self.__config = config
+    if not re.match("[A-Z0-9]+", sender):
+        raise EmailSenderError("Sender must be alphanumeric string")
+    return sender
 
 
-class DratsPOP3ServerThread(TCPServerThread):
+def store_mail(config, mailfrom, rcpttos, handle):
     '''
-    D-RATS POP3 Server Thread.
+    Store an SMTP message in the Outbox as a form.
 
     :param config: D-Rats configuration
     :type config: :class:`DratsConfig`
+    :param mailfrom: Sender information
+    :type mailfrom: str
+    :param rcpttos: Receiver information
+    :type rcpttos: list[str]
+    :param handle: Message data, from the start
+    :type handle: :class:`io.BufferedIOBase`
+    :returns: Form filename
+    :rtype: str
+    :raises: :class:`EmailSenderError` if sender is invalid
+    :raises: :class:`emailgw.NoUsablePartError` if the message has no
+             usable part
     '''
+    logger = logging.getLogger("store_mail")
+    msg = email.message_from_binary_file(handle)
+    sender = smtp_sender(mailfrom)
 
-    name = "[POP3]"
+    recip = rcpttos[0]
+    if recip.lower().endswith("@d-rats.com"):
+        recip, _host = recip.upper().split("@", 1)
 
-    def __init__(self, config):
-        self.logger = logging.getLogger("DratsPOP3ServerThread")
-        port = config.getint("settings", "msg_pop3_port")
-        self.logger.info("[POP3] Starting server on port %i", port)
-        TCPServerThread.__init__(self, config, DratsPOP3Server,
-                                 ("0.0.0.0", port), DratsPOP3Handler)
-        self.daemon = True
+    logger.info("Sender is %s", sender)
+    logger.info("Recip  is %s", recip)
 
+    mid = mkmsgid(config.get("user", "callsign"))
+    ffn = os.path.join(config.form_store_dir(), "Outbox", "%s.xml" % mid)
+    logger.info("Storing mail at %s", ffn)
 
-class DratsSMTPServer(smtpd.SMTPServer):
+    form = emailgw.create_form_from_mail(config, msg, ffn)
+    form.set_path_src(sender)
+    form.set_path_dst(recip)
+    form.save_to(ffn)
+    if msgrouting.msg_is_locked(ffn):
+        msgrouting.msg_unlock(ffn)
+
+    # POP3 sessions see the new message without rescanning the folder.
+    get_pop3_cache(config, "Outbox").add(ffn)
+    return ffn
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class SMTPSession:
     '''
-    D-RATS SMTP Server.
+    SMTP Session.
+
+    One SMTP submission session on an asyncio stream.  The message
+    data is spooled to a temporary file as it arrives, and stored as
+    a form in a worker thread.
 
     :param config: D-Rats configuration
     :type config: :class:`DratsConfig`
+    :param reader: Stream from the client
+    :type reader: :class:`asyncio.StreamReader`
+    :param writer: Stream to the client
+    :type writer: :class:`asyncio.StreamWriter`
+    :param executor: Worker threads for storing the messages
+    :type executor: :class:`concurrent.futures.Executor`
     '''
 
-    def __init__(self, config):
-        self.logger = logging.getLogger("DratsSMTPServer")
-        self.__config = config
-        port = config.getint("settings", "msg_smtp_port")
-        smtpd.SMTPServer.__init__(self, ("0.0.0.0", port), None)
+    logger = logging.getLogger("SMTPSession")
 
-    def process_message(self, _peer, mailfrom, rcpttos, data, **kwargs):
-        '''
-        Process Message.
+    def __init__(self, config, reader, writer, executor):
+        self._config = config
+        self._reader = reader
+        self._writer = writer
+        self._executor = executor
+        self._mailfrom = None
+        self._rcpttos = []
 
-        :param peer: Peer to send to
-        :type peer: str
-        :param mailfrom: Sender information
-        :type mailfrom: str
-        :param rcpttos: Receiver information
-        :type rcpttos: str
-        :param data: Message data
-        :type data: bytes
-        :raises: :class:`EmailSenderError` if sender is invalid
+    async def _reply(self, *lines):
         '''
-        self.logger.info('process_message entered')
-        msg = email.message_from_bytes(data)
-        if "@" in mailfrom:
-            sender, _other = mailfrom.split("@", 1)
-        else:
-            sender = mailfrom
-        sender = sender.upper()
+        Send a reply.
 
-        if not re.match("[A-Z0-9]+", sender):
-            raise EmailSenderError("Sender must be alphanumeric string")
+        :param lines: Reply lines, with the code
+        :type lines: bytes
+        '''
+        self._writer.write(b"".join(line + b"\r\n" for line in lines))
+        await self._writer.drain()
+
+    async def run(self):
+        '''Run the session until the client quits.'''
+        commands = {
+            b"HELO": self._handle_helo,
+            b"EHLO": self._handle_ehlo,
+            b"MAIL": self._handle_mail,
+            b"RCPT": self._handle_rcpt,
+            b"DATA": self._handle_data,
+            b"RSET": self._handle_rset,
+            }
+        await self._reply(b"220 D-RATS ESMTP ready")
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            cmd, _sep, args = line.strip().partition(b" ")
+            cmd = cmd.upper()
+            self.logger.info("[SMTP] %s %s", cmd, args)
+            if cmd == b"QUIT":
+                await self._reply(b"221 Goodbye")
+                break
+            if cmd == b"NOOP":
+                await self._reply(b"250 OK")
+            elif cmd == b"VRFY":
+                await self._reply(b"252 Cannot verify user")
+            elif cmd in commands:
+                await commands[cmd](args)
+            else:
+                await self._reply(b"500 Unsupported command `%s'" % cmd)
+
+    async def _handle_helo(self, _args):
+        self._handle_reset()
+        await self._reply(b"250 D-RATS")
+
+    async def _handle_ehlo(self, _args):
+        self._handle_reset()
+        await self._reply(b"250-D-RATS", b"250-8BITMIME", b"250 PIPELINING")
+
+    def _handle_reset(self):
+        self._mailfrom = None
+        self._rcpttos = []
+
+    async def _handle_rset(self, _args):
+        self._handle_reset()
+        await self._reply(b"250 OK")
+
+    async def _handle_mail(self, args):
+        match = re.match(rb"FROM:\s*<([^>]*)>", args, re.IGNORECASE)
+        if not match:
+            await self._reply(b"501 Syntax: MAIL FROM:<address>")
+            return
+        mailfrom = match.group(1).decode('utf-8', 'replace')
+        try:
+            smtp_sender(mailfrom)
+        except EmailSenderError as err:
+            await self._reply(b"553 %s" % str(err).encode())
+            return
+        self._handle_reset()
+        self._mailfrom = mailfrom
+        await self._reply(b"250 OK")
 
-        recip = rcpttos[0]
-        if recip.lower().endswith("@d-rats.com"):
-            recip, _host = recip.upper().split("@", 1)
+    async def _handle_rcpt(self, args):
+        if self._mailfrom is None:
+            await self._reply(b"503 Need MAIL first")
+            return
+        match = re.match(rb"TO:\s*<([^>]+)>", args, re.IGNORECASE)
+        if not match:
+            await self._reply(b"501 Syntax: RCPT TO:<address>")
+            return
+        self._rcpttos.append(match.group(1).decode('utf-8', 'replace'))
+        await self._reply(b"250 OK")
 
-        self.logger.info("Sender is %s", sender)
-        self.logger.info("Recip  is %s", recip)
+    async def _handle_data(self, _args):
+        if not self._rcpttos:
+            await self._reply(b"503 Need RCPT first")
+            return
+        await self._reply(b"354 End data with <CR><LF>.<CR><LF>")
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed in DATA")
+                if line in (b".\r\n", b".\n"):
+                    break
+                if line.startswith(b"."):
+                    line = line[1:]
+                spool.write(line)
+            spool.seek(0)
+            loop = asyncio.get_running_loop()
+            try:
+                ffn = await loop.run_in_executor(
+                    self._executor, store_mail, self._config,
+                    self._mailfrom, self._rcpttos, spool)
+            # Any failure to store the message must be reported to the
+            # client, or it would think the message was accepted.
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.info("_handle_data: %s", err, exc_info=True)
+                await self._reply(b"554 %s" % str(err).encode())
+                return
+            finally:
+                self._handle_reset()
+        await self._reply(b"250 OK queued as %s" %
+                          os.path.basename(ffn).encode())
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class MailService(threading.Thread):
+    '''
+    Mail Service.
 
-        mid = mkmsgid(self.__config.get("user", "callsign"))
-        ffn = os.path.join(self.__config.form_store_dir(),
-                           "Outbox", "%s.xml" % mid)
-        self.logger.info("Storing mail at %s", ffn)
+    Serves SMTP submission and POP3 from one asyncio event loop, with
+    the sessions running concurrently.  The blocking work, reading the
+    POP3 message caches and storing forms, runs in a few worker
+    threads.  Both protocols share the :class:`Pop3Cache` of the
+    folders, so a message submitted by SMTP can be fetched by POP3
+    right away.
 
-        self.logger.info('process_message calling create form from e-mail')
-        form = emailgw.create_form_from_mail(self.__config, msg, ffn)
-        form.set_path_src(sender)
-        form.set_path_dst(recip)
-        form.save_to(ffn)
-        if msgrouting.msg_is_locked(ffn):
-            msgrouting.msg_unlock(ffn)
+    A port of None takes the port from the configuration if that
+    server is enabled there, a port of 0 picks a free one.  Each port
+    is opened on its own, the ones that can not be opened are left in
+    :attr:`errors` and the service runs with the others.
 
+    :param config: D-Rats configuration
+    :type config: :class:`DratsConfig`
+    :param address: Address to listen on, default "0.0.0.0"
+    :type address: str
+    :param smtp_port: SMTP port, default from the configuration
+    :type smtp_port: int
+    :param pop3_port: POP3 port, default from the configuration
+    :type pop3_port: int
+    '''
 
-class DratsSMTPServerThread(threading.Thread):
-    '''D-Rats SMTP Server Thread.'''
+    logger = logging.getLogger("MailService")
 
-    def __init__(self, config):
-        self.logger = logging.getLogger("DratsSMTPServerThread")
+    def __init__(self, config, address="0.0.0.0", smtp_port=None,
+                 pop3_port=None):
         threading.Thread.__init__(self)
         self.daemon = True
+        self.ports = {}
+        self.errors = {}
         self.__config = config
-        self.__server = None
+        self.__address = address
+        if smtp_port is None and \
+                config.getboolean("settings", "msg_smtp_server"):
+            smtp_port = config.getint("settings", "msg_smtp_port")
+        if pop3_port is None and \
+                config.getboolean("settings", "msg_pop3_server"):
+            pop3_port = config.getint("settings", "msg_pop3_port")
+        self.__wanted = {"smtp": smtp_port, "pop3": pop3_port}
+        self.__executor = ThreadPoolExecutor(max_workers=SESSION_WORKERS,
+                                             thread_name_prefix="MailService")
+        self.__loop = None
+        self.__servers = []
+        self.__ready = threading.Event()
+        self.__error = None
+
+    def start(self):
+        '''
+        Start the service, once the ports are open.
+
+        :raises: :class:`OSError` if none of the ports can be opened
+        '''
+        threading.Thread.start(self)
+        self.__ready.wait()
+        if self.__error:
+            self.join()
+            raise self.__error
+
+    async def _open(self):
+        '''Open the listening ports.'''
+        sessions = {"smtp": self._smtp_session, "pop3": self._pop3_session}
+        for name, port in self.__wanted.items():
+            if port is None:
+                continue
+            try:
+                server = await asyncio.start_server(sessions[name],
+                                                    self.__address, port,
+                                                    limit=LINE_LIMIT)
+            except OSError as err:
+                self.logger.info("[%s] Unable to start server on port %i: %s",
+                                 name.upper(), port, err)
+                self.errors[name] = err
+                continue
+            self.__servers.append(server)
+            self.ports[name] = server.sockets[0].getsockname()[1]
+            self.logger.info("[%s] Starting server on port %i",
+                             name.upper(), self.ports[name])
+        if "pop3" in self.ports:
+            # Have the messages rendered before the first client asks.
+            for folder in ("Inbox", "Outbox"):
+                get_pop3_cache(self.__config, folder).start()
 
     def run(self):
-        '''Run SMTP Server.'''
-        if SMTPD_AVAILABLE and ASYNCORE_AVAILABLE:
-            self.logger.info("[SMTP] Starting server")
-            self.__server = DratsSMTPServer(self.__config)
-            asyncore.loop(timeout=1)
-            self.logger.info("[SMTP] Stopped")
-        else:
-            self.logger.info("[SMTP] SMTP Server not available.")
+        self.__loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_until_complete(self._open())
+        if self.errors and not self.ports:
+            self.__error = next(iter(self.errors.values()))
+        self.__ready.set()
+        if not self.__error:
+            self.__loop.run_forever()
+
+        for server in self.__servers:
+            server.close()
+        tasks = asyncio.all_tasks(self.__loop)
+        for task in tasks:
+            task.cancel()
+        self.__loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.__loop.close()
+        self.logger.info("Stopped")
 
     def stop(self):
-        '''Stop SMTP Server.'''
-        if self.__server:
-            self.__server.close()
-        self.join()
+        '''Stop the service.'''
+        if self.__loop and self.is_alive():
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.join()
+        self.__executor.shutdown(wait=False)
 
+    async def _smtp_session(self, reader, writer):
+        '''
+        Serve an SMTP client.
 
-def main():
-    '''Main program for unit testing.'''
+        :param reader: Stream from the client
+        :type reader: :class:`asyncio.StreamReader`
+        :param writer: Stream to the client
+        :type writer: :class:`asyncio.StreamWriter`
+        '''
+        session = SMTPSession(self.__config, reader, writer, self.__executor)
+        try:
+            await session.run()
+        except (ConnectionError, OSError, ValueError) as err:
+            self.logger.info("_smtp_session: %s", err)
+        finally:
+            writer.close()
+
+    async def _pop3_session(self, reader, writer):
+        '''
+        Serve a POP3 client.
+
+        The commands run in the worker threads, the replies they
+        collect are sent once each command is done.
+
+        :param reader: Stream from the client
+        :type reader: :class:`asyncio.StreamReader`
+        :param writer: Stream to the client
+        :type writer: :class:`asyncio.StreamWriter`
+        '''
+        loop = asyncio.get_running_loop()
+        replies = []
+        handler = DratsPOP3Handler(self.__config, replies.append)
+        handler.greet()
+        active = True
+        try:
+            while active:
+                writer.write(b"".join(replies))
+                replies.clear()
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+                active = await loop.run_in_executor(
+                    self.__executor, handler.handle_line, line)
+            writer.write(b"".join(replies))
+            await writer.drain()
+        except (ConnectionError, OSError, ValueError) as err:
+            self.logger.info("_pop3_session: %s", err)
+        finally:
+            writer.close()
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class _TestConfig:
+    '''Configuration for the load test.'''
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+        self._source_dir = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "forms")
+
+    def form_store_dir(self):
+        '''Form store directory.'''
+        return self._store_dir
+
+    def form_source_dir(self):
+        '''Form template directory.'''
+        return self._source_dir
+
+    @staticmethod
+    def get(_section, _option):
+        '''Only the station callsign is used.'''
+        return "N0CALL"
+
+    @staticmethod
+    def getboolean(_section, _option):
+        '''No servers from the configuration.'''
+        return False
+
+
+def _test_client(smtp_port, pop3_port, num, think, results):
+    '''
+    Submit a message by SMTP and fetch it by POP3.
 
+    The client waits think seconds between the commands, like a mail
+    client on a slow link.
+    '''
     # pylint: disable=import-outside-toplevel
-    from d_rats.dratsconfig import DratsConfig
+    import poplib
+    import smtplib
+    call = "K%03iTST" % num
+    subject = "Load test %i" % num
+    with smtplib.SMTP("127.0.0.1", smtp_port) as smtp:
+        time.sleep(think)
+        smtp.sendmail("n0call@d-rats.com", ["%s@d-rats.com" % call],
+                      "From: n0call@d-rats.com\r\nTo: %s@d-rats.com\r\n"
+                      "Subject: %s\r\n\r\nMessage %i\r\n" %
+                      (call, subject, num))
+    pop = poplib.POP3("127.0.0.1", pop3_port)
+    pop.user(call)
+    pop.pass_("test")
+    time.sleep(think)
+    count = len(pop.list()[1])
+    found = count == 1 and \
+        b"Subject: EMAIL: %s" % subject.encode() in pop.retr(1)[1]
+    pop.quit()
+    results.append(found)
+
+
+def _port_test(logger, config, smtp_port):
+    '''Check that an SMTP port in use does not stop the POP3 server.'''
+    service = MailService(config, "127.0.0.1", smtp_port=smtp_port,
+                          pop3_port=0)
+    service.start()
+    passed = "smtp" in service.errors and "pop3" in service.ports
+    service.stop()
+    logger.info("%s: POP3 started with the SMTP port in use",
+                ("FAIL", "PASS")[passed])
+
+
+def main():
+    '''Load test with 50 concurrent SMTP and POP3 clients.'''
     logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
                         datefmt="%m/%d/%Y %H:%M:%S",
                         level=logging.INFO)
+    logger = logging.getLogger("MailService.test")
+    for name in ("SMTPSession", "DratsPOP3Handler", "store_mail",
+                 "emailgw:create_form_from_mail", "FormFile", "Pop3Cache"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    clients = 50
+    think = 0.2
+    with tempfile.TemporaryDirectory() as store_dir:
+        config = _TestConfig(store_dir)
+        for folder in ("Inbox", "Outbox", "Trash"):
+            os.mkdir(os.path.join(store_dir, folder))
+            Pop3Cache.get_cache(os.path.join(store_dir, folder),
+                                functools.partial(render_message, config),
+                                os.path.join(store_dir, "cache", folder))
+
+        service = MailService(config, "127.0.0.1", smtp_port=0, pop3_port=0)
+        service.start()
+        results = []
+        threads = [threading.Thread(target=_test_client,
+                                    args=(service.ports["smtp"],
+                                          service.ports["pop3"],
+                                          num, think, results))
+                   for num in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        _port_test(logger, config, service.ports["smtp"])
+        service.stop()
+
+        passed = results.count(True) == clients
+        logger.info("%s: %i of %i clients got their message in %.2f s, "
+                    "one session at a time would take over %.1f s",
+                    ("FAIL", "PASS")[passed], results.count(True), clients,
+                    elapsed, clients * 2 * think)
 
-    my_config = DratsConfig()
-    smtpsrv = DratsSMTPServerThread(my_config)
-    smtpsrv.start()
-
-    pop3s = DratsPOP3Server(("localhost", 9090), DratsPOP3Handler)
-    pop3s.set_config(my_config)
-    pop3s.serve_forever()
 
 if __name__ == "__main__":
     main()
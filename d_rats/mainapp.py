@@ -40,6 +40,7 @@ from time import gmtime, strftime
 # import various libraries of support functions
 import time
 import socket
+import threading
 
 import glob
 import shutil
@@ -92,6 +93,10 @@ from . import msgrouting
 from . import wl2k
 from . import version
 from . import mailsrv
+from .attachment_store import AttachmentStore
+from .chat_log import ChatLogWriter
+from .duplicate_cache import DuplicateCache
+from .form_registry import FormRegistry
 
 from .emailgw import PeriodicAccountMailThread
 from .emailgw import AccountMailThread
@@ -374,6 +379,7 @@ class MainApp(Gtk.Application):
         self.mainwindow = None
         self.__unused_pipes = {}
         self.__pipes = {}
+        self.dup_cache = None
         self.pop3srv = None
         self.msgrouter = None
         self.plugsrv = None
@@ -573,6 +579,7 @@ class MainApp(Gtk.Application):
         print("mainapp/ev_shutdown")
         if application.map:
             application.map.exiting = True
+        ChatLogWriter.stop_writer()
 
     def stop_comms(self, portid):
         '''
@@ -712,8 +719,20 @@ class MainApp(Gtk.Application):
             }
 
         if name not in self.active_sessions:
+            # One duplicate cache is shared by all ports, so a frame
+            # heard on two ports is only handled once.  Chat and ping
+            # frames may be repeated on purpose, so they are not dropped.
+            dup_ttl = float(self.config.get("settings", "dup_cache_ttl"))
+            if self.dup_cache is None and dup_ttl > 0:
+                self.dup_cache = DuplicateCache(
+                    dup_ttl,
+                    self.config.getint("settings", "dup_cache_entries"),
+                    stateless=False)
+
             # if we are not chatting 1-to-1 let's do CQ
-            smgr = sessionmgr.SessionManager(path, call, **transport_args)
+            smgr = sessionmgr.SessionManager(path, call,
+                                             dup_cache=self.dup_cache,
+                                             **transport_args)
 
             chat_session = smgr.start_session("chat",
                                               dest="CQCQCQ",
@@ -756,6 +775,8 @@ class MainApp(Gtk.Application):
                                       cls=sniff.SniffSession)
             # pylint: disable=protected-access
             smgr.set_sniffer_session(sses._id)
+            # pylint can not tell that this is a SniffSession
+            # pylint: disable=no-member
             sses.connect("incoming_frame", sniff_event, name)
 
             scoord = session_coordinator.SessionCoordinator(
@@ -995,23 +1016,20 @@ class MainApp(Gtk.Application):
             mthread.start()
             self.mail_threads[acct] = mthread
 
-        if self.config.getboolean("settings", "msg_smtp_server"):
-            try:
-                smtpsrv = mailsrv.DratsSMTPServerThread(self.config)
-                smtpsrv.start()
-                self.mail_threads["SMTPSRV"] = smtpsrv
-            except OSError:
-                self.logger.info("_refresh_mail_threads: "
-                                 "Unable to start SMTP server", exc_info=True)
-
-        if self.config.getboolean("settings", "msg_pop3_server"):
+        if self.config.getboolean("settings", "msg_smtp_server") or \
+                self.config.getboolean("settings", "msg_pop3_server"):
             try:
-                pop3srv = mailsrv.DratsPOP3ServerThread(self.config)
-                pop3srv.start()
-                self.mail_threads["POP3SRV"] = pop3srv
+                mailservice = mailsrv.MailService(self.config)
+                mailservice.start()
+                self.mail_threads["MAILSRV"] = mailservice
             except OSError:
                 self.logger.info("_refresh_mail_threads: "
-                                 "Unable to start POP3 server", exc_info=True)
+                                 "Unable to start mail server", exc_info=True)
+            else:
+                for name, err in mailservice.errors.items():
+                    self.logger.info("_refresh_mail_threads: "
+                                     "Unable to start %s server: %s",
+                                     name.upper(), err)
 
 
     def set_locale(self, lang_code):
@@ -2168,15 +2186,30 @@ class MainApp(Gtk.Application):
                 smgr.manual_heard_station(station)
 
     def clear_all_msg_locks(self):
-        '''Clear all message locks.'''
+        '''
+        Clear all message locks.
+
+        Message locks are released by the operating system when the
+        program exits, this removes the lock files of older versions.
+        '''
         path = os.path.join(self.config.platform.config_dir(),
                             "messages",
                             "*",
-                            ".lock*")
+                            ".lock.*")
         for lock in glob.glob(path):
             self.logger.info("Removing stale message lock %s", lock)
             os.remove(lock)
 
+    def prune_attachments(self):
+        '''
+        Remove the attachments of deleted messages in the background.
+        '''
+        prune = threading.Thread(target=AttachmentStore.get_store().prune,
+                                 args=(self.config.form_store_dir(),),
+                                 name="AttachmentPrune")
+        prune.daemon = True
+        prune.start()
+
     # pylint wants wants a maximum of 15 local variables
     # pylint wants a maximum of 12 branches
     # pylint wants a maximum of 50 statements
@@ -2208,8 +2241,10 @@ class MainApp(Gtk.Application):
                 except (OSError, shutil.SameFileError) as err:
                     self.logger.info("Copyfile FAILED: %s", err)
                     raise
+        FormRegistry.get_registry(userdir).load()
 
         self.clear_all_msg_locks()
+        self.prune_attachments()
 
         if self.config.options("ports") and \
                 self.config.has_option("settings", "port"):
@@ -0,0 +1,326 @@
+#!/usr/bin/python
+'''Message Lock.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+HAVE_FCNTL = False
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    pass
+
+# One hidden file per message folder holds the byte range locks.
+LOCK_FILE = ".msglocks"
+
+
+class MessageLockManager:
+    '''
+    Message Lock Manager.
+
+    Keeps the locked messages of this process in memory, so checking
+    a lock does not touch the disk.
+
+    Other processes using the same message folders are kept out with
+    a POSIX byte range lock in the LOCK_FILE of the folder, at an
+    offset taken from a hash of the message name.  The operating
+    system drops these locks when a process exits, so a crash can not
+    leave stale locks behind.  Where fcntl is not available only the
+    locks of this process are checked.
+
+    When debug logging is on, the stack of the caller is kept with
+    each lock and logged if another caller finds the message locked.
+
+    Safe to use from several threads.
+    '''
+
+    logger = logging.getLogger("MessageLock")
+
+    def __init__(self):
+        self._locks = {}
+        self._ranges = {}
+        self._dir_fds = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _dir_fd(self, dirname):
+        '''
+        Open the lock file of a folder, once.
+
+        :param dirname: Message folder
+        :type dirname: str
+        :returns: File descriptor, or None if it can not be opened
+        :rtype: int
+        '''
+        lock_fd = self._dir_fds.get(dirname, None)
+        if lock_fd is None:
+            try:
+                lock_fd = os.open(os.path.join(dirname, LOCK_FILE),
+                                  os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError as err:
+                self.logger.debug("_dir_fd: %s", err)
+                return None
+            # The file must stay open, closing any descriptor of it
+            # drops all of the locks this process holds on it.
+            self._dir_fds[dirname] = lock_fd
+        return lock_fd
+
+    def _lock_range(self, path):
+        '''
+        Take the cross process lock of a message.
+
+        :param path: Absolute message filename
+        :type path: str
+        :returns: True unless another process holds the lock
+        :rtype: bool
+        '''
+        if not HAVE_FCNTL:
+            return True
+        dirname, name = os.path.split(path)
+        lock_fd = self._dir_fd(dirname)
+        if lock_fd is None:
+            return True
+        key = (dirname, zlib.crc32(name.encode('utf-8', 'replace')))
+        count = self._ranges.get(key, 0)
+        if not count:
+            try:
+                fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                            1, key[1])
+            except OSError:
+                return False
+        self._ranges[key] = count + 1
+        return True
+
+    def _unlock_range(self, path):
+        '''
+        Release the cross process lock of a message.
+
+        :param path: Absolute message filename
+        :type path: str
+        '''
+        if not HAVE_FCNTL:
+            return
+        dirname, name = os.path.split(path)
+        key = (dirname, zlib.crc32(name.encode('utf-8', 'replace')))
+        count = self._ranges.pop(key, 0)
+        if count > 1:
+            # Another message of this process hashed to the same range
+            self._ranges[key] = count - 1
+        elif count:
+            fcntl.lockf(self._dir_fds[dirname], fcntl.LOCK_UN, 1, key[1])
+
+    def lock(self, fname):
+        '''
+        Lock a message.
+
+        :param fname: Message filename
+        :type fname: str
+        :returns: True if the message was locked
+        :rtype: bool
+        '''
+        path = os.path.abspath(fname)
+        with self._lock:
+            if path in self._locks:
+                owner = self._locks[path]
+                if owner:
+                    self.logger.debug("lock: %s owned by\n%s", path, owner)
+                return False
+            if not self._lock_range(path):
+                self.logger.info("lock: %s locked by another process", path)
+                return False
+            owner = ""
+            if self.logger.isEnabledFor(logging.DEBUG):
+                owner = "".join(traceback.format_stack(limit=8))
+            self._locks[path] = owner
+        return True
+
+    def unlock(self, fname):
+        '''
+        Unlock a message.
+
+        :param fname: Message filename
+        :type fname: str
+        :returns: True if the message was locked
+        :rtype: bool
+        '''
+        path = os.path.abspath(fname)
+        with self._lock:
+            if self._locks.pop(path, None) is None:
+                self.logger.info("unlock: %s was not locked", path)
+                return False
+            self._unlock_range(path)
+        return True
+
+    def is_locked(self, fname):
+        '''
+        Is a message locked by this process?
+
+        :param fname: Message filename
+        :type fname: str
+        :returns: True if the message is locked
+        :rtype: bool
+        '''
+        return os.path.abspath(fname) in self._locks
+
+    def close_folder(self, dirname):
+        '''
+        Close the lock file of a folder that is being deleted.
+
+        :param dirname: Message folder
+        :type dirname: str
+        '''
+        dirname = os.path.abspath(dirname)
+        with self._lock:
+            lock_fd = self._dir_fds.pop(dirname, None)
+            if lock_fd is not None:
+                os.close(lock_fd)
+                for key in [key for key in self._ranges if key[0] == dirname]:
+                    del self._ranges[key]
+
+    def clear(self):
+        '''Release all of the locks and close the lock files.'''
+        with self._lock:
+            self._locks.clear()
+            self._ranges.clear()
+            for lock_fd in self._dir_fds.values():
+                os.close(lock_fd)
+            self._dir_fds.clear()
+
+
+# Locks of all of the message folders of this process
+MESSAGE_LOCKS = MessageLockManager()
+
+
+def stress_test(logger, lock_manager, folder, threads=4, count=20000):
+    '''
+    Lock and unlock messages from several threads.
+
+    :param logger: Logger object
+    :type logger: :class:`logging.Logger`
+    :param lock_manager: Lock manager to test
+    :type lock_manager: :class:`MessageLockManager`
+    :param folder: Message folder
+    :type folder: str
+    :param threads: Number of threads, default 4
+    :type threads: int
+    :param count: Lock and unlock pairs per thread, default 20000
+    :type count: int
+    :returns: Lock and unlock pairs per second, and errors seen
+    :rtype: tuple[float, int]
+    '''
+    # The threads share half of the names to make them collide.
+    errors = []
+
+    def worker(num):
+        names = [os.path.join(folder, "form_%i_%i.xml" % (num % 2, i))
+                 for i in range(100)]
+        held = 0
+        for i in range(count):
+            fname = names[i % 100]
+            if lock_manager.lock(fname):
+                if not lock_manager.is_locked(fname):
+                    errors.append(fname)
+                held += 1
+                lock_manager.unlock(fname)
+        logger.debug("thread %i locked %i of %i", num, held, count)
+
+    workers = [threading.Thread(target=worker, args=(num,))
+               for num in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return threads * count / elapsed, len(errors)
+
+
+def _legacy_lock_test(folder, count):
+    '''
+    Lock and unlock with the dot-file locks used before.
+
+    :param folder: Message folder
+    :type folder: str
+    :param count: Lock and unlock pairs
+    :type count: int
+    :returns: Lock and unlock pairs per second
+    :rtype: float
+    '''
+    start = time.perf_counter()
+    for i in range(count):
+        lock_name = os.path.join(folder, ".lock.form_%i.xml" % (i % 100))
+        if not os.path.exists(lock_name):
+            with open(lock_name, "w") as lock:
+                traceback.print_stack(file=lock)
+        os.remove(lock_name)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    '''Unit test for module.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MessageLock.test")
+
+    folder = tempfile.mkdtemp()
+    try:
+        locks = MessageLockManager()
+        fname = os.path.join(folder, "form_1.xml")
+        held = locks.lock(fname) and not locks.lock(fname) and \
+            locks.is_locked(fname)
+        if held and locks.unlock(fname) and \
+                not locks.is_locked(fname) and not locks.unlock(fname):
+            logger.info("PASS: lock and unlock")
+        else:
+            logger.info("FAIL: lock and unlock")
+
+        # A child process must not get a lock held by this process.
+        locks.lock(fname)
+        if HAVE_FCNTL:
+            pid = os.fork()
+            if not pid:
+                os._exit(0 if not MessageLockManager().lock(fname) else 1)
+            _pid, status = os.waitpid(pid, 0)
+            if status == 0:
+                logger.info("PASS: locked against another process")
+            else:
+                logger.info("FAIL: locked against another process")
+        locks.clear()
+
+        rate, errors = stress_test(logger, locks, folder)
+        if not errors and rate > 10000 and len(locks) == 0:
+            logger.info("PASS: stress %i locks per second", rate)
+        else:
+            logger.info("FAIL: stress %i locks per second, %i errors",
+                        rate, errors)
+        logger.info("dot-file locks: %i locks per second",
+                    _legacy_lock_test(folder, 20000))
+        locks.clear()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
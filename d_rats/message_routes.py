@@ -0,0 +1,470 @@
+#!/usr/bin/python
+'''Message Routes.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import logging.handlers
+import os
+import random
+import tempfile
+import threading
+import time
+
+# Weight of the newest sample in the moving averages.
+METRIC_WEIGHT = 0.25
+
+# Seconds assumed for a delivery through a gateway not yet measured.
+DEFAULT_LATENCY = 60.0
+
+
+class RouteMetric:
+    '''
+    Route Metric.
+
+    Delivery statistics learned for one gateway.
+
+    :param gateway: Gateway station
+    :type gateway: str
+    '''
+
+    __slots__ = ("gateway", "attempts", "successes", "failures",
+                 "success_rate", "latency")
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        # Start out trusting the route.
+        self.success_rate = 1.0
+        self.latency = 0.0
+
+    def record(self, success, latency=None):
+        '''
+        Record a delivery through the gateway.
+
+        :param success: True if the message was delivered
+        :type success: bool
+        :param latency: Seconds the delivery took, default None
+        :type latency: float
+        '''
+        self.attempts += 1
+        if success:
+            self.successes += 1
+        else:
+            self.failures += 1
+        self.success_rate += METRIC_WEIGHT * \
+            ((1.0 if success else 0.0) - self.success_rate)
+        if success and latency is not None:
+            if self.latency:
+                self.latency += METRIC_WEIGHT * (latency - self.latency)
+            else:
+                self.latency = latency
+
+    def cost(self):
+        '''
+        Cost of the route, lower is better.
+
+        :returns: Expected seconds per delivered message
+        :rtype: float
+        '''
+        rate = max(self.success_rate, 0.01)
+        return (self.latency or DEFAULT_LATENCY) / rate
+
+    def to_dict(self):
+        '''
+        To dictionary.
+
+        :returns: Metric values by name
+        :rtype: dict
+        '''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class MessageRouteTable:
+    '''
+    Message Route Table.
+
+    Static message routes from the routes.txt file, built once and
+    only parsed again when the file changes.  Each line holds a
+    destination, a gateway and a port.  The destination may be a call
+    sign, a prefix ending in ``*`` such as ``W1*``, or ``*`` for the
+    default route.  An exact route is tried first, then the matching
+    prefixes from the longest to the shortest, then the default route,
+    skipping the gateways that already failed.
+
+    Unlike older versions, where the last line for a destination won,
+    a destination listed more than once has several gateways, and the
+    one with the best delivery metrics is tried first.
+
+    Lookups are cached per destination, so a next hop decision is a
+    dictionary lookup.  Decisions can be written to a journal file
+    for debugging.
+
+    :param route_file: Path of routes.txt
+    :type route_file: str
+    :param journal_file: Path of the routing journal, default None
+    :type journal_file: str
+    '''
+
+    logger = logging.getLogger("MessageRouteTable")
+
+    def __init__(self, route_file, journal_file=None):
+        self.route_file = route_file
+        self._file_stat = None
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_lengths = []
+        self._cache = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._journal = None
+        if journal_file:
+            self.set_journal(journal_file)
+
+    def set_journal(self, journal_file):
+        '''
+        Set the journal file.
+
+        :param journal_file: Path of the routing journal, None for none
+        :type journal_file: str
+        '''
+        if self._journal:
+            for handler in list(self._journal.handlers):
+                self._journal.removeHandler(handler)
+                handler.close()
+            self._journal = None
+        if not journal_file:
+            return
+        handler = logging.handlers.RotatingFileHandler(
+            journal_file, maxBytes=1024 * 1024, backupCount=3)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        self._journal = logging.getLogger("MessageRouteJournal")
+        self._journal.propagate = False
+        self._journal.setLevel(logging.INFO)
+        self._journal.addHandler(handler)
+
+    def journal(self, dst, route, reason):
+        '''
+        Record a routing decision in the journal.
+
+        :param dst: Destination of the message
+        :type dst: str
+        :param route: Route chosen, or None
+        :type route: str
+        :param reason: Why the route was chosen or rejected
+        :type reason: str
+        '''
+        if self._journal:
+            self._journal.info("%s -> %s: %s", dst, route, reason)
+
+    def _parse(self, lines):
+        '''
+        Parse the route lines.
+
+        :param lines: Lines of routes.txt
+        :type lines: list[str]
+        :returns: Exact routes and prefix routes
+        :rtype: tuple[dict, dict]
+        '''
+        exact = {}
+        prefixes = {}
+        for line in lines:
+            if not line.strip() or line.startswith("#"):
+                continue
+            try:
+                dest, gateway, _port = line.split()
+            except ValueError as err:
+                self.logger.info("_parse: Error parsing line '%s': %s",
+                                 line, err)
+                continue
+            if dest.endswith("*"):
+                table = prefixes
+                dest = dest[:-1]
+            else:
+                table = exact
+            gateways = table.setdefault(dest, [])
+            if gateway not in gateways:
+                gateways.append(gateway)
+        return exact, prefixes
+
+    def reload(self, force=False):
+        '''
+        Reload the routes if routes.txt changed.
+
+        :param force: Reload even if the file looks unchanged
+        :type force: bool
+        :returns: True if the routes were reloaded
+        :rtype: bool
+        '''
+        try:
+            stat = os.stat(self.route_file)
+            file_stat = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            file_stat = None
+        if file_stat == self._file_stat and not force:
+            return False
+
+        lines = []
+        if file_stat:
+            try:
+                with open(self.route_file) as f_handle:
+                    lines = f_handle.readlines()
+            except OSError as err:
+                self.logger.info("reload: Unable to read %s: %s",
+                                 self.route_file, err)
+        exact, prefixes = self._parse(lines)
+        with self._lock:
+            self._exact = exact
+            self._prefixes = prefixes
+            self._prefix_lengths = sorted(set(len(prefix)
+                                              for prefix in prefixes),
+                                          reverse=True)
+            self._cache = {}
+            self._file_stat = file_stat
+        self.logger.info("reload: %i routes and %i prefix routes from %s",
+                         len(exact), len(prefixes), self.route_file)
+        return True
+
+    def _resolve(self, dst):
+        '''
+        Resolve the candidate gateways for a destination.
+
+        :param dst: Destination call sign
+        :type dst: str
+        :returns: Gateways with the route pattern that matched, exact
+                  route first, then the prefixes longest first, then
+                  the default route
+        :rtype: list[tuple[str, str]]
+        '''
+        matches = []
+        gateways = self._exact.get(dst, None)
+        if gateways:
+            matches.append((gateways, dst))
+        # One dictionary lookup per distinct prefix length, the default
+        # route is the empty prefix.
+        for length in self._prefix_lengths:
+            if length > len(dst):
+                continue
+            gateways = self._prefixes.get(dst[:length], None)
+            if gateways:
+                matches.append((gateways, dst[:length] + "*"))
+        candidates = []
+        for gateways, pattern in matches:
+            for gateway in sorted(gateways, key=self._gateway_cost):
+                candidates.append((gateway, pattern))
+        return candidates
+
+    def lookup(self, dst):
+        '''
+        Look up the candidate gateways for a destination.
+
+        :param dst: Destination call sign
+        :type dst: str
+        :returns: Gateways with the route pattern matched, in the
+                  order to try them
+        :rtype: list[tuple[str, str]]
+        '''
+        result = self._cache.get(dst, None)
+        if result is None:
+            with self._lock:
+                result = self._resolve(dst)
+                self._cache[dst] = result
+        return result
+
+    def next_hop(self, dst, invalid=()):
+        '''
+        Next hop for a destination.
+
+        :param dst: Destination call sign
+        :type dst: str
+        :param invalid: Gateways not to use
+        :type invalid: set[str]
+        :returns: Gateway and the route pattern matched, or None and ""
+        :rtype: tuple[str, str]
+        '''
+        for gateway, pattern in self.lookup(dst):
+            if gateway not in invalid:
+                return gateway, pattern
+        return None, ""
+
+    def _gateway_cost(self, gateway):
+        metric = self._metrics.get(gateway, None)
+        if metric is None:
+            return DEFAULT_LATENCY
+        return metric.cost()
+
+    def record_delivery(self, gateway, success, latency=None):
+        '''
+        Record a delivery through a gateway.
+
+        :param gateway: Gateway the message was handed to
+        :type gateway: str
+        :param success: True if the message was delivered
+        :type success: bool
+        :param latency: Seconds the delivery took, default None
+        :type latency: float
+        '''
+        with self._lock:
+            metric = self._metrics.get(gateway, None)
+            if metric is None:
+                metric = RouteMetric(gateway)
+                self._metrics[gateway] = metric
+            metric.record(success, latency)
+            # The best gateway may have changed.
+            self._cache = {}
+        self.journal(gateway, gateway,
+                     "delivery %s, latency %s, cost %.1f" %
+                     ("ok" if success else "failed",
+                      "%.1f" % latency if latency is not None else "-",
+                      metric.cost()))
+
+    def get_metrics(self):
+        '''
+        Get the route metrics.
+
+        :returns: Metrics for each gateway used
+        :rtype: dict[str, dict]
+        '''
+        with self._lock:
+            return {gateway: metric.to_dict()
+                    for gateway, metric in self._metrics.items()}
+
+
+def _linear_lookup(lines, dst):
+    '''
+    Look up a route by scanning the lines, for comparison.
+
+    :param lines: Lines of routes.txt
+    :type lines: list[str]
+    :param dst: Destination call sign
+    :type dst: str
+    :returns: Gateway or None
+    :rtype: str
+    '''
+    best = None
+    best_len = -1
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        dest, gateway, _port = line.split()
+        if dest == dst:
+            return gateway
+        if dest.endswith("*") and dst.startswith(dest[:-1]) and \
+                len(dest) > best_len:
+            best = gateway
+            best_len = len(dest)
+    return best
+
+
+# pylint wants a maximum of 15 local variables
+# pylint wants a maximum of 50 statements
+# pylint: disable=too-many-locals, too-many-statements
+def main():
+    '''Unit test and benchmark routing 50000 destinations.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MessageRouteTable.test")
+
+    rand = random.Random(42)
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    lines = ["# Benchmark routes\n"]
+    for num in range(1000):
+        lines.append("K%i%s%s%s GW%i port1\n" %
+                     (num % 10, letters[num % 26], letters[num // 26 % 26],
+                      letters[num // 676 % 26], num % 20))
+    for num in range(200):
+        lines.append("%s%i* PFX%i port1\n" %
+                     (rand.choice("KNW") + rand.choice(letters[:5]),
+                      num % 10, num % 7))
+    lines.append("W1* NE1 port1\n")
+    lines.append("W1A* NE2 port1\n")
+    lines.append("W1AW HQ port1\n")
+    lines.append("W1AW HQ2 port1\n")
+    lines.append("* DEFAULT port1\n")
+
+    destinations = []
+    for num in range(50000):
+        destinations.append("%s%i%s" % (rand.choice("KNWA") +
+                                        rand.choice(letters[:5]),
+                                        num % 10,
+                                        "".join(rand.choice(letters)
+                                                for _i in range(3))))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        route_file = os.path.join(tmp_dir, "routes.txt")
+        journal_file = os.path.join(tmp_dir, "route_journal.txt")
+        with open(route_file, "w") as f_handle:
+            f_handle.writelines(lines)
+
+        sample = destinations[:500]
+        start = time.perf_counter()
+        expected = [_linear_lookup(lines, dst) for dst in sample]
+        elapsed = time.perf_counter() - start
+        logger.info("linear scan: %.1f usec per destination",
+                    elapsed * 1000000 / len(sample))
+
+        table = MessageRouteTable(route_file, journal_file)
+        start = time.perf_counter()
+        table.reload()
+        elapsed = time.perf_counter() - start
+        logger.info("loaded %s routes in %.1f ms", len(lines),
+                    elapsed * 1000)
+
+        for passes in ("cold", "warm"):
+            start = time.perf_counter()
+            for dst in destinations:
+                table.next_hop(dst)
+            elapsed = time.perf_counter() - start
+            logger.info("%s: routed %i destinations in %.1f ms, "
+                        "%.2f usec each", passes, len(destinations),
+                        elapsed * 1000, elapsed * 1000000 / len(destinations))
+
+        start = time.perf_counter()
+        table.reload()
+        elapsed = time.perf_counter() - start
+        logger.info("unchanged reload check: %.1f usec", elapsed * 1000000)
+
+        results = [table.next_hop(dst)[0] for dst in sample]
+        ok_match = results == expected
+        ok_prefix = table.next_hop("W1ABC") == ("NE2", "W1A*") and \
+            table.next_hop("W1XYZ") == ("NE1", "W1*") and \
+            table.next_hop("ZZ9ZZ") == ("DEFAULT", "*") and \
+            table.next_hop("W1AW", {"HQ"}) == ("HQ2", "W1AW") and \
+            table.next_hop("W1AW", {"HQ", "HQ2"}) == ("NE2", "W1A*") and \
+            table.next_hop("W1ABC", {"NE2", "NE1"}) == ("DEFAULT", "*")
+
+        # HQ keeps failing, so HQ2 becomes the preferred gateway.
+        for _i in range(4):
+            table.record_delivery("HQ", False)
+        table.record_delivery("HQ2", True, 30.0)
+        ok_metric = table.next_hop("W1AW") == ("HQ2", "W1AW")
+
+        table.journal("W1AW", "HQ2", "test")
+        table.set_journal(None)
+        with open(journal_file) as f_handle:
+            ok_journal = "W1AW -> HQ2: test" in f_handle.read()
+
+        if ok_match and ok_prefix and ok_metric and ok_journal:
+            logger.info("PASS")
+        else:
+            logger.info("FAIL: match %s prefix %s metric %s journal %s",
+                        ok_match, ok_prefix, ok_metric, ok_journal)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,626 @@
+#!/usr/bin/python
+'''Message Search.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .form_header import FormHeaderError
+from .form_header import read_form_header
+
+INDEX_FILE = "search_index.db"
+
+# Bump when the tables change, the index is then rebuilt.
+SCHEMA_VERSION = 1
+
+# Forms read between commits while indexing.
+INDEX_BATCH = 500
+
+# Weights of the subject, sender, recipient, body, other fields and
+# attachment names when ranking the results.
+RANK_WEIGHTS = (10.0, 4.0, 4.0, 1.0, 1.0, 2.0)
+
+SEARCH_LIMIT = 500
+
+
+def read_form_text(filename):
+    '''
+    Read the searchable text of a form.
+
+    :param filename: Form filename
+    :type filename: str
+    :returns: Text for each column of the index
+    :rtype: tuple[str, str, str, str, str, str]
+    :raises: :class:`FormHeaderError` if the form is not valid
+    :raises: :class:`OSError` if the form can not be read
+    '''
+    # Not cached, indexing reads every form once.
+    form = read_form_header(filename)
+    body = ""
+    values = []
+    for field_id, text in form.fields.items():
+        words = [text] + form.choices.get(field_id, [])
+        value = " ".join(word for word in words if word)
+        if field_id == "message":
+            body = value
+        elif value:
+            values.append(value)
+    attachments = [name or "" for name, _size in form.get_attachments()]
+    return (form.get_subject_string(), form.get_sender_string(),
+            form.get_recipient_string(), body, "\n".join(values),
+            " ".join(attachments))
+
+
+def fts_query(text):
+    '''
+    Make an FTS5 query from what the user typed.
+
+    Every word has to match, and the last one may be the start of a
+    word, so results show up while typing.
+
+    :param text: Search text
+    :type text: str
+    :returns: FTS5 query, or "" if there is nothing to search for
+    :rtype: str
+    '''
+    words = ['"%s"' % word.replace('"', '""') for word in text.split()]
+    if not words:
+        return ""
+    words[-1] += "*"
+    return " ".join(words)
+
+
+# pylint wants only 7 instance attributes
+# pylint wants at least 2 public methods
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
+class SearchResult:
+    '''
+    Search Result.
+
+    Has the same fields as the message store uses for the message list.
+
+    :param path: Message filename
+    :type path: str
+    :param subject: Subject of the message
+    :type subject: str
+    :param sender: Sender of the message
+    :type sender: str
+    :param recip: Recipient of the message
+    :type recip: str
+    :param snippet: Matching text with the matches in []
+    :type snippet: str
+    :param stamp: Modification time of the message
+    :type stamp: float
+    '''
+
+    __slots__ = ("path", "subject", "sender", "recip", "snippet", "stamp",
+                 "msg_type", "read")
+
+    # pylint wants a max of 5 arguments
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, path, subject, sender, recip, snippet, stamp):
+        self.path = path
+        self.subject = subject
+        self.sender = sender
+        self.recip = recip
+        self.snippet = snippet
+        self.stamp = stamp
+        self.msg_type = ""
+        self.read = True
+
+    def __str__(self):
+        return "%s: %s" % (self.path, self.snippet)
+
+
+class MessageSearchIndex:
+    '''
+    Message Search Index.
+
+    Full text index of the subject, sender, recipient, body, other
+    field values and attachment names of all of the messages in the
+    message folders, in an SQLite FTS5 table.
+
+    The index is updated by a worker thread.  :meth:`update_file`,
+    :meth:`remove_file` and :meth:`move_file` queue the changes the
+    program makes, and :meth:`sync` catches everything else by
+    comparing the modification times of the files with the index.
+    :meth:`search_async` brings the index up to date before it
+    searches, also on the worker thread.  Use :meth:`get_index` to
+    share one index for each message folder tree.
+
+    If the SQLite library has no FTS5 support the index is disabled:
+    nothing is indexed and every search finds nothing.
+
+    :param root_dir: Directory holding the message folders
+    :type root_dir: str
+    :param index_file: SQLite file to keep the index in
+    :type index_file: str
+    '''
+
+    logger = logging.getLogger("MessageSearchIndex")
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+    _fts5_logged = False
+
+    def __init__(self, root_dir, index_file):
+        self.root_dir = os.path.abspath(root_dir)
+        self.index_file = index_file
+        self.indexed = 0
+        self.enabled = True
+        self._lock = threading.RLock()
+        self._mtimes = None
+        self._dir_mtimes = {}
+        self._queue = queue.Queue()
+        self._thread = None
+
+        self._db = sqlite3.connect(index_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != \
+                SCHEMA_VERSION:
+            # The index only holds what is in the files.
+            self._db.execute("DROP TABLE IF EXISTS files")
+            self._db.execute("DROP TABLE IF EXISTS docs")
+            self._db.execute("PRAGMA user_version=%i" % SCHEMA_VERSION)
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "id INTEGER PRIMARY KEY, "
+                         "path TEXT UNIQUE NOT NULL, mtime REAL)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs "
+                             "USING fts5(subject, sender, recip, body, "
+                             "fields, attachments, "
+                             "tokenize='unicode61 remove_diacritics 2')")
+        except sqlite3.OperationalError as err:
+            self.enabled = False
+            if not MessageSearchIndex._fts5_logged:
+                MessageSearchIndex._fts5_logged = True
+                self.logger.info("Message search disabled, SQLite has no "
+                                 "FTS5 support: %s", err)
+        self._db.commit()
+
+    @classmethod
+    def get_index(cls, root_dir, index_file=None):
+        '''
+        Get the shared index for a message folder tree.
+
+        :param root_dir: Directory holding the message folders
+        :type root_dir: str
+        :param index_file: SQLite file, default INDEX_FILE in root_dir
+        :type index_file: str
+        :returns: Search index
+        :rtype: :class:`MessageSearchIndex`
+        '''
+        root_dir = os.path.abspath(root_dir)
+        with cls._indexes_lock:
+            index = cls._indexes.get(root_dir, None)
+            if index is None:
+                if not index_file:
+                    index_file = os.path.join(root_dir, INDEX_FILE)
+                index = cls(root_dir, index_file)
+                cls._indexes[root_dir] = index
+            return index
+
+    def __len__(self):
+        return len(self._get_mtimes())
+
+    def _relative(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root_dir)
+
+    def _get_mtimes(self):
+        if self._mtimes is None:
+            with self._lock:
+                self._mtimes = dict(self._db.execute(
+                    "SELECT path, mtime FROM files"))
+        return self._mtimes
+
+    def _scan(self, full):
+        '''
+        Find the message files in the folders.
+
+        Files are only looked at in the folders that changed since the
+        last scan, unless full is set.  Forms rewritten in place do not
+        change their folder, the program queues those with
+        :meth:`update_file`.
+
+        :param full: Look at the files in all of the folders
+        :type full: bool
+        :returns: Modification time of each message by relative path,
+                  the relative folders looked at and all folders found
+        :rtype: tuple[dict[str, float], set[str], set[str]]
+        '''
+        found = {}
+        scanned = set()
+        folders = set()
+        todo = [self.root_dir]
+        while todo:
+            folder = todo.pop()
+            rel = os.path.relpath(folder, self.root_dir)
+            folders.add(rel)
+            try:
+                mtime = os.stat(folder).st_mtime
+                check = full or self._dir_mtimes.get(rel, None) != mtime
+                self._dir_mtimes[rel] = mtime
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            todo.append(entry.path)
+                        elif check and entry.name.endswith(".xml"):
+                            name = entry.name if rel == os.curdir else \
+                                os.path.join(rel, entry.name)
+                            found[name] = entry.stat().st_mtime
+            except OSError as err:
+                self.logger.info("_scan: %s", err)
+                continue
+            if check:
+                scanned.add(rel)
+        return found, scanned, folders
+
+    def _index(self, files):
+        '''
+        Read forms and put them in the index.
+
+        :param files: Modification time of each form by relative path
+        :type files: dict[str, float]
+        '''
+        mtimes = self._get_mtimes()
+        names = list(files)
+        for start in range(0, len(names), INDEX_BATCH):
+            docs = []
+            for name in names[start:start + INDEX_BATCH]:
+                try:
+                    docs.append((name, files[name], read_form_text(
+                        os.path.join(self.root_dir, name))))
+                except (FormHeaderError, OSError) as err:
+                    self.logger.info("_index: %s", err)
+            with self._lock:
+                for name, mtime, text in docs:
+                    self._remove(name)
+                    cursor = self._db.execute(
+                        "INSERT INTO files (path, mtime) VALUES (?, ?)",
+                        (name, mtime))
+                    self._db.execute(
+                        "INSERT INTO docs (rowid, subject, sender, recip, "
+                        "body, fields, attachments) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (cursor.lastrowid,) + text)
+                    mtimes[name] = mtime
+                self._db.commit()
+            self.indexed += len(docs)
+
+    def _remove(self, name):
+        '''
+        Remove a form from the index, with the lock held.
+
+        :param name: Relative path of the form
+        :type name: str
+        '''
+        row = self._db.execute("SELECT id FROM files WHERE path = ?",
+                               (name,)).fetchone()
+        if row:
+            self._db.execute("DELETE FROM docs WHERE rowid = ?", row)
+            self._db.execute("DELETE FROM files WHERE id = ?", row)
+        self._get_mtimes().pop(name, None)
+
+    def sync(self, full=False):
+        '''
+        Bring the index up to date with the message folders.
+
+        :param full: Check every file, not only the changed folders
+        :type full: bool
+        :returns: Number of forms read
+        :rtype: int
+        '''
+        if not self.enabled:
+            return 0
+        found, scanned, folders = self._scan(full)
+        mtimes = self._get_mtimes()
+        gone = []
+        for name in mtimes:
+            folder = os.path.dirname(name) or os.curdir
+            if folder not in folders or \
+                    (folder in scanned and name not in found):
+                gone.append(name)
+        if gone:
+            with self._lock:
+                for name in gone:
+                    self._remove(name)
+                self._db.commit()
+        changed = {name: mtime for name, mtime in found.items()
+                   if mtimes.get(name, None) != mtime}
+        self._index(changed)
+        return len(changed)
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        '''
+        Search the index.
+
+        :param text: Words to search for
+        :type text: str
+        :param limit: Most results to return, default SEARCH_LIMIT
+        :type limit: int
+        :returns: Matching messages, best first
+        :rtype: list[:class:`SearchResult`]
+        '''
+        query = fts_query(text)
+        if not query or not self.enabled:
+            return []
+        with self._lock:
+            try:
+                rows = self._db.execute(
+                    "SELECT f.path, f.mtime, d.subject, d.sender, d.recip, "
+                    "snippet(docs, -1, '[', ']', '...', 10) "
+                    "FROM docs d JOIN files f ON f.id = d.rowid "
+                    "WHERE docs MATCH ? "
+                    "ORDER BY bm25(docs, %s) LIMIT ?" %
+                    ", ".join(str(weight) for weight in RANK_WEIGHTS),
+                    (query, limit)).fetchall()
+            except sqlite3.OperationalError as err:
+                self.logger.info("search: %s: %s", query, err)
+                return []
+        return [SearchResult(os.path.join(self.root_dir, name), subject,
+                             sender, recip, snippet, mtime)
+                for name, mtime, subject, sender, recip, snippet in rows]
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="MessageSearchIndex")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._do_job(*job)
+            except sqlite3.Error as err:
+                self.logger.info("_run: %s failed: %s", job[0], err)
+            self._queue.task_done()
+
+    def _do_job(self, action, *args):
+        if action == "update":
+            filename, = args
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                return
+            self._index({self._relative(filename): mtime})
+        elif action == "remove":
+            filename, = args
+            with self._lock:
+                self._remove(self._relative(filename))
+                self._db.commit()
+        elif action == "move":
+            old_name, new_name = (self._relative(name) for name in args)
+            with self._lock:
+                self._remove(new_name)
+                mtime = self._get_mtimes().pop(old_name, None)
+                self._db.execute("UPDATE files SET path = ? WHERE path = ?",
+                                 (new_name, old_name))
+                self._db.commit()
+                if mtime is not None:
+                    self._get_mtimes()[new_name] = mtime
+        elif action == "sync":
+            self.sync(full=True)
+        elif action == "search":
+            text, call_back = args
+            self.sync()
+            call_back(text, self.search(text))
+
+    def start(self):
+        '''Start the worker and bring the index up to date.'''
+        if not self.enabled:
+            return
+        self._start()
+        self._queue.put(("sync",))
+
+    def update_file(self, filename):
+        '''
+        Queue a new or changed form to be indexed.
+
+        :param filename: Form filename
+        :type filename: str
+        '''
+        if not self.enabled:
+            return
+        self._start()
+        self._queue.put(("update", filename))
+
+    def remove_file(self, filename):
+        '''
+        Queue a deleted form to be removed from the index.
+
+        :param filename: Form filename
+        :type filename: str
+        '''
+        if not self.enabled:
+            return
+        self._start()
+        self._queue.put(("remove", filename))
+
+    def move_file(self, old_filename, new_filename):
+        '''
+        Queue a form moved to another folder.
+
+        :param old_filename: Old form filename
+        :type old_filename: str
+        :param new_filename: New form filename
+        :type new_filename: str
+        '''
+        if not self.enabled:
+            return
+        self._start()
+        self._queue.put(("move", old_filename, new_filename))
+
+    def search_async(self, text, call_back):
+        '''
+        Search on the worker thread, after bringing the index up to date.
+
+        :param text: Words to search for
+        :type text: str
+        :param call_back: Called from the worker thread with the text
+                          and the results
+        :type call_back: function(str, list[:class:`SearchResult`])
+        '''
+        self._start()
+        self._queue.put(("search", text, call_back))
+
+    def wait(self):
+        '''Wait until the worker has nothing left to do.'''
+        self._queue.join()
+
+    def close(self):
+        '''Close the index.'''
+        with self._lock:
+            self._db.close()
+        with self._indexes_lock:
+            if self._indexes.get(self.root_dir, None) is self:
+                del self._indexes[self.root_dir]
+
+
+def get_search_index(config):
+    '''
+    Get the search index of the message folders.
+
+    :param config: Config object
+    :type config: :class:`DratsConfig`
+    :returns: Shared search index
+    :rtype: :class:`MessageSearchIndex`
+    '''
+    return MessageSearchIndex.get_index(config.form_store_dir())
+
+
+_BENCH_FORM = '''<xml>
+<form id="ics213">
+<title>ICS-213 General Message</title>
+<field id="subject"><caption>Subject</caption>
+<entry type="text">%(subject)s</entry></field>
+<field id="message"><caption>Message</caption>
+<entry type="multiline">%(body)s</entry></field>
+<field id="position"><caption>Position</caption>
+<entry type="text">%(position)s</entry></field>
+<field id="precedence"><caption>Precedence</caption>
+<entry type="choice"><choice>Routine</choice>\
+<choice set="y">%(precedence)s</choice></entry></field>
+<att name="%(att)s">aGVsbG8=</att>
+<path><src>N%(src)03i</src><dst>W1AW</dst></path>
+</form>
+</xml>
+'''
+
+_WORDS = ("shelter water generator fuel road closed bridge medical supply "
+          "evacuation power outage radio antenna battery volunteer county "
+          "hospital school flood fire wind damage food blanket cot").split()
+
+
+def _write_forms(root_dir, count):
+    '''
+    Write forms for the benchmark.
+
+    :param root_dir: Directory holding the message folders
+    :type root_dir: str
+    :param count: Number of forms
+    :type count: int
+    '''
+    folders = [os.path.join(root_dir, name) for name in ("Inbox", "Sent")]
+    for folder in folders:
+        os.mkdir(folder)
+    words = len(_WORDS)
+    for num in range(count):
+        body = " ".join(_WORDS[(num * 7 + i * 3) % words] for i in range(40))
+        values = {"subject": "Report %i %s" % (num, _WORDS[num % words]),
+                  "body": body,
+                  "position": "Station %i" % (num % 97),
+                  "precedence": ("Priority", "Emergency")[num % 2],
+                  "att": "photo%i.jpg" % num,
+                  "src": num % 500}
+        with open(os.path.join(folders[num % 2], "form%06i.xml" % num),
+                  "w") as handle:
+            handle.write(_BENCH_FORM % values)
+
+
+# pylint wants a maximum of 15 local variables
+# pylint wants a maximum of 50 statements
+# pylint: disable=too-many-locals, too-many-statements
+def main():
+    '''Unit test and benchmark with 100000 forms.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MessageSearchIndex.test")
+
+    count = 100000
+    with tempfile.TemporaryDirectory() as root_dir:
+        _write_forms(root_dir, count)
+        index = MessageSearchIndex.get_index(root_dir)
+
+        start = time.perf_counter()
+        index.sync(full=True)
+        elapsed = time.perf_counter() - start
+        logger.info("indexed %i forms in %.1f sec, %.2f ms each",
+                    index.indexed, elapsed, elapsed * 1000 / index.indexed)
+
+        for full in (True, False):
+            start = time.perf_counter()
+            read = index.sync(full)
+            elapsed = time.perf_counter() - start
+            logger.info("%s sync with nothing changed: %.1f ms, %i read",
+                        ("quick", "full")[full], elapsed * 1000, read)
+
+        queries = ("generator", "shel", "evacuation hospital",
+                   "photo4242.jpg", "N123", "Emergency flood", "report 99998")
+        for text in queries:
+            start = time.perf_counter()
+            for _num in range(10):
+                results = index.search(text)
+            elapsed = (time.perf_counter() - start) / 10
+            logger.info("search %-20s %3i results in %6.2f ms",
+                        repr(text), len(results), elapsed * 1000)
+
+        # Changes made by the program, then ones found by sync.
+        name = "form%06i.xml" % (count - 2)
+        moved = os.path.join(root_dir, "Sent", name)
+        os.rename(os.path.join(root_dir, "Inbox", name), moved)
+        index.move_file(os.path.join(root_dir, "Inbox", name), moved)
+        gone = os.path.join(root_dir, "Sent", "form000001.xml")
+        os.unlink(gone)
+        found = []
+        index.search_async("report %i" % (count - 2),
+                           lambda text, results: found.extend(results))
+        index.wait()
+        if len(found) == 1 and found[0].path == moved and \
+                not index.search("photo1 jpg") and \
+                len(index) == count - 1:
+            logger.info("PASS: %s", found[0])
+        else:
+            logger.info("FAIL: %s", [str(result) for result in found])
+
+        if index.search('"unbalanced') == [] and \
+                fts_query('say "hi"') == '"say" """hi"""*':
+            logger.info("PASS: query quoting")
+        else:
+            logger.info("FAIL: query quoting")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
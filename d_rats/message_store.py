@@ -0,0 +1,619 @@
+#!/usr/bin/python
+'''Message Store.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from configparser import ConfigParser
+from configparser import Error as ConfigParserError
+
+from .dplatform import Platform
+
+STORE_FILE = "message_store.db"
+
+# Bump when the tables change, and add the upgrade to _create_tables.
+SCHEMA_VERSION = 1
+
+# Message header fields extracted from the forms.
+HEADER_FIELDS = ("msg_type", "subject", "sender", "recip", "path_dst")
+
+# Legacy per folder ConfigParser file and its option names.
+LEGACY_DB = ".db"
+LEGACY_OPTIONS = {"type": "msg_type", "subject": "subject",
+                  "sender": "sender", "recip": "recip"}
+
+
+# pylint wants only 7 instance attributes
+# pylint wants at least 2 public methods
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
+class MessageInfo:
+    '''
+    Message Info.
+
+    What the store knows about one message.  Header fields that have
+    not been extracted from the form yet are None.  The stamp is the
+    modification time of the file when the fields were extracted.
+
+    :param filename: Message file name, without the folder
+    :type filename: str
+    :param msg_id: Row id of the message
+    :type msg_id: int
+    '''
+
+    __slots__ = ("filename", "msg_id", "msg_type", "subject", "sender",
+                 "recip", "path_dst", "stamp", "read")
+
+    def __init__(self, filename, msg_id):
+        self.filename = filename
+        self.msg_id = msg_id
+        self.msg_type = None
+        self.subject = None
+        self.sender = None
+        self.recip = None
+        self.path_dst = None
+        self.stamp = None
+        self.read = False
+
+    def __str__(self):
+        return "%s: %s from %s to %s" % (self.filename, self.subject,
+                                         self.sender, self.recip)
+
+
+class MessageStore:
+    '''
+    Message Store.
+
+    Keeps the folders, the header fields extracted from the messages
+    and the read state of the messages in an SQLite file, replacing the
+    ConfigParser .db file that was kept in each folder.  The .db file
+    of a folder is imported the first time the folder is used.
+
+    The messages of a folder are read from the file once and then kept
+    in memory.  Each change is written through and committed, unless
+    it is made inside :meth:`transaction`, which commits once at the
+    end.  Use :meth:`get_store` to share one store between threads.
+
+    :param store_file: SQLite file to keep the store in
+    :type store_file: str
+    '''
+
+    logger = logging.getLogger("MessageStore")
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.migrated = 0
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._folders = {}
+
+        self._db = sqlite3.connect(store_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._create_tables()
+
+    def _create_tables(self):
+        '''Create the tables of a new store.'''
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if version == SCHEMA_VERSION:
+            return
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, "
+            "folder_id INTEGER NOT NULL "
+            "REFERENCES folders(id) ON DELETE CASCADE, "
+            "filename TEXT NOT NULL, stamp REAL, "
+            "UNIQUE (folder_id, filename));"
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "message_id INTEGER PRIMARY KEY "
+            "REFERENCES messages(id) ON DELETE CASCADE, "
+            "msg_type TEXT, subject TEXT, sender TEXT, recip TEXT, "
+            "path_dst TEXT);"
+            "CREATE TABLE IF NOT EXISTS read_state ("
+            "message_id INTEGER PRIMARY KEY "
+            "REFERENCES messages(id) ON DELETE CASCADE, "
+            "read INTEGER NOT NULL);"
+            "PRAGMA user_version=%i;" % SCHEMA_VERSION)
+        self._db.commit()
+
+    @classmethod
+    def get_store(cls, store_file=None):
+        '''
+        Get the shared store.
+
+        :param store_file: SQLite file, default STORE_FILE in the
+                           configuration directory
+        :type store_file: str
+        :returns: Message store
+        :rtype: :class:`MessageStore`
+        '''
+        if not store_file:
+            store_file = Platform.get_platform().config_file(STORE_FILE)
+        store_file = os.path.abspath(store_file)
+        with cls._stores_lock:
+            store = cls._stores.get(store_file, None)
+            if store is None:
+                store = cls(store_file)
+                cls._stores[store_file] = store
+            return store
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Batch changes into one commit.
+
+        Transactions can be nested, the changes are committed when the
+        outermost one ends.  Other threads wait until then.
+        '''
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self._db.commit()
+
+    def _commit(self):
+        if not self._depth:
+            self._db.commit()
+
+    def _folder(self, folder):
+        '''
+        Get a folder, loading or creating it.
+
+        :param folder: Folder directory
+        :type folder: str
+        :returns: Folder id and the messages of the folder by file name
+        :rtype: tuple[int, dict[str, :class:`MessageInfo`]]
+        '''
+        folder = os.path.abspath(folder)
+        result = self._folders.get(folder, None)
+        if result is not None:
+            return result
+        row = self._db.execute("SELECT id FROM folders WHERE path = ?",
+                               (folder,)).fetchone()
+        messages = {}
+        if row:
+            folder_id, = row
+            self._load(folder_id, messages)
+        else:
+            cursor = self._db.execute("INSERT INTO folders (path) VALUES (?)",
+                                      (folder,))
+            folder_id = cursor.lastrowid
+            self._migrate(folder, folder_id, messages)
+            self._commit()
+        result = (folder_id, messages)
+        self._folders[folder] = result
+        return result
+
+    def _load(self, folder_id, messages):
+        '''
+        Load the messages of a folder.
+
+        :param folder_id: Folder id
+        :type folder_id: int
+        :param messages: Dict to load the messages into
+        :type messages: dict[str, :class:`MessageInfo`]
+        '''
+        rows = self._db.execute(
+            "SELECT m.id, m.filename, m.stamp, h.msg_type, h.subject, "
+            "h.sender, h.recip, h.path_dst, r.read "
+            "FROM messages m "
+            "LEFT JOIN headers h ON h.message_id = m.id "
+            "LEFT JOIN read_state r ON r.message_id = m.id "
+            "WHERE m.folder_id = ?", (folder_id,))
+        for msg_id, filename, stamp, msg_type, subject, sender, recip, \
+                path_dst, read in rows:
+            info = MessageInfo(filename, msg_id)
+            info.stamp = stamp
+            info.msg_type = msg_type
+            info.subject = subject
+            info.sender = sender
+            info.recip = recip
+            info.path_dst = path_dst
+            info.read = bool(read)
+            messages[filename] = info
+
+    def _migrate(self, folder, folder_id, messages):
+        '''
+        Import the legacy .db file of a folder.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param folder_id: Folder id
+        :type folder_id: int
+        :param messages: Dict to add the messages to
+        :type messages: dict[str, :class:`MessageInfo`]
+        '''
+        legacy_file = os.path.join(folder, LEGACY_DB)
+        if not os.path.exists(legacy_file):
+            return
+        legacy = ConfigParser(interpolation=None)
+        try:
+            legacy.read(legacy_file)
+        except ConfigParserError as err:
+            self.logger.info("_migrate: Can not read %s: %s",
+                             legacy_file, err)
+            return
+        for filename in legacy.sections():
+            info = self._add(folder_id, messages, filename)
+            fields = {}
+            for option, field in LEGACY_OPTIONS.items():
+                if legacy.has_option(filename, option):
+                    fields[field] = legacy.get(filename, option)
+            if fields:
+                self._set_headers(info, **fields)
+            if legacy.has_option(filename, "read"):
+                self._set_read(info, legacy.get(filename, "read") == "True")
+            self.migrated += 1
+        self.logger.info("_migrate: Imported %i messages from %s",
+                         len(messages), legacy_file)
+
+    def _add(self, folder_id, messages, filename):
+        info = messages.get(filename, None)
+        if info is None:
+            cursor = self._db.execute(
+                "INSERT INTO messages (folder_id, filename) VALUES (?, ?)",
+                (folder_id, filename))
+            info = MessageInfo(filename, cursor.lastrowid)
+            messages[filename] = info
+        return info
+
+    def _set_headers(self, info, **fields):
+        for field, value in fields.items():
+            if field not in HEADER_FIELDS:
+                raise KeyError("Unknown message field %s" % field)
+            setattr(info, field, value)
+        self._db.execute(
+            "INSERT OR REPLACE INTO headers (message_id, msg_type, subject, "
+            "sender, recip, path_dst) VALUES (?, ?, ?, ?, ?, ?)",
+            (info.msg_id, info.msg_type, info.subject, info.sender,
+             info.recip, info.path_dst))
+
+    def _set_read(self, info, read):
+        info.read = bool(read)
+        self._db.execute("INSERT OR REPLACE INTO read_state "
+                         "(message_id, read) VALUES (?, ?)",
+                         (info.msg_id, int(info.read)))
+
+    def messages(self, folder):
+        '''
+        Get the messages of a folder.
+
+        :param folder: Folder directory
+        :type folder: str
+        :returns: Messages the store knows about
+        :rtype: list[:class:`MessageInfo`]
+        '''
+        with self._lock:
+            _folder_id, messages = self._folder(folder)
+            return list(messages.values())
+
+    def get_info(self, folder, filename):
+        '''
+        Get a message.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param filename: Message file name
+        :type filename: str
+        :returns: Message info, or None if the message is not known
+        :rtype: :class:`MessageInfo`
+        '''
+        with self._lock:
+            _folder_id, messages = self._folder(folder)
+            return messages.get(os.path.basename(filename), None)
+
+    def add_message(self, folder, filename):
+        '''
+        Add a message.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param filename: Message file name
+        :type filename: str
+        :returns: False if the message was already in the folder
+        :rtype: bool
+        '''
+        filename = os.path.basename(filename)
+        with self._lock:
+            folder_id, messages = self._folder(folder)
+            if filename in messages:
+                return False
+            self._add(folder_id, messages, filename)
+            self._commit()
+        return True
+
+    def set_headers(self, folder, filename, stamp=None, **fields):
+        '''
+        Set header fields of a message, adding the message if needed.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param filename: Message file name
+        :type filename: str
+        :param stamp: Modification time of the file the fields were
+                      read from, default None to leave it unchanged
+        :type stamp: float
+        :param fields: Values for the fields in HEADER_FIELDS to set
+        :type fields: dict[str, str]
+        :raises: :class:`KeyError` for a field not in HEADER_FIELDS
+        '''
+        with self._lock:
+            folder_id, messages = self._folder(folder)
+            info = self._add(folder_id, messages, os.path.basename(filename))
+            self._set_headers(info, **fields)
+            if stamp is not None:
+                info.stamp = stamp
+                self._db.execute("UPDATE messages SET stamp = ? "
+                                 "WHERE id = ?", (stamp, info.msg_id))
+            self._commit()
+
+    def set_read(self, folder, filename, read):
+        '''
+        Set the read state of a message, adding the message if needed.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param filename: Message file name
+        :type filename: str
+        :param read: True if the message has been read
+        :type read: bool
+        '''
+        with self._lock:
+            folder_id, messages = self._folder(folder)
+            info = self._add(folder_id, messages, os.path.basename(filename))
+            self._set_read(info, read)
+            self._commit()
+
+    def delete_message(self, folder, filename):
+        '''
+        Forget a message.
+
+        :param folder: Folder directory
+        :type folder: str
+        :param filename: Message file name
+        :type filename: str
+        '''
+        with self._lock:
+            _folder_id, messages = self._folder(folder)
+            info = messages.pop(os.path.basename(filename), None)
+            if info:
+                self._db.execute("DELETE FROM messages WHERE id = ?",
+                                 (info.msg_id,))
+                self._commit()
+
+    def move_message(self, src_folder, dst_folder, filename):
+        '''
+        Move a message to another folder, keeping what is known about it.
+
+        :param src_folder: Folder directory the message was in
+        :type src_folder: str
+        :param dst_folder: Folder directory the message is now in
+        :type dst_folder: str
+        :param filename: Message file name
+        :type filename: str
+        '''
+        filename = os.path.basename(filename)
+        with self._lock:
+            _src_id, src_messages = self._folder(src_folder)
+            dst_id, dst_messages = self._folder(dst_folder)
+            if src_messages is dst_messages:
+                return
+            info = src_messages.pop(filename, None)
+            old = dst_messages.pop(filename, None)
+            if old:
+                self._db.execute("DELETE FROM messages WHERE id = ?",
+                                 (old.msg_id,))
+            if info:
+                self._db.execute("UPDATE messages SET folder_id = ? "
+                                 "WHERE id = ?", (dst_id, info.msg_id))
+                dst_messages[filename] = info
+            self._commit()
+
+    def rename_folder(self, old_folder, new_folder):
+        '''
+        Rename a folder and its subfolders.
+
+        :param old_folder: Old folder directory
+        :type old_folder: str
+        :param new_folder: New folder directory
+        :type new_folder: str
+        '''
+        old_folder = os.path.abspath(old_folder)
+        new_folder = os.path.abspath(new_folder)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, path FROM folders WHERE path = ? OR path LIKE ?",
+                (old_folder, old_folder + os.sep + "%")).fetchall()
+            for folder_id, path in rows:
+                if path != old_folder and \
+                        not path.startswith(old_folder + os.sep):
+                    continue # LIKE also matched a _ or % in the name
+                new_path = new_folder + path[len(old_folder):]
+                self._db.execute("UPDATE folders SET path = ? WHERE id = ?",
+                                 (new_path, folder_id))
+                cached = self._folders.pop(path, None)
+                if cached:
+                    self._folders[new_path] = cached
+            self._commit()
+
+    def delete_folder(self, folder):
+        '''
+        Forget a folder and its messages.
+
+        :param folder: Folder directory
+        :type folder: str
+        '''
+        folder = os.path.abspath(folder)
+        with self._lock:
+            self._folders.pop(folder, None)
+            self._db.execute("DELETE FROM folders WHERE path = ?", (folder,))
+            self._commit()
+
+    def close(self):
+        '''Close the store.'''
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+            self._folders = {}
+        with self._stores_lock:
+            if self._stores.get(self.store_file, None) is self:
+                del self._stores[self.store_file]
+
+
+def _write_legacy_db(folder, count):
+    '''
+    Write a legacy .db file like older versions did.
+
+    :param folder: Folder directory
+    :type folder: str
+    :param count: Number of messages
+    :type count: int
+    '''
+    legacy = ConfigParser(interpolation=None)
+    for num in range(count):
+        section = "msg%05i.xml" % num
+        legacy.add_section(section)
+        legacy.set(section, "type", "email")
+        legacy.set(section, "read", str(num % 3 == 0))
+        legacy.set(section, "subject", "Subject %i" % num)
+        legacy.set(section, "sender", "N%03i" % (num % 50))
+        legacy.set(section, "recip", "W1AW")
+    with open(os.path.join(folder, LEGACY_DB), "w") as handle:
+        legacy.write(handle)
+
+
+def _legacy_indexing(folder, count):
+    '''
+    Index messages the way the ConfigParser .db file was updated.
+
+    :param folder: Folder directory
+    :type folder: str
+    :param count: Number of messages
+    :type count: int
+    :returns: Seconds taken
+    :rtype: float
+    '''
+    legacy = ConfigParser(interpolation=None)
+    start = time.perf_counter()
+    for num in range(count):
+        section = "new%05i.xml" % num
+        legacy.add_section(section)
+        for option in ("type", "read", "subject", "sender", "recip"):
+            legacy.set(section, option, "value %i" % num)
+            # Every property change rewrote the whole file
+            with open(os.path.join(folder, LEGACY_DB), "w") as handle:
+                legacy.write(handle)
+    return time.perf_counter() - start
+
+
+# pylint wants a maximum of 15 local variables
+# pylint wants a maximum of 50 statements
+# pylint: disable=too-many-locals, too-many-statements
+def main():
+    '''Unit test and benchmark with a 20000 message folder.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MessageStore.test")
+
+    count = 20000
+    with tempfile.TemporaryDirectory() as store_dir:
+        inbox = os.path.join(store_dir, "Inbox")
+        sent = os.path.join(store_dir, "Sent")
+        scratch = os.path.join(store_dir, "Scratch")
+        for folder in (inbox, sent, scratch):
+            os.mkdir(folder)
+        _write_legacy_db(inbox, count)
+        store_file = os.path.join(store_dir, STORE_FILE)
+
+        elapsed = _legacy_indexing(scratch, 500)
+        logger.info("legacy .db indexing: %.1f ms for 500 messages",
+                    elapsed * 1000)
+
+        start = time.perf_counter()
+        legacy = ConfigParser(interpolation=None)
+        legacy.read(os.path.join(inbox, LEGACY_DB))
+        elapsed = time.perf_counter() - start
+        logger.info("legacy .db open: %.1f ms", elapsed * 1000)
+
+        store = MessageStore.get_store(store_file)
+        start = time.perf_counter()
+        messages = store.messages(inbox)
+        elapsed = time.perf_counter() - start
+        logger.info("migration of %i messages: %.1f ms",
+                    store.migrated, elapsed * 1000)
+        store.close()
+
+        store = MessageStore.get_store(store_file)
+        start = time.perf_counter()
+        messages = store.messages(inbox)
+        elapsed = time.perf_counter() - start
+        logger.info("cold open: %.1f ms for %i messages",
+                    elapsed * 1000, len(messages))
+
+        start = time.perf_counter()
+        messages = store.messages(inbox)
+        elapsed = time.perf_counter() - start
+        logger.info("warm open: %.2f ms", elapsed * 1000)
+
+        start = time.perf_counter()
+        with store.transaction():
+            for num in range(count):
+                store.set_headers(sent, "out%05i.xml" % num, stamp=num,
+                                  msg_type="email", subject="Out %i" % num,
+                                  sender="N0CALL", recip="W1AW",
+                                  path_dst="W1AW")
+        elapsed = time.perf_counter() - start
+        logger.info("batch indexing: %.1f ms for %i messages",
+                    elapsed * 1000, count)
+
+        read_ok = all(info.read == (int(info.filename[3:8]) % 3 == 0)
+                      for info in messages)
+        store.move_message(inbox, sent, "msg00003.xml")
+        store.delete_message(sent, "out00000.xml")
+        store.close()
+
+        store = MessageStore.get_store(store_file)
+        moved = store.get_info(sent, "msg00003.xml")
+        moved_ok = moved and moved.read and moved.subject == "Subject 3"
+        if read_ok and moved_ok and store.migrated == 0 and \
+                len(store.messages(inbox)) == count - 1 and \
+                len(store.messages(sent)) == count:
+            logger.info("PASS")
+        else:
+            logger.info("FAIL")
+        store.delete_folder(sent)
+        if store.get_info(sent, "msg00003.xml") is None:
+            logger.info("PASS: delete folder")
+        else:
+            logger.info("FAIL: delete folder")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -25,8 +25,6 @@ import time
 import os
 import smtplib
 import shutil
-import traceback
-from glob import glob
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
@@ -39,6 +37,13 @@ from gi.repository import GObject
 
 from . import formgui
 from . import signals
+from .forward_scheduler import ForwardScheduler
+from .message_lock import MESSAGE_LOCKS
+from .message_routes import MessageRouteTable
+from .message_search import get_search_index
+from .message_store import MessageStore
+from .message_store import STORE_FILE
+from .outbox_index import OutboxIndex
 
 from . import utils
 from . import wl2k
@@ -58,77 +63,43 @@ class EmailTypeRequired(MessageRouterException):
 
 CALL_TIMEOUT_RETRY = 300
 
-MSG_LOCK_LOCK = threading.Lock()
-
 MSGROUTING_LOGGER = logging.getLogger("MsgRouting")
 
 
-def __msg_lockfile(fname):
-    name = os.path.basename(fname)
-    path = os.path.dirname(fname)
-    return os.path.join(path, ".lock.%s" % name)
-
-
 def msg_is_locked(fname):
     '''
     Message is locked?
 
-    :param fname: Lock filename
+    :param fname: Message filename
     :type fname: str
-    :returns: True if the lock filename exists
+    :returns: True if the message is locked
     :rtype: bool
     '''
-    return os.path.exists(__msg_lockfile(fname))
+    return MESSAGE_LOCKS.is_locked(fname)
 
 
 def msg_lock(fname):
     '''
     Message Lock
 
-    :param fname: Filename for lock
+    :param fname: Message filename
     :type fname: str
     :returns: True if lock is successful
     :rtype: bool
     '''
-    MSG_LOCK_LOCK.acquire()
-    if not msg_is_locked(fname):
-        lock = open(__msg_lockfile(fname), "w")
-        traceback.print_stack(file=lock)
-        lock.close()
-        success = True
-    else:
-        lock = open(__msg_lockfile(fname), "r")
-        MSGROUTING_LOGGER.info("msg_lock: "
-                               "------ LOCK OWNED BY -------\n%s------------\n",
-                               lock.read())
-        lock.close()
-        success = False
-    MSG_LOCK_LOCK.release()
-
-    # MSGROUTING_LOGGER.info("Locked %s: %s", fname, success)
-    return success
+    return MESSAGE_LOCKS.lock(fname)
 
 
 def msg_unlock(fname):
     '''
     Message Unlock
 
-    :param fname: Lock filename
+    :param fname: Message filename
     :type fname: str
     :returns: True if the unlock is successful
     :rtype: bool
     '''
-    success = True
-    MSG_LOCK_LOCK.acquire()
-    try:
-        os.remove(__msg_lockfile(fname))
-    except OSError:
-        utils.log_exception()
-        success = False
-    MSG_LOCK_LOCK.release()
-
-    # MSGROUTING_LOGGER.info("Unlocked %s: %s", fn, success)
-    return success
+    return MESSAGE_LOCKS.unlock(fname)
 
 
 def gratuitous_next_hop(route, path):
@@ -265,6 +236,36 @@ def form_to_email(config, msgfn, replyto=None):
     return root
 
 
+def get_outbox_index(config):
+    '''
+    Get Outbox index.
+
+    :param config: Config object
+    :type config: :class:`DratsConfig`
+    :returns: Shared index of the Outbox folder
+    :rtype: :class:`OutboxIndex`
+    '''
+    return OutboxIndex.get_index(os.path.join(config.form_store_dir(),
+                                              "Outbox"))
+
+
+def outbox_changed(config, msg):
+    '''
+    Outbox changed.
+
+    Tell the Outbox index that a message was written or moved, so
+    the router sees the change without waiting for the next check.
+
+    :param config: Config object
+    :type config: :class:`DratsConfig`
+    :param msg: Message file name
+    :type msg: str
+    '''
+    outbox = get_outbox_index(config)
+    if os.path.dirname(os.path.abspath(msg)) == outbox.outbox_dir:
+        outbox.update_file(msg)
+
+
 def move_to_folder(config, msg, folder):
     '''
     Move to folder
@@ -282,6 +283,12 @@ def move_to_folder(config, msg, folder):
     msg_lock(newfn)
     shutil.move(msg, newfn)
     msg_unlock(newfn)
+    store = MessageStore.get_store(config.platform.config_file(STORE_FILE))
+    store.move_message(os.path.dirname(msg),
+                       os.path.dirname(newfn), newfn)
+    get_search_index(config).move_file(msg, newfn)
+    outbox_changed(config, msg)
+    outbox_changed(config, newfn)
 
 
 def move_to_outgoing(config, msg):
@@ -353,13 +360,21 @@ class MessageRouter(GObject.GObject):
         self._validate_incoming = validate_incoming
 
         self.__sent_call = {}
-        self.__sent_port = {}
         self.__file_to_call = {}
+        self.__scheduler = ForwardScheduler(
+            port_limit=config.getint("settings", "msg_port_limit"),
+            batch_limit=config.getint("settings", "msg_batch_limit"),
+            busy_timeout=CALL_TIMEOUT_RETRY)
+        self.__route_table = MessageRouteTable(
+            config.platform.config_file("routes.txt"))
+        self.__journal_on = False
+        self.__pass_routes = {}
         self.__failed_stations = {}
         self.__pinged_stations = {}
 
         self.__thread = None
         self.__enabled = False
+        self.__outbox = None
 
     def _emit(self, signal, *args):
         GLib.idle_add(self.emit, signal, *args)
@@ -374,30 +389,21 @@ class MessageRouter(GObject.GObject):
         '''
         Get Routes internal.
 
-        :returns: Routes keyed by gateway
-        :rtype: dict
+        routes.txt is only parsed again when it has changed.
+
+        :returns: Static message routes
+        :rtype: :class:`MessageRouteTable`
         '''
-        r_file = self.__config.platform.config_file("routes.txt")
-        try:
-            f_handle = open(r_file)
-            lines = f_handle.readlines()
-            f_handle.close()
-        except IOError:
-            return {}
-
-        routes = {}
-
-        for line in lines:
-            if not line.strip() or line.startswith("#"):
-                continue
-            try:
-                dest, gateway, _port = line.split()
-                routes[dest] = gateway
-            except ValueError as err:
-                self.logger.info("_get_routes: Error parsing line '%s': %s",
-                                 line, err)
-
-        return routes
+        journal_on = self.__config.getboolean("settings", "msg_route_journal")
+        if journal_on != self.__journal_on:
+            journal_file = None
+            if journal_on:
+                journal_file = \
+                    self.__config.platform.log_file("message_routes")
+            self.__route_table.set_journal(journal_file)
+            self.__journal_on = journal_on
+        self.__route_table.reload()
+        return self.__route_table
 
     def _sleep(self):
         t_limit = self.__config.getint("settings", "msg_flush")
@@ -407,33 +413,17 @@ class MessageRouter(GObject.GObject):
         '''
         Get queue internal.
 
-        :returns: files queued for each callsign
-        :rtype: dict
-        '''
-        queue = {}
-
-        q_dir = os.path.join(self.__config.form_store_dir(), "Outbox")
-        filename_list = glob(os.path.join(q_dir, "*.xml"))
-        for filename in filename_list:
-            if not msg_lock(filename):
-                self.logger.info("_get_queue: Message %s is locked, skipping",
-                                 filename)
-                continue
-
-            form = formgui.FormFile(filename)
-            call = form.get_path_dst()
-            del form
-
-            if not call:
-                if msg_is_locked(filename):
-                    msg_unlock(filename)
-                continue
-            if call not in queue:
-                queue[call] = [filename]
-            else:
-                queue[call].append(filename)
+        The messages are taken from the Outbox index, so only the
+        messages that changed since the last pass are parsed.  A
+        message is only locked once a route has been found for it.
 
-        return queue
+        :returns: Outbox entries queued for each callsign
+        :rtype: dict[str, list[:class:`OutboxEntry`]]
+        '''
+        if not self.__outbox:
+            self.__outbox = get_outbox_index(self.__config)
+        self.__outbox.refresh()
+        return self.__outbox.get_queue()
 
     def _send_form(self, call, port, filename):
         '''
@@ -447,17 +437,28 @@ class MessageRouter(GObject.GObject):
         :type filename: str
         '''
         self.__sent_call[call] = time.time()
-        self.__sent_port[port] = time.time()
         self.__file_to_call[filename] = call
         self._emit("user-send-form", call, port, filename, "Foo")
 
-    def _sent_recently(self, call):
-        if call in self.__sent_call:
-            return (time.time() - self.__sent_call[call]) < CALL_TIMEOUT_RETRY
-        return False
+    def _start_forward(self, batch, entry):
+        '''
+        Send the next message of a forwarding batch.
 
-    def _port_free(self, port):
-        return port not in self.__sent_port
+        Messages that are gone or locked by another task are skipped.
+
+        :param batch: Batch the message is in
+        :type batch: :class:`ForwardBatch`
+        :param entry: Outbox entry of the message
+        :type entry: :class:`OutboxEntry`
+        '''
+        while entry:
+            if os.path.exists(entry.filename) and \
+                    self._lock_msg(entry.filename):
+                self.logger.info("_start_forward: Sending %s to %s (via %s)",
+                                 entry.filename, entry.dst, batch)
+                self._send_form(batch.next_hop, batch.port, entry.filename)
+                return
+            entry = self.__scheduler.skip(batch, entry)
 
     # pylint: disable=too-many-arguments, too-many-branches, too-many-statements
     def _route_msg(self, src, dst, path, slist, routes):
@@ -472,12 +473,12 @@ class MessageRouter(GObject.GObject):
         :type path: str
         :param slist: List of active stations
         :type slist: dict
-        :param routes: Routes for message
-        :type routes: dict
-        :returns: True
-        :rtype bool
+        :param routes: Static message routes
+        :type routes: :class:`MessageRouteTable`
+        :returns: Next hop for the message, or None
+        :rtype: str
         '''
-        invalid = []
+        invalid = set()
 
         def old(call):
             station = slist.get(call, None)
@@ -493,49 +494,56 @@ class MessageRouter(GObject.GObject):
                 route = gratuitous_next_hop(dst, path)
                 self.logger.info("_route_msg: Route for %s: %s (%s)",
                                  dst, route, path)
+                routes.journal(dst, route, "gratuitous")
                 break
             if "@" in dst and dst not in invalid and \
                     not ":" in dst and \
                     self._validate_incoming(self.__config, src, dst):
                 # Out via email
                 route = dst
+                reason = "email"
             elif dst in slist and dst not in invalid:
                 # Direct send
                 route = dst
-            elif dst in routes and routes[dst] not in invalid:
-                # Static route present
-                route = routes[dst]
-            elif "*" in routes and routes["*"] not in invalid:
-                # Default route
-                route = routes["*"]
-            elif dst.upper().startswith("WL2K:"):
-                route = dst
+                reason = "direct"
             else:
-                route = None
-                break
+                # Static, prefix or default route, best metric first
+                route, pattern = routes.next_hop(dst, invalid)
+                reason = "route %s" % pattern
+                if not route and dst.upper().startswith("WL2K:"):
+                    route = dst
+                    reason = "winlink"
+                elif not route:
+                    break
 
             # Validate the @route
 
             if route.upper().startswith("WL2K:"):
+                routes.journal(dst, route, reason)
                 break # WL2K is easy
             if route != dst and route in path:
                 self.logger.info("_route_msg: Route %s in path", route)
-                invalid.append(route)
+                routes.journal(dst, route, "rejected, in path")
+                invalid.add(route)
                 route = None # Don't route to the same location twice
             elif self._is_station_failed(route):
                 self.logger.info("_route_msg: Route %s is failed", route)
-                invalid.append(route)
+                routes.journal(dst, route, "rejected, failed")
+                invalid.add(route)
                 route = None # This one is not responding lately
             elif old(route) and self._station_pinged_out(route):
                 self.logger.info("_route_msg: Route %s for %s is pinged out",
                                  route, dst)
-                invalid.append(route)
+                routes.journal(dst, route, "rejected, pinged out")
+                invalid.add(route)
                 route = None # This one has been pinged and isn't responding
             else:
+                routes.journal(dst, route, reason)
                 break # We have a route to try
 
         if not route:
             self.logger.info("_route_msg: No route for station %s", dst)
+            routes.journal(dst, None, "no route")
         elif old(route) and "@" not in route and ":" not in route:
             # This station is heard, but a long time ago.  Ping it first
             # and consider it unrouteable for now
@@ -613,36 +621,26 @@ class MessageRouter(GObject.GObject):
 
         return True
 
-    def _route_via_station(self, call, route, slist, msg):
+    def _route_via_station(self, entry, route, slist, candidates):
         '''
         Route via station internal.
 
-        :param call: callsign for station.
-        :type call: str
-        :param route: Route for message
-        :type route: dict
+        The message is handed to the forwarding scheduler, which sends
+        it when the station and the port are free.
+
+        :param entry: Outbox entry of the message
+        :type entry: :class:`OutboxEntry`
+        :param route: Next hop station for message
+        :type route: str
         :param slist: List of active stations
         :type slist: dict
-        :param msg: Message
-        :type msg: str
+        :param candidates: Messages for the scheduler, added to
+        :type candidates: list[tuple[:class:`OutboxEntry`, str, str]]
         :returns: True
         :rtype bool
         '''
-        if self._sent_recently(route):
-            self.logger.info("_route_via_station: Call %s is busy", route)
-            return False
-
-        self.logger.info("_route_va_station: %s", slist)
         port = slist[route].get_port()
-        if not self._port_free(port):
-            self.logger.info("_route_via_station: I think port %s is busy",
-                             port)
-            return False # likely already a transfer going here so skip it
-
-        self.logger.info("_route_via_station: Sending %s to %s (via %s)",
-                         msg, call, route)
-        self._send_form(route, port, msg)
-
+        candidates.append((entry, route, port))
         return True
 
     def _route_via_wl2k(self, src, dst, msgfn):
@@ -686,44 +684,86 @@ class MessageRouter(GObject.GObject):
 
         return True
 
-    def _route_message(self, msg, slist, routes):
+    def _route_message(self, entry, slist, routes, candidates):
         '''
         Route message internal.
 
-        :param msg: message filename to send.
-        :type msg: str
+        :param entry: Outbox entry of the message to send.
+        :type entry: :class:`OutboxEntry`
         :param slist: List of active stations
         :type slist: dict
-        :param routes: Routes for message
-        :type routes: dict
+        :param routes: Static message routes
+        :type routes: :class:`MessageRouteTable`
+        :param candidates: Messages for the forwarding scheduler
+        :type candidates: list[tuple[:class:`OutboxEntry`, str, str]]
         :returns: True if a route found.
         :rtype bool
         '''
-        form = formgui.FormFile(msg)
-        path = form.get_path()
+        msg = entry.filename
+        path = entry.path
         emok = path[-2:] != ["EMAIL", self.__config.get("user", "callsign")]
-        src = form.get_path_src()
-        dst = form.get_path_dst()
-        del form
+        src = entry.src
+        dst = entry.dst
 
         routed = False
-        route = self._route_msg(src, dst, path, slist, routes)
+        # Messages with the same addressing get the same route in a
+        # pass, and the stale station is only pinged once.
+        key = (src, dst, tuple(path))
+        if key in self.__pass_routes:
+            route = self.__pass_routes[key]
+        else:
+            route = self._route_msg(src, dst, path, slist, routes)
+            self.__pass_routes[key] = route
 
         if not route:
             pass
         elif route.upper().startswith("WL2K:"):
-            routed = self._route_via_wl2k(src, route, msg)
+            if self._lock_msg(msg):
+                try:
+                    routed = self._route_via_wl2k(src, route, msg)
+                finally:
+                    self._unlock_unless(routed, msg)
         elif "@" in src and "@" in dst:
             # Don't route a message from email to email
             pass
         elif "@" in route:
-            if emok:
-                routed = self._route_via_email(dst, msg)
+            if emok and self._lock_msg(msg):
+                try:
+                    routed = self._route_via_email(dst, msg)
+                finally:
+                    self._unlock_unless(routed, msg)
         else:
-            routed = self._route_via_station(dst, route, slist, msg)
+            routed = self._route_via_station(entry, route, slist, candidates)
 
         return routed
 
+    def _lock_msg(self, msg):
+        '''
+        Lock a message that is about to be sent.
+
+        :param msg: Message filename
+        :type msg: str
+        :returns: True if the message was locked
+        :rtype: bool
+        '''
+        if msg_lock(msg):
+            return True
+        self.logger.info("_lock_msg: Message %s is locked, skipping", msg)
+        return False
+
+    def _unlock_unless(self, routed, msg):
+        '''
+        Unlock a message unless it was handed off.
+
+        :param routed: True if the message was handed off
+        :type routed: bool
+        :param msg: Message filename
+        :type msg: str
+        '''
+        if not routed and msg_is_locked(msg):
+            self.logger.info("_unlock_unless: unlocking message %s", msg)
+            msg_unlock(msg)
+
     def _run_one(self, queue):
         '''
         Run one internal.
@@ -735,6 +775,7 @@ class MessageRouter(GObject.GObject):
         slist = {}
 
         routes = self._get_routes()
+        self.__pass_routes = {}
 
         if plist:
             for _port, stations in plist.copy().items():
@@ -743,21 +784,23 @@ class MessageRouter(GObject.GObject):
         else:
             self.logger.info("_run_one: Station list was empty")
 
+        candidates = []
+        now = time.time()
         for _dst, callq in queue.copy().items():
-            for msg in callq:
+            for entry in callq:
+                # Wait a while after a failed transfer before trying again.
+                if not entry.retry_due(now):
+                    continue
 
                 try:
-                    routed = self._route_message(msg, slist, routes)
+                    self._route_message(entry, slist, routes, candidates)
                 # pylint: disable=broad-except
                 except Exception:
                     self.logger.info("_run_one: broad-except", exc_info=True)
                     utils.log_exception()
-                    routed = False
 
-                if not routed:
-                    if msg_is_locked(msg):
-                        self.logger.info("_run_one: unlocking message %s", msg)
-                        msg_unlock(msg)
+        for batch, entry in self.__scheduler.schedule(candidates):
+            self._start_forward(batch, entry)
 
     def _run(self):
         while self.__enabled:
@@ -770,14 +813,9 @@ class MessageRouter(GObject.GObject):
                     self._run_one(queue)
                 # pylint: disable=broad-except
                 except Exception:
+                    # Messages are unlocked by _route_message.
                     utils.log_exception()
-                    self.logger.info("_run: Fail-safe unlocking messages "
-                                     "in queue: broad-except", exc_info=True)
-                    for msgs in queue.values():
-                        for msg in msgs:
-                            self.logger.info("_run: Unlocking %s", msg)
-                            if msg_is_locked(msg):
-                                msg_unlock(msg)
+                    self.logger.info("_run: broad-except", exc_info=True)
 
                 self.__event.clear()
             self.__event.wait(self.__config.getint("settings", "msg_flush"))
@@ -849,8 +887,13 @@ class MessageRouter(GObject.GObject):
         call = self.__file_to_call.get(fname, None)
         if call and call in self.__sent_call:
             # This callsign completed (or failed) a transfer
+            latency = time.time() - self.__sent_call[call]
+            self.__route_table.record_delivery(call, not failed, latency)
             if failed:
                 self._station_failed(call)
+                if self.__outbox:
+                    self.__outbox.record_attempt(fname, False)
+                    self.__outbox.save()
             else:
                 self._station_succeeded(call)
                 self._update_path(fname, call)
@@ -858,6 +901,10 @@ class MessageRouter(GObject.GObject):
             del self.__sent_call[call]
             del self.__file_to_call[fname]
 
-        if port in self.__sent_port:
-            # This port is now open for another transfer
-            del self.__sent_port[port]
+        # Keep the station busy with the rest of its batch, or let the
+        # next routing pass start another batch on this port.
+        next_send = self.__scheduler.done(fname, failed)
+        if next_send:
+            self._start_forward(*next_send)
+        elif self.__enabled:
+            self.__event.set()
@@ -0,0 +1,559 @@
+#!/usr/bin/python
+'''Outbox Index.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+from .form_header import FORM_HEADERS
+from .form_header import FormHeaderError
+
+INDEX_FILE = "outbox_index.db"
+
+# Bump when the outbox table changes, the index is then rebuilt.
+SCHEMA_VERSION = 2
+
+# Seconds between full checks of every file in the outbox, which catch
+# a message rewritten in place without a hook telling the index.
+VERIFY_INTERVAL = 60
+
+# Seconds to wait before sending a message again after a failed
+# transfer, doubled for each further failure up to the maximum.
+RETRY_BACKOFF = 60
+RETRY_BACKOFF_MAX = 3600
+
+
+def _empty_fields():
+    return {"src": "", "dst": "", "mid": "", "path": [],
+            "ident": "", "precedence": ""}
+
+
+def read_form_path(filename):
+    '''
+    Read the routing fields of a form without building the form.
+
+    :param filename: Form file name
+    :type filename: str
+    :returns: Source, destination, message id, path elements,
+              form id and precedence
+    :rtype: dict
+    :raises: :class:`FormHeaderError` if the file is not valid
+    '''
+    header = FORM_HEADERS.get(filename)
+    return {"src": header.get_path_src(),
+            "dst": header.get_path_dst(),
+            "mid": header.get_path_mid(),
+            "path": header.get_path(),
+            "ident": header.ident,
+            "precedence": header.get_precedence()}
+
+
+# pylint wants at least 2 public methods
+# pylint wants only 7 instance attributes
+# pylint: disable=too-few-public-methods, too-many-instance-attributes
+class OutboxEntry:
+    '''
+    Outbox Entry.
+
+    One message waiting in the outbox, as recorded in the index.
+
+    :param filename: Message file name
+    :type filename: str
+    :param fields: Routing fields from :func:`read_form_path`
+    :type fields: dict
+    :param size: File size
+    :type size: int
+    :param mtime: File modification time in nanoseconds
+    :type mtime: int
+    '''
+
+    __slots__ = ("filename", "src", "dst", "mid", "path", "ident",
+                 "precedence", "size", "mtime", "retries", "last_try")
+
+    def __init__(self, filename, fields, size, mtime):
+        self.filename = filename
+        self.src = fields["src"]
+        self.dst = fields["dst"]
+        self.mid = fields["mid"]
+        self.path = fields["path"]
+        self.ident = fields["ident"]
+        self.precedence = fields["precedence"]
+        self.size = size
+        self.mtime = mtime
+        self.retries = 0
+        self.last_try = 0
+
+    def to_row(self):
+        '''
+        To row.
+
+        :returns: Values for the index row
+        :rtype: tuple
+        '''
+        return (os.path.basename(self.filename), self.src, self.dst,
+                self.mid, json.dumps(self.path), self.ident, self.precedence,
+                self.size, self.mtime, self.retries, self.last_try)
+
+    def retry_due(self, now):
+        '''
+        Check if the message may be sent again.
+
+        :param now: Current time
+        :type now: float
+        :returns: True if the message has not failed or has waited out
+                  its backoff
+        :rtype: bool
+        '''
+        if not self.retries:
+            return True
+        backoff = min(RETRY_BACKOFF * 2 ** (self.retries - 1),
+                      RETRY_BACKOFF_MAX)
+        return now >= self.last_try + backoff
+
+    def __str__(self):
+        return self.filename
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class OutboxIndex:
+    '''
+    Outbox Index.
+
+    Persistent index of the messages in the outbox, with the routing
+    fields of each message so that the router does not have to parse
+    every queued form on every pass.
+
+    The index is brought up to date by :meth:`refresh`, which only
+    looks at the files when the outbox directory has changed, and by
+    :meth:`update_file` and :meth:`remove_file` from the code that
+    moves or rewrites messages.  The entries are kept in memory and
+    written through to an SQLite file, so a restart does not have to
+    parse the outbox again.  Use :meth:`get_index` to share one index
+    for each outbox between threads.
+
+    :param outbox_dir: Outbox directory
+    :type outbox_dir: str
+    :param index_file: SQLite file to keep the index in
+    :type index_file: str
+    '''
+
+    logger = logging.getLogger("OutboxIndex")
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, outbox_dir, index_file):
+        self.outbox_dir = outbox_dir
+        self.index_file = index_file
+        self.verify_interval = VERIFY_INTERVAL
+        self.parsed = 0
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._verified = 0
+        self._entries = {}
+        self._tried = set()
+
+        self._db = sqlite3.connect(index_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        version, = self._db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            # The index only caches what is in the files.
+            self._db.execute("DROP TABLE IF EXISTS outbox")
+            self._db.execute("PRAGMA user_version=%i" % SCHEMA_VERSION)
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                         "name TEXT PRIMARY KEY, "
+                         "src TEXT, dst TEXT, mid TEXT, path TEXT, "
+                         "ident TEXT, precedence TEXT, "
+                         "size INTEGER, mtime INTEGER, "
+                         "retries INTEGER, last_try REAL)")
+        self._db.commit()
+        self._load()
+
+    def _load(self):
+        '''Load the entries saved in the index file.'''
+        for row in self._db.execute("SELECT * FROM outbox"):
+            name, src, dst, mid, path, ident, precedence, \
+                size, mtime, retries, last_try = row
+            fields = {"src": src, "dst": dst, "mid": mid,
+                      "path": json.loads(path), "ident": ident,
+                      "precedence": precedence}
+            entry = OutboxEntry(os.path.join(self.outbox_dir, name),
+                                fields, size, mtime)
+            entry.retries = retries
+            entry.last_try = last_try
+            self._entries[name] = entry
+
+    @classmethod
+    def get_index(cls, outbox_dir, index_file=None):
+        '''
+        Get the shared index for an outbox.
+
+        :param outbox_dir: Outbox directory
+        :type outbox_dir: str
+        :param index_file: SQLite file, default INDEX_FILE in the
+                           parent of the outbox directory
+        :type index_file: str
+        :returns: Index for the outbox
+        :rtype: :class:`OutboxIndex`
+        '''
+        outbox_dir = os.path.abspath(outbox_dir)
+        with cls._indexes_lock:
+            index = cls._indexes.get(outbox_dir, None)
+            if index is None:
+                if not index_file:
+                    index_file = os.path.join(os.path.dirname(outbox_dir),
+                                              INDEX_FILE)
+                index = cls(outbox_dir, index_file)
+                cls._indexes[outbox_dir] = index
+            return index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _parse(self, name, size, mtime):
+        '''
+        Parse a message.
+
+        :param name: File name in the outbox
+        :type name: str
+        :param size: File size
+        :type size: int
+        :param mtime: File modification time in nanoseconds
+        :type mtime: int
+        :returns: New entry for the message
+        :rtype: :class:`OutboxEntry`
+        '''
+        self.parsed += 1
+        filename = os.path.join(self.outbox_dir, name)
+        try:
+            fields = read_form_path(filename)
+        except (FormHeaderError, OSError) as err:
+            # Keep it in the index with no destination so it is not
+            # parsed again until it changes.
+            self.logger.info("_parse: Unable to read %s: %s", name, err)
+            fields = _empty_fields()
+        entry = OutboxEntry(filename, fields, size, mtime)
+        old_entry = self._entries.get(name, None)
+        if old_entry:
+            # Retry state is kept when a message is rewritten.
+            entry.retries = old_entry.retries
+            entry.last_try = old_entry.last_try
+        return entry
+
+    def _store(self, entries):
+        self._db.executemany("INSERT OR REPLACE INTO outbox "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [entry.to_row() for entry in entries])
+        for entry in entries:
+            self._entries[os.path.basename(entry.filename)] = entry
+
+    def _remove(self, names):
+        self._db.executemany("DELETE FROM outbox WHERE name = ?",
+                             [(name,) for name in names])
+        for name in names:
+            self._entries.pop(name, None)
+
+    def _changed(self, name, size, mtime):
+        entry = self._entries.get(name, None)
+        return entry is None or entry.size != size or entry.mtime != mtime
+
+    def refresh(self, force=False):
+        '''
+        Bring the index up to date with the outbox directory.
+
+        Nothing is read when the directory has not changed since the
+        last refresh, except for a check of all files every
+        verify_interval seconds.  Only new or changed messages are
+        parsed.
+
+        :param force: Check all files even if nothing seems changed
+        :type force: bool
+        :returns: Number of messages added, changed or removed
+        :rtype: int
+        '''
+        try:
+            dir_mtime = os.stat(self.outbox_dir).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime = None
+        now = time.monotonic()
+        if not force and dir_mtime == self._dir_mtime and \
+                now - self._verified < self.verify_interval:
+            return 0
+
+        found = {}
+        if dir_mtime is not None:
+            with os.scandir(self.outbox_dir) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name.startswith(".") or \
+                            not dir_entry.name.endswith(".xml"):
+                        continue
+                    try:
+                        stat = dir_entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    found[dir_entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            entries = [self._parse(name, size, mtime)
+                       for name, (size, mtime) in found.items()
+                       if self._changed(name, size, mtime)]
+            gone = [name for name in self._entries if name not in found]
+            if entries or gone:
+                with self._db:
+                    self._store(entries)
+                    self._remove(gone)
+            self._dir_mtime = dir_mtime
+            self._verified = now
+        if entries or gone:
+            self.logger.info("refresh: %i messages indexed, %i removed, "
+                             "%i queued", len(entries), len(gone),
+                             len(self._entries))
+        return len(entries) + len(gone)
+
+    def update_file(self, filename):
+        '''
+        Update the index for a message added to or rewritten in the outbox.
+
+        :param filename: Message file name
+        :type filename: str
+        '''
+        name = os.path.basename(filename)
+        try:
+            stat = os.stat(os.path.join(self.outbox_dir, name))
+        except FileNotFoundError:
+            self.remove_file(filename)
+            return
+        with self._lock:
+            entry = self._parse(name, stat.st_size, stat.st_mtime_ns)
+            with self._db:
+                self._store([entry])
+
+    def remove_file(self, filename):
+        '''
+        Remove a message moved out of the outbox from the index.
+
+        :param filename: Message file name
+        :type filename: str
+        '''
+        name = os.path.basename(filename)
+        with self._lock:
+            if name in self._entries:
+                with self._db:
+                    self._remove([name])
+
+    def get_entries(self):
+        '''
+        Get the indexed messages.
+
+        :returns: Messages in the outbox
+        :rtype: list[:class:`OutboxEntry`]
+        '''
+        with self._lock:
+            return list(self._entries.values())
+
+    def get_queue(self):
+        '''
+        Get the messages that have a destination.
+
+        :returns: Messages for each destination, oldest first
+        :rtype: dict[str, list[:class:`OutboxEntry`]]
+        '''
+        queue = {}
+        for entry in sorted(self.get_entries(), key=lambda e: e.mtime):
+            if entry.dst:
+                queue.setdefault(entry.dst, []).append(entry)
+        return queue
+
+    def record_attempt(self, filename, success):
+        '''
+        Record an attempt to send a message.
+
+        Only record transfers that were actually tried, as each failure
+        makes :meth:`OutboxEntry.retry_due` wait longer before the next
+        one.  The retry state is written to the file by :meth:`save`.
+
+        :param filename: Message file name
+        :type filename: str
+        :param success: True if the message was sent or handed off
+        :type success: bool
+        '''
+        name = os.path.basename(filename)
+        with self._lock:
+            entry = self._entries.get(name, None)
+            if entry is None:
+                return
+            entry.last_try = time.time()
+            if not success:
+                entry.retries += 1
+            self._tried.add(name)
+
+    def save(self):
+        '''Save the retry state recorded since the last save.'''
+        with self._lock:
+            rows = [(self._entries[name].retries,
+                     self._entries[name].last_try, name)
+                    for name in self._tried if name in self._entries]
+            self._tried.clear()
+            if rows:
+                with self._db:
+                    self._db.executemany("UPDATE outbox SET retries = ?, "
+                                         "last_try = ? WHERE name = ?", rows)
+
+    def close(self):
+        '''Close the index.'''
+        self.save()
+        with self._indexes_lock:
+            if self._indexes.get(self.outbox_dir, None) is self:
+                del self._indexes[self.outbox_dir]
+        with self._lock:
+            self._db.close()
+
+
+BENCH_FORM = '''<xml>
+<form id="email">
+<title>Email Message</title>
+<field id="subject">
+<caption>Subject</caption>
+<entry type="text">Test message %(num)i</entry>
+</field>
+<field id="message">
+<caption>Message</caption>
+<entry type="multiline">%(body)s</entry>
+</field>
+<path><src>N0CALL</src><dst>%(dst)s</dst><mid>N0CALL.%(num)i</mid>\
+<e>N0CALL</e></path>
+</form>
+</xml>
+'''
+
+
+def _glob_parse_pass(outbox_dir):
+    '''
+    Routing pass the way it was done before the index.
+
+    Every message is fully parsed and searched with xpath.
+
+    :param outbox_dir: Outbox directory
+    :type outbox_dir: str
+    :returns: Message file names for each destination
+    :rtype: dict
+    '''
+    queue = {}
+    for name in os.listdir(outbox_dir):
+        if not name.endswith(".xml"):
+            continue
+        filename = os.path.join(outbox_dir, name)
+        doc = etree.parse(filename)
+        doc.xpath("//form")
+        doc.xpath("//form/title")
+        doc.xpath("//form/logo")
+        dst = doc.xpath("//form/path/dst")[0].text.strip()
+        doc.xpath("//form/path/e")
+        queue.setdefault(dst, []).append(filename)
+    return queue
+
+
+# pylint wants a maximum of 50 statements
+# pylint: disable=too-many-statements
+def main():
+    '''Unit test and benchmark with 10000 queued messages.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("OutboxIndex.test")
+
+    count = 10000
+    calls = ["N%03i" % i for i in range(50)]
+    body = "Lorem ipsum dolor sit amet. " * 20
+    with tempfile.TemporaryDirectory() as store_dir:
+        outbox_dir = os.path.join(store_dir, "Outbox")
+        os.mkdir(outbox_dir)
+        for num in range(count):
+            with open(os.path.join(outbox_dir, "msg%05i.xml" % num),
+                      "w") as handle:
+                handle.write(BENCH_FORM % {"num": num, "body": body,
+                                           "dst": calls[num % len(calls)]})
+
+        start = time.perf_counter()
+        old_queue = _glob_parse_pass(outbox_dir)
+        elapsed = time.perf_counter() - start
+        logger.info("glob and parse pass: %.1f ms", elapsed * 1000)
+
+        index = OutboxIndex.get_index(outbox_dir)
+        start = time.perf_counter()
+        index.refresh()
+        elapsed = time.perf_counter() - start
+        logger.info("cold index build: %.1f ms", elapsed * 1000)
+
+        start = time.perf_counter()
+        index.refresh()
+        queue = index.get_queue()
+        elapsed = time.perf_counter() - start
+        logger.info("indexed pass, nothing changed: %.1f ms", elapsed * 1000)
+
+        start = time.perf_counter()
+        index.refresh(force=True)
+        queue = index.get_queue()
+        elapsed = time.perf_counter() - start
+        logger.info("indexed pass, all files checked: %.1f ms",
+                    elapsed * 1000)
+
+        if sorted((dst, len(msgs)) for dst, msgs in queue.items()) != \
+                sorted((dst, len(msgs)) for dst, msgs in old_queue.items()):
+            logger.info("FAIL: queues differ")
+
+        # A message rewritten in place and one moved out.
+        changed = os.path.join(outbox_dir, "msg00000.xml")
+        with open(changed, "w") as handle:
+            handle.write(BENCH_FORM % {"num": 0, "body": "", "dst": "W1AW"})
+        index.update_file(changed)
+        os.unlink(os.path.join(outbox_dir, "msg00001.xml"))
+        index.refresh()
+        index.record_attempt(changed, False)
+        index.close()
+
+        # Reopen cold from the saved index.
+        index = OutboxIndex.get_index(outbox_dir)
+        start = time.perf_counter()
+        index.refresh()
+        queue = index.get_queue()
+        elapsed = time.perf_counter() - start
+        logger.info("reopened index pass: %.1f ms, %i parsed",
+                    elapsed * 1000, index.parsed)
+        entry = queue.get("W1AW", [None])[0]
+        if len(index) == count - 1 and entry and entry.retries == 1 and \
+                index.parsed == 0:
+            logger.info("PASS")
+        else:
+            logger.info("FAIL: index not updated")
+        start = time.time()
+        if entry and not entry.retry_due(start) and \
+                entry.retry_due(start + RETRY_BACKOFF):
+            logger.info("PASS: retry backoff")
+        else:
+            logger.info("FAIL: retry backoff")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
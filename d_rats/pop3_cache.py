@@ -0,0 +1,507 @@
+#!/usr/bin/python
+'''POP3 Message Cache.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from email.generator import BytesGenerator
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .dplatform import Platform
+from .form_header import read_form_header
+
+CACHE_DIR = "pop3_cache"
+INDEX_FILE = "index.db"
+
+# Bump when the rendering changes, the cache is then rebuilt.
+SCHEMA_VERSION = 1
+
+# Messages rendered between commits of the index.
+COMMIT_BATCH = 100
+
+# Seconds between the checks of the mailbox for new messages.
+POLL_INTERVAL = 10.0
+
+# Seconds a POP3 session waits for new messages to be rendered,
+# the rest are offered on the next poll.
+RENDER_WAIT = 2.0
+
+
+def message_uid(name):
+    '''
+    Unique id of a message for the POP3 UIDL command.
+
+    :param name: Filename of the message in the mailbox
+    :type name: str
+    :returns: Unique id, stays the same while the message exists
+    :rtype: str
+    '''
+    return hashlib.sha1(name.encode("utf-8", "replace")).hexdigest()
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class CachedMessage:
+    '''
+    Cached Message.
+
+    :param name: Filename of the message in the mailbox
+    :type name: str
+    :param size: Size of the rendered message in octets
+    :type size: int
+    :param uid: Unique id of the message
+    :type uid: str
+    '''
+
+    __slots__ = ("name", "size", "uid")
+
+    def __init__(self, name, size, uid):
+        self.name = name
+        self.size = size
+        self.uid = uid
+
+    def __str__(self):
+        return "%s: %i octets" % (self.name, self.size)
+
+
+# pylint wants only 7 instance attributes
+# pylint: disable=too-many-instance-attributes
+class Pop3Cache:
+    '''
+    POP3 Message Cache.
+
+    Keeps the messages of a mailbox folder rendered as RFC822
+    messages, with CRLF line ends as POP3 sends them.  An SQLite
+    index holds the modification time, the size and the destination
+    of each message, so a POP3 session can answer STAT, LIST and UIDL
+    without reading any form, and RETR and TOP stream the rendered
+    file.
+
+    A worker thread renders the new and changed messages in the
+    background.  Use :meth:`get_cache` to share one cache for each
+    mailbox.
+
+    :param mailbox_dir: Message folder
+    :type mailbox_dir: str
+    :param cache_dir: Directory for the index and rendered messages
+    :type cache_dir: str
+    :param render: Function taking the filename of a message,
+                   returning its destination and email message
+    :type render: function(str)
+    '''
+
+    logger = logging.getLogger("Pop3Cache")
+
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, mailbox_dir, cache_dir, render):
+        self.mailbox_dir = os.path.abspath(mailbox_dir)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.rendered = 0
+        self._render = render
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._pending = {}
+        self._dir_mtime = None
+        self._thread = None
+        self._closed = False
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, INDEX_FILE),
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # Everything in the cache can be rendered again.
+            self._db.execute("DROP TABLE IF EXISTS messages")
+            self._db.execute("PRAGMA user_version=%i" % SCHEMA_VERSION)
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                         "name TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                         "size INTEGER, dst TEXT)")
+        self._db.commit()
+        # A size of None is a message that could not be rendered,
+        # it is tried again when it changes.
+        self._entries = {name: (mtime_ns, size, dst, message_uid(name))
+                         for name, mtime_ns, size, dst in self._db.execute(
+                             "SELECT name, mtime_ns, size, dst "
+                             "FROM messages")}
+
+    @classmethod
+    def get_cache(cls, mailbox_dir, render, cache_dir=None):
+        '''
+        Get the shared cache of a mailbox.
+
+        :param mailbox_dir: Message folder
+        :type mailbox_dir: str
+        :param render: Function rendering a message, see :class:`Pop3Cache`
+        :type render: function(str)
+        :param cache_dir: Directory, default the name of the folder
+                          in CACHE_DIR in the configuration directory
+        :type cache_dir: str
+        :returns: Message cache
+        :rtype: :class:`Pop3Cache`
+        '''
+        mailbox_dir = os.path.abspath(mailbox_dir)
+        with cls._caches_lock:
+            cache = cls._caches.get(mailbox_dir, None)
+            if cache is None:
+                if not cache_dir:
+                    cache_dir = os.path.join(
+                        Platform.get_platform().config_file(CACHE_DIR),
+                        os.path.basename(mailbox_dir))
+                cache = cls(mailbox_dir, cache_dir, render)
+                cls._caches[mailbox_dir] = cache
+            return cache
+
+    def _cache_path(self, uid):
+        return os.path.join(self.cache_dir, uid + ".eml")
+
+    def sync(self, full=True):
+        '''
+        Compare the mailbox with the cache.
+
+        Messages that are gone are dropped, new and changed messages
+        are queued for the worker thread.
+
+        :param full: Also look for messages rewritten in place, which
+                     does not change the modification time of the folder
+        :type full: bool
+        :returns: Number of messages waiting to be rendered
+        :rtype: int
+        '''
+        found = {}
+        try:
+            dir_mtime = os.stat(self.mailbox_dir).st_mtime_ns
+            if not full and dir_mtime == self._dir_mtime:
+                with self._lock:
+                    return len(self._pending)
+            with os.scandir(self.mailbox_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".xml") and entry.is_file():
+                        found[entry.name] = entry.stat().st_mtime_ns
+        except OSError as err:
+            self.logger.info("sync: %s", err)
+            return 0
+
+        with self._lock:
+            self._dir_mtime = dir_mtime
+            gone = [name for name in self._entries if name not in found]
+            for name in gone:
+                self._drop(name)
+            if gone:
+                self._db.commit()
+            for name, mtime_ns in found.items():
+                entry = self._entries.get(name, None)
+                if entry is None or entry[0] != mtime_ns:
+                    self._pending[name] = mtime_ns
+            self._pending = {name: mtime_ns
+                             for name, mtime_ns in self._pending.items()
+                             if name in found}
+            return len(self._pending)
+
+    def _drop(self, name):
+        '''
+        Drop a message from the cache, with the lock held.
+
+        :param name: Filename of the message in the mailbox
+        :type name: str
+        '''
+        self._entries.pop(name, None)
+        self._pending.pop(name, None)
+        self._db.execute("DELETE FROM messages WHERE name = ?", (name,))
+        try:
+            os.remove(self._cache_path(message_uid(name)))
+        except OSError:
+            pass # Was never rendered
+
+    def add(self, filename):
+        '''
+        Queue a message just stored in the mailbox for rendering.
+
+        :param filename: Filename of the message
+        :type filename: str
+        '''
+        try:
+            mtime_ns = os.stat(filename).st_mtime_ns
+        except OSError as err:
+            self.logger.info("add: %s", err)
+            return
+        with self._lock:
+            self._pending[os.path.basename(filename)] = mtime_ns
+        self.start()
+        self._wake.set()
+
+    def forget(self, filename):
+        '''
+        Drop a message that was moved out of the mailbox.
+
+        :param filename: Filename of the message
+        :type filename: str
+        '''
+        with self._lock:
+            self._drop(os.path.basename(filename))
+            self._db.commit()
+
+    def _render_message(self, name, mtime_ns):
+        '''
+        Render a message into the cache.
+
+        :param name: Filename of the message in the mailbox
+        :type name: str
+        :param mtime_ns: Modification time it was queued with
+        :type mtime_ns: int
+        '''
+        uid = message_uid(name)
+        path = self._cache_path(uid)
+        size = None
+        dst = None
+        # Any message that can not be rendered must not stop the
+        # others from being served.
+        # pylint: disable=broad-except
+        try:
+            dst, msg = self._render(os.path.join(self.mailbox_dir, name))
+            # A session may still be sending the old file.
+            with open(path + ".tmp", "wb") as handle:
+                BytesGenerator(handle, mangle_from_=False,
+                               policy=msg.policy.clone(linesep="\r\n")
+                               ).flatten(msg)
+                size = handle.tell()
+            os.replace(path + ".tmp", path)
+        except Exception:
+            self.logger.warning("Can not render %s", name, exc_info=True)
+            size = None
+
+        with self._lock:
+            if self._pending.get(name, None) != mtime_ns:
+                # Changed or moved away while it was rendered.
+                return
+            del self._pending[name]
+            self._entries[name] = (mtime_ns, size, dst, uid)
+            self._db.execute("INSERT OR REPLACE INTO messages "
+                             "(name, mtime_ns, size, dst) "
+                             "VALUES (?, ?, ?, ?)",
+                             (name, mtime_ns, size, dst))
+            if not self._pending:
+                self._db.commit()
+                self._done.notify_all()
+        self.rendered += 1
+
+    def render_pending(self):
+        '''
+        Render the messages waiting in the queue.
+
+        :returns: Number of messages rendered
+        :rtype: int
+        '''
+        count = 0
+        while True:
+            with self._lock:
+                if not self._pending or self._closed:
+                    self._db.commit()
+                    return count
+                name, mtime_ns = next(iter(self._pending.items()))
+            self._render_message(name, mtime_ns)
+            count += 1
+            if count % COMMIT_BATCH == 0:
+                with self._lock:
+                    self._db.commit()
+
+    def start(self):
+        '''Start rendering the mailbox in the background.'''
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="Pop3Cache")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self.sync()
+                self.render_pending()
+            except sqlite3.Error as err:
+                self.logger.info("_run: %s", err)
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+    def messages(self, dst=None, wait=RENDER_WAIT):
+        '''
+        Get the rendered messages of the mailbox.
+
+        New messages are rendered by the worker thread first, for at
+        most wait seconds.
+
+        :param dst: Only messages for this station, default all
+        :type dst: str
+        :param wait: Seconds to wait for new messages, default RENDER_WAIT
+        :type wait: float
+        :returns: Messages, in the order of their filenames
+        :rtype: list[:class:`CachedMessage`]
+        '''
+        if self.sync(full=False):
+            self.start()
+            self._wake.set()
+            deadline = time.monotonic() + wait
+            with self._lock:
+                while self._pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.logger.info("messages: %i not rendered yet",
+                                         len(self._pending))
+                        break
+                    self._done.wait(remaining)
+
+        with self._lock:
+            return [CachedMessage(name, size, uid)
+                    for name, (_mtime_ns, size, msg_dst, uid)
+                    in sorted(self._entries.items())
+                    if size is not None and dst in (None, msg_dst)]
+
+    def open_message(self, message):
+        '''
+        Open a rendered message.
+
+        :param message: Message from :meth:`messages`
+        :type message: :class:`CachedMessage`
+        :returns: Rendered message, with CRLF line ends
+        :rtype: :class:`io.BufferedReader`
+        :raises: :class:`OSError` if the message was dropped
+        '''
+        return open(self._cache_path(message.uid), "rb")
+
+    def close(self):
+        '''Stop the worker thread and close the index.'''
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._db.close()
+
+
+_BENCH_FORM = '''<xml>
+<form id="email">
+<title>Email</title>
+<field id="subject"><caption>Subject</caption>
+<entry type="text">Report %(num)i</entry></field>
+<field id="message"><caption>Message</caption>
+<entry type="multiline">%(body)s</entry></field>
+<path><src>N%(src)03i</src><dst>%(dst)s</dst></path>
+</form>
+</xml>
+'''
+
+
+def _bench_render(filename):
+    '''Render a form like msgrouting.form_to_email, without the XSLT.'''
+    form = read_form_header(filename)
+    root = MIMEMultipart("related")
+    root["Subject"] = form.get_subject_string()
+    root["From"] = "%s@d-rats.com" % form.get_path_src()
+    root["To"] = "%s@d-rats.com" % form.get_path_dst()
+    altp = MIMEMultipart("alternative")
+    root.attach(altp)
+    altp.attach(MIMEText(form.get_field_value("message"), "plain"))
+    with open(filename, "r", encoding="utf-8") as handle:
+        altp.attach(MIMEText(handle.read(), "html"))
+    return form.get_path_dst(), root
+
+
+def _stat(cache, dst=None):
+    msgs = cache.messages(dst)
+    return len(msgs), sum(msg.size for msg in msgs)
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Unit test and benchmark with a 5000 message mailbox.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("Pop3Cache.test")
+    count = 5000
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        mailbox = os.path.join(work_dir, "Outbox")
+        os.makedirs(mailbox)
+        for num in range(count):
+            with open(os.path.join(mailbox, "form%06i.xml" % num), "w",
+                      encoding="utf-8") as handle:
+                handle.write(_BENCH_FORM % {
+                    "num": num, "src": num % 100,
+                    "dst": "W1AW" if num % 10 else "K7ABC",
+                    "body": ".leading dot\n" * 20})
+        cache_dir = os.path.join(work_dir, CACHE_DIR, "Outbox")
+
+        cache = Pop3Cache(mailbox, cache_dir, _bench_render)
+        start = time.perf_counter()
+        for num in range(50):
+            _dst, msg = _bench_render(
+                os.path.join(mailbox, "form%06i.xml" % num))
+            len(str(msg))
+        uncached = (time.perf_counter() - start) / 50 * count
+        logger.info("Rendering every message, as each session did "
+                    "before: %.0f ms", uncached * 1000)
+
+        start = time.perf_counter()
+        cache.sync()
+        cache.render_pending()
+        logger.info("Cache filled in %.0f ms",
+                    (time.perf_counter() - start) * 1000)
+
+        times = []
+        for _num in range(20):
+            start = time.perf_counter()
+            stat = _stat(cache)
+            times.append(time.perf_counter() - start)
+        logger.info("STAT %i messages %i octets: %.1f ms",
+                    stat[0], stat[1], sorted(times)[len(times) // 2] * 1000)
+        cache.close()
+
+        # A new program run finds the cache.
+        cache = Pop3Cache(mailbox, cache_dir, _bench_render)
+        start = time.perf_counter()
+        k7abc = _stat(cache, "K7ABC")
+        elapsed = time.perf_counter() - start
+        changed = os.path.join(mailbox, "form%06i.xml" % 10)
+        os.utime(changed, ns=(0, 0))
+        os.remove(os.path.join(mailbox, "form%06i.xml" % 20))
+        after = _stat(cache, "K7ABC")
+        msg = cache.messages("K7ABC")[0]
+        with cache.open_message(msg) as handle:
+            data = handle.read()
+        if (stat[0], k7abc[0], after[0], cache.rendered) == \
+                (count, count // 10, count // 10 - 1, 1) and \
+                len(data) == msg.size and \
+                b"\n" not in data.replace(b"\r\n", b""):
+            logger.info("PASS: STAT after restart in %.1f ms", elapsed * 1000)
+        else:
+            logger.info("FAIL: %s %s %s %i", stat, k7abc, after,
+                        cache.rendered)
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/python
+'''Repeater Routes.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import logging
+import os
+import time
+
+
+def path_name(path):
+    '''
+    Path name.
+
+    :param path: Transport to name
+    :type path: :class:`Transporter`
+    Network clients are named by their host, because the source port
+    of a client changes each time it connects.
+
+    :param path: Transport to name
+    :type path: :class:`Transporter`
+    :returns: Name that identifies the transport across restarts
+    :rtype: str
+    '''
+    name = getattr(path, "route_name", "") or getattr(path, "name", "")
+    if name:
+        return name
+    return str(path)
+
+
+class CallInfo:
+    '''
+    Call Information.
+
+    :param call: Call sign
+    :type call: str
+    :param call_transport: Transport call was heard on
+    :type call_transport: :class:`Transporter`
+    :param heard: Time the call was heard, default now
+    :type heard: float
+    '''
+
+    def __init__(self, call, call_transport, heard=None):
+        self.__call = call
+        self.__heard = 0
+        self.__transport = None
+        self.name = None
+        self.frames = 0
+        self.moves = 0
+        self.just_heard(call_transport)
+        if heard is not None:
+            self.__heard = heard
+
+    def get_call(self):
+        '''
+        Get call.
+
+        :returns: Call sign
+        :rtype: str
+        '''
+        return self.__call
+
+    def just_heard(self, heard_transport):
+        '''
+        Just heard.
+
+        :param heard_transport: Transport that had something heard
+        :type heard_transport: :class:`Transporter`
+        '''
+        self.__heard = time.time()
+        if heard_transport is not self.__transport and self.frames:
+            self.moves += 1
+        self.set_transport(heard_transport)
+        self.frames += 1
+
+    def set_transport(self, heard_transport):
+        '''
+        Set the transport without counting a frame heard.
+
+        :param heard_transport: Transport for the call, may be None
+        :type heard_transport: :class:`Transporter`
+        '''
+        self.__transport = heard_transport
+        if heard_transport is not None:
+            self.name = path_name(heard_transport)
+
+    def heard_time(self):
+        '''
+        Heard time.
+
+        :returns: Time station was last heard, seconds since the epoch
+        :rtype: float
+        '''
+        return self.__heard
+
+    def last_heard(self):
+        '''
+        Last heard.
+
+        :returns: Time for last heard station
+        :type float:
+        '''
+        return time.time() - self.__heard
+
+    def last_transport(self):
+        '''
+        Last transport.
+
+        :returns: Last transport heard, None if not yet known
+        :rtype: :class:`Transporter`
+        '''
+        return self.__transport
+
+    def to_list(self):
+        '''
+        To list.
+
+        :returns: Values to save in a snapshot
+        :rtype: list
+        '''
+        return [self.__call, self.name, self.__heard, self.frames, self.moves]
+
+    @classmethod
+    def from_list(cls, values):
+        '''
+        From list.
+
+        :param values: Values from a snapshot
+        :type values: list
+        :returns: Call information without a transport
+        :rtype: :class:`CallInfo`
+        '''
+        call, name, heard, frames, moves = values
+        info = cls(call, None, heard)
+        info.name = name
+        info.frames = frames
+        info.moves = moves
+        return info
+
+
+class RouteTable:
+    '''
+    Route Table.
+
+    Maps each station heard to the transport it was last heard on.
+    Lookups are a dictionary access, and stations that have not been
+    heard within the timeout are expired from a heap by
+    :meth:`expire`, which the owner calls from a timer.
+
+    The table is only changed from the repeater event loop.  Other
+    threads, such as the GUI, use :meth:`get_routes`, which returns a
+    copy and does not need a lock.
+
+    :param timeout: Seconds a station is remembered, default 600
+    :type timeout: float
+    :param snapshot_file: File to keep learned routes in, default None
+    :type snapshot_file: str
+    '''
+
+    logger = logging.getLogger("RouteTable")
+
+    def __init__(self, timeout=600, snapshot_file=None):
+        self.timeout = timeout
+        self.snapshot_file = snapshot_file
+        self._routes = {}
+        self._expire_heap = []
+        self._dirty = False
+        if snapshot_file:
+            self.load()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, call):
+        '''
+        Get the route for a station.
+
+        :param call: Call sign
+        :type call: str
+        :returns: Call information or None if not known
+        :rtype: :class:`CallInfo`
+        '''
+        return self._routes.get(call, None)
+
+    def heard(self, call, heard_transport):
+        '''
+        Station heard.
+
+        :param call: Call sign heard
+        :type call: str
+        :param heard_transport: Transport the station was heard on
+        :type heard_transport: :class:`Transporter`
+        :returns: Call information and True if the station is new or moved
+        :rtype: tuple[:class:`CallInfo`, bool]
+        '''
+        info = self._routes.get(call, None)
+        if info is None:
+            info = CallInfo(call, heard_transport)
+            self._routes[call] = info
+            heapq.heappush(self._expire_heap,
+                           (info.heard_time() + self.timeout, call))
+            self._dirty = True
+            return info, True
+        changed = info.last_transport() is not heard_transport
+        info.just_heard(heard_transport)
+        if changed:
+            self._dirty = True
+        # The heap entry is left alone, expire() reschedules it.
+        return info, changed
+
+    def lookup(self, call):
+        '''
+        Look up the transport for a station.
+
+        :param call: Call sign
+        :type call: str
+        :returns: Transport to deliver to, or None to flood
+        :rtype: :class:`Transporter`
+        '''
+        info = self._routes.get(call, None)
+        if info is None or info.last_heard() >= self.timeout:
+            return None
+        route_transport = info.last_transport()
+        if route_transport is None or not route_transport.enabled:
+            return None
+        return route_transport
+
+    def attach(self, new_transport):
+        '''
+        Attach routes to a new transport.
+
+        Routes restored from a snapshot, or left on a transport that
+        has gone away, are moved to a new transport with the same name.
+
+        :param new_transport: Transport that was added
+        :type new_transport: :class:`Transporter`
+        :returns: Number of routes attached
+        :rtype: int
+        '''
+        name = path_name(new_transport)
+        count = 0
+        for info in self._routes.values():
+            last = info.last_transport()
+            if (last is None or not last.enabled) and info.name == name:
+                info.set_transport(new_transport)
+                count += 1
+        return count
+
+    def expire(self, now=None):
+        '''
+        Expire routes not heard within the timeout.
+
+        :param now: Current time, default time.time()
+        :type now: float
+        :returns: Number of routes removed
+        :rtype: int
+        '''
+        if now is None:
+            now = time.time()
+        count = 0
+        while self._expire_heap and self._expire_heap[0][0] <= now:
+            _expires, call = heapq.heappop(self._expire_heap)
+            info = self._routes.get(call, None)
+            if info is None:
+                continue
+            expires = info.heard_time() + self.timeout
+            if expires > now:
+                # Heard since this entry was queued
+                heapq.heappush(self._expire_heap, (expires, call))
+                continue
+            del self._routes[call]
+            self._dirty = True
+            count += 1
+        if count:
+            self.logger.info("expire: Expired %i routes, %i left",
+                             count, len(self._routes))
+        return count
+
+    def get_routes(self):
+        '''
+        Get routes.
+
+        Safe to call from any thread.
+
+        :returns: Call information for all known stations
+        :rtype: list[:class:`CallInfo`]
+        '''
+        # Copying the values of a dict is atomic in CPython.
+        return list(self._routes.values())
+
+    def snapshot(self):
+        '''
+        Snapshot.
+
+        :returns: Routes in a form that can be saved, or None if
+                  nothing changed since the last snapshot
+        :rtype: list
+        '''
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return [info.to_list() for info in self._routes.values()]
+
+    def save(self, routes=None):
+        '''
+        Save routes to the snapshot file.
+
+        :param routes: Result of :meth:`snapshot`, default take one now
+        :type routes: list
+        '''
+        if not self.snapshot_file:
+            return
+        if routes is None:
+            routes = self.snapshot()
+            if routes is None:
+                return
+        temp_file = self.snapshot_file + ".tmp"
+        try:
+            with open(temp_file, "w") as handle:
+                json.dump(routes, handle)
+            os.replace(temp_file, self.snapshot_file)
+        except OSError as err:
+            self.logger.info("save: Unable to save %s: %s",
+                             self.snapshot_file, err)
+
+    def load(self):
+        '''Load routes from the snapshot file.'''
+        try:
+            with open(self.snapshot_file, "r") as handle:
+                routes = json.load(handle)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            self.logger.info("load: Unable to load %s: %s",
+                             self.snapshot_file, err)
+            return
+
+        now = time.time()
+        for values in routes:
+            try:
+                info = CallInfo.from_list(values)
+            except (TypeError, ValueError):
+                continue
+            expires = info.heard_time() + self.timeout
+            if expires <= now:
+                continue
+            self._routes[info.get_call()] = info
+            heapq.heappush(self._expire_heap, (expires, info.get_call()))
+        self.logger.info("load: Restored %i routes from %s",
+                         len(self._routes), self.snapshot_file)
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class _BenchTransport:
+    '''Stand in transport for the benchmark.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.enabled = True
+
+
+def main():
+    '''Unit test and benchmark with 10000 learned stations.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("RouteTable.test")
+
+    stations = 10000
+    ports = [_BenchTransport("port%i" % i) for i in range(8)]
+    calls = ["N%05i" % i for i in range(stations)]
+    snapshot_file = "route_table_test.json"
+    table = RouteTable(timeout=600, snapshot_file=snapshot_file)
+
+    start = time.perf_counter()
+    for index, call in enumerate(calls):
+        table.heard(call, ports[index % len(ports)])
+    elapsed = time.perf_counter() - start
+    logger.info("learned %i stations in %.1f ms", stations, elapsed * 1000)
+
+    start = time.perf_counter()
+    for call in calls:
+        table.heard(call, ports[0])
+        table.lookup(call)
+    elapsed = time.perf_counter() - start
+    logger.info("heard + lookup: %.2f usec per frame",
+                elapsed * 1000000 / stations)
+
+    start = time.perf_counter()
+    table.save()
+    elapsed = time.perf_counter() - start
+    logger.info("saved snapshot in %.1f ms", elapsed * 1000)
+
+    start = time.perf_counter()
+    restored = RouteTable(timeout=600, snapshot_file=snapshot_file)
+    attached = restored.attach(ports[0])
+    elapsed = time.perf_counter() - start
+    os.unlink(snapshot_file)
+    logger.info("restored %i routes, attached %i, in %.1f ms",
+                len(restored), attached, elapsed * 1000)
+    if len(restored) != stations or restored.lookup(calls[0]) is not ports[0]:
+        logger.info("FAIL: restore")
+
+    start = time.perf_counter()
+    expired = table.expire(time.time() + 601)
+    elapsed = time.perf_counter() - start
+    logger.info("expired %i routes in %.1f ms", expired, elapsed * 1000)
+    if expired == stations and not table.get_routes():
+        logger.info("PASS")
+    else:
+        logger.info("FAIL: expire")
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,8 @@ from . import formgui
 # from . import emailgw
 from . import signals
 from . import msgrouting
+from .attachment_store import externalize_file
+from .message_search import get_search_index
 
 if not '_' in locals():
     import gettext
@@ -277,10 +279,14 @@ class FormRecvThread(FileBaseThread):
                               self.session.get_station())
 
         if file_name == newfn:
+            # Keep the attachments out of the form file, so the form
+            # reads fast from now on.
+            externalize_file(file_name)
             worker_form = formgui.FormFile(file_name)
             worker_form.add_path_element(self.config.get("user",
                                                          "callsign"))
             worker_form.save_to(file_name)
+            get_search_index(self.config).update_file(file_name)
 
             self.completed("form")
             self.coord.session_newform(self.session, file_name)
@@ -38,12 +38,16 @@ class SessionManager():
     :type pipe: :class:`comm.DataPath`
     :param station: Call sign for session
     :type station: str
+    :param dup_cache: Cache for dropping duplicate frames, default None.
+                      May be shared by several session managers.
+    :type dup_cache: :class:`DuplicateCache`
     '''
     logger = logging.getLogger("SessionManager")
 
-    def __init__(self, pipe, station, **kwargs):
+    def __init__(self, pipe, station, dup_cache=None, **kwargs):
         self.pipe = self.tport = None
         self.station = station
+        self.dup_cache = dup_cache
 
         self.sniff_session = None
 
@@ -73,8 +77,11 @@ class SessionManager():
         if self.tport:
             self.tport.disable()
 
+        # Duplicate frames are dropped by the transport before they are
+        # decompressed, so incoming() never sees them.
         self.tport = transport.Transporter(self.pipe,
                                            inhandler=self.incoming,
+                                           dup_cache=self.dup_cache,
                                            **kwargs)
 
     def set_call(self, callsign):
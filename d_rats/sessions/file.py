@@ -169,6 +169,7 @@ class FileTransferSession(stateful.StatefulSession):
                 break
             elif resp.startswith(b"RESUME:"):
                 _resume, _offset = resp.split(b":", 1)
+                _offset, _sep, options = _offset.partition(b";")
                 self.logger.info("send_file: Got RESUME request at %s",
                                  _offset)
                 try:
@@ -176,7 +177,11 @@ class FileTransferSession(stateful.StatefulSession):
                 except ValueError:
                     self.logger.info("send_file: Unable to parse RESUME value")
                     offset = 0
-                self.status(_("Resuming at") + "%i" % offset)
+                if offset == 0 and options:
+                    data = self.select_data(options, data)
+                    self.status(_("Negotiation Complete"))
+                else:
+                    self.status(_("Resuming at") + "%i" % offset)
                 break
             else:
                 self.logger.info("send_file: Got unknown start: `%s'", resp)
@@ -271,7 +276,7 @@ class FileTransferSession(stateful.StatefulSession):
                 self.logger.info("recv_file: Sending resume at %i", offset)
                 self.write("RESUME:%i" % offset)
             else:
-                self.write("OK")
+                self.write(self.offer_reply())
         except base.SessionClosedError:
             self.logger.info("recv_file: "
                              "Session closed while sending start ack")
@@ -310,6 +315,28 @@ class FileTransferSession(stateful.StatefulSession):
         self.status(_("Complete"))
         return filename
 
+    def offer_reply(self):
+        '''
+        Reply accepting a file from the start.
+
+        :returns: Reply to the offer
+        :rtype: bytes
+        '''
+        return b"OK"
+
+    def select_data(self, _options, data):
+        '''
+        Select the data to send for the options of the receiver.
+
+        :param _options: Options from the receiver, unused
+        :type _options: bytes
+        :param data: Compressed file data
+        :type data: bytes
+        :returns: Data to send
+        :rtype: bytes
+        '''
+        return data
+
     @staticmethod
     def get_file_data(filename):
         '''
@@ -19,13 +19,36 @@
 from __future__ import absolute_import
 
 import logging
+import zlib
+
+from lxml import etree
+
+from d_rats.attachment_store import AttachmentStoreError
+from d_rats.attachment_store import inline_file
+from d_rats.form_codec import MAGIC
+from d_rats.form_codec import FormCodecError
+from d_rats.form_codec import decode_form
+from d_rats.form_codec import encode_form
+from d_rats.form_registry import FormRegistry
 from d_rats.sessions import base
 from d_rats.sessions import file as sessions_file
 
+# Offer reply option listing the form templates the receiver has.
+# Older senders take the reply as a resume from the start and send
+# the form as XML.
+TEMPLATE_OPTION = b"TD="
+
+
 class FormTransferSession(sessions_file.FileTransferSession):
     '''
     Form Transfer Session.
 
+    A receiver that has form templates lists them in its reply to the
+    offer.  A sender with the same version of the template of the form
+    then sends only what the form changed from the template, see
+    :func:`d_rats.form_codec.encode_form`.  Otherwise the form is sent
+    as XML.
+
     :param name: Name of session
     :type name: str
     :param status_cb: Status call back, default=None
@@ -41,3 +64,127 @@ class FormTransferSession(sessions_file.FileTransferSession):
     def __init__(self, name, status_cb=None, **kwargs):
         sessions_file.FileTransferSession.__init__(self, name, **kwargs)
         self.logger = logging.getLogger("FormTransferSession")
+        self._form_filename = None
+
+    # The base class reads the file in a static method
+    # pylint: disable=arguments-differ
+    def get_file_data(self, filename):
+        '''
+        Get form data and compress it.
+
+        Attachments kept in the attachment store are inlined into the
+        form as it is compressed, without building the inlined form.
+
+        :param filename: Filename of the form
+        :type filename: str
+        :returns: Compressed data, or None if the form can not be read
+        :rtype: bytes
+        '''
+        self._form_filename = filename
+        compressor = zlib.compressobj(9)
+        try:
+            zdata = [compressor.compress(piece)
+                     for piece in inline_file(filename)]
+        except (etree.XMLSyntaxError, AttachmentStoreError, OSError) as err:
+            self.logger.info("get_file_data: Unable to send %s: %s",
+                             filename, err)
+            return None
+        zdata.append(compressor.flush())
+        return b"".join(zdata)
+
+    def offer_reply(self):
+        '''
+        Reply accepting a form, with the templates this station has.
+
+        :returns: Reply to the offer
+        :rtype: bytes
+        '''
+        keys = FormRegistry.get_registry().keys()
+        if not keys:
+            return b"OK"
+        return b"RESUME:0;" + TEMPLATE_OPTION + \
+            b",".join(key.hex().encode("ascii") for key in keys)
+
+    def select_data(self, options, data):
+        '''
+        Send the form as a template diff if the receiver has the template.
+
+        :param options: Options from the receiver
+        :type options: bytes
+        :param data: Compressed form XML
+        :type data: bytes
+        :returns: Data to send
+        :rtype: bytes
+        '''
+        accept = set()
+        for option in options.split(b";"):
+            if option.startswith(TEMPLATE_OPTION):
+                for key in option[len(TEMPLATE_OPTION):].split(b","):
+                    try:
+                        accept.add(bytes.fromhex(key.decode("ascii")))
+                    except (UnicodeDecodeError, ValueError):
+                        pass
+        if not accept or not self._form_filename:
+            return data
+        try:
+            xml = b"".join(inline_file(self._form_filename))
+        except (etree.XMLSyntaxError, AttachmentStoreError, OSError) as err:
+            self.logger.info("select_data: %s", err)
+            return data
+        encoded = encode_form(xml, FormRegistry.get_registry(), accept)
+        if encoded is None:
+            return data
+        zdata = zlib.compress(encoded, 9)
+        if len(zdata) >= len(data):
+            return data
+        self.logger.info("select_data: Sending %s as template diff, "
+                         "%i bytes instead of %i", self._form_filename,
+                         len(zdata), len(data))
+        return zdata
+
+    # The base class writes the file in a static method
+    # pylint: disable=arguments-differ
+    def put_file_data(self, filename, zdata):
+        '''
+        Write a received form, rebuilding it from the template if needed.
+
+        :param filename: Filename to write
+        :type filename: str
+        :param zdata: Compressed data
+        :type zdata: bytes
+        :raises: :class:`zlib.error` if the form can not be written
+        '''
+        data = zlib.decompress(zdata)
+        if data.startswith(MAGIC):
+            try:
+                data = decode_form(data, FormRegistry.get_registry())
+            except FormCodecError as err:
+                self.logger.info("put_file_data: %s", err)
+                raise zlib.error(str(err)) from err
+            # The offer had the size of the form as XML
+            self.stats["total_size"] = len(zdata)
+        with open(filename, "wb") as file_handle:
+            file_handle.write(data)
+
+    def put_file_partial_data(self, filename, data):
+        '''
+        Keep the data of an incomplete transfer for resuming.
+
+        A partial template diff is dropped, a resumed transfer is sent
+        as XML.
+
+        :param filename: Filename to write
+        :type filename: str
+        :param data: Data received
+        :type data: bytes
+        '''
+        try:
+            start = zlib.decompressobj().decompress(data, len(MAGIC))
+        except zlib.error:
+            start = b""
+        if start == MAGIC:
+            self.logger.info("put_file_partial_data: "
+                             "Dropping partial template diff")
+            return
+        sessions_file.FileTransferSession.put_file_partial_data(filename,
+                                                                data)
@@ -0,0 +1,3 @@
+'''Setup Version.'''
+# This file generated by version.py
+SETUP_VERSION = "0.4.1.dev0"
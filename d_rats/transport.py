@@ -111,11 +111,11 @@ class BlockQueue():
         '''
         Peek All.
 
-        :returns: queue of locks
+        :returns: Copy of the queue of locks
         :rtype: list[:class:`DDT2Frame`]
         '''
         self._lock.acquire()
-        queue = self._queue
+        queue = list(self._queue)
         self._lock.release()
 
         return queue
@@ -130,9 +130,135 @@ class BlockQueue():
         '''Unlock.'''
         self._lock.release()
 
+
+class BlockParser():
+    '''
+    Block Parser.
+
+    Extracts DDT2 frames and raw GPS sentences from a received byte
+    stream.  Subclasses supply the data through :attr:`inbuf` and
+    receive the results through :meth:`_handle_frame`.
+
+    :param compat: Compatibility mode?, default False
+    :type compat: bool
+    :param dup_cache: Cache for dropping duplicate blocks, default None
+    :type dup_cache: :class:`DuplicateCache`
+    '''
+
+    def __init__(self, compat=False, dup_cache=None):
+        self.logger = logging.getLogger("BlockParser")
+        self.inbuf = b''
+        self.compat = compat
+        self.dup_cache = dup_cache
+
+    def _handle_frame(self, frame):
+        '''
+        Handle a parsed frame.
+
+        :param frame: Frame that was parsed
+        :type frame: :class:`DDT2Frame`
+        '''
+        raise NotImplementedError
+
+    def parse_blocks(self):
+        '''Parse Blocks.'''
+        # start processing data from the packet arrived
+        while ddt2.ENCODED_HEADER in self.inbuf and \
+                ddt2.ENCODED_TRAILER in self.inbuf:
+            start = self.inbuf.index(ddt2.ENCODED_HEADER)
+            end = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
+                  len(ddt2.ENCODED_TRAILER)
+
+            if end < start:
+                # Excise the extraneous end
+                _tmp = self.inbuf[:end - len(ddt2.ENCODED_TRAILER)] + \
+                    self.inbuf[end:]
+                self.inbuf = _tmp
+                continue
+
+            block = self.inbuf[start:end]
+            self.inbuf = self.inbuf[end:]
+
+            if self.dup_cache is not None and \
+                    self.dup_cache.seen_block(block):
+                self.logger.debug("parse_blocks: %s Dropped a duplicate block",
+                                  self)
+                continue
+
+            frame = ddt2.DDT2EncodedFrame()
+            try:
+                if frame.unpack(block):
+                    self.logger.debug("parse_blocks: %s Got a block: %s",
+                                      self, frame)
+                    self._handle_frame(frame)
+                elif self.compat:
+                    self._send_text_block(block)
+                else:
+                    self.logger.info("parse_blocks: %s Found a broken block "
+                                     "(S:%i E:%i len(buf):%i",
+                                     self, start, end, len(self.inbuf))
+                    utils.hexprintlog(block)
+            except DataPathError:
+                self.logger.info("parse_blocks: %s Failed to process block",
+                                 self, exc_info=True)
+
+    def _match_gps(self):
+        # NMEA-style
+        # Starts with $GP**[a-f0-9]{2}\r?\n?
+        inbuf_str = self.inbuf.decode('utf-8', 'replace')
+        match = re.search(
+            r"((?:\$GP[^\*]+\*[A-f0-9]{2}\r?\n?){1,2}.{8},.{20})",
+            inbuf_str)
+        if match:
+            return bytearray(match.group(1), 'utf-8', 'replace')
+
+        # GPS-A style
+        # Starts with $$CRC[A-Z0-9]{4},\r
+        match = re.search(r"(\$\$CRC[A-z0-9]{4},[^\r]*\r)", inbuf_str)
+        if match:
+            return bytearray(match.group(1), 'utf-8', 'replace')
+        if u"$$CRC" in inbuf_str:
+            self.logger.info("_match_gps: %s Didn't match:\n%s",
+                             self, repr(self.inbuf))
+        return None
+
+    def _send_text_block(self, string):
+        frame = ddt2.DDT2RawData()
+        frame.seq = 0
+        frame.session = 1 # Chat (for now)
+        frame.s_station = "CQCQCQ"
+        frame.d_station = "CQCQCQ"
+        if isinstance(string, str):
+            self.logger.info("_send_text_block: %s Called with str data!",
+                             self)
+            ascii_data = utils.filter_to_ascii(string)
+        else:
+            ascii_data = utils.filter_to_ascii_bytes(string)
+        frame.data = ascii_data
+
+        self._handle_frame(frame)
+
+    def _parse_gps(self):
+        result = self._match_gps()
+        if result:
+            new_inbuf = self.inbuf.replace(result, b"")
+            if isinstance(new_inbuf, str):
+                self.inbuf = bytearray(new_inbuf, 'utf-8', 'replace')
+            else:
+                self.inbuf = new_inbuf
+            self.logger.info("_parse_gps: %s Found GPS string: %s",
+                             self, repr(result))
+            self._send_text_block(result)
+
+    def parse_gps(self):
+        '''Parse GPS.'''
+        while self._match_gps():
+            self._parse_gps()
+
+
 # pylint wants a max of 7 instance attributes
 # pylint: disable=too-many-instance-attributes
-class Transporter():
+class Transporter(BlockParser):
     '''
     Transporter.
 
@@ -153,18 +279,20 @@ class Transporter():
     :type force_delay: float
     :param compat_delay: Compatibility delay in seconds, default 5
     :type compat_delay: float
+    :param dup_cache: Cache for dropping duplicate blocks, default None
+    :type dup_cache: :class:`DuplicateCache`
     '''
 
     def __init__(self, pipe, inhandler=None, authfn=None, **kwargs):
+        BlockParser.__init__(self, kwargs.get("compat", False),
+                             kwargs.get("dup_cache", None))
         self.logger = logging.getLogger("Transporter")
         self.inq = BlockQueue()
         self.outq = BlockQueue()
         self.pipe = pipe
-        self.inbuf = b''
         self.enabled = True
         self.was_connected = False
         self.inhandler = inhandler
-        self.compat = kwargs.get("compat", False)
         self.warmup_length = kwargs.get("warmup_length", 8)
         self.warmup_timeout = kwargs.get("warmup_timeout", 3)
         self.force_delay = kwargs.get("force_delay", 0)
@@ -243,95 +371,6 @@ class Transporter():
         else:
             self.inq.enqueue(frame)
 
-    def parse_blocks(self):
-        '''Parse Blocks.'''
-        # start processing data from the packet arrived
-        while ddt2.ENCODED_HEADER in self.inbuf and \
-                ddt2.ENCODED_TRAILER in self.inbuf:
-            start = self.inbuf.index(ddt2.ENCODED_HEADER)
-            end = self.inbuf.index(ddt2.ENCODED_TRAILER) + \
-                  len(ddt2.ENCODED_TRAILER)
-
-            if end < start:
-                # Excise the extraneous end
-                _tmp = self.inbuf[:end - len(ddt2.ENCODED_TRAILER)] + \
-                    self.inbuf[end:]
-                self.inbuf = _tmp
-                continue
-
-            block = self.inbuf[start:end]
-            self.inbuf = self.inbuf[end:]
-
-            frame = ddt2.DDT2EncodedFrame()
-            try:
-                if frame.unpack(block):
-                    self.logger.debug("parse_blocks: %s Got a block: %s",
-                                      self.pipe, frame)
-                    self._handle_frame(frame)
-                elif self.compat:
-                    self._send_text_block(block)
-                else:
-                    self.logger.info("parse_blocks: %s Found a broken block "
-                                     "(S:%i E:%i len(buf):%i",
-                                     self.pipe, start, end, len(self.inbuf))
-                    utils.hexprintlog(block)
-            except DataPathError:
-                self.logger.info("parse_blocks: %s Failed to process block",
-                                 self.pipe, exc_info=True)
-
-    def _match_gps(self):
-        # NMEA-style
-        # Starts with $GP**[a-f0-9]{2}\r?\n?
-        inbuf_str = self.inbuf.decode('utf-8', 'replace')
-        match = re.search(
-            r"((?:\$GP[^\*]+\*[A-f0-9]{2}\r?\n?){1,2}.{8},.{20})",
-            inbuf_str)
-        if match:
-            return bytearray(match.group(1), 'utf-8', 'replace')
-
-        # GPS-A style
-        # Starts with $$CRC[A-Z0-9]{4},\r
-        match = re.search(r"(\$\$CRC[A-z0-9]{4},[^\r]*\r)", inbuf_str)
-        if match:
-            return bytearray(match.group(1), 'utf-8', 'replace')
-        if u"$$CRC" in inbuf_str:
-            self.logger.info("_match_gps: %s Didn't match:\n%s",
-                             self.pipe, repr(self.inbuf))
-        return None
-
-    def _send_text_block(self, string):
-        frame = ddt2.DDT2RawData()
-        frame.seq = 0
-        frame.session = 1 # Chat (for now)
-        frame.s_station = "CQCQCQ"
-        frame.d_station = "CQCQCQ"
-        if isinstance(string, str):
-            self.logger.info("_send_text_block: %s Called with str data!",
-                             self.pipe)
-            ascii_data = utils.filter_to_ascii(string)
-        else:
-            ascii_data = utils.filter_to_ascii_bytes(string)
-        frame.data = ascii_data
-
-        self._handle_frame(frame)
-
-    def _parse_gps(self):
-        result = self._match_gps()
-        if result:
-            new_inbuf = self.inbuf.replace(result, b"")
-            if isinstance(new_inbuf, str):
-                self.inbuf = bytearray(new_inbuf, 'utf-8', 'replace')
-            else:
-                self.inbuf = new_inbuf
-            self.logger.info("_parse_gps: %s Found GPS string: %s",
-                             self.pipe, repr(result))
-            self._send_text_block(result)
-
-    def parse_gps(self):
-        '''Parse GPS.'''
-        while self._match_gps():
-            self._parse_gps()
-
     def send_frames(self):
         '''Send Frames.'''
         delayed = False
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 '''Main Chat'''
-# pylint wants 1000 lines/per module, this has over 1280
+# pylint wants 1000 lines/per module, this has over 1400
 # pylint: disable=too-many-lines
 #
 # Copyright 2009 Dan Smith <dsmith@danplanet.com>
@@ -41,6 +41,7 @@ from d_rats.ui.main_common import MainWindowElement, MainWindowTab
 from d_rats.ui.main_common import ask_for_confirmation, display_error, \
     set_toolbar_buttons
 from d_rats.menu_helpers import add_menu_accel_theme_image
+from d_rats.chat_log import ChatLog
 from d_rats import inputdialog, utils
 from d_rats import qst
 from d_rats import signals
@@ -56,14 +57,33 @@ class LoggedTextBuffer(Gtk.TextBuffer):
     '''
     Logged Text Buffer.
 
+    The text is written to the chat log by the chat log writer thread,
+    and only the newest scrollback lines are kept in the buffer.
+
     :param logfile: Logfile name
     :type logfile: str
+    :param config: Configuration object, default None
+    :type config: :class:`DratsConfig`
     '''
 
-    def __init__(self, logfile):
+    def __init__(self, logfile, config=None):
         Gtk.TextBuffer.__init__(self)
-        # pylint: disable=unspecified-encoding, consider-using-with
-        self.__logfile = open(logfile, "a+", 1)
+        self.__log = None
+        self.__logfile = logfile
+        self.__scrollback = 0
+        if not config:
+            self.__log = ChatLog(logfile)
+            return
+        self.__scrollback = config.getint("prefs", "scrollback")
+        log = ChatLog(logfile, config.get("prefs", "logrotate"),
+                      config.getint("prefs", "logsize") << 10)
+        if config.getboolean("prefs", "logenabled"):
+            self.__log = log
+        if config.getboolean("prefs", "logresume") and self.__scrollback:
+            lines = log.history().older(self.__scrollback)
+            if lines:
+                Gtk.TextBuffer.insert(self, self.get_end_iter(),
+                                      os.linesep.join(lines) + os.linesep)
 
     def get_logfile(self):
         '''
@@ -72,7 +92,27 @@ class LoggedTextBuffer(Gtk.TextBuffer):
         :returns: Logfile name
         :rtype: str
         '''
-        return self.__logfile.name
+        if self.__log:
+            self.__log.flush()
+        return self.__logfile
+
+    def get_log(self):
+        '''
+        Get the chat log.
+
+        :returns: Chat log, or None if logging is not enabled
+        :rtype: :class:`ChatLog`
+        '''
+        return self.__log
+
+    def _trim(self):
+        '''Remove the lines older than the scrollback.'''
+        # Trim in steps, so that lines are not removed one at a time.
+        lines = self.get_line_count() - 1
+        if self.__scrollback and \
+                lines > self.__scrollback + max(16, self.__scrollback >> 3):
+            self.delete(self.get_start_iter(),
+                        self.get_iter_at_line(lines - self.__scrollback))
 
     # This matches the documented arguments of the super class.
     # pylint: disable=arguments-differ
@@ -88,7 +128,81 @@ class LoggedTextBuffer(Gtk.TextBuffer):
         :type tags: str
         '''
         Gtk.TextBuffer.insert_with_tags_by_name(self, log_iter, text, *tags)
-        self.__logfile.write(text)
+        if self.__log:
+            self.__log.write(text)
+        self._trim()
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class ChatHistoryDialog(Gtk.Dialog):
+    '''
+    Chat History Dialog.
+
+    Shows the older lines of a chat log, a page at a time, read from
+    the log and the rotated logs.
+
+    :param log: Chat log
+    :type log: :class:`ChatLog`
+    :param title: Title for dialog
+    :type title: str
+    :param parent: Parent widget, default None
+    :type parent: :class:`Gtk.Window`
+    '''
+
+    PAGE_LINES = 500
+
+    def __init__(self, log, title, parent=None):
+        Gtk.Dialog.__init__(self, parent=parent)
+        self.set_title(title)
+        self.set_default_size(600, 400)
+        self.__history = log.history()
+
+        self.__older = self.add_button(_("Older"), Gtk.ResponseType.APPLY)
+        self.add_button(_("Close"), Gtk.ResponseType.CLOSE)
+        self.connect("response", self._response)
+
+        self.__view = Gtk.TextView()
+        self.__view.set_wrap_mode(Gtk.WrapMode.CHAR)
+        self.__view.set_editable(False)
+        self.__view.set_cursor_visible(False)
+        scroll_window = Gtk.ScrolledWindow()
+        scroll_window.set_policy(Gtk.PolicyType.AUTOMATIC,
+                                 Gtk.PolicyType.AUTOMATIC)
+        scroll_window.add(self.__view)
+        self.vbox.pack_start(scroll_window, 1, 1, 0)
+        self.__view.show()
+        scroll_window.show()
+
+        self.load_older()
+        end = self.__view.get_buffer().get_end_iter()
+        self.__view.scroll_to_iter(end, 0.0, True, 0, 1)
+
+    def load_older(self):
+        '''Add the next page of older lines at the top.'''
+        lines = self.__history.older(self.PAGE_LINES)
+        if len(lines) < self.PAGE_LINES:
+            self.__older.set_sensitive(False)
+        if lines:
+            buffer = self.__view.get_buffer()
+            buffer.insert(buffer.get_start_iter(),
+                          os.linesep.join(lines) + os.linesep)
+
+    def _response(self, _dialog, response):
+        '''
+        Response Handler.
+
+        :param _dialog: Dialog, unused
+        :type _dialog: :class:`ChatHistoryDialog`
+        :param response: Response
+        :type response: :class:`Gtk.ResponseType`
+        '''
+        if response == Gtk.ResponseType.APPLY:
+            self.load_older()
+            self.__view.scroll_to_iter(
+                self.__view.get_buffer().get_start_iter(), 0.0, True, 0, 0)
+        else:
+            self.destroy()
 
 
 class ChatQM(MainWindowElement):
@@ -553,6 +667,9 @@ class ChatTab(MainWindowTab):
         vlog = self._wtree.get_object("main_menu_viewlog")
         vlog.connect("activate", self._view_log)
 
+        history = self._wtree.get_object("main_menu_history")
+        history.connect("activate", self._view_history)
+
         send.connect("clicked", self._send_button, dest, entry)
         send.set_can_default(True)
         #send.set_flags(Gtk.CAN_DEFAULT)
@@ -988,6 +1105,25 @@ class ChatTab(MainWindowTab):
         file_name = display.get_buffer().get_logfile()
         self._config.platform.open_text_file(file_name)
 
+    def _view_history(self, _button):
+        '''
+        View Older History Button Handler.
+
+        :param _button: Button activated, unused
+        :type _button: :class:`Gtk.MenuItem`
+        '''
+        display = self._display_selected()
+        log = display.get_buffer().get_log()
+        if not log:
+            display_error(_("Chat logging is not enabled"))
+            return
+        page = self.__filtertabs.get_current_page()
+        text = self.__filtertabs.get_tab_label(
+            self.__filtertabs.get_nth_page(page)).get_text()
+        dialog = ChatHistoryDialog(log, _("Chat history: %s") % text,
+                                   parent=self._wtree.get_object("mainwindow"))
+        dialog.show()
+
     def _enter_to_send(self, view, event, dest):
         '''
         Enter Key to Send handler.
@@ -1196,7 +1332,7 @@ class ChatTab(MainWindowTab):
         else:
             ffn = "Main"
         file_name = self._config.platform.log_file(ffn)
-        buffer = LoggedTextBuffer(file_name)
+        buffer = LoggedTextBuffer(file_name, self._config)
         buffer.create_mark("end", buffer.get_end_iter(), False)
 
         display = Gtk.TextView.new_with_buffer(buffer)
@@ -1293,7 +1429,7 @@ class ChatTab(MainWindowTab):
 
         make_visible = ["main_menu_bcast", "main_menu_clear",
                         "main_menu_addfilter", "main_menu_delfilter",
-                        "main_menu_viewlog"]
+                        "main_menu_viewlog", "main_menu_history"]
 
         for name in make_visible:
             item = self._wtree.get_object(name)
@@ -1308,7 +1444,7 @@ class ChatTab(MainWindowTab):
 
         make_invisible = ["main_menu_bcast", "main_menu_clear",
                           "main_menu_addfilter", "main_menu_delfilter",
-                          "main_menu_viewlog"]
+                          "main_menu_viewlog", "main_menu_history"]
 
         for name in make_invisible:
             item = self._wtree.get_object(name)
@@ -27,11 +27,14 @@ import random
 
 from glob import glob
 
+from lxml import etree
+
 # Some packages not available to Visual Studio Code Python
 # Need an ignore for pylance.
 import gi  # type: ignore
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk  # type: ignore
+from gi.repository import GLib  # type: ignore
 
 from d_rats.ui.main_common import MainWindowTab
 from d_rats.ui.main_common import prompt_for_station
@@ -45,6 +48,10 @@ from d_rats import inputdialog
 from d_rats import formgui
 from d_rats import signals
 from d_rats import msgrouting
+from d_rats.attachment_store import AttachmentStoreError
+from d_rats.attachment_store import externalize_file
+from d_rats.attachment_store import inline_file
+from d_rats.message_search import get_search_index
 
 
 if not '_' in locals():
@@ -91,6 +98,8 @@ class MessagesTab(MainWindowTab):
 
     def __init__(self, wtree, config, window):
         MainWindowTab.__init__(self, wtree, config, window=window, prefix="msg")
+        self._search_index = get_search_index(config)
+        self._search_shown = False
         self._init_toolbar()
         self.folders = MessageFolders(wtree, config, window)
         self._messages = MessageList(wtree, config)
@@ -99,7 +108,7 @@ class MessagesTab(MainWindowTab):
         self._messages.connect("delete-form", self._del_msg)
 
         self.folders.connect("user-selected-folder",
-                             lambda x, y: self._messages.open_folder(y))
+                             lambda x, y: self._open_folder(y))
         self.folders.select_folder(_("Inbox"))
 
         iport = self._wtree.get_object("main_menu_importmsg")
@@ -108,6 +117,61 @@ class MessagesTab(MainWindowTab):
         eport = self._wtree.get_object("main_menu_exportmsg")
         eport.connect("activate", self._exportmsg)
 
+        # Bring the search index up to date in the background.
+        self._search_index.start()
+
+    def _open_folder(self, folder):
+        '''
+        Open a folder, leaving the search results.
+
+        :param folder: Folder name
+        :type folder: str
+        '''
+        self._search_shown = False
+        self._search.set_text("")
+        self._messages.open_folder(folder)
+
+    def _search_changed(self, entry):
+        '''
+        Search Entry search-changed handler.
+
+        :param entry: Search entry
+        :type entry: :class:`Gtk.SearchEntry`
+        '''
+        text = entry.get_text().strip()
+        if text:
+            self._search_index.search_async(
+                text,
+                lambda text, results: GLib.idle_add(self._show_results,
+                                                    text, results))
+        elif self._search_shown:
+            self._search_shown = False
+            self._messages.refresh()
+
+    def _show_results(self, text, results):
+        '''
+        Show search results from the index worker in the message list.
+
+        :param text: Text that was searched for
+        :type text: str
+        :param results: Search results
+        :type results: list[:class:`d_rats.message_search.SearchResult`]
+        :returns: False to run only once
+        :rtype: bool
+        '''
+        if text != self._search.get_text().strip():
+            return False # The search text changed since
+        self._search_shown = True
+        self._messages.show_results(results)
+        return False
+
+    def _refresh_messages(self):
+        '''Refresh the message list, or the search results shown in it.'''
+        if self._search_shown:
+            self._search_changed(self._search)
+        else:
+            self._messages.refresh()
+
     def _new_msg(self, _button, msg_type=None):
         '''
         New Message clicked handler.
@@ -306,7 +370,7 @@ class MessagesTab(MainWindowTab):
                 return
 
             file_name = sel[0]
-        recip = self._messages.current_info.get_msg_recip(file_name)
+        recip = self._messages.info_for(file_name).get_msg_recip(file_name)
 
         if not msgrouting.msg_lock(file_name):
             display_error(_("Unable to send: message in use by another task"))
@@ -347,9 +411,9 @@ class MessagesTab(MainWindowTab):
             return
 
         for file_name in sel:
-            self._messages.current_info.set_msg_read(file_name, read)
+            self._messages.info_for(file_name).set_msg_read(file_name, read)
 
-        self._messages.refresh()
+        self._refresh_messages()
 
     def _importmsg(self, _button):
         '''
@@ -368,6 +432,11 @@ class MessagesTab(MainWindowTab):
                            time.strftime("form_%m%d%Y_%H%M%S.xml"))
 
         shutil.copy(file_name, dst)
+        try:
+            externalize_file(dst)
+        except etree.XMLSyntaxError as err:
+            self.logger.info("_importmsg: %s is not a valid form: %s",
+                             file_name, err)
         self.refresh_if_folder(_("Inbox"))
 
     def _exportmsg(self, _button):
@@ -395,7 +464,13 @@ class MessagesTab(MainWindowTab):
         if not nfn:
             return
 
-        shutil.copy(file_name, nfn)
+        # Exported forms carry their attachments.
+        try:
+            with open(nfn, "wb") as handle:
+                for piece in inline_file(file_name):
+                    handle.write(piece)
+        except (AttachmentStoreError, etree.XMLSyntaxError, OSError) as err:
+            display_error(_("Unable to export message: %s") % err)
 
     def _sndrcv(self, _button, account=""):
         '''
@@ -521,6 +596,18 @@ class MessagesTab(MainWindowTab):
             toolbar.insert(item, count)
             count += 1
 
+        self._search = Gtk.SearchEntry()
+        self._search.set_placeholder_text(_("Search messages"))
+        self._search.set_tooltip_text(
+            _("Search the subject, sender, recipient, text and "
+              "attachment names of the messages in all folders"))
+        self._search.connect("search-changed", self._search_changed)
+        self._search.show()
+        item = Gtk.ToolItem()
+        item.add(self._search)
+        item.show()
+        toolbar.insert(item, count)
+
     def refresh_if_folder(self, folder):
         '''
         Refresh if folder is current.
@@ -529,7 +616,9 @@ class MessagesTab(MainWindowTab):
         :type folder: str
         '''
         self._notice()
-        if self._messages.current_info.name() == folder:
+        if self._search_shown:
+            self._refresh_messages()
+        elif self._messages.current_info.name() == folder:
             self._messages.refresh()
 
     def message_sent(self, file_name):
@@ -21,10 +21,12 @@ import logging
 import os
 
 from glob import glob
-from configparser import ConfigParser
 from configparser import DuplicateSectionError
-from configparser import NoOptionError
-from configparser import NoSectionError
+
+from d_rats.message_lock import LOCK_FILE
+from d_rats.message_lock import MESSAGE_LOCKS
+from d_rats.message_store import LEGACY_DB
+from d_rats.message_store import MessageStore
 
 
 if not '_' in locals():
@@ -32,46 +34,26 @@ if not '_' in locals():
     _ = gettext.gettext
 
 
+# pylint wants a max of 20 public methods
+# pylint: disable=too-many-public-methods
 class MessageFolderInfo():
     '''
     Message Folder Info.
 
+    The information about the messages is kept in the
+    :class:`MessageStore`.
+
     :param folder_path: Folder to operate on
     :type folder_path: str
+    :param store: Message store, default the shared store
+    :type store: :class:`MessageStore`
     '''
-    _folder_cache = {}
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, store=None):
         self._path = folder_path
 
         self.logger = logging.getLogger("MessageFolderInfo")
-        if folder_path in self._folder_cache:
-            self._database = self._folder_cache[folder_path]
-        else:
-            self._database = ConfigParser()
-            reg_path = os.path.join(self._path, ".db")
-            if os.path.exists(reg_path):
-                self._database.read(reg_path)
-            self._save()
-            self._folder_cache[folder_path] = self._database
-
-    @classmethod
-    def _set_folder_cache(cls, path, database):
-        '''
-        Set Folder Cache.
-
-        :param path: Path to folder
-        :type path: str
-        :param database: Database for folder
-        :type database: :class:`ConfigParser`
-        '''
-        cls._folder_cache[path] = database
-
-    def _save(self):
-        reg_path = os.path.join(self._path, ".db")
-        file_handle = open(reg_path, "w")
-        self._database.write(file_handle)
-        file_handle.close()
+        self._store = store or MessageStore.get_store()
 
     def name(self):
         '''
@@ -82,22 +64,84 @@ class MessageFolderInfo():
         '''
         return os.path.basename(self._path)
 
-    def _set_prop(self, filename, prop, value):
-        filename = os.path.basename(filename)
+    def folder_path(self):
+        '''
+        Folder Path.
 
-        if not self._database.has_section(filename):
-            self._database.add_section(filename)
+        :returns: Directory of the folder
+        :rtype: str
+        '''
+        return self._path
 
-        self._database.set(filename, prop, value)
-        self._save()
+    def _set_prop(self, filename, prop, value):
+        self._store.set_headers(self._path, filename, **{prop: value})
 
     def _get_prop(self, filename, prop):
-        filename = os.path.basename(filename)
+        info = self._store.get_info(self._path, filename)
+        value = getattr(info, prop, None)
+        if value is None:
+            return _("Unknown")
+        return value
 
+    def batch(self):
+        '''
+        Batch changes to the folder into one commit.
+
+        :returns: Context manager for the batch
+        :rtype: :class:`contextlib.AbstractContextManager`
+        '''
+        return self._store.transaction()
+
+    def get_msg(self, filename):
+        '''
+        Get what is known about a message.
+
+        :param filename: Filename for message
+        :type filename: str
+        :returns: Message information, or None if not known
+        :rtype: :class:`MessageInfo`
+        '''
+        return self._store.get_info(self._path, filename)
+
+    def messages(self):
+        '''
+        Get what is known about the messages in the folder.
+
+        :returns: Messages known to the message store
+        :rtype: list[:class:`MessageInfo`]
+        '''
+        return self._store.messages(self._path)
+
+    # pylint wants a max of 5 arguments
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def set_msg_info(self, filename, msg_type, subject, sender, recip,
+                     path_dst=None):
+        '''
+        Set the header fields of a message at once.
+
+        The modification time of the message is recorded with them.
+
+        :param filename: Filename for message
+        :type filename: str
+        :param msg_type: Type of message
+        :type msg_type: str
+        :param subject: Subject for message
+        :type subject: str
+        :param sender: Sender of message
+        :type sender: str
+        :param recip: Recipient
+        :type recip: str
+        :param path_dst: Destination station of the message, default None
+        :type path_dst: str
+        '''
         try:
-            return self._database.get(filename, prop)
-        except (NoOptionError, NoSectionError):
-            return _("Unknown")
+            stamp = os.stat(os.path.join(self._path,
+                                         os.path.basename(filename))).st_mtime
+        except OSError:
+            stamp = None
+        self._store.set_headers(self._path, filename, stamp=stamp,
+                                msg_type=msg_type, subject=subject,
+                                sender=sender, recip=recip, path_dst=path_dst)
 
     def get_msg_subject(self, filename):
         '''
@@ -130,7 +174,7 @@ class MessageFolderInfo():
         :returns: Message Type
         :rtype: str
         '''
-        return self._get_prop(filename, "type")
+        return self._get_prop(filename, "msg_type")
 
     def set_msg_type(self, filename, msg_type):
         '''
@@ -141,7 +185,7 @@ class MessageFolderInfo():
         :param msg_type: Type of message
         :type msg_type: str
         '''
-        self._set_prop(filename, "type", msg_type)
+        self._set_prop(filename, "msg_type", msg_type)
 
     def get_msg_read(self, filename):
         '''
@@ -152,8 +196,8 @@ class MessageFolderInfo():
         :returns: True if message has been read
         :rtype: bool
         '''
-        val = self._get_prop(filename, "read")
-        return val == "True"
+        info = self._store.get_info(self._path, filename)
+        return bool(info and info.read)
 
     def set_msg_read(self, filename, read):
         '''
@@ -164,7 +208,7 @@ class MessageFolderInfo():
         :param read: True for message to be marked read
         :type read: bool
         '''
-        self._set_prop(filename, "read", str(read))
+        self._store.set_read(self._path, filename, read)
 
     def get_msg_sender(self, filename):
         '''
@@ -224,7 +268,7 @@ class MessageFolderInfo():
             if entry in (".", ".."):
                 continue
             if os.path.isdir(entry):
-                info.append(MessageFolderInfo(entry))
+                info.append(MessageFolderInfo(entry, self._store))
 
         return info
 
@@ -235,9 +279,9 @@ class MessageFolderInfo():
         :returns: files in the folder.
         :rtype: list[str]
         '''
-        file_list = glob(os.path.join(self._path, "*"))
-        return [x_file for x_file in file_list
-                if os.path.isfile(x_file) and not x_file.startswith(".")]
+        with os.scandir(self._path) as entries:
+            return [entry.path for entry in entries
+                    if entry.is_file() and not entry.name.startswith(".")]
 
     def get_subfolder(self, name):
         '''
@@ -269,37 +313,51 @@ class MessageFolderInfo():
         except OSError as err:
             if err.errno != 17:  # File or directory exists
                 raise
-        return MessageFolderInfo(path)
+        return MessageFolderInfo(path, self._store)
 
     def delete_self(self):
         '''Delete Self.'''
         try:
-            os.remove(os.path.join(self._path, ".db"))
+            os.remove(os.path.join(self._path, LEGACY_DB))
         except OSError:
             pass # Don't freak if no .db
+        self._store.delete_folder(self._path)
+        MESSAGE_LOCKS.close_folder(self._path)
+        try:
+            os.remove(os.path.join(self._path, LOCK_FILE))
+        except OSError:
+            pass # No message of the folder was ever locked
         os.rmdir(self._path)
 
     def create_msg(self, name):
         '''
         Create a message.
 
-        Store the message name in the users configuration data
+        Add the message name to the message store
 
         :param name: Name for message path
         :type name: str
         :returns: Path for message
         :rtype: str
-        :raises: DuplicateSectionError if the section already exists
+        :raises: DuplicateSectionError if the message already exists
         '''
         exists = os.path.exists(os.path.join(self._path, name))
-        try:
-            self._database.add_section(name)
-        except DuplicateSectionError as err:
-            if exists:
-                raise err
+        if not self._store.add_message(self._path, name) and exists:
+            raise DuplicateSectionError(name)
 
         return os.path.join(self._path, name)
 
+    def move_msg_info(self, filename, dest):
+        '''
+        Move what is known about a message to another folder.
+
+        :param filename: Filename for message
+        :type filename: str
+        :param dest: Folder the message is moved to
+        :type dest: :class:`MessageFolderInfo`
+        '''
+        self._store.move_message(self._path, dest.folder_path(), filename)
+
     def delete(self, filename):
         '''
         Delete a file.
@@ -308,7 +366,7 @@ class MessageFolderInfo():
         :type filename: str
         '''
         filename = os.path.basename(filename)
-        self._database.remove_section(filename)
+        self._store.delete_message(self._path, filename)
         os.remove(os.path.join(self._path, filename))
 
     def rename(self, new_name):
@@ -321,6 +379,7 @@ class MessageFolderInfo():
         new_path = os.path.join(os.path.dirname(self._path), new_name)
         self.logger.info("Renaming %s -> %s", self._path, new_path)
         os.rename(self._path, new_path)
+        self._store.rename_folder(self._path, new_path)
         self._path = new_path
 
     def __str__(self):
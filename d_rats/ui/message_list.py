@@ -38,9 +38,13 @@ from gi.repository import Pango
 from d_rats.ui.main_common import MainWindowElement
 from d_rats.ui.main_common import display_error
 from d_rats.ui.message_folder_info import MessageFolderInfo
+from d_rats.ui.message_list_loader import MessageListLoader
+from d_rats.ui.message_list_loader import MessageRow
 
 from d_rats import formgui
 from d_rats import msgrouting
+from d_rats.form_header import FORM_HEADERS
+from d_rats.message_search import get_search_index
 
 
 if not '_' in locals():
@@ -213,6 +217,10 @@ class MessageList(MainWindowElement):
         self.message_pixbuf = self._config.ship_img("message.png")
         self.unread_pixbuf = self._config.ship_img("msg-markunread.png")
         self.current_info = None
+        # ListStore iters stay valid until the row is removed
+        self._iters = {}
+        self._loader = MessageListLoader(self._post_rows)
+        self._search_index = get_search_index(self._config)
 
     def _folder_path(self, folder):
         path = os.path.join(self._config.platform.config_dir(),
@@ -270,6 +278,8 @@ class MessageList(MainWindowElement):
             if response in saveable_actions:
                 self.logger.debug("open_msg: Saving to %s", filename)
                 dlg.save_to(filename)
+                self._search_index.update_file(filename)
+                msgrouting.outbox_changed(self._config, filename)
             else:
                 self.logger.debug("open_msg : Not saving")
             dlg.destroy()
@@ -288,7 +298,7 @@ class MessageList(MainWindowElement):
 
         form.build_gui(editable)
         form.show()
-        msg_info = MessageInfo(filename, self.current_info)
+        msg_info = MessageInfo(filename, self.info_for(filename))
         form.connect("response", form_done, msg_info)
         return Gtk.ResponseType.OK
 
@@ -319,7 +329,7 @@ class MessageList(MainWindowElement):
 
         editable = "Outbox" in path or "Drafts" in path # Dirty hack
         self.open_msg(path, editable, close_msg_cb, self.current_info)
-        self.current_info.set_msg_read(path, True)
+        self.info_for(path).set_msg_read(path, True)
         msg_iter = self.iter_from_fn(path)
         self.logger.debug("_open_msg: Updating iter %s", msg_iter)
         if msg_iter:
@@ -356,33 +366,73 @@ class MessageList(MainWindowElement):
         GLib.idle_add(self.refresh)
 
 
-    def _update_message_info(self, msg_iter, force=False):
-        fname, = self.store.get(msg_iter, ML_COL_FILE)
+    def _row_values(self, row):
+        '''
+        Get the column values for a message row.
 
-        subj = self.current_info.get_msg_subject(fname)
-        read = self.current_info.get_msg_read(fname)
-        if subj == _("Unknown") or force:
-            # Not registered, so update the registry
-            form = formgui.FormFile(fname)
-            self.current_info.set_msg_type(fname, form.ident)
-            self.current_info.set_msg_read(fname, read)
-            self.current_info.set_msg_subject(fname, form.get_subject_string())
-            self.current_info.set_msg_sender(fname, form.get_sender_string())
-            self.current_info.set_msg_recip(fname, form.get_recipient_string())
-
-        time_stamp = os.stat(fname).st_ctime
-        if read:
+        :param row: Message row
+        :type row: :class:`MessageRow`
+        :returns: Values in column order
+        :rtype: list
+        '''
+        if row.read:
             icon = self.message_pixbuf
         else:
             icon = self.unread_pixbuf
-        self.store.set(msg_iter,
-                       ML_COL_ICON, icon,
-                       ML_COL_SEND, self.current_info.get_msg_sender(fname),
-                       ML_COL_RECP, self.current_info.get_msg_recip(fname),
-                       ML_COL_SUBJ, self.current_info.get_msg_subject(fname),
-                       ML_COL_TYPE, self.current_info.get_msg_type(fname),
-                       ML_COL_DATE, time_stamp,
-                       ML_COL_READ, read)
+        return [icon, row.sender, row.subject, row.msg_type, row.stamp,
+                row.path, row.read, row.recip]
+
+    def _post_rows(self, generation, rows):
+        '''
+        Post rows from the loader thread to the main loop.
+
+        :param generation: Generation of the folder scan
+        :type generation: int
+        :param rows: Rows read by the loader
+        :type rows: list[:class:`MessageRow`]
+        '''
+        GLib.idle_add(self._apply_rows, generation, rows)
+
+    def _apply_rows(self, generation, rows):
+        '''
+        Add or update rows read by the loader.
+
+        :param generation: Generation of the folder scan
+        :type generation: int
+        :param rows: Rows read by the loader
+        :type rows: list[:class:`MessageRow`]
+        :returns: False to run only once
+        :rtype: bool
+        '''
+        if generation != self._loader.generation:
+            return False # Another folder was opened since
+        for row in rows:
+            msg_iter = self._iters.get(row.path, None)
+            if msg_iter is None:
+                self._iters[row.path] = self.store.append(
+                    self._row_values(row))
+            else:
+                self.store.set(msg_iter, list(range(ML_COL_RECP + 1)),
+                               self._row_values(row))
+        return False
+
+    def _update_message_info(self, msg_iter, force=False):
+        fname, = self.store.get(msg_iter, ML_COL_FILE)
+
+        info = self.info_for(fname)
+        msg = info.get_msg(fname)
+        if msg is None or msg.subject is None or force:
+            # Not registered, so update the registry
+            form = FORM_HEADERS.get(fname)
+            info.set_msg_info(fname, form.ident,
+                              form.get_subject_string(),
+                              form.get_sender_string(),
+                              form.get_recipient_string(),
+                              form.get_path_dst())
+            msg = info.get_msg(fname)
+
+        self.store.set(msg_iter, list(range(ML_COL_RECP + 1)),
+                       self._row_values(MessageRow(fname, msg)))
 
     def iter_from_fn(self, file_name):
         '''
@@ -390,37 +440,86 @@ class MessageList(MainWindowElement):
 
         :param file_name: File Name to lookup
         :type file_name: str
-        :returns: Iterated file name with each call
+        :returns: Row of the file, or None if it is not in the list
         :rtype: :class:`Gtk.TreeIter`
         '''
-        fn_iter = self.store.get_iter_first()
-        while fn_iter:
-            _fn, = self.store.get(fn_iter, ML_COL_FILE)
-            if _fn == file_name:
-                break
-            fn_iter = self.store.iter_next(fn_iter)
+        return self._iters.get(file_name, None)
+
+    def info_for(self, file_name):
+        '''
+        Get the folder information for a message in the list.
+
+        Search results can be from any folder.
+
+        :param file_name: Message filename
+        :type file_name: str
+        :returns: Folder information of the message
+        :rtype: :class:`MessageFolderInfo`
+        '''
+        folder = os.path.dirname(file_name)
+        if self.current_info and \
+                os.path.abspath(self.current_info.folder_path()) == \
+                os.path.abspath(folder):
+            return self.current_info
+        return MessageFolderInfo(folder)
+
+    def _fill(self, rows):
+        '''
+        Replace the rows of the list.
 
-        return fn_iter
+        :param rows: New rows
+        :type rows: list[:class:`MessageRow`]
+        '''
+        msglist = self._get_widget("msglist")
+        sort_id, order = self.store.get_sort_column_id()
+        # Fill the list unsorted and detached from the view, then
+        # sort it once.
+        msglist.set_model(None)
+        self.store.set_sort_column_id(
+            Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID, order)
+        self.store.clear()
+        self._iters = {}
+        for row in rows:
+            self._iters[row.path] = self.store.append(
+                self._row_values(row))
+        self.store.set_sort_column_id(sort_id, order)
+        msglist.set_model(self.store)
+
+    def show_results(self, results):
+        '''
+        Show search results in place of the current folder.
+
+        :param results: Search results
+        :type results: list[:class:`d_rats.message_search.SearchResult`]
+        '''
+        self._loader.cancel()
+        rows = []
+        for result in results:
+            msg = self.info_for(result.path).get_msg(result.path)
+            if msg is None or msg.subject is None:
+                msg = result
+            rows.append(MessageRow(result.path, msg))
+        self._fill(rows)
 
     def refresh(self, file_name=None):
         '''
         Refresh the current folder or optional filename.
 
+        The messages the message store knows are listed at once, the
+        others are added as the loader reads them.
+
         :param file_name: File name, default None
         :type file_name: str
         '''
         if file_name is None:
-            self.store.clear()
-            for msg in self.current_info.files():
-                msg_iter = self.store.append()
-                self.store.set(msg_iter, ML_COL_FILE, msg)
-                self._update_message_info(msg_iter)
+            self._fill(self._loader.scan(self.current_info))
         else:
-            msg_iter = self.iter_from_fn(file_name)
+            msg_iter = self._iters.get(file_name, None)
             if not msg_iter:
                 msg_iter = self.store.append()
                 self.store.set(msg_iter,
                                ML_COL_FILE, file_name)
+                self._iters[file_name] = msg_iter
 
             self._update_message_info(msg_iter, True)
 
@@ -446,7 +545,9 @@ class MessageList(MainWindowElement):
         for msg_iter in iters:
             file_name, = store.get(msg_iter, ML_COL_FILE)
             store.remove(msg_iter)
-            self.current_info.delete(file_name)
+            self._iters.pop(file_name, None)
+            self.info_for(file_name).delete(file_name)
+            self._search_index.remove_file(file_name)
 
     def move_message(self, info, path, new_folder):
         '''
@@ -469,8 +570,12 @@ class MessageList(MainWindowElement):
             return path
 
         self.logger.debug("move_message Moving %s -> %s", path, newfn)
-        shutil.copy(path, newfn)
+        # Keep the modification time, so the moved header fields in the
+        # message store are still current.
+        shutil.copy2(path, newfn)
+        info.move_msg_info(path, dest)
         info.delete(path)
+        self._search_index.move_file(path, newfn)
 
         if info == self.current_info:
             self.refresh()
@@ -485,7 +590,7 @@ class MessageList(MainWindowElement):
         :type folder: str
         '''
         for msg in self.get_selected_messages():
-            self.move_message(self.current_info, msg, folder)
+            self.move_message(self.info_for(msg), msg, folder)
 
     def get_selected_messages(self):
         '''
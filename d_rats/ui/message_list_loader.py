@@ -0,0 +1,399 @@
+#!/usr/bin/python
+'''Main Messages Message List Loader.'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from d_rats.form_header import FORM_HEADERS
+from d_rats.form_header import FormHeaderError
+from d_rats.message_store import MessageStore
+from d_rats.ui.message_folder_info import MessageFolderInfo
+
+# Rows resolved in the background are handed to the user interface
+# in batches of this many, or at least this often in seconds.
+RESOLVE_BATCH = 250
+RESOLVE_INTERVAL = 0.2
+
+
+# pylint wants at least 2 public methods
+# pylint: disable=too-few-public-methods
+class MessageRow:
+    '''
+    Message Row.
+
+    What the message list shows for one message.
+
+    Messages imported from an old folder database have no stamp, the
+    date of the file is shown for them.
+
+    :param path: Message filename
+    :type path: str
+    :param info: Message information from the message store, or a
+                 search result
+    :type info: :class:`d_rats.message_store.MessageInfo`
+    '''
+
+    __slots__ = ("path", "sender", "recip", "subject", "msg_type",
+                 "stamp", "read")
+
+    def __init__(self, path, info):
+        self.path = path
+        self.sender = info.sender or ""
+        self.recip = info.recip or ""
+        self.subject = info.subject or ""
+        self.msg_type = info.msg_type or ""
+        stamp = info.stamp
+        if stamp is None:
+            try:
+                stamp = os.stat(path).st_mtime
+            except OSError:
+                stamp = 0
+        self.stamp = int(stamp)
+        self.read = info.read
+
+    def __str__(self):
+        return "%s: %s" % (self.path, self.subject)
+
+
+class MessageListLoader:
+    '''
+    Message List Loader.
+
+    Fills the message list of a folder without blocking the user
+    interface.
+
+    :meth:`scan` returns the rows of the messages the message store
+    already knows about, so the list can be filled in one go.  The
+    messages it does not know about, or whose file changed since, are
+    then read by a worker thread.  Their rows are passed to the
+    post_rows function in batches, from the worker thread.  Scanning
+    another folder starts a new generation, and the worker drops what
+    is left of the older one.
+
+    :param post_rows: Function called with the generation and a list
+                      of :class:`MessageRow` from the worker thread
+    :type post_rows: function(int, list[:class:`MessageRow`])
+    '''
+
+    logger = logging.getLogger("MessageListLoader")
+
+    def __init__(self, post_rows):
+        self.generation = 0
+        self.resolved = 0
+        self._post_rows = post_rows
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def scan(self, info):
+        '''
+        Scan a folder.
+
+        Only the directory and the message store are read.
+
+        :param info: Folder to scan
+        :type info: :class:`MessageFolderInfo`
+        :returns: Rows for the messages already known
+        :rtype: list[:class:`MessageRow`]
+        '''
+        self.generation += 1
+        known = {}
+        for msg in info.messages():
+            if msg.subject is not None:
+                known[msg.filename] = msg
+
+        rows = []
+        unknown = []
+        for path in info.files():
+            msg = known.get(os.path.basename(path), None)
+            if msg is None:
+                unknown.append(path)
+            else:
+                rows.append(MessageRow(path, msg))
+
+        self._start()
+        self._queue.put((self.generation, info, unknown,
+                         [row.path for row in rows]))
+        return rows
+
+    def cancel(self):
+        '''Drop what is left of the current scan.'''
+        self.generation += 1
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="MessageListLoader")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            generation, info, unknown, known = self._queue.get()
+            if generation == self.generation:
+                self._resolve(generation, info, unknown, known)
+            self._queue.task_done()
+
+    def _changed(self, info, path):
+        '''
+        Check if a message file changed since the store read it.
+
+        :param info: Folder of the message
+        :type info: :class:`MessageFolderInfo`
+        :param path: Message filename
+        :type path: str
+        :returns: True if the message needs to be read again
+        :rtype: bool
+        '''
+        msg = info.get_msg(path)
+        try:
+            return msg is None or os.stat(path).st_mtime != msg.stamp
+        except OSError:
+            return False # Deleted, the next refresh drops the row
+
+    def _read(self, info, path):
+        '''
+        Read a message into the message store.
+
+        :param info: Folder of the message
+        :type info: :class:`MessageFolderInfo`
+        :param path: Message filename
+        :type path: str
+        :returns: Row for the message, or None if it can not be read
+        :rtype: :class:`MessageRow`
+        '''
+        try:
+            form = FORM_HEADERS.get(path)
+        except (FormHeaderError, OSError) as err:
+            self.logger.info("_read: %s", err)
+            return None
+        info.set_msg_info(path, form.ident,
+                          form.get_subject_string(),
+                          form.get_sender_string(),
+                          form.get_recipient_string(),
+                          form.get_path_dst())
+        self.resolved += 1
+        return MessageRow(path, info.get_msg(path))
+
+    def _resolve(self, generation, info, unknown, known):
+        '''
+        Read the messages of a folder that the store does not know.
+
+        :param generation: Generation of the scan
+        :type generation: int
+        :param info: Folder scanned
+        :type info: :class:`MessageFolderInfo`
+        :param unknown: Messages to read
+        :type unknown: list[str]
+        :param known: Messages to read only if they changed
+        :type known: list[str]
+        '''
+        todo = [(path, False) for path in unknown] + \
+            [(path, True) for path in known]
+        rows = []
+        posted = time.monotonic()
+        for start in range(0, len(todo), RESOLVE_BATCH):
+            if generation != self.generation:
+                return
+            with info.batch():
+                for path, check in todo[start:start + RESOLVE_BATCH]:
+                    if check and not self._changed(info, path):
+                        continue
+                    row = self._read(info, path)
+                    if row:
+                        rows.append(row)
+            now = time.monotonic()
+            if rows and (len(rows) >= RESOLVE_BATCH or
+                         now - posted >= RESOLVE_INTERVAL):
+                self._post_rows(generation, rows)
+                rows = []
+                posted = now
+        if rows:
+            self._post_rows(generation, rows)
+
+    def wait(self):
+        '''Wait until the worker has nothing left to do.'''
+        self._queue.join()
+
+
+class _HeadlessList:
+    '''
+    List model for the timing harness.
+
+    Stands in for the Gtk.ListStore, with the filename map the message
+    list keeps to find rows.
+    '''
+
+    def __init__(self):
+        self.rows = []
+        self.by_file = {}
+        self.updates = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def fill(self, rows):
+        '''
+        Replace the rows.
+
+        :param rows: New rows
+        :type rows: list[:class:`MessageRow`]
+        '''
+        self.rows = list(rows)
+        self.by_file = {row.path: index for index, row in enumerate(rows)}
+
+    def post_rows(self, generation, rows):
+        '''
+        Queue rows from the loader, like GLib.idle_add would.
+
+        :param generation: Generation of the rows
+        :type generation: int
+        :param rows: Rows from the worker
+        :type rows: list[:class:`MessageRow`]
+        '''
+        with self._lock:
+            self._pending.append((generation, rows))
+
+    def apply_rows(self, current):
+        '''
+        Add or update the queued rows, like the idle handler would.
+
+        :param current: Generation the list shows
+        :type current: int
+        '''
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        for generation, rows in pending:
+            if generation == current:
+                self._update(rows)
+
+    def _update(self, rows):
+        for row in rows:
+            index = self.by_file.get(row.path, None)
+            if index is None:
+                self.by_file[row.path] = len(self.rows)
+                self.rows.append(row)
+            else:
+                self.rows[index] = row
+            self.updates += 1
+
+    def linear_find(self, path):
+        '''
+        Find a row the way iter_from_fn did.
+
+        :param path: Message filename
+        :type path: str
+        :returns: Row index, or None
+        :rtype: int
+        '''
+        for index, row in enumerate(self.rows):
+            if row.path == path:
+                return index
+        return None
+
+
+def _write_forms(folder, count):
+    '''
+    Write messages for the timing harness.
+
+    :param folder: Folder directory
+    :type folder: str
+    :param count: Number of messages
+    :type count: int
+    '''
+    # pylint: disable=import-outside-toplevel
+    from d_rats.outbox_index import BENCH_FORM
+    body = "Lorem ipsum dolor sit amet. " * 10
+    for num in range(count):
+        with open(os.path.join(folder, "msg%05i.xml" % num), "w") as handle:
+            handle.write(BENCH_FORM % {"num": num, "body": body,
+                                       "dst": "N%03i" % (num % 50)})
+
+
+# pylint wants a maximum of 15 local variables
+# pylint: disable=too-many-locals
+def main():
+    '''Headless timing harness with a 50000 message folder.'''
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        level=logging.INFO)
+    logger = logging.getLogger("MessageListLoader.test")
+
+    count = 50000
+    with tempfile.TemporaryDirectory() as store_dir:
+        inbox = os.path.join(store_dir, "Inbox")
+        os.mkdir(inbox)
+        _write_forms(inbox, count)
+        store = MessageStore(os.path.join(store_dir, "message_store.db"))
+        info = MessageFolderInfo(inbox, store)
+        model = _HeadlessList()
+        loader = MessageListLoader(model.post_rows)
+
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            model.fill(loader.scan(info))
+            blocked = time.perf_counter() - start
+            loader.wait()
+            model.apply_rows(loader.generation)
+            elapsed = time.perf_counter() - start
+            logger.info("%s: ui thread %.1f ms for %i rows, "
+                        "background %.1f ms for %i more, %i in list",
+                        label, blocked * 1000, count - loader.resolved,
+                        elapsed * 1000,
+                        loader.resolved, len(model.rows))
+            loader.resolved = 0
+
+        paths = [row.path for row in model.rows[::50]]
+        start = time.perf_counter()
+        for path in paths:
+            model.linear_find(path)
+        linear = (time.perf_counter() - start) / len(paths)
+        start = time.perf_counter()
+        for path in paths:
+            model.rows[model.by_file[path]] = model.rows[model.by_file[path]]
+        mapped = (time.perf_counter() - start) / len(paths)
+        logger.info("row lookup: linear %.1f usec, mapped %.2f usec",
+                    linear * 1000000, mapped * 1000000)
+
+        # A message rewritten in place is read again in the background.
+        changed = os.path.join(inbox, "msg00007.xml")
+        with open(changed, "w") as handle:
+            handle.write(_CHANGED_FORM)
+        os.utime(changed, (time.time() + 10, time.time() + 10))
+        model.fill(loader.scan(info))
+        loader.wait()
+        model.apply_rows(loader.generation)
+        row = model.rows[model.by_file[changed]]
+        if len(model.rows) == count and row.subject == "Changed" and \
+                loader.resolved == 1:
+            logger.info("PASS")
+        else:
+            logger.info("FAIL: %s, %i rows, %i read", row, len(model.rows),
+                        loader.resolved)
+        store.close()
+
+
+_CHANGED_FORM = '''<xml><form id="email"><title>Email</title>
+<field id="subject"><caption>Subject</caption>
+<entry type="text">Changed</entry></field>
+<path><src>N0CALL</src><dst>W1AW</dst></path></form></xml>
+'''
+
+
+if __name__ == "__main__":
+    main()
@@ -102,6 +102,19 @@ FBB_BLOCK_TYPES = {FBB_BLOCK_HDR : "header",
                    FBB_BLOCK_EOF : "eof",
                    }
 
+# Most data in one FBB data block
+FBB_BLOCK_SIZE = 128
+
+# Most proposals in one FS exchange
+FBB_MAX_PROPOSALS = 5
+
+# Answers in an FS line
+FBB_ACCEPT = b"Y+"
+FBB_DEFER = b"L="
+
+# Bytes read from a socket at a time
+RECV_SIZE = 16 * 1024
+
 
 def escaped(data):
     '''
@@ -115,6 +128,167 @@ def escaped(data):
     return data.replace(b'\n', b'\\n').replace(b'\r', b'\\r')
 
 
+class B2FStream:
+    '''
+    Buffered B2F Stream.
+
+    Reads lines and FBB blocks from a buffer that is filled a socket
+    read at a time, and collects what is written until :meth:`flush`,
+    so a batch of proposals or messages goes out in one send.
+
+    :param conn: Socket, or connection with recv and send methods
+    :type conn: :class:`socket.socket`
+    '''
+
+    def __init__(self, conn):
+        self.logger = logging.getLogger("B2FStream")
+        self._conn = conn
+        self._inbuf = bytearray()
+        self._outbuf = []
+        self._recv_into = getattr(conn, "recv_into", None)
+        self._chunk = bytearray(RECV_SIZE)
+        self._send = getattr(conn, "sendall", None) or conn.send
+
+    def _fill(self):
+        '''
+        Read more data into the buffer.
+
+        :raises: :class:`Wl2kMessageSocketReadError` if the connection
+                 was closed
+        '''
+        if self._recv_into:
+            count = self._recv_into(self._chunk)
+            if not count:
+                raise Wl2kMessageSocketReadError("Connection closed")
+            self._inbuf += memoryview(self._chunk)[:count]
+        else:
+            # An AGW connection returns nothing when no frame came in.
+            self._inbuf += self._conn.recv()
+
+    def read_line(self):
+        '''
+        Read a line.
+
+        :returns: Line with the carriage return ending it
+        :rtype: bytes
+        '''
+        start = 0
+        while True:
+            end = self._inbuf.find(b"\r", start)
+            if end >= 0:
+                break
+            start = len(self._inbuf)
+            self._fill()
+        line = bytes(self._inbuf[:end + 1])
+        del self._inbuf[:end + 1]
+        return line.lstrip(b"\n")
+
+    def read_exactly(self, length):
+        '''
+        Read Exactly.
+
+        :param length: Count of data to read
+        :type length: int
+        :returns: data
+        :rtype: bytes
+        '''
+        while len(self._inbuf) < length:
+            self._fill()
+        data = bytes(self._inbuf[:length])
+        del self._inbuf[:length]
+        return data
+
+    def read_blocks(self):
+        '''
+        Read the FBB blocks of a message.
+
+        :returns: Header, data and checksum of the message
+        :rtype: tuple[bytes, bytes, int]
+        :raises: :class:`Wl2kMessageSocketReadError` if the other side
+                 reports an error
+        '''
+        header = b""
+        data = []
+        while True:
+            while len(self._inbuf) < 2:
+                self._fill()
+            block_type = self._inbuf[0]
+            if block_type == ord("*"):
+                del self._inbuf[:1]
+                raise Wl2kMessageSocketReadError(
+                    "Error getting message: %s" % self.read_line())
+            if block_type not in FBB_BLOCK_TYPES:
+                self.logger.info("read_blocks: Skipping %x (%c)",
+                                 block_type, block_type)
+                del self._inbuf[:1]
+                continue
+            # A size of 0 is 256 bytes, except for the checksum.
+            size = self._inbuf[1]
+            if block_type == FBB_BLOCK_EOF:
+                del self._inbuf[:2]
+                return header, b"".join(data), size
+            size = size or 256
+            while len(self._inbuf) < size + 2:
+                self._fill()
+            block = bytes(self._inbuf[2:size + 2])
+            del self._inbuf[:size + 2]
+            if block_type == FBB_BLOCK_HDR:
+                header = block
+            else:
+                data.append(block)
+
+    def write(self, data):
+        '''
+        Queue data to send.
+
+        :param data: Data to send
+        :type data: bytes
+        '''
+        self._outbuf.append(data)
+
+    def flush(self):
+        '''Send the queued data.'''
+        if self._outbuf:
+            data = b"".join(self._outbuf)
+            self._outbuf = []
+            self._send(data)
+
+
+def fbb_blocks(name, data):
+    '''
+    Frame a compressed message in FBB blocks.
+
+    :param name: Title of the message
+    :type name: bytes
+    :param data: Compressed message
+    :type data: bytes
+    :returns: Header, data and end blocks
+    :rtype: bytes
+    '''
+    # title \0 offset \0
+    header = name + b"\x000\x00"
+    blocks = [struct.pack("<BB", FBB_BLOCK_HDR, len(header)), header]
+    for start in range(0, len(data), FBB_BLOCK_SIZE):
+        chunk = data[start:start + FBB_BLOCK_SIZE]
+        blocks.append(struct.pack("<BB", FBB_BLOCK_DAT, len(chunk)))
+        blocks.append(chunk)
+    # Checksum, mod 256, two's complement
+    blocks.append(struct.pack("<BB", FBB_BLOCK_EOF, -sum(data) & 0xFF))
+    return b"".join(blocks)
+
+
+def proposal_checksum(proposals):
+    '''
+    Checksum of proposals for the F> line.
+
+    :param proposals: Proposal lines without the carriage return
+    :type proposals: list[bytes]
+    :returns: Checksum
+    :rtype: int
+    '''
+    return -sum(sum(proposal) + ord("\r") for proposal in proposals) & 0xFF
+
+
 # Called by msgrouting.py
 class WinLinkAttachment:
     '''
@@ -297,79 +471,26 @@ class WinLinkMessage:
 
         return formfn
 
-    @staticmethod
-    def recv_exactly(sock, length):
-        '''
-        Receive Exactly.
-
-        :param sock: Socket to receive on
-        :type sock: socket.socket
-        :type length: Count of data to receive
-        :type length: int
-        :returns: data
-        :rtype: bytes
-        '''
-        data = ""
-        while len(data) < length:
-            data += sock.recv(length - len(data))
-
-        return data
-
-    def read_from_socket(self, sock):
+    def read_from_socket(self, stream):
         '''
         Read From Socket.
 
-        :param sock: Socket to read from
-        :type sock: socket.socket
+        :param stream: Stream to read from
+        :type stream: :class:`B2FStream`
         :raises: :class:`Wl2kMessageSocketReadError` if bad data read in
                  from the socket
         :raises: :class:`Wl2kMessageDecodeError` if message can not be decoded
         '''
-        data = b""
-
-        i = 0
-        while True:
-            self.logger.info("read_from_socket: Reading at %i", i)
-            block_type = self.recv_exactly(sock, 1)
-
-            if block_type == b"*":
-                msg = sock.recv(1024)
-                raise Wl2kMessageSocketReadError("Error getting message: %s" %
-                                                 msg)
-
-            if block_type not in list(FBB_BLOCK_TYPES.keys()):
-                i += 1
-                self.logger.info("read_from_socket: "
-                                 "Got %x (%c) while reading %i",
-                                 block_type, chr(block_type), i)
-                continue
-
-            self.logger.info("read_from_socket: Found %s at %i",
-                             FBB_BLOCK_TYPES.get(block_type, "unknown"), i)
-            size = self.recv_exactly(sock, 1)
-            i += 2 # Account for the type and size
-
-            if block_type == FBB_BLOCK_HDR:
-                header = self.recv_exactly(sock, size)
-                self.__name, offset, _foo = header.split(b"\0")
-                self.logger.info("read_from_socket: Name is `%s' offset %s\n",
-                                 self.__name, offset)
-                i += size
-            elif block_type == FBB_BLOCK_DAT:
-                self.logger.info("read_from_socket: "
-                                 "Reading data block %i bytes", size)
-                data += self.recv_exactly(sock, size)
-                i += size
-            elif block_type == FBB_BLOCK_EOF:
-                content_size = size
-                for i in data:
-                    content_size += i
-                if (content_size % 256) != 0:
-                    self.logger.info("read_from_socket: "
-                                     "Ack! %i left from content_size %i",
-                                     content_size, size)
-
-                break
+        header, data, checksum = stream.read_blocks()
+        try:
+            name, offset, _rest = header.split(b"\0", 2)
+            self.__name = name.decode('utf-8', 'replace')
+        except ValueError:
+            offset = b""
+        self.logger.info("read_from_socket: Name is `%s' offset %s",
+                         self.__name, offset)
+        if (sum(data) + checksum) & 0xFF:
+            self.logger.info("read_from_socket: Bad checksum %i", checksum)
 
         self.logger.info("read_from_socket: Got data: %i bytes", len(data))
         self.__content = Lzhuf.decode(data)
@@ -383,34 +504,15 @@ class WinLinkMessage:
             self.logger.info("read_from_socket: Uncompressed size %i != %i",
                              len(self.__content), self.__usize)
 
-    def send_to_socket(self, sock):
+    def send_to_socket(self, stream):
         '''
-        Send Content To Socket.
+        Queue the message for sending.
 
-        :param sock: Socket for sending
-        :type sock: socket.socket
+        :param stream: Stream for sending, flushed by the caller
+        :type stream: :class:`B2FStream`
         '''
-        data = self.__lzh_content
-
-        # filename \0 length(0) \0
-        data_len = chr(len(data) & 0xFF)
-        header = self.__name.encode('utf-8', 'replace') + b'\x00' + \
-            data_len.to_bytes(1,'little') + b'\x00'
-        sock.send(struct.pack("<BB", FBB_BLOCK_HDR, len(header)) + header)
-
-        checksum = 0
-        while data:
-            chunk = data[:128]
-            data = data[128:]
-
-            for i in chunk:
-                checksum += i
-
-            sock.send(struct.pack("<BB", FBB_BLOCK_DAT, len(chunk)) + chunk)
-
-        # Checksum, mod 256, two's complement
-        checksum = (~checksum & 0xFF) + 1
-        sock.send(struct.pack("<BB", FBB_BLOCK_EOF, checksum))
+        stream.write(fbb_blocks(self.__name.encode('utf-8', 'replace'),
+                                self.__lzh_content))
 
     def get_content(self):
         '''
@@ -470,11 +572,16 @@ class WinLinkCMS:
     :param callsign: Call sign
     :type callsign: str
     '''
+
+    # Proposals sent in one FS exchange
+    batch_size = FBB_MAX_PROPOSALS
+
     def __init__(self, callsign):
         self.logger = logging.getLogger("WinLinkCMS")
         self._callsign = callsign
         self.__messages = []
         self._conn = None
+        self._stream = None
 
     def _connect(self):
         '''
@@ -512,6 +619,11 @@ class WinLinkCMS:
         if not self._conn:
             raise Wl2kClassStubMethodError(type(self))
 
+    def _open(self):
+        '''Connect and log in, with a buffered stream on the connection.'''
+        self._connect()
+        self._stream = B2FStream(self._conn)
+        self._login()
 
     @staticmethod
     def ssid():
@@ -524,39 +636,31 @@ class WinLinkCMS:
         ssid_str = "[DRATS-%s-B2FHIM$]" % version.DRATS_VERSION_NUM
         return ssid_str.encode('utf-8', 'replace')
 
-    def _send(self, data):
+    def _send(self, data, flush=True):
         '''
         Send Internal.
 
         :param data: data to send
         :type data: bytes
+        :param flush: Send now, default True
+        :type flush: bool
         '''
         self.logger.info("_send:  -> %s", data)
-        self._conn.send(data + b"\r")
-
-    def __recv(self):
-        '''
-        Receive Internal.
-
-        :returns: Received data
-        :rtype bytes
-        '''
-        resp = b""
-        while not resp.endswith(b"\r"):
-            resp += self._conn.recv(1)
-        self.logger.info("__recv:  <- %s", escaped(resp))
-        return resp
+        self._stream.write(data + b"\r")
+        if flush:
+            self._stream.flush()
 
     def _recv(self):
         '''
         Receive Internal.
 
-        :returns: Received data
+        :returns: Received line, without the comment lines
         :rtype: bytes
         '''
         received = b";"
         while received.startswith(b";"):
-            received = self.__recv()
+            received = self._stream.read_line()
+            self.logger.info("_recv:  <- %s", escaped(received))
         return received
 
     def _send_ssid(self, recv_ssid):
@@ -580,63 +684,73 @@ class WinLinkCMS:
         if not prompt.endswith(b">"):
             raise Wl2kCMSNoPrompt("Conversation error (never got prompt)")
 
-    def __get_list(self):
+    def _get_proposals(self, resp):
         '''
-        Get List Internal.
+        Get the proposals of the other side.
 
-        :returns: List of messages
+        :param resp: First line of the proposals
+        :type resp: bytes
+        :returns: Proposed messages, None if the other side ended the
+                  session or has nothing to send
         :rtype: list[:class:`WinLinkMessage`]
         :raises: :class:`Wl2kCMSInvalidLine` if invalid line found.
         '''
-        self._send(b'FF')
-
         msgs = []
-        reading = True
-        while reading:
-            resp = self._recv()
-            for line in resp.split(b"\r"):
-                if line.startswith(b"FC"):
-                    self.logger.info("__get_list: Creating message for %s",
-                                     line)
-                    msgs.append(WinLinkMessage(line.decode('utf-8', 'replace')))
-                elif line.startswith(b"F>"):
-                    reading = False
-                    break
-                elif line.startswith(b"FQ"):
-                    reading = False
-                    break
-                elif not line:
-                    pass
-                else:
-                    self.logger.info("__get_list: Invalid line: %s", line)
-                    raise Wl2kCMSInvalidLine(
-                        "Conversation error (%s while listing)" % line)
-
-        return msgs
+        proposals = []
+        line = resp.strip()
+        while True:
+            if line.startswith(b"FC"):
+                self.logger.info("_get_proposals: Creating message for %s",
+                                 line)
+                msgs.append(WinLinkMessage(line.decode('utf-8', 'replace')))
+                proposals.append(line)
+            elif line.startswith(b"F>"):
+                if line[2:].strip():
+                    try:
+                        checksum = int(line[2:], 16)
+                    except ValueError as err:
+                        self.logger.info("_get_proposals: Invalid line: %s",
+                                         line)
+                        raise Wl2kCMSInvalidLine(
+                            "Conversation error (%s while listing)" %
+                            line) from err
+                    if checksum != proposal_checksum(proposals):
+                        self.logger.info("_get_proposals: Bad checksum %s",
+                                         line)
+                return msgs
+            elif line.startswith(b"FQ") or line.startswith(b"FF"):
+                return None
+            elif line:
+                self.logger.info("_get_proposals: Invalid line: %s", line)
+                raise Wl2kCMSInvalidLine(
+                    "Conversation error (%s while listing)" % line)
+            line = self._recv().strip()
 
     def get_messages(self):
         '''
         Get Messages.
 
+        The other side proposes up to five messages at a time, they are
+        accepted with one FS line and read from the buffered stream.
+
         :returns: Number of messages
         :rtype: int
         '''
-        if not Lzhuf.have_lzhuf:
-            self.logger.info("get_messages: Lzhuf package not installed.")
-            return 0
-        self._connect()
-        self._login()
-        self.__messages = self.__get_list()
-
-        if self.__messages:
-            data_str = b"FS %s" % ("Y" * len(self.__messages))
-            self._send(data_str.encode('utf-8', 'replace'))
-
-            for msg in self.__messages:
+        self._open()
+        self.__messages = []
+        while True:
+            self._send(b"FF")
+            resp = self._recv()
+            batch = self._get_proposals(resp)
+            if batch is None:
+                if resp.startswith(b"FF"):
+                    self._send(b"FQ")
+                break
+            self._send(b"FS " + b"Y" * len(batch))
+            for msg in batch:
                 self.logger.info("get_message: Getting message...")
-                msg.read_from_socket(self._conn)
-
-            self._send(b"FQ")
+                msg.read_from_socket(self._stream)
+            self.__messages.extend(batch)
 
         self._disconnect()
 
@@ -653,54 +767,85 @@ class WinLinkCMS:
         '''
         return self.__messages[index]
 
-    def send_messages(self, messages):
+    def _send_batch(self, batch):
         '''
-        Send Messages.
+        Propose messages and send the accepted ones.
 
-        :param messages: WinLink messages to send
-        :type message: list[:class:`Wl2kMessage`]
+        The proposals go out together, and so do the accepted messages.
+
+        :param batch: Up to five messages
+        :type batch: list[:class:`WinLinkMessage`]
         :returns: Number of messages sent
         :rtype: int
-        :raises: :class:`Wl2kCMSNotImplemented` if more than one message
-                 in list
         :raises: :class:`Wl2kCMSServerError` if error talking to server
-        :raises: :class:`Wl2kCMSRefusedMessages` if server refused some
-                 messages
+        :raises: :class:`Wl2kCMSRefusedMessages` if the answer does not
+                 match the proposals
         '''
-        if len(messages) != 1:
-            raise Wl2kCMSNotImplemented("Sorry, batch not implemented yet")
-
-        self._connect()
-        self._login()
-
-        cs_octet = 0
-        for msg in messages:
-            proposal = msg.get_proposal()
-            for item in proposal:
-                cs_octet += item
-            cs_octet += ord("\r")
-            self._send(proposal)
-
-        cs_octet = (~cs_octet & 0xFF) + 1
-        data_str = "F> %02X" % cs_octet
-        self._send(data_str.encode('utf-8', 'replace'))
+        proposals = [msg.get_proposal() for msg in batch]
+        for proposal in proposals:
+            self._send(proposal, flush=False)
+        self._send(b"F> %02X" % proposal_checksum(proposals))
         resp = self._recv()
 
         if not resp.startswith(b"FS"):
             raise Wl2kCMSServerError("Error talking to server: %s" % resp)
 
-        _fs, accepts = resp.split()
-        if len(accepts) != len(messages):
+        answers = resp[2:].strip()
+        if len(answers) != len(batch):
             raise Wl2kCMSRefusedMessages(
-                "Server refused some of my messages?!")
+                "Server answered %i of %i proposals" %
+                (len(answers), len(batch)))
+
+        sent = 0
+        for msg, answer in zip(batch, answers):
+            if answer in FBB_ACCEPT:
+                msg.send_to_socket(self._stream)
+                sent += 1
+            else:
+                self.logger.info("_send_batch: %s answered %c",
+                                 msg.get_id(), answer)
+        self._stream.flush()
+        return sent
 
-        for msg in messages:
-            msg.send_to_socket(self._conn)
+    def send_messages(self, messages):
+        '''
+        Send Messages.
+
+        :param messages: WinLink messages to send
+        :type message: list[:class:`Wl2kMessage`]
+        :returns: Number of messages sent
+        :rtype: int
+        :raises: :class:`Wl2kCMSServerError` if error talking to server
+        :raises: :class:`Wl2kCMSRefusedMessages` if server refused some
+                 messages
+        '''
+        self._open()
+
+        sent = 0
+        batches = [messages[start:start + self.batch_size]
+                   for start in range(0, len(messages), self.batch_size)]
+        while True:
+            if batches:
+                sent += self._send_batch(batches.pop(0))
+            else:
+                self._send(b"FF")
+            resp = self._recv()
+            if resp.startswith(b"FQ"):
+                break
+            proposals = self._get_proposals(resp)
+            if proposals:
+                # Left on the server for the next time mail is fetched.
+                self._send(b"FS " + FBB_DEFER[:1] * len(proposals))
+            if not batches:
+                self._send(b"FQ")
+                break
 
-        resp = self._recv()
         self._disconnect()
 
-        return 1
+        if sent != len(messages):
+            raise Wl2kCMSRefusedMessages(
+                "Server refused %i of my messages" % (len(messages) - sent))
+        return sent
 
 
 class WinLinkTelnet(WinLinkCMS):
@@ -939,6 +1084,7 @@ class WinLinkThread(threading.Thread, GObject.GObject):
         # _server = self._config.get("prefs", "msg_wl2k_server")
         # _port = self._config.getint("prefs", "msg_wl2k_port")
         winlink = self.wl2k_connect()
+        messages = []
         for message_thread in self.__send_msgs:
 
             message = re.search(b"Mid: (.*)\r\nSubject: (.*)\r\n",
@@ -955,15 +1101,21 @@ class WinLinkThread(threading.Thread, GObject.GObject):
             wlm.set_content(message_thread.get_content(), subj)
             self.logger.info("message: %s", message)
             self.logger.info("message_thread : %s", message_thread)
-            winlink.send_messages([wlm])
+            messages.append(wlm)
+        winlink.send_messages(messages)
 
         return "Complete"
 
     def run(self):
-        if self.__send_msgs:
-            result = self._run_outgoing()
-        else:
-            result = self._run_incoming()
+        try:
+            if self.__send_msgs:
+                result = self._run_outgoing()
+            else:
+                result = self._run_incoming()
+        except (DataPathIOError, OSError) as err:
+            self.logger.info("run: %s", err)
+            self._emit("mail-thread-complete", False, str(err))
+            return
 
         self._emit("mail-thread-complete", True, result)
 
@@ -1108,6 +1260,151 @@ def test_agw_server(host="127.0.0.1", port=8000):
             logger.info("test_server: failed", exc_info=True)
 
 
+def test_cms_server(listener, outgoing, incoming, turnaround=0.0):
+    '''
+    Test CMS Server.
+
+    Serves one B2F session on a listening socket, as a stand-in for
+    a WinLink CMS.
+
+    :param listener: Listening socket
+    :type listener: :class:`socket.socket`
+    :param outgoing: Messages to send, removed as they are sent
+    :type outgoing: list[:class:`WinLinkMessage`]
+    :param incoming: List to add the received messages to
+    :type incoming: list[:class:`WinLinkMessage`]
+    :param turnaround: Seconds to wait before each answer, default 0.0
+    :type turnaround: float
+    '''
+    logger = logging.getLogger("wl2k_test_cms_server")
+    conn, _addr = listener.accept()
+    stream = B2FStream(conn)
+
+    def answer(*lines):
+        # Emulate the turnaround delay of a radio link.
+        time.sleep(turnaround)
+        for line in lines:
+            stream.write(line + b"\r")
+        stream.flush()
+
+    def propose():
+        batch = outgoing[:FBB_MAX_PROPOSALS]
+        proposals = [msg.get_proposal() for msg in batch]
+        answer(*proposals, b"F> %02X" % proposal_checksum(proposals))
+        answers = stream.read_line().strip()[3:]
+        for msg, accept in zip(batch, answers):
+            if accept in FBB_ACCEPT:
+                msg.send_to_socket(stream)
+                outgoing.remove(msg)
+        stream.flush()
+
+    answer(b"Test CMS", b"Callsign :")
+    stream.read_line()
+    answer(b"Password :")
+    stream.read_line()
+    answer(b"[WL2K-5.0-B2FWIHJM$]", b"CMS>")
+    stream.read_line()
+
+    try:
+        line = stream.read_line().strip()
+        while not line.startswith(b"FQ"):
+            if line.startswith(b"FF"):
+                if not outgoing:
+                    answer(b"FQ")
+                    break
+                propose()
+            elif line.startswith(b"FC"):
+                batch = []
+                while line.startswith(b"FC"):
+                    batch.append(WinLinkMessage(line.decode()))
+                    line = stream.read_line().strip()
+                answer(b"FS " + b"Y" * len(batch))
+                for msg in batch:
+                    msg.read_from_socket(stream)
+                incoming.extend(batch)
+                if outgoing:
+                    propose()
+                else:
+                    answer(b"FF")
+            else:
+                logger.info("test_cms_server: Unexpected %s", line)
+                break
+            line = stream.read_line().strip()
+    except Wl2kMessageSocketReadError:
+        logger.info("test_cms_server: Connection closed")
+    conn.close()
+
+
+# pylint wants only 15 local variables per function
+# pylint: disable=too-many-locals
+def test_b2f_exchange(count=100, turnaround=0.02):
+    '''
+    Time sending and fetching messages through the test CMS server.
+
+    :param count: Number of messages, default 100
+    :type count: int
+    :param turnaround: Seconds the server waits before each answer,
+                       default 0.02
+    :type turnaround: float
+    :returns: True if all the messages got through intact
+    :rtype: bool
+    '''
+    logger = logging.getLogger("wl2k_test_b2f")
+    logging.getLogger("WinLinkTelnet").setLevel(logging.WARNING)
+    logging.getLogger("WinLinkMessage").setLevel(logging.WARNING)
+
+    messages = []
+    for index in range(count):
+        msg = WinLinkMessage()
+        msg.set_id("%06iDRATS" % index)
+        msg.encode_message("N0CALL", ["KK7DS"], "Test %i" % index,
+                           "Test message %i\r\n" % index * 20, [])
+        messages.append(msg)
+    contents = sorted(msg.get_content() for msg in messages)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    result = True
+    for batch_size in (1, FBB_MAX_PROPOSALS):
+        incoming = []
+        server = threading.Thread(
+            target=test_cms_server,
+            args=(listener, [], incoming, turnaround))
+        server.start()
+        winlink = WinLinkTelnet("N0CALL", "127.0.0.1", port)
+        winlink.batch_size = batch_size
+        start = time.monotonic()
+        winlink.send_messages(messages)
+        send_time = time.monotonic() - start
+        server.join()
+
+        server = threading.Thread(
+            target=test_cms_server,
+            args=(listener, list(messages), [], turnaround))
+        server.start()
+        start = time.monotonic()
+        fetched = winlink.get_messages()
+        fetch_time = time.monotonic() - start
+        server.join()
+
+        received = sorted(msg.get_content() for msg in incoming)
+        fetched = sorted(winlink.get_message(index).get_content()
+                         for index in range(fetched))
+        if (received, fetched) == (contents, contents):
+            status = "PASS"
+        else:
+            status = "FAIL"
+            result = False
+        logger.info("%s batch %i: sent %i messages in %.2f s, "
+                    "fetched in %.2f s", status, batch_size,
+                    count, send_time, fetch_time)
+    listener.close()
+    return result
+
+
 def main():
     '''Unit Test.'''
 
@@ -1117,6 +1414,8 @@ def main():
 
     logger = logging.getLogger("wl2k_test")
 
+    test_b2f_exchange()
+
     server = threading.Thread(target=test_agw_server)
     server.start()
     time.sleep(2)
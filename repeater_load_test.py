@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# pylint: disable=invalid-name
+'''
+repeater_load_test.
+
+Load generator for the D-Rats repeater (ratflector).
+
+Connects a number of fake stations to a running repeater, has each of
+them send frames to the others, and reports the relayed frames per
+second and the relay latency.
+'''
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import gettext
+import json
+import logging
+import random
+import struct
+import time
+import urllib.request
+
+from d_rats import ddt2
+from d_rats import transport
+
+# This makes pylance happy with out overriding settings
+# from the invoker of the classes and methods in this module.
+if not '_' in locals():
+    _ = gettext.gettext
+
+# Session number used for the load frames, it is not a real session.
+LOAD_SESSION = 99
+
+
+def percentile(values, percent):
+    '''
+    Percentile.
+
+    :param values: Sorted list of values
+    :type values: list[float]
+    :param percent: Percentile wanted, 0 to 100
+    :type percent: float
+    :returns: Value at the percentile, or 0 for an empty list
+    :rtype: float
+    '''
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class LoadStation(transport.BlockParser):
+    '''
+    Load Station.
+
+    One fake D-Rats station connected to the repeater.
+
+    :param call: Station call sign
+    :type call: str
+    :param stats: Shared statistics
+    :type stats: :class:`LoadStats`
+    '''
+
+    def __init__(self, call, stats):
+        transport.BlockParser.__init__(self)
+        self.logger = logging.getLogger("LoadStation")
+        self.call = call
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+
+    def _handle_frame(self, frame):
+        if frame.session != LOAD_SESSION or len(frame.data) < 8:
+            return
+        sent, = struct.unpack("!d", frame.data[:8])
+        if sent:
+            self.stats.received(time.time() - sent)
+
+    async def connect(self, host, port, user=None, password=None):
+        '''
+        Connect to the repeater and do the authorization exchange.
+
+        :param host: Repeater host
+        :type host: str
+        :param port: Repeater port
+        :type port: int
+        :param user: User name if authorization required, Default None
+        :type user: str
+        :param password: Password if authorization required, Default None
+        :type password: str
+        :raises: :class:`ConnectionError` if not authorized
+        '''
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        line = await self.reader.readline()
+        if line.startswith(b"101"):
+            if not user:
+                raise ConnectionError("Repeater requires authorization")
+            self.writer.write(b"USER %s\r\n" % user.encode())
+            await self.reader.readline()
+            self.writer.write(b"PASS %s\r\n" % password.encode())
+            line = await self.reader.readline()
+            if not line.startswith(b"200"):
+                raise ConnectionError("Not authorized: %s" % line)
+
+        # Send a frame to ourselves so the repeater learns our port.
+        self.send(self.call, 0)
+
+    def send(self, dest, sent):
+        '''
+        Send a load frame.
+
+        :param dest: Destination station
+        :type dest: str
+        :param sent: Time stamp to put in the frame, 0 for none
+        :type sent: float
+        '''
+        frame = ddt2.DDT2EncodedFrame()
+        frame.session = LOAD_SESSION
+        frame.s_station = self.call
+        frame.d_station = dest
+        frame.data = struct.pack("!d", sent) + \
+            b"x" * self.stats.payload_size
+        self.writer.write(frame.get_packed())
+
+    async def read_loop(self):
+        '''Read and parse frames until disconnected.'''
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                break
+            self.inbuf += data
+            self.parse_blocks()
+
+    async def send_loop(self, calls, rate, duration, broadcast):
+        '''
+        Send frames at a fixed rate.
+
+        :param calls: Call signs of all the load stations
+        :type calls: list[str]
+        :param rate: Frames per second to send
+        :type rate: float
+        :param duration: Seconds to send for
+        :type duration: float
+        :param broadcast: Send to CQCQCQ instead of one station
+        :type broadcast: bool
+        '''
+        interval = 1.0 / rate
+        end = time.time() + duration
+        # Spread the stations out over the first interval
+        await asyncio.sleep(random.random() * interval)
+        while time.time() < end:
+            if broadcast:
+                dest = "CQCQCQ"
+            else:
+                dest = random.choice(calls)
+                while dest == self.call and len(calls) > 1:
+                    dest = random.choice(calls)
+            self.send(dest, time.time())
+            self.stats.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+    def __str__(self):
+        return self.call
+
+
+class LoadStats:
+    '''
+    Load Stats.
+
+    :param payload_size: Bytes of padding in each load frame
+    :type payload_size: int
+    '''
+
+    def __init__(self, payload_size):
+        self.payload_size = payload_size
+        self.sent = 0
+        self.latencies = []
+        self.last_report = ""
+        self.problems = []
+
+    def received(self, latency):
+        '''
+        Record a received frame.
+
+        :param latency: Relay latency in seconds
+        :type latency: float
+        '''
+        self.latencies.append(latency)
+
+    def report(self, elapsed):
+        '''
+        Report.
+
+        :param elapsed: Seconds the load ran
+        :type elapsed: float
+        :returns: Printable report
+        :rtype: str
+        '''
+        latencies = sorted(self.latencies)
+        self.last_report = (
+            "sent %i frames, received %i frames in %.1f sec: "
+            "%.1f frames/sec, latency p50 %.1f ms p99 %.1f ms max %.1f ms" %
+            (self.sent, len(latencies), elapsed,
+             len(latencies) / elapsed,
+             percentile(latencies, 50) * 1000,
+             percentile(latencies, 99) * 1000,
+             percentile(latencies, 100) * 1000))
+        return self.last_report
+
+
+def get_metrics(server, port):
+    '''
+    Get the metrics of the repeater.
+
+    :param server: Repeater host name
+    :type server: str
+    :param port: Repeater metrics port
+    :type port: int
+    :returns: Repeater metrics
+    :rtype: dict
+    '''
+    url = "http://%s:%i/metrics.json" % (server, port)
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def check_metrics(before, after, stats):
+    '''
+    Check the repeater metrics against what the load stations saw.
+
+    :param before: Metrics before the load ran
+    :type before: dict
+    :param after: Metrics after the load ran
+    :type after: dict
+    :param stats: Statistics of the load
+    :type stats: :class:`LoadStats`
+    :returns: Problems found, empty if the counts agree
+    :rtype: list[str]
+    '''
+    problems = []
+    checks = (("frames_in", stats.sent),
+              ("frames_out", len(stats.latencies)),
+              ("frames_dropped", 0))
+    for name, expected in checks:
+        counted = after[name] - before[name]
+        if counted != expected:
+            problems.append("%s: repeater counted %i, expected %i" %
+                            (name, counted, expected))
+    latency_count = after["relay_latency_seconds"]["count"] - \
+        before["relay_latency_seconds"]["count"]
+    if latency_count != stats.sent:
+        problems.append("relay latency count %i, expected %i" %
+                        (latency_count, stats.sent))
+    return problems
+
+
+async def run_load(args):
+    '''
+    Run the load test.
+
+    :param args: Parsed command line arguments
+    :type args: :class:`argparse.Namespace`
+    :returns: Statistics of the run
+    :rtype: :class:`LoadStats`
+    '''
+    logger = logging.getLogger("Repeater_Load_Test")
+    stats = LoadStats(args.size)
+    calls = ["LT%04i" % i for i in range(args.clients)]
+    stations = [LoadStation(call, stats) for call in calls]
+
+    for station in stations:
+        await station.connect(args.server, args.port,
+                              args.user, args.password)
+    logger.info("%i stations connected", len(stations))
+    readers = [asyncio.ensure_future(station.read_loop())
+               for station in stations]
+
+    # Give the repeater time to learn all of the stations.
+    await asyncio.sleep(1)
+    stats.latencies = []
+    if args.metrics_port:
+        before = get_metrics(args.server, args.metrics_port)
+
+    start = time.time()
+    await asyncio.gather(*[station.send_loop(calls, args.rate,
+                                             args.duration, args.broadcast)
+                           for station in stations])
+    # Wait for frames still in flight.
+    await asyncio.sleep(1)
+    elapsed = time.time() - start
+    if args.metrics_port:
+        after = get_metrics(args.server, args.metrics_port)
+        stats.problems = check_metrics(before, after, stats)
+        for problem in stats.problems:
+            logger.info("Metrics mismatch: %s", problem)
+        if not stats.problems:
+            logger.info("Metrics match the load: PASS")
+
+    for station in stations:
+        station.writer.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+    logger.info(stats.report(elapsed))
+    return stats
+
+
+def main():
+    '''Repeater load test main module.'''
+
+    gettext.install("D-RATS")
+    lang = gettext.translation("D-RATS",
+                               localedir="locale",
+                               fallback=True)
+    lang.install()
+    # pylint: disable=global-statement
+    global _
+    _ = lang.gettext
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=_('REPEATER_LOAD_TEST'))
+
+    parser.add_argument('--loglevel',
+                        default='INFO',
+                        help=_('LOGLEVEL TO TEST WITH'))
+
+    parser.add_argument("-s", "--server",
+                        default='localhost',
+                        help="Repeater host name")
+
+    parser.add_argument("-p", "--port",
+                        type=int,
+                        default=9000,
+                        help="Repeater port")
+
+    parser.add_argument("-n", "--clients",
+                        type=int,
+                        default=100,
+                        help="Number of stations to connect")
+
+    parser.add_argument("-r", "--rate",
+                        type=float,
+                        default=2.0,
+                        help="Frames per second sent by each station")
+
+    parser.add_argument("-t", "--duration",
+                        type=float,
+                        default=10.0,
+                        help="Seconds to send frames for")
+
+    parser.add_argument("--size",
+                        type=int,
+                        default=64,
+                        help="Payload bytes in each frame")
+
+    parser.add_argument("-b", "--broadcast",
+                        action="store_true",
+                        help="Send frames to CQCQCQ instead of one station")
+
+    parser.add_argument("--sweep",
+                        help="Comma separated station counts to run the "
+                        "load with in turn, for example 1,10,100")
+
+    parser.add_argument("--metrics-port",
+                        type=int,
+                        default=0,
+                        help="Repeater metrics port, to check its counters "
+                        "against the load")
+
+    parser.add_argument("--user",
+                        help="User name if the repeater requires it")
+
+    parser.add_argument("--password",
+                        help="Password if the repeater requires it")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S",
+                        level=args.loglevel.upper())
+
+    client_counts = [args.clients]
+    if args.sweep:
+        client_counts = [int(count) for count in args.sweep.split(",")]
+
+    results = []
+    loop = asyncio.get_event_loop()
+    for count in client_counts:
+        args.clients = count
+        stats = loop.run_until_complete(run_load(args))
+        results.append((count, stats.last_report))
+
+    for count, report in results:
+        print("%5i stations: %s" % (count, report))
+
+
+if __name__ == "__main__":
+    main()